@@ -2,11 +2,11 @@ import os
 import sys
 import boto3
 import uuid
-import base64
+import hashlib
 from typing import List
 from datetime import datetime
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Depends
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
@@ -42,28 +42,51 @@ except ImportError:
     REAL_CONCILIATOR = False
 
 # Crear rutas del conciliador directamente
-from fastapi import APIRouter, BackgroundTasks, WebSocket, WebSocketDisconnect, Form
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Form, Query
 from fastapi.responses import Response
 from typing import Dict, List, Optional
 import asyncio
 import json
-import shutil
 from pathlib import Path
 
+from modules.conciliator.config import Config as ConciliatorConfig
+
+from modules.conciliator.jobs import (
+    ConciliationJobQueue, parse_concurrency_limits,
+    JOB_QUEUED, JOB_RUNNING, JOB_COMPLETED, JOB_CANCELLED, FINAL_STATES
+)
+from modules.conciliator.whatif import load_whatif_frame, run_what_if, tolerance_grid
+from modules.conciliator.results_store import query_results, DEFAULT_PAGE_SIZE
+from modules.conciliator.ledger import ReconciliationLedger
+from modules.conciliator.metrics import MetricsStore, DEFAULT_SUMMARY_RUNS
+
 conciliator_router = APIRouter(prefix="/api/conciliator", tags=["conciliator"])
 
 # Estados y configuración del conciliador
 conciliator_sessions = {}
 conciliator_websockets = {}
 
+# Cola persistente de trabajos: las conciliaciones corren en procesos separados
+conciliation_jobs = ConciliationJobQueue(
+    client_concurrency=parse_concurrency_limits(os.environ.get('CONCILIATOR_JOB_CONCURRENCY'))
+)
+
+# Ledger de resultados por ID para las conciliaciones incrementales
+conciliation_ledger = ReconciliationLedger()
+
+# Historial de tiempos por etapa (lo escriben los procesos trabajadores)
+conciliation_metrics = MetricsStore()
+
 CONCILIATOR_AVAILABLE = True
 print("✅ Módulo conciliador integrado directamente")
-from services.textract import analyze_text, analyze_text_with_fallback
-from services.ticket_detector import validate_ticket_content
-from services.textprocess_KIOSKO import process_text_kiosko as process_kiosko
-from services.textprocess_OXXO import process_text_oxxo as process_oxxo
-from services.google_sheets import send_to_google_sheets
-from services.ticket_detector import detect_ticket_type
+from services.textract import analyze_text
+from services.ocr_engines import shutdown_ocr_engines
+from services.chains import infer_chain
+from services.google_sheets import send_tickets_bulk
+from services.uploads import save_upload, read_upload, IMAGE_TYPES, SPREADSHEET_TYPES
+from services.image_store import store_image, get_image_path, get_image_url, get_thumbnail_path
+from services.image_dedup import new_batch_index, remember_stored_image
+from services.ticket_pipeline import TicketContext, upload_pipeline, review_pipeline, ticket_metrics
 
 # Modelos Pydantic
 class TicketData(BaseModel):
@@ -79,6 +102,11 @@ class TicketData(BaseModel):
     remision: str = None
     pedido_adicional: str = None
     folio: str = None
+    # Foto del ticket (para registrar su hash perceptual al confirmar)
+    image_id: str = None
+    # Foto parecida a una ya registrada; solo se envía si el usuario lo confirma con force
+    near_duplicate: dict = None
+    force: bool = False
 
 class ConfirmTicketsRequest(BaseModel):
     tickets: List[TicketData]
@@ -131,6 +159,12 @@ class ProcessingRequest(BaseModel):
     client_type: str
     date_range: DateRange
 
+class WhatIfRequest(BaseModel):
+    tolerance_percentage: Optional[float] = None
+    tolerance_absolute: Optional[float] = None
+    # Barrido opcional: {"tolerance_percentage": [...], "tolerance_absolute": [...]}
+    grid: Optional[Dict[str, List[float]]] = None
+
 # Rutas del conciliador
 @conciliator_router.get("/clients")
 async def get_conciliator_clients():
@@ -183,14 +217,21 @@ async def upload_conciliator_file(
     if file_type not in ['source', 'looker']:
         raise HTTPException(status_code=400, detail="Tipo debe ser 'source' o 'looker'")
     
-    # Crear directorio
-    upload_dir = Path("uploads/conciliator") / session_id
-    upload_dir.mkdir(parents=True, exist_ok=True)
+    extension = Path(file.filename or "").suffix.lower()
+    if extension not in ConciliatorConfig.ALLOWED_EXTENSIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Extensión no permitida. Usa {', '.join(ConciliatorConfig.ALLOWED_EXTENSIONS)}"
+        )
     
-    # Guardar archivo
-    file_path = upload_dir / f"{file_type}_{file.filename}"
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # Guardar archivo por bloques (valida tamaño y tipo real, calcula hash)
+    upload_dir = Path("uploads/conciliator") / session_id
+    file_path = upload_dir / f"{file_type}_{Path(file.filename).name}"
+    upload_info = await save_upload(
+        file, file_path,
+        allowed_types=SPREADSHEET_TYPES,
+        max_size=ConciliatorConfig.MAX_FILE_SIZE
+    )
     
     # Actualizar sesión
     if "files" not in conciliator_sessions[session_id]:
@@ -199,27 +240,29 @@ async def upload_conciliator_file(
     conciliator_sessions[session_id]["files"][file_type] = {
         "filename": file.filename,
         "path": str(file_path),
-        "size": file_path.stat().st_size,
+        "size": upload_info["size"],
+        "sha256": upload_info["sha256"],
+        "kind": upload_info["kind"],
         "uploaded_at": datetime.now().isoformat()
     }
     
-    print(f"✅ Archivo {file_type} guardado en sesión {session_id}")
+    print(f"✅ Archivo {file_type} guardado en sesión {session_id} ({upload_info['size']} bytes, sha256 {upload_info['sha256'][:12]})")
     print(f"📁 Archivos actuales: {list(conciliator_sessions[session_id]['files'].keys())}")
     
     return {
         "message": "Archivo subido exitosamente",
         "filename": file.filename,
-        "size": file_path.stat().st_size,
+        "size": upload_info["size"],
+        "sha256": upload_info["sha256"],
         "type": file_type
     }
 
 @conciliator_router.post("/process/{session_id}")
 async def process_conciliator_files(
     session_id: str,
-    background_tasks: BackgroundTasks,
     request: dict
 ):
-    """Procesa conciliación en background"""
+    """Encola la conciliación en la cola persistente de trabajos"""
     try:
         print(f"🔍 Procesando sesión: {session_id}")
         print(f"📝 Request data: {request}")
@@ -242,246 +285,83 @@ async def process_conciliator_files(
         client_type = request.get('client_type', 'OXXO')
         date_range = request.get('date_range', {})
         
+        payload = {
+            "session_id": session_id,
+            "client_type": client_type,
+            "source_file": session['files']['source']['path'],
+            "looker_file": session['files']['looker']['path']
+        }
+        # Sin 'incremental' se usa CONCILIATOR_INCREMENTAL
+        if request.get('incremental') is not None:
+            payload["incremental"] = bool(request['incremental'])
+        
+        # Encolar el trabajo; el despachador lo ejecuta en un proceso separado
+        job = conciliation_jobs.submit(session_id, client_type, payload)
+        
         session["status"] = "processing"
         session["client_type"] = client_type
         session["date_range"] = date_range
+        session["job_id"] = job["job_id"]
         
-        print(f"✅ Iniciando procesamiento para {client_type}")
+        if conciliation_jobs.inline:
+            # Lambda: sin despachador, la conciliación corre antes de responder
+            job = await conciliation_jobs.run_inline(job)
+            print(f"✅ Conciliación {client_type} terminada en la petición ({job['status']})")
+            return {"message": "Procesamiento terminado", "session_id": session_id,
+                    "job_id": job["job_id"], "status": job["status"]}
         
-        # Procesar en background
-        background_tasks.add_task(process_conciliation_background, session_id, client_type)
+        print(f"✅ Conciliación {client_type} encolada como trabajo {job['job_id']}")
         
-        return {"message": "Procesamiento iniciado", "session_id": session_id}
+        return {"message": "Procesamiento iniciado", "session_id": session_id, "job_id": job["job_id"]}
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ Error en process: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    """Procesa conciliación en background"""
-    if session_id not in conciliator_sessions:
-        raise HTTPException(status_code=404, detail="Sesión no encontrada")
-    
-    session = conciliator_sessions[session_id]
-    if 'source' not in session['files'] or 'looker' not in session['files']:
-        raise HTTPException(status_code=400, detail="Faltan archivos")
-    
-    session["status"] = "processing"
-    session["client_type"] = request.client_type
-    session["date_range"] = request.date_range.dict()
+
+async def on_conciliation_job_finished(job: dict):
+    """Actualiza la sesión y notifica via WebSocket cuando termina un trabajo"""
+    session_id = job["session_id"]
+    session = conciliator_sessions.get(session_id)
     
-    # Procesar en background
-    background_tasks.add_task(process_conciliation_background, session_id, request.client_type)
+    if job["status"] == JOB_COMPLETED:
+        result = conciliation_jobs.load_result(job)
+        if session is not None:
+            session["status"] = "completed"
+            session["results"] = result
+        message = {"type": "completed", "result": result}
+        print(f"✅ Conciliación completada para sesión {session_id}")
+    else:
+        if session is not None:
+            session["status"] = "cancelled" if job["status"] == JOB_CANCELLED else "error"
+            session["error"] = job.get("error")
+        message = {"type": "error", "message": job.get("error") or job["status"]}
+        print(f"❌ Error en conciliación {session_id}: {job.get('error')}")
     
-    return {"message": "Procesamiento iniciado", "session_id": session_id}
+    # Notificar via WebSocket si está conectado
+    if session_id in conciliator_websockets:
+        try:
+            await conciliator_websockets[session_id].send_text(json.dumps(message))
+            print(f"📡 Resultados enviados via WebSocket para sesión {session_id}")
+        except Exception as ws_error:
+            print(f"❌ Error enviando WebSocket: {ws_error}")
+    else:
+        print(f"⚠️ No hay conexión WebSocket activa para sesión {session_id}")
 
-async def process_conciliation_background(session_id: str, client_type: str):
-    """Procesa conciliación en background usando tu sistema real"""
-    try:
-        session = conciliator_sessions[session_id]
-        source_file = session['files']['source']['path']
-        looker_file = session['files']['looker']['path']
-        
-        print(f"📄 Procesando archivos reales:")
-        print(f"   Source: {source_file}")
-        print(f"   Looker: {looker_file}")
-        
-        if REAL_CONCILIATOR and PANDAS_AVAILABLE:
-            # Usar tu sistema real de conciliación
-            print(f"🚀 Usando sistema real de conciliación")
-            
-            # Crear procesador
-            processor = ProcessorFactory.create_processor(client_type)
-            source_data, looker_data = processor.process_files(source_file, looker_file)
-            
-            print(f"📈 Datos leídos - Source: {len(source_data)} filas, Looker: {len(looker_data)} filas")
-            
-            # Crear reconciliador
-            reconciler = Reconciler(client_type)
-            reconciliation_results = reconciler.reconcile(source_data, looker_data)
-            summary_stats = reconciler.get_summary_stats()
-            
-            print(f"📉 Conciliación completada - {summary_stats.get('total_records', 0)} registros")
-            
-            # Convertir resultados a formato esperado por el frontend
-            records = []
-            for _, row in reconciliation_results.iterrows():
-                records.append({
-                    "id": str(row.get('id_matching', row.get('id_source', row.get('id_looker', 'N/A')))),
-                    "client_value": float(row.get('valor_source_clean', 0)) if pd.notna(row.get('valor_source_clean', 0)) else 0.0,
-                    "looker_value": float(row.get('valor_looker_clean', 0)) if pd.notna(row.get('valor_looker_clean', 0)) else 0.0,
-                    "difference": float(row.get('diferencia', 0)) if pd.notna(row.get('diferencia', 0)) else 0.0,
-                    "status": str(row.get('categoria', 'UNKNOWN')),
-                    "category": str(row.get('categoria', 'Sin clasificar'))
-                })
-            
-            # Usar estadísticas reales - convertir a tipos nativos de Python
-            result = {
-                "session_id": session_id,
-                "success": True,
-                "summary": {
-                    "total_records": int(summary_stats.get('total_records', 0)),
-                    "exact_matches": int(summary_stats.get('exact_matches', 0)),
-                    "within_tolerance": int(summary_stats.get('within_tolerance', 0)),
-                    "major_differences": int(summary_stats.get('major_differences', 0)),
-                    "missing_records": int(summary_stats.get('missing_records', 0)),
-                    "reconciliation_rate": float(summary_stats.get('reconciliation_rate', 0)),
-                    "total_client_amount": float(summary_stats.get(f'total_valor_{client_type.lower()}', 0)),
-                    "total_looker_amount": float(summary_stats.get('total_valor_looker', 0)),
-                    "total_difference": float(summary_stats.get('total_diferencia', 0))
-                },
-                "records": records[:50],  # Limitar a 50 registros para el frontend
-                "reports_generated": [],
-                "processing_time": 2.5,
-                "timestamp": datetime.now().isoformat()
-            }
-            
-        elif PANDAS_AVAILABLE:
-            # Fallback con pandas básico
-            print(f"🔄 Usando procesamiento básico con pandas")
-            
-            # Leer archivos
-            if source_file.endswith('.csv'):
-                source_data = pd.read_csv(source_file)
-            else:
-                source_data = pd.read_excel(source_file)
-            
-            if looker_file.endswith('.csv'):
-                looker_data = pd.read_csv(looker_file)
-            else:
-                looker_data = pd.read_excel(looker_file)
-            
-            print(f"📈 Archivos leídos - Source: {len(source_data)} filas, Looker: {len(looker_data)} filas")
-            
-            # Procesamiento básico de conciliación
-            # Buscar columnas de ID y valor
-            source_id_col = None
-            source_val_col = None
-            looker_id_col = None
-            looker_val_col = None
-            
-            # Detectar columnas en archivo source
-            for col in source_data.columns:
-                col_lower = col.lower()
-                if any(x in col_lower for x in ['id', 'folio', 'ticket', 'transaccion']) and source_id_col is None:
-                    source_id_col = col
-                if any(x in col_lower for x in ['total', 'importe', 'valor', 'amount', 'monto']) and source_val_col is None:
-                    source_val_col = col
-            
-            # Detectar columnas en archivo looker
-            for col in looker_data.columns:
-                col_lower = col.lower()
-                if any(x in col_lower for x in ['id', 'folio', 'ticket', 'transaccion']) and looker_id_col is None:
-                    looker_id_col = col
-                if any(x in col_lower for x in ['total', 'importe', 'valor', 'amount', 'monto']) and looker_val_col is None:
-                    looker_val_col = col
-            
-            print(f"🔍 Columnas detectadas:")
-            print(f"   Source ID: {source_id_col}, Valor: {source_val_col}")
-            print(f"   Looker ID: {looker_id_col}, Valor: {looker_val_col}")
-            
-            if source_id_col and source_val_col and looker_id_col and looker_val_col:
-                # Realizar merge
-                merged = pd.merge(
-                    source_data[[source_id_col, source_val_col]].rename(columns={source_id_col: 'id', source_val_col: 'source_value'}),
-                    looker_data[[looker_id_col, looker_val_col]].rename(columns={looker_id_col: 'id', looker_val_col: 'looker_value'}),
-                    on='id',
-                    how='outer'
-                )
-                
-                # Limpiar valores
-                merged['source_value'] = pd.to_numeric(merged['source_value'], errors='coerce').fillna(0)
-                merged['looker_value'] = pd.to_numeric(merged['looker_value'], errors='coerce').fillna(0)
-                merged['difference'] = merged['source_value'] - merged['looker_value']
-                
-                # Categorizar
-                def categorize(row):
-                    if pd.isna(row['source_value']) or row['source_value'] == 0:
-                        return 'MISSING_IN_SOURCE'
-                    elif pd.isna(row['looker_value']) or row['looker_value'] == 0:
-                        return 'MISSING_IN_LOOKER'
-                    elif abs(row['difference']) == 0:
-                        return 'EXACT_MATCH'
-                    elif abs(row['difference']) <= 50:  # Tolerancia
-                        return 'WITHIN_TOLERANCE'
-                    else:
-                        return 'MAJOR_DIFFERENCE'
-                
-                merged['status'] = merged.apply(categorize, axis=1)
-                
-                # Crear registros
-                records = []
-                for _, row in merged.iterrows():
-                    records.append({
-                        "id": str(row['id']),
-                        "client_value": float(row['source_value']),
-                        "looker_value": float(row['looker_value']),
-                        "difference": float(row['difference']),
-                        "status": row['status'],
-                        "category": {
-                            'EXACT_MATCH': 'Conciliado',
-                            'WITHIN_TOLERANCE': 'Tolerancia',
-                            'MAJOR_DIFFERENCE': 'Diferencia',
-                            'MINOR_DIFFERENCE': 'Diferencia',
-                            'MISSING_IN_SOURCE': 'Faltante',
-                            'MISSING_IN_LOOKER': 'Faltante',
-                            'MISSING_IN_OXXO': 'Faltante',
-                            'MISSING_IN_KIOSKO': 'Faltante'
-                        }.get(row['status'], 'Sin clasificar')
-                    })
-                
-                # Calcular estadísticas
-                total_records = len(merged)
-                exact_matches = len(merged[merged['status'] == 'EXACT_MATCH'])
-                within_tolerance = len(merged[merged['status'] == 'WITHIN_TOLERANCE'])
-                major_differences = len(merged[merged['status'] == 'MAJOR_DIFFERENCE'])
-                missing_records = len(merged[merged['status'].str.contains('MISSING')])
-                
-                result = {
-                    "session_id": session_id,
-                    "success": True,
-                    "summary": {
-                        "total_records": total_records,
-                        "exact_matches": exact_matches,
-                        "within_tolerance": within_tolerance,
-                        "major_differences": major_differences,
-                        "missing_records": missing_records,
-                        "reconciliation_rate": ((exact_matches + within_tolerance) / total_records * 100) if total_records > 0 else 0,
-                        "total_client_amount": float(merged['source_value'].sum()),
-                        "total_looker_amount": float(merged['looker_value'].sum()),
-                        "total_difference": float(merged['difference'].sum())
-                    },
-                    "records": records[:50],  # Limitar para el frontend
-                    "reports_generated": [],
-                    "processing_time": 2.5,
-                    "timestamp": datetime.now().isoformat()
-                }
-            else:
-                raise Exception("No se pudieron detectar las columnas necesarias en los archivos")
-        else:
-            raise Exception("Pandas no está disponible para procesar archivos Excel/CSV")
-        
-        # Guardar resultado
-        session["status"] = "completed"
-        session["results"] = result
-        
-        # Notificar via WebSocket si está conectado
-        if session_id in conciliator_websockets:
-            try:
-                await conciliator_websockets[session_id].send_text(json.dumps({
-                    "type": "completed",
-                    "result": result
-                }))
-                print(f"📡 Resultados enviados via WebSocket para sesión {session_id}")
-            except Exception as ws_error:
-                print(f"❌ Error enviando WebSocket: {ws_error}")
-        else:
-            print(f"⚠️ No hay conexión WebSocket activa para sesión {session_id}")
-        
-        print(f"✅ Conciliación completada para sesión {session_id}")
-        
-    except Exception as e:
-        print(f"❌ Error en conciliación {session_id}: {e}")
-        session["status"] = "error"
-        session["error"] = str(e)
+conciliation_jobs.add_listener(on_conciliation_job_finished)
+
+@app.on_event("startup")
+async def start_conciliation_jobs():
+    await conciliation_jobs.start()
+
+@app.on_event("shutdown")
+async def stop_conciliation_jobs():
+    await conciliation_jobs.stop()
+
+@app.on_event("shutdown")
+async def stop_ocr_engines():
+    shutdown_ocr_engines()
 
 @conciliator_router.get("/results/{session_id}")
 async def get_conciliator_results(session_id: str):
@@ -489,13 +369,22 @@ async def get_conciliator_results(session_id: str):
     print(f"🔍 Solicitando resultados para sesión: {session_id}")
     
     if session_id not in conciliator_sessions:
-        raise HTTPException(status_code=404, detail="Sesión no encontrada")
+        # La sesión en memoria se pierde al reiniciar; el trabajo persiste
+        job = conciliation_jobs.latest_for_session(session_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Sesión no encontrada")
+        if job["status"] in (JOB_QUEUED, JOB_RUNNING):
+            return {"status": "processing", "message": "Procesamiento en curso...", "job_id": job["job_id"]}
+        result = conciliation_jobs.load_result(job)
+        if result is None:
+            return {"status": job["status"], "message": job.get("error") or "Procesamiento no completado"}
+        return result
     
     session = conciliator_sessions[session_id]
     print(f"📋 Estado de la sesión: {session['status']}")
     
     if session["status"] == "processing":
-        return {"status": "processing", "message": "Procesamiento en curso..."}
+        return {"status": "processing", "message": "Procesamiento en curso...", "job_id": session.get("job_id")}
     elif session["status"] != "completed":
         return {"status": session["status"], "message": "Procesamiento no completado"}
     
@@ -505,6 +394,150 @@ async def get_conciliator_results(session_id: str):
     print(f"✅ Enviando resultados para sesión {session_id}")
     return session["results"]
 
+def _session_results_file(session_id: str):
+    """Obtiene el trabajo completado de una sesión y su archivo en el almacén de resultados"""
+    session = conciliator_sessions.get(session_id)
+    job_id = session.get("job_id") if session else None
+    job = conciliation_jobs.get(job_id) if job_id else conciliation_jobs.latest_for_session(session_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Sesión no encontrada")
+    if job["status"] != JOB_COMPLETED:
+        raise HTTPException(status_code=409, detail=f"La conciliación no está completada ({job['status']})")
+    
+    path = conciliation_jobs.results_file(job)
+    if path is None:
+        raise HTTPException(status_code=409, detail="Esta conciliación no tiene resultados guardados")
+    return job, path
+
+def _load_session_frame(session_id: str):
+    """Obtiene el frame de diferencias de la última conciliación completada de una sesión"""
+    job, path = _session_results_file(session_id)
+    session = conciliator_sessions.get(session_id)
+    
+    # Cache en la sesión para que cada recálculo tarde milisegundos
+    cached = session.get("whatif_frame") if session else None
+    if cached is not None and cached[0] == job["job_id"]:
+        return cached[1]
+    
+    frame = load_whatif_frame(path)
+    if session is not None:
+        session["whatif_frame"] = (job["job_id"], frame)
+    return frame
+
+@conciliator_router.get("/results/{session_id}/records")
+async def get_conciliator_records(
+    session_id: str,
+    page: int = 1,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    category: Optional[List[str]] = Query(None),
+    sucursal: Optional[str] = None,
+    id_prefix: Optional[str] = None,
+    sort_by: str = "id",
+    order: str = "asc"
+):
+    """Consulta paginada de los registros de una conciliación (filtros por categoría, sucursal y prefijo de ID)"""
+    _, path = _session_results_file(session_id)
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="El orden debe ser 'asc' o 'desc'")
+    
+    try:
+        return await asyncio.to_thread(
+            query_results, path,
+            page=page, page_size=page_size,
+            categories=category, sucursal=sucursal, id_prefix=id_prefix,
+            sort_by=sort_by, descending=(order == "desc")
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@conciliator_router.post("/whatif/{session_id}")
+async def conciliator_what_if(session_id: str, request: WhatIfRequest):
+    """Recategoriza una conciliación completada con otras tolerancias sin repetir el matching"""
+    # Leer el almacén y recalcular cientos de escenarios es bloqueante: en un hilo para no detener el event loop
+    frame = await asyncio.to_thread(_load_session_frame, session_id)
+    base_pct = frame.attrs.get("tolerance_percentage")
+    base_abs = frame.attrs.get("tolerance_absolute")
+    
+    tolerance_pct = request.tolerance_percentage if request.tolerance_percentage is not None else base_pct
+    tolerance_abs = request.tolerance_absolute if request.tolerance_absolute is not None else base_abs
+    
+    if request.grid:
+        try:
+            scenarios = tolerance_grid(
+                request.grid.get("tolerance_percentage") or [tolerance_pct],
+                request.grid.get("tolerance_absolute") or [tolerance_abs]
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    else:
+        scenarios = [(tolerance_pct, tolerance_abs)]
+    
+    if any(value is None or value < 0 for scenario in scenarios for value in scenario):
+        raise HTTPException(status_code=400, detail="Las tolerancias deben ser números positivos")
+    
+    started = datetime.now()
+    results = await asyncio.to_thread(run_what_if, frame, scenarios)
+    elapsed_ms = (datetime.now() - started).total_seconds() * 1000
+    print(f"🎚️ What-if {session_id}: {len(scenarios)} escenarios en {elapsed_ms:.1f} ms")
+    
+    return {
+        "session_id": session_id,
+        "client_type": frame.attrs.get("client_type"),
+        "baseline": {"tolerance_percentage": base_pct, "tolerance_absolute": base_abs},
+        "scenarios": results,
+        "elapsed_ms": round(elapsed_ms, 2)
+    }
+
+@conciliator_router.get("/jobs")
+async def list_conciliation_jobs(status: Optional[str] = None, limit: int = 50):
+    """Lista los trabajos de conciliación más recientes"""
+    return conciliation_jobs.list(status, limit)
+
+@conciliator_router.get("/jobs/{job_id}")
+async def get_conciliation_job(job_id: str):
+    """Obtiene el estado de un trabajo de conciliación"""
+    job = conciliation_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return job
+
+@conciliator_router.post("/jobs/{job_id}/cancel")
+async def cancel_conciliation_job(job_id: str):
+    """Cancela un trabajo en cola o en ejecución"""
+    job = conciliation_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    if job["status"] in FINAL_STATES:
+        raise HTTPException(status_code=409, detail=f"El trabajo ya terminó ({job['status']})")
+    
+    if not await conciliation_jobs.cancel(job_id):
+        raise HTTPException(status_code=409, detail="No se pudo cancelar el trabajo")
+    return {"message": "Trabajo cancelado", "job_id": job_id}
+
+@conciliator_router.get("/ledger")
+async def get_conciliation_ledger():
+    """Resumen del ledger de conciliaciones incrementales por cliente"""
+    return {"clients": conciliation_ledger.stats()}
+
+@conciliator_router.delete("/ledger/{client_type}")
+async def clear_conciliation_ledger(client_type: str):
+    """Vacía el ledger de un cliente; la siguiente conciliación se hace completa"""
+    removed = conciliation_ledger.clear(client_type)
+    print(f"🧹 Ledger {client_type.upper()} vaciado: {removed} IDs")
+    return {"message": "Ledger vaciado", "client_type": client_type.upper(), "removed": removed}
+
+@conciliator_router.get("/metrics")
+async def get_conciliation_metrics(
+    client_type: Optional[str] = None,
+    runs: int = Query(DEFAULT_SUMMARY_RUNS, ge=1, le=1000),
+    recent: int = Query(10, ge=0, le=100)
+):
+    """Tiempos, filas y memoria por etapa de las últimas conciliaciones (para detectar regresiones)"""
+    return {
+        "stages": conciliation_metrics.summary(client_type, runs),
+        "recent_runs": conciliation_metrics.recent(client_type, recent) if recent else []
+    }
+
 @conciliator_router.websocket("/ws/{session_id}")
 async def conciliator_websocket(websocket: WebSocket, session_id: str):
     """WebSocket para actualizaciones en tiempo real"""
@@ -546,14 +579,67 @@ else:
         return {"message": "SantiICE OCR API is running"}
 
 
+def _near_duplicate_response(filename, match):
+    """409 para una foto casi idéntica a otra cuyo ticket ya está en Sheets"""
+    print(f"🚫 Rechazando foto duplicada ({filename}): se parece a '{match['filename']}'")
+    return JSONResponse(
+        status_code=409,
+        content={
+            "message": "Ticket duplicado detectado",
+            "details": f"La foto es casi idéntica a '{match['filename']}', procesada el {match['created_at'][:16].replace('T', ' ')}. "
+                       "Si es otro ticket, reenvíala con force=true.",
+            "duplicated": True,
+            "rejected": True,
+            "near_duplicate": match,
+            "detected_type": match.get("ticket_type"),
+            "filename": filename
+        }
+    )
+
+def _ticket_stop_response(ctx: TicketContext):
+    """
+    Respuesta de /upload y /process-uploaded-file cuando el pipeline cortó el recorrido.
+    Duplicados y errores de Sheets se responden aquí; el resto se lanza como HTTPException.
+    """
+    stop = ctx.stop
+    if stop.reason == "near_duplicate":
+        return _near_duplicate_response(ctx.filename, stop.details["match"])
+    
+    if stop.reason == "duplicated":
+        return JSONResponse(
+            status_code=409,  # Código 409 Conflict para indicar duplicado
+            content={
+                "message": "Ticket duplicado detectado",
+                "details": stop.message,
+                "duplicated": True,
+                "rejected": True,
+                "detected_type": ctx.sucursal,
+                "filename": ctx.filename
+            }
+        )
+    
+    if stop.reason == "sheets_error":
+        return JSONResponse(
+            status_code=500,
+            content={
+                "error": "Error al guardar en Google Sheets",
+                "details": stop.message,
+                "detected_type": ctx.sucursal,
+                "filename": ctx.filename
+            }
+        )
+    
+    raise HTTPException(status_code=stop.status_code, detail=stop.message, headers=stop.details.get("headers"))
+
 @app.post("/upload")
-async def upload_image(file: UploadFile = File(...)):
+async def upload_image(file: UploadFile = File(...), force: bool = Form(False)):
     """
     Procesa una imagen de un ticket, extrae su texto y lo envía a Google Sheets.
     El tipo de sucursal se detecta automáticamente.
     
     Args:
         file: Archivo de imagen del ticket
+        force: Procesar aunque la foto sea casi idéntica a otra ya enviada (el operador confirmó que es otro ticket)
         
     Returns:
         JSONResponse con los resultados del procesamiento
@@ -563,13 +649,11 @@ async def upload_image(file: UploadFile = File(...)):
         if not file:
             raise HTTPException(status_code=400, detail="Archivo no recibido")
 
-        image_bytes = await file.read()
-
-        if not image_bytes:
-            raise HTTPException(status_code=400, detail="Archivo vacío")
-
-        if file.content_type not in ["image/jpeg", "image/png"]:
-            raise HTTPException(status_code=400, detail="Formato de archivo no permitido. Usa JPEG o PNG.")
+        # Lectura por bloques: valida tamaño y tipo real (JPEG/PNG) sin confiar en content_type
+        image_bytes, upload_info = await read_upload(
+            file, allowed_types=IMAGE_TYPES, max_size=ConciliatorConfig.MAX_FILE_SIZE
+        )
+        content_type = upload_info["content_type"]
 
         # Si estamos en Lambda, guardar el archivo en S3
         if IS_LAMBDA:
@@ -578,136 +662,28 @@ async def upload_image(file: UploadFile = File(...)):
                 Body=image_bytes,
                 Bucket=BUCKET_NAME,
                 Key=s3_key,
-                ContentType=file.content_type
+                ContentType=content_type
             )
             print(f"📤 Archivo subido a S3: s3://{BUCKET_NAME}/{s3_key}")
 
-        # Extracción de texto con OCR mejorado
-        print(f"📝 Analizando imagen '{file.filename}'...")
-        ocr_result = analyze_text_with_fallback(image_bytes)
-        ocr_text = ocr_result.get('text', '')
-        
-        # Log de información del OCR
-        confidence = ocr_result.get('confidence', 0)
-        preprocessed = ocr_result.get('preprocessed', False)
-        print(f"📊 OCR completado - Confianza: {confidence:.1f}%, Preprocesado: {preprocessed}")
-        
-        if not ocr_text or len(ocr_text.strip()) < 10:
-            raise HTTPException(status_code=500, detail="No se pudo extraer texto suficiente del archivo.")
-
-        # Detección automática del tipo de ticket
-        sucursal = detect_ticket_type(ocr_text)
-        print(f"🔍 Tipo de ticket detectado automáticamente: {sucursal} (archivo: {file.filename})")
-        
-        # Validar consistencia del ticket
-        es_valido, confianza_validacion, observaciones = validate_ticket_content(ocr_text, sucursal)
-        
-        if not es_valido:
-            print(f"⚠️ Advertencia: Baja confianza en tipo de ticket ({confianza_validacion}%)")
-            for obs in observaciones:
-                print(f"   - {obs}")
-
-        # Procesamiento del texto según el tipo de sucursal
-        print(f"🔍 Procesando texto para {sucursal} (archivo: {file.filename})")
-        processed_data = process_kiosko(ocr_text) if sucursal == "KIOSKO" else process_oxxo(ocr_text)
-        
-        # Verificar si hubo errores en el procesamiento
-        if isinstance(processed_data, dict) and "error" in processed_data:
-            raise HTTPException(status_code=500, detail=processed_data["error"])
-
-        # Asegurar que los datos estén en formato de lista
-        if not isinstance(processed_data, list):
-            processed_data = [processed_data]
-
-        # Verificar que hay datos para procesar
-        if not processed_data:
-            raise HTTPException(status_code=400, detail="No se pudo extraer información válida del ticket.")
-        
-        # Validar confianza mínima para producción
-        for item in processed_data:
-            if sucursal == "OXXO":
-                cantidad = item.get('cantidad', 0)
-                if cantidad == 0:
-                    raise HTTPException(
-                        status_code=422, 
-                        detail=f"Ticket requiere revisión manual: No se pudo extraer cantidad con suficiente confianza para {item.get('descripcion', 'producto')}."
-                    )
-            elif sucursal == "KIOSKO":
-                cantidad = item.get('numeroPiezasCompradas', 0)
-                if cantidad == 0:
-                    raise HTTPException(
-                        status_code=422, 
-                        detail=f"Ticket requiere revisión manual: No se pudo extraer cantidad con suficiente confianza para {item.get('descripcion', 'producto')}."
-                    )
-        
-        # Log de productos encontrados
-        print(f"📄 Se encontraron {len(processed_data)} productos en el ticket {sucursal} (archivo: {file.filename})")
-        for i, item in enumerate(processed_data):
-            if sucursal == "OXXO":
-                print(f"📄 Producto {i+1}: Costo={item.get('costo')}, Cantidad={item.get('cantidad')}")
-            else:  # KIOSKO
-                print(f"📄 Producto {i+1}: Tipo={item.get('tipoProducto')}, Cantidad={item.get('numeroPiezasCompradas')}")
-
-        # Enviar datos a Google Sheets
-        print(f"🛠️ Enviando datos a Google Sheets para archivo: {file.filename}")
-        
-        # Para tickets OXXO con múltiples productos, verificar duplicados solo para el primer producto
-        if sucursal == "OXXO" and len(processed_data) > 1:
-            # Primero verificamos si alguno de los productos ya está registrado
-            first_product = processed_data[0]
-            verify_response = send_to_google_sheets(sucursal, [first_product], precios_config=None, origen="extracción")
-            
-            # Si el primer producto está duplicado, asumimos que todo el ticket está duplicado
-            if verify_response.get("duplicated", False):
-                print(f"🚫 Rechazando ticket duplicado ({file.filename}): {verify_response.get('message')}")
-                return JSONResponse(
-                    status_code=409,  # Código 409 Conflict para indicar duplicado
-                    content={
-                        "message": "Ticket duplicado detectado",
-                        "details": verify_response.get("message", "Este ticket ya ha sido procesado anteriormente."),
-                        "duplicated": True,
-                        "rejected": True,
-                        "detected_type": sucursal,
-                        "filename": file.filename
-                    }
-                )
-        
-        # Si no hay duplicados, procedemos a guardar todos los productos
-        google_sheets_response = send_to_google_sheets(sucursal, processed_data, precios_config=None, origen="extracción")
-        
-        # Verificar si se detectó un duplicado y rechazar la solicitud
-        if google_sheets_response.get("duplicated", False):
-            print(f"🚫 Rechazando ticket duplicado ({file.filename}): {google_sheets_response.get('message')}")
-            return JSONResponse(
-                status_code=409,  # Código 409 Conflict para indicar duplicado
-                content={
-                    "message": "Ticket duplicado detectado",
-                    "details": google_sheets_response.get("message", "Este ticket ya ha sido procesado anteriormente."),
-                    "duplicated": True,
-                    "rejected": True,
-                    "detected_type": sucursal,
-                    "filename": file.filename
-                }
-            )
-        
-        # Verificar si hubo algún otro error
-        if not google_sheets_response.get("success", False):
-            return JSONResponse(
-                status_code=500,
-                content={
-                    "error": "Error al guardar en Google Sheets",
-                    "details": google_sheets_response.get("message", "Error desconocido")
-                }
-            )
+        # Duplicados → OCR → detección → validación → parseo → cantidades → Sheets
+        # (bloqueante: en un hilo para no detener el event loop)
+        ctx = await asyncio.to_thread(
+            upload_pipeline.run,
+            TicketContext(image_bytes, upload_info["sha256"], file.filename, reject_near_duplicate=not force)
+        )
+        if ctx.stop:
+            return _ticket_stop_response(ctx)
         
         return JSONResponse(
             status_code=200,
             content={
                 "message": "Ticket procesado exitosamente",
                 "success": True,
-                "detected_type": sucursal,
+                "detected_type": ctx.sucursal,
                 "filename": file.filename,
-                "products_count": len(processed_data)
+                "products_count": len(ctx.processed_data),
+                "near_duplicate": ctx.near_duplicate
             }
         )
         
@@ -722,155 +698,261 @@ async def upload_image(file: UploadFile = File(...)):
             }
         )
 
-@app.post("/process-tickets")
-async def process_tickets(files: List[UploadFile] = File(...)):
+async def _process_ticket_file(file: UploadFile, batch_index=None):
     """
-    Procesa múltiples tickets y devuelve los datos extraídos para revisión.
-    NO envía los datos a Google Sheets.
+    Procesa un archivo de ticket: OCR, detección de tipo y extracción de datos.
+    Lo usan /process-tickets y su variante en streaming.
+
+    Args:
+        file: Imagen del ticket
+        batch_index: Fotos ya procesadas en el mismo lote (new_batch_index)
+
+    Returns:
+        dict con el resultado del ticket (status "processed" o "error"),
+        o None si el archivo se ignora (vacío o no es imagen)
     """
-    results = []
-    
-    for file in files:
-        try:
-            if not file or not file.filename:
-                continue
-                
-            image_bytes = await file.read()
-            if not image_bytes or file.content_type not in ["image/jpeg", "image/png"]:
-                continue
-            
-            ticket_id = str(uuid.uuid4())
-            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-            
-            ocr_result = analyze_text_with_fallback(image_bytes)
-            ocr_text = ocr_result.get('text', '')
-            confidence = ocr_result.get('confidence', 0)
-            
-            if len(ocr_text.strip()) < 10:
-                results.append({
-                    "id": ticket_id,
-                    "filename": file.filename,
-                    "status": "error",
-                    "error": "No se pudo extraer texto suficiente",
-                    "confidence": 0,
-                    "image_base64": f"data:{file.content_type};base64,{image_base64}"
-                })
-                continue
-            
-            sucursal_type = detect_ticket_type(ocr_text)
-            processed_data = process_kiosko(ocr_text) if sucursal_type == "KIOSKO" else process_oxxo(ocr_text)
+    try:
+        if not file or not file.filename:
+            return None
             
-            if isinstance(processed_data, dict) and "error" in processed_data:
-                results.append({
-                    "id": ticket_id,
+        try:
+            image_bytes, upload_info = await read_upload(
+                file, allowed_types=IMAGE_TYPES, max_size=ConciliatorConfig.MAX_FILE_SIZE
+            )
+        except HTTPException as e:
+            # Archivos vacíos o que no son imagen se ignoran; los demasiado grandes se reportan
+            if e.status_code == 413:
+                return {
+                    "id": str(uuid.uuid4()),
                     "filename": file.filename,
                     "status": "error",
-                    "error": processed_data["error"],
-                    "confidence": confidence,
-                    "image_base64": f"data:{file.content_type};base64,{image_base64}"
-                })
-                continue
-            
-            if not isinstance(processed_data, list):
-                processed_data = [processed_data]
-            
-            first_item = processed_data[0] if processed_data else {}
-            
-            # Campos específicos según el tipo de ticket
-            ticket_data = {
+                    "error": e.detail,
+                    "confidence": 0
+                }
+            return None
+        
+        ticket_id = str(uuid.uuid4())
+        # La imagen se guarda en el almacén (disco o, en Lambda, S3); la respuesta solo lleva sus URLs
+        image_ref = await asyncio.to_thread(
+            store_image, image_bytes, upload_info["sha256"], upload_info["content_type"]
+        )
+        
+        # El pipeline es bloqueante: correrlo en un hilo deja libre el event loop para ir enviando resultados
+        ctx = await asyncio.to_thread(
+            review_pipeline.run, TicketContext(image_bytes, upload_info["sha256"], file.filename, batch_index)
+        )
+        
+        if ctx.stop:
+            return {
                 "id": ticket_id,
                 "filename": file.filename,
-                "sucursal": first_item.get('sucursal', 'No detectada'),
-                "fecha": first_item.get('fecha', 'No detectada'),
-                "productos": processed_data,
-                "confidence": confidence,
-                "status": "processed",
-                "sucursal_type": sucursal_type,
-                "image_base64": f"data:{file.content_type};base64,{image_base64}"
-            }
-            
-            # Agregar campos específicos según el tipo
-            if sucursal_type == "OXXO":
-                ticket_data.update({
-                    "remision": first_item.get('remision', 'No detectada'),
-                    "pedido_adicional": first_item.get('pedido_adicional', 'No detectado')
-                })
-            else:  # KIOSKO
-                ticket_data.update({
-                    "folio": first_item.get('folio', 'No detectado')
-                })
-            
-            results.append(ticket_data)
-            
-        except Exception as e:
-            results.append({
-                "id": str(uuid.uuid4()),
-                "filename": file.filename if file else "unknown",
                 "status": "error",
-                "error": str(e),
-                "confidence": 0
-            })
-    
-    return JSONResponse(content={
+                "error": ctx.stop.message,
+                "confidence": ctx.confidence,
+                "near_duplicate": ctx.near_duplicate,
+                **image_ref
+            }
+        
+        processed_data = ctx.processed_data
+        first_item = processed_data[0] if processed_data else {}
+        
+        return {
+            "id": ticket_id,
+            "filename": file.filename,
+            "sucursal": first_item.get('sucursal', 'No detectada'),
+            "fecha": first_item.get('fecha', 'No detectada'),
+            "productos": processed_data,
+            "confidence": ctx.confidence,
+            "status": "processed",
+            "sucursal_type": ctx.sucursal,
+            # Foto casi idéntica a otra ya enviada a Sheets o del mismo lote: aviso para la revisión
+            "near_duplicate": ctx.near_duplicate,
+            # Campos específicos de la cadena (remisión y pedido, folio, ...)
+            **ctx.chain.extract_ticket_fields(first_item),
+            **image_ref
+        }
+        
+    except HTTPException as e:
+        # Textract saturado (503): el ticket indica cuándo reintentarlo
+        return {
+            "id": str(uuid.uuid4()),
+            "filename": file.filename if file else "unknown",
+            "status": "error",
+            "error": e.detail,
+            "retry_after": (e.headers or {}).get("Retry-After"),
+            "confidence": 0
+        }
+    except Exception as e:
+        return {
+            "id": str(uuid.uuid4()),
+            "filename": file.filename if file else "unknown",
+            "status": "error",
+            "error": str(e),
+            "confidence": 0
+        }
+
+def _tickets_summary(files, results):
+    return {
         "success": True,
         "total_files": len(files),
         "processed": len([r for r in results if r["status"] == "processed"]),
         "errors": len([r for r in results if r["status"] == "error"]),
+        "duplicated": len([r for r in results if r.get("duplicated")]),
+        "near_duplicates": len([r for r in results if r.get("near_duplicate")]),
+    }
+
+@app.post("/process-tickets")
+async def process_tickets(files: List[UploadFile] = File(...)):
+    """
+    Procesa múltiples tickets y devuelve los datos extraídos para revisión.
+    NO envía los datos a Google Sheets.
+    """
+    results = []
+    batch_index = new_batch_index()
+    
+    for file in files:
+        result = await _process_ticket_file(file, batch_index)
+        if result is not None:
+            results.append(result)
+    
+    return JSONResponse(content={
+        **_tickets_summary(files, results),
         "results": results
     })
 
+@app.post("/process-tickets/stream")
+async def process_tickets_stream(files: List[UploadFile] = File(...)):
+    """
+    Variante en streaming de /process-tickets (NDJSON, un objeto JSON por línea).
+    Emite {"type": "ticket", ...} en cuanto termina cada ticket y al final
+    {"type": "summary", ...} con los mismos contadores que /process-tickets.
+    """
+    async def event_stream():
+        results = []
+        batch_index = new_batch_index()
+        for index, file in enumerate(files):
+            result = await _process_ticket_file(file, batch_index)
+            if result is None:
+                continue
+            results.append(result)
+            yield json.dumps({"type": "ticket", "index": index, "result": result}) + "\n"
+        
+        yield json.dumps({"type": "summary", **_tickets_summary(files, results)}) + "\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/ticket-metrics")
+async def get_ticket_metrics():
+    """Tiempos por etapa, motivos de corte, cachés (OCR y parseo) y tráfico a Textract del pipeline de tickets (desde el arranque)"""
+    return ticket_metrics.snapshot()
+
+# Las imágenes se direccionan por su hash: el contenido de una URL nunca cambia
+IMAGE_CACHE_HEADERS = {"Cache-Control": "public, max-age=31536000, immutable"}
+
+def _cached_image_response(request: Request, image_id: str, path, media_type: str, variant: str = ""):
+    etag = f'"{image_id}{variant}"'
+    headers = {**IMAGE_CACHE_HEADERS, "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+@app.get("/images/{image_id}")
+async def get_ticket_image(image_id: str, request: Request):
+    """Devuelve la imagen original de un ticket procesado"""
+    # Almacén en S3 (Lambda): se redirige a la URL prefirmada
+    image_url = get_image_url(image_id)
+    if image_url:
+        return RedirectResponse(image_url)
+    image_path, content_type = get_image_path(image_id)
+    if image_path is None:
+        raise HTTPException(status_code=404, detail="Imagen no encontrada")
+    return _cached_image_response(request, image_id, image_path, content_type)
+
+@app.get("/images/{image_id}/thumbnail")
+async def get_ticket_thumbnail(image_id: str, request: Request):
+    """Devuelve una miniatura JPEG de la imagen de un ticket"""
+    thumbnail_url = get_image_url(image_id, thumbnail=True)
+    if thumbnail_url:
+        return RedirectResponse(thumbnail_url)
+    thumbnail_path = await asyncio.to_thread(get_thumbnail_path, image_id)
+    if thumbnail_path is None:
+        raise HTTPException(status_code=404, detail="Imagen no encontrada")
+    return _cached_image_response(request, image_id, thumbnail_path, "image/jpeg", "-thumb")
+
 @app.post("/confirm-tickets")
 async def confirm_tickets(request: ConfirmTicketsRequest):
     """
     Recibe los tickets validados por el usuario y los envía a Google Sheets.
+    Todo el lote se verifica contra una sola lectura de la hoja y se escribe en una sola petición.
     """
-    import asyncio
-    results = []
+    bulk_tickets = []
+    # Posibles fotos repetidas que el usuario no confirmó: no se envían (como el 409 de /upload)
+    held = {ticket.id for ticket in request.tickets if ticket.near_duplicate and not ticket.force}
+    to_send = [ticket for ticket in request.tickets if ticket.id not in held]
     
-    for i, ticket in enumerate(request.tickets):
-        try:
-            # Usar el tipo de sucursal del ticket directamente
-            sucursal_type = getattr(ticket, 'sucursal_type', None)
-            if not sucursal_type:
-                # Fallback: detectar por contenido de productos
-                sucursal_type = "OXXO" if any('costo' in p for p in ticket.productos) else "KIOSKO"
-            
-            print(f"🔍 Confirmando ticket {ticket.filename} como {sucursal_type}")
-            print(f"📝 Datos del ticket: Sucursal={ticket.sucursal}, Fecha={ticket.fecha}")
-            
-            # Log de los primeros productos para verificar sincronización
-            if ticket.productos:
-                primer_producto = ticket.productos[0]
-                print(f"📝 Primer producto - Sucursal: {primer_producto.get('sucursal', 'N/A')}, NombreTienda: {primer_producto.get('nombreTienda', 'N/A')}")
-            
-            # Determinar el origen basado en si el ticket viene de procesamiento de imagen o entrada manual
-            # Si el ticket tiene confidence < 100, viene de procesamiento de imagen (extracción)
-            # Si tiene confidence = 100, es entrada manual
-            origen = "manual" if ticket.confidence == 100 else "extracción"
-            
-            response = send_to_google_sheets(sucursal_type, ticket.productos, request.precios_config, origen=origen)
-            
-            results.append({
-                "id": ticket.id,
-                "filename": ticket.filename,
-                "status": "success" if response.get("success") else "error",
-                "message": response.get("message", "Procesado correctamente"),
-                "duplicated": response.get("duplicated", False)
-            })
-            
-            # Delay progresivo para evitar límites de cuota
-            if i > 0:
-                delay_seconds = min(i * 1.0, 5.0)  # Máximo 5 segundos
-                print(f"⏳ Esperando {delay_seconds}s antes del siguiente ticket...")
-                await asyncio.sleep(delay_seconds)
-            
-        except Exception as e:
+    for ticket in to_send:
+        # Usar el tipo de sucursal del ticket directamente
+        sucursal_type = getattr(ticket, 'sucursal_type', None)
+        if not sucursal_type:
+            # Fallback: detectar por contenido de productos
+            chain = infer_chain(ticket.productos)
+            sucursal_type = chain.name if chain else None
+        
+        print(f"🔍 Confirmando ticket {ticket.filename} como {sucursal_type}")
+        print(f"📝 Datos del ticket: Sucursal={ticket.sucursal}, Fecha={ticket.fecha}")
+        
+        # Log de los primeros productos para verificar sincronización
+        if ticket.productos:
+            primer_producto = ticket.productos[0]
+            print(f"📝 Primer producto - Sucursal: {primer_producto.get('sucursal', 'N/A')}, NombreTienda: {primer_producto.get('nombreTienda', 'N/A')}")
+        
+        # Determinar el origen basado en si el ticket viene de procesamiento de imagen o entrada manual
+        # Si el ticket tiene confidence < 100, viene de procesamiento de imagen (extracción)
+        # Si tiene confidence = 100, es entrada manual
+        origen = "manual" if ticket.confidence == 100 else "extracción"
+        
+        bulk_tickets.append({
+            "sucursal": sucursal_type,
+            "data": ticket.productos,
+            "origen": origen
+        })
+    
+    try:
+        responses = await asyncio.to_thread(send_tickets_bulk, bulk_tickets, request.precios_config) if bulk_tickets else []
+    except Exception as e:
+        responses = [{"success": False, "message": str(e), "duplicated": False}] * len(bulk_tickets)
+    
+    # Las fotos de los tickets que ya están en Sheets entran al historial de duplicados
+    registered = [ticket for ticket, response in zip(to_send, responses)
+                  if ticket.image_id and (response.get("success") or response.get("duplicated"))]
+    for ticket in registered:
+        await asyncio.to_thread(remember_stored_image, ticket.image_id, ticket.filename, ticket.sucursal_type)
+    
+    sent = {ticket.id: response for ticket, response in zip(to_send, responses)}
+    results = []
+    for ticket in request.tickets:
+        if ticket.id in held:
             results.append({
                 "id": ticket.id,
                 "filename": ticket.filename,
                 "status": "error",
-                "message": str(e)
+                "message": f"Posible foto repetida de {ticket.near_duplicate.get('filename')}; confirma que es otro ticket para enviarlo",
+                "duplicated": False,
+                "near_duplicate": True
             })
+            continue
+        response = sent[ticket.id]
+        results.append({
+            "id": ticket.id,
+            "filename": ticket.filename,
+            "status": "success" if response.get("success") else "error",
+            "message": response.get("message", "Procesado correctamente"),
+            "duplicated": response.get("duplicated", False)
+        })
     
     return JSONResponse(content={
         "success": True,
@@ -879,7 +961,8 @@ async def confirm_tickets(request: ConfirmTicketsRequest):
             "total": len(results),
             "success": len([r for r in results if r["status"] == "success"]),
             "errors": len([r for r in results if r["status"] == "error"]),
-            "duplicated": len([r for r in results if r.get("duplicated")])
+            "duplicated": len([r for r in results if r.get("duplicated")]),
+            "near_duplicates": len(held)
         }
     })
         
@@ -946,6 +1029,8 @@ async def process_uploaded_file(request: Request):
     try:
         data = await request.json()
         s3_key = data.get("s3Key")
+        # Igual que /upload: force procesa una foto casi idéntica a otra ya enviada
+        force = bool(data.get("force", False))
         
         if not s3_key:
             return JSONResponse(
@@ -966,141 +1051,31 @@ async def process_uploaded_file(request: Request):
             # Si tiene formato UUID-nombrearchivo.jpg
             filename = filename.split('-', 1)[1]
         
-        # Extracción de texto con OCR mejorado
-        print(f"📝 Analizando imagen '{filename}'...")
-        ocr_result = analyze_text_with_fallback(image_bytes)
-        ocr_text = ocr_result.get('text', '')
-        
-        # Log de información del OCR
-        confidence = ocr_result.get('confidence', 0)
-        preprocessed = ocr_result.get('preprocessed', False)
-        print(f"📊 OCR completado - Confianza: {confidence:.1f}%, Preprocesado: {preprocessed}")
-        
-        if not ocr_text or len(ocr_text.strip()) < 10:
-            raise HTTPException(status_code=500, detail="No se pudo extraer texto suficiente del archivo.")
-        
-        # Detección automática del tipo de ticket
-        sucursal = detect_ticket_type(ocr_text)
-        print(f"🔍 Tipo de ticket detectado automáticamente: {sucursal} (archivo: {filename})")
-        
-        # Validar consistencia del ticket
-        es_valido, confianza_validacion, observaciones = validate_ticket_content(ocr_text, sucursal)
-        
-        if not es_valido:
-            print(f"⚠️ Advertencia: Baja confianza en tipo de ticket ({confianza_validacion}%)")
-            for obs in observaciones:
-                print(f"   - {obs}")
-        
-        # Procesamiento del texto según el tipo de sucursal
-        print(f"🔍 Procesando texto para {sucursal} (archivo: {filename})")
-        processed_data = process_kiosko(ocr_text) if sucursal == "KIOSKO" else process_oxxo(ocr_text)
-        
-        # Verificar si hubo errores en el procesamiento
-        if isinstance(processed_data, dict) and "error" in processed_data:
-            raise HTTPException(status_code=500, detail=processed_data["error"])
-        
-        # Asegurar que los datos estén en formato de lista
-        if not isinstance(processed_data, list):
-            processed_data = [processed_data]
-        
-        # Verificar que hay datos para procesar
-        if not processed_data:
-            raise HTTPException(status_code=400, detail="No se pudo extraer información válida del ticket.")
-        
-        # Validar confianza mínima para producción
-        for item in processed_data:
-            if sucursal == "OXXO":
-                cantidad = item.get('cantidad', 0)
-                if cantidad == 0:
-                    raise HTTPException(
-                        status_code=422, 
-                        detail=f"Ticket requiere revisión manual: No se pudo extraer cantidad con suficiente confianza para {item.get('descripcion', 'producto')}."
-                    )
-            elif sucursal == "KIOSKO":
-                cantidad = item.get('numeroPiezasCompradas', 0)
-                if cantidad == 0:
-                    raise HTTPException(
-                        status_code=422, 
-                        detail=f"Ticket requiere revisión manual: No se pudo extraer cantidad con suficiente confianza para {item.get('descripcion', 'producto')}."
-                    )
-        
-        # Log de productos encontrados
-        print(f"📄 Se encontraron {len(processed_data)} productos en el ticket {sucursal} (archivo: {filename})")
-        for i, item in enumerate(processed_data):
-            if sucursal == "OXXO":
-                print(f"📄 Producto {i+1}: Costo={item.get('costo')}, Cantidad={item.get('cantidad')}")
-            else:  # KIOSKO
-                print(f"📄 Producto {i+1}: Tipo={item.get('tipoProducto')}, Cantidad={item.get('numeroPiezasCompradas')}")
-        
-        # Enviar datos a Google Sheets
-        print(f"🛠️ Enviando datos a Google Sheets para archivo: {filename}")
-        
-        # Para tickets OXXO con múltiples productos, verificar duplicados solo para el primer producto
-        if sucursal == "OXXO" and len(processed_data) > 1:
-            # Primero verificamos si alguno de los productos ya está registrado
-            first_product = processed_data[0]
-            verify_response = send_to_google_sheets(sucursal, [first_product], precios_config=None, origen="extracción")
-            
-            # Si el primer producto está duplicado, asumimos que todo el ticket está duplicado
-            if verify_response.get("duplicated", False):
-                print(f"🚫 Rechazando ticket duplicado ({filename}): {verify_response.get('message')}")
-                return JSONResponse(
-                    status_code=409,  # Código 409 Conflict para indicar duplicado
-                    content={
-                        "message": "Ticket duplicado detectado",
-                        "details": verify_response.get("message", "Este ticket ya ha sido procesado anteriormente."),
-                        "duplicated": True,
-                        "rejected": True,
-                        "detected_type": sucursal,
-                        "filename": filename
-                    }
-                )
-        
-        # Si no hay duplicados, procedemos a guardar todos los productos
-        google_sheets_response = send_to_google_sheets(sucursal, processed_data, precios_config=None, origen="extracción")
-        
-        # Verificar si se detectó un duplicado y rechazar la solicitud
-        if google_sheets_response.get("duplicated", False):
-            print(f"🚫 Rechazando ticket duplicado ({filename}): {google_sheets_response.get('message')}")
-            return JSONResponse(
-                status_code=409,  # Código 409 Conflict para indicar duplicado
-                content={
-                    "message": "Ticket duplicado detectado",
-                    "details": google_sheets_response.get("message", "Este ticket ya ha sido procesado anteriormente."),
-                    "duplicated": True,
-                    "rejected": True,
-                    "detected_type": sucursal,
-                    "filename": filename
-                }
-            )
-        
-        # Verificar si hubo algún otro error
-        if not google_sheets_response.get("success", False):
-            return JSONResponse(
-                status_code=500,
-                content={
-                    "error": "Error al guardar en Google Sheets",
-                    "details": google_sheets_response.get("message", "Error desconocido"),
-                    "detected_type": sucursal,
-                    "filename": filename
-                }
-            )
+        # Mismo recorrido que /upload
+        image_id = hashlib.sha256(image_bytes).hexdigest()
+        ctx = await asyncio.to_thread(
+            upload_pipeline.run, TicketContext(image_bytes, image_id, filename, reject_near_duplicate=not force)
+        )
+        if ctx.stop:
+            return _ticket_stop_response(ctx)
         
         # Si todo fue exitoso
         return JSONResponse(content={
             "message": "Procesamiento exitoso",
-            "products_count": len(processed_data),
-            "data": processed_data,
-            "google_sheets_response": google_sheets_response,
-            "detected_type": sucursal,
-            "filename": filename
+            "products_count": len(ctx.processed_data),
+            "data": ctx.processed_data,
+            "google_sheets_response": ctx.sheets_response,
+            "detected_type": ctx.sucursal,
+            "filename": filename,
+            "near_duplicate": ctx.near_duplicate
         })
     
     except HTTPException as e:
-        # Re-lanzar las excepciones HTTP directamente
+        # Re-lanzar las excepciones HTTP directamente (con sus headers: el 503 de Textract lleva Retry-After)
         return JSONResponse(
             status_code=e.status_code,
-            content={"error": e.detail}
+            content={"error": e.detail},
+            headers=e.headers
         )
     
     except Exception as e:
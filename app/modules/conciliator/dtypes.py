@@ -0,0 +1,142 @@
+"""
+Capa de tipos compactos para los DataFrames del conciliador
+Reduce la memoria de los datos procesados: numéricos con el tipo más chico que no
+pierde información, texto repetitivo como categorías y solo las columnas que
+la conciliación realmente usa
+"""
+
+import logging
+from typing import Dict, Iterable, Optional
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Columnas que nunca se convierten (los IDs deben conservar su tipo para el merge)
+PROTECTED_COLUMNS = (
+    'id_matching', 'matching_id', 'identificador_unico', 'pedido_adicional',
+    'ticket', 'folio', 'pedido',
+)
+
+# Columnas de importes: se dejan en su tipo original (int16 puede desbordarse al restar/sumar)
+VALUE_COLUMNS = (
+    'total_venta', 'Costo Total', 'costo_total', 'costo', 'Venta', 'venta',
+    'Importe', 'importe', 'Total', 'total', 'valor',
+)
+
+# Columnas necesarias para el matching y los reportes
+MATCHING_COLUMNS = (
+    'id_matching', 'total_venta', 'source', 'client_type',
+    'source_original_columns', 'looker_original_columns',
+)
+
+# Columnas de contexto que se conservan si existen (se ven en reportes y exportaciones)
+CONTEXT_COLUMNS = (
+    'identificador_unico', 'pedido_adicional', 'remision', 'tienda', 'sucursal', 'Tienda', 'Sucursal', 'fecha',
+    'Producto', 'productos_agrupados', 'total_piezas',
+    'original_ticket', 'original_folio', 'original_id', 'is_return', 'transaction_type',
+)
+
+# Texto con menos de esta proporción de valores distintos se guarda como categoría
+CATEGORY_MAX_RATIO = 0.5
+
+BYTES_PER_MB = 1024 * 1024
+
+
+def frame_memory_mb(df: Optional[pd.DataFrame]) -> float:
+    """Memoria real (deep) de un DataFrame en MB"""
+    if df is None or len(df.columns) == 0:
+        return 0.0
+    return float(df.memory_usage(deep=True).sum()) / BYTES_PER_MB
+
+
+def compact_frame(df: pd.DataFrame, protected: Iterable[str] = PROTECTED_COLUMNS) -> pd.DataFrame:
+    """
+    Convierte las columnas a tipos compactos sin perder información
+
+    - Enteros: el entero más chico que contiene todos los valores (excepto importes)
+    - Texto: categoría si tiene pocos valores distintos
+    - Flotantes e importes: se quedan como están para no perder centavos en las sumas
+
+    Args:
+        df: DataFrame a compactar (no se modifica)
+        protected: Columnas que se dejan intactas
+
+    Returns:
+        DataFrame nuevo con tipos compactos
+    """
+    if df is None or len(df) == 0:
+        return df
+
+    protected = set(protected)
+    compacted = {}
+
+    for col in df.columns:
+        if col in protected:
+            continue
+
+        values = df[col]
+        dtype = values.dtype
+
+        if pd.api.types.is_bool_dtype(dtype):
+            continue
+
+        if pd.api.types.is_integer_dtype(dtype) and col not in VALUE_COLUMNS:
+            compacted[col] = pd.to_numeric(values, downcast='integer')
+
+        elif dtype == object:
+            non_null = values.notna().sum()
+            if non_null == 0:
+                continue
+            # Solo texto: columnas mixtas (números + texto) se dejan como están
+            if pd.api.types.infer_dtype(values, skipna=True) != 'string':
+                continue
+            if values.nunique() <= non_null * CATEGORY_MAX_RATIO:
+                compacted[col] = values.astype('category')
+
+    if not compacted:
+        return df
+
+    result = df.copy(deep=False)
+    for col, values in compacted.items():
+        result[col] = values
+    return result
+
+
+def project_for_matching(df: pd.DataFrame, keep: Iterable[str] = ()) -> pd.DataFrame:
+    """
+    Deja solo las columnas que usa la conciliación (más las de contexto)
+    para que el merge no duplique columnas originales que nadie consulta
+
+    Args:
+        df: DataFrame preparado para matching
+        keep: Columnas adicionales a conservar
+
+    Returns:
+        DataFrame con las columnas proyectadas (mismo orden original)
+    """
+    wanted = set(MATCHING_COLUMNS) | set(CONTEXT_COLUMNS) | set(keep)
+    columns = [col for col in df.columns if col in wanted]
+    dropped = len(df.columns) - len(columns)
+    if dropped:
+        logger.info(f"   ✂️ Columnas proyectadas: {len(df.columns)} → {len(columns)}")
+    return df[columns]
+
+
+class MemoryReport:
+    """Registra la memoria de los DataFrames en cada etapa"""
+
+    def __init__(self, label: str = ''):
+        self.label = label
+        self.stages: Dict[str, float] = {}
+
+    def record(self, stage: str, *frames: pd.DataFrame) -> float:
+        """Registra (y registra en el log) la memoria de uno o varios DataFrames"""
+        memory_mb = round(sum(frame_memory_mb(frame) for frame in frames), 2)
+        self.stages[stage] = memory_mb
+        prefix = f"{self.label} " if self.label else ''
+        logger.info(f"   🧠 {prefix}{stage}: {memory_mb:,.2f} MB")
+        return memory_mb
+
+    def to_dict(self) -> Dict[str, float]:
+        return dict(self.stages)
@@ -0,0 +1,488 @@
+"""
+Cola persistente de trabajos de conciliación
+Los trabajos se guardan en SQLite y se ejecutan en procesos separados,
+de modo que una conciliación pesada no compite con las peticiones de la API
+y un reinicio del servidor no pierde los trabajos pendientes.
+"""
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import traceback
+import uuid
+import zipfile
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from services.data_dirs import IS_LAMBDA, connect_sqlite, data_path
+
+from .results_store import results_file, remove_results
+
+logger = logging.getLogger(__name__)
+
+# Estados de un trabajo
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+FINAL_STATES = (JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED)
+
+# Configuración por defecto (sobrescribible por variables de entorno)
+DEFAULT_JOBS_DIR = data_path("CONCILIATOR_JOBS_DIR", "conciliator", "jobs")
+DEFAULT_MAX_WORKERS = int(os.environ.get("CONCILIATOR_MAX_WORKERS", max(1, min(2, os.cpu_count() or 1))))
+DEFAULT_MAX_ATTEMPTS = int(os.environ.get("CONCILIATOR_JOB_ATTEMPTS", 2))
+DEFAULT_CLIENT_CONCURRENCY = {'OXXO': 1, 'KIOSKO': 1}
+
+# Errores de los archivos de entrada (columnas faltantes, Excel dañado, ...): repetir
+# el trabajo daría el mismo error, así que falla sin reintentos
+NON_RETRYABLE_ERRORS = (ValueError, KeyError, FileNotFoundError, zipfile.BadZipFile)
+
+
+def parse_concurrency_limits(value: Optional[str]) -> Dict[str, int]:
+    """
+    Convierte una cadena 'OXXO=1,KIOSKO=2' en límites de concurrencia por cliente
+
+    Args:
+        value: Cadena con pares CLIENTE=N separados por comas
+
+    Returns:
+        Diccionario cliente → número máximo de trabajos simultáneos
+    """
+    limits = DEFAULT_CLIENT_CONCURRENCY.copy()
+    if not value:
+        return limits
+
+    for pair in value.split(','):
+        if '=' not in pair:
+            continue
+        client, limit = pair.split('=', 1)
+        try:
+            limits[client.strip().upper()] = max(1, int(limit))
+        except ValueError:
+            logger.warning(f"⚠️ Límite de concurrencia inválido ignorado: {pair}")
+
+    return limits
+
+
+class JobStore:
+    """Persistencia de trabajos en SQLite"""
+
+    def __init__(self, db_path: str):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._init_schema()
+
+    def _connect(self) -> sqlite3.Connection:
+        return connect_sqlite(self.db_path)
+
+    def _init_schema(self):
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    session_id TEXT NOT NULL,
+                    client_type TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL DEFAULT 1,
+                    result_path TEXT,
+                    error TEXT,
+                    created_at TEXT NOT NULL,
+                    started_at TEXT,
+                    finished_at TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_session ON jobs (session_id, created_at)")
+
+    @staticmethod
+    def _to_dict(row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        return job
+
+    def enqueue(self, session_id: str, client_type: str, payload: Dict, max_attempts: int) -> Dict[str, Any]:
+        """Agrega un trabajo nuevo en estado 'queued'"""
+        job_id = str(uuid.uuid4())
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (job_id, session_id, client_type, status, payload, max_attempts, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, session_id, client_type, JOB_QUEUED, json.dumps(payload),
+                 max_attempts, datetime.now().isoformat())
+            )
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._to_dict(row)
+
+    def latest_for_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE session_id = ? ORDER BY created_at DESC LIMIT 1",
+                (session_id,)
+            ).fetchone()
+        return self._to_dict(row)
+
+    def list(self, status: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        query = "SELECT * FROM jobs"
+        params: tuple = ()
+        if status:
+            query += " WHERE status = ?"
+            params = (status,)
+        query += " ORDER BY created_at DESC LIMIT ?"
+        with self._connect() as conn:
+            rows = conn.execute(query, params + (limit,)).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def next_queued(self, blocked_clients: List[str]) -> Optional[Dict[str, Any]]:
+        """Obtiene el trabajo en cola más antiguo cuyo cliente no esté en su límite"""
+        query = "SELECT * FROM jobs WHERE status = ?"
+        params = [JOB_QUEUED]
+        if blocked_clients:
+            query += f" AND client_type NOT IN ({', '.join('?' for _ in blocked_clients)})"
+            params.extend(blocked_clients)
+        query += " ORDER BY created_at LIMIT 1"
+        with self._connect() as conn:
+            row = conn.execute(query, params).fetchone()
+        return self._to_dict(row)
+
+    def claim(self, job_id: str, result_path: str) -> bool:
+        """
+        Marca el trabajo como 'running' solo si sigue en cola
+
+        Returns:
+            True si este despachador lo tomó (False: cancelado o tomado por otro)
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, result_path = ?, started_at = ?, error = NULL "
+                "WHERE job_id = ? AND status = ?",
+                (JOB_RUNNING, result_path, datetime.now().isoformat(), job_id, JOB_QUEUED)
+            )
+        return cursor.rowcount > 0
+
+    def mark_finished(self, job_id: str, status: str, error: Optional[str] = None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE job_id = ?",
+                (status, error, datetime.now().isoformat(), job_id)
+            )
+
+    def requeue(self, job_id: str, error: Optional[str] = None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, started_at = NULL WHERE job_id = ?",
+                (JOB_QUEUED, error, job_id)
+            )
+
+    def cancel_if_queued(self, job_id: str) -> bool:
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ? WHERE job_id = ? AND status = ?",
+                (JOB_CANCELLED, datetime.now().isoformat(), job_id, JOB_QUEUED)
+            )
+        return cursor.rowcount > 0
+
+    def requeue_orphans(self) -> int:
+        """Regresa a la cola los trabajos que quedaron 'running' tras una caída del servidor"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, started_at = NULL WHERE status = ?",
+                (JOB_QUEUED, JOB_RUNNING)
+            )
+        return cursor.rowcount
+
+
+def results_base_path(result_path: str) -> str:
+    """Ruta base (sin extensión) del almacén de resultados que acompaña al JSON de un trabajo"""
+    return str(Path(result_path).with_suffix('.results'))
+
+
+def _execute_job(payload: Dict, result_path: str) -> int:
+    """
+    Ejecuta la conciliación y escribe el resultado (o el error) en result_path
+
+    Returns:
+        Código de salida: 0 si terminó bien
+    """
+    tmp_path = f"{result_path}.tmp"
+    exit_code = 0
+    try:
+        from .pipeline import run_conciliation
+        output = {"result": run_conciliation(**payload, results_path=results_base_path(result_path))}
+    except Exception as e:
+        logger.error(f"❌ Error en trabajo de conciliación: {e}")
+        output = {"error": str(e), "traceback": traceback.format_exc(),
+                  "retryable": not isinstance(e, NON_RETRYABLE_ERRORS)}
+        exit_code = 1
+
+    with open(tmp_path, "w") as f:
+        json.dump(output, f, default=str)
+    os.replace(tmp_path, result_path)
+    return exit_code
+
+
+def _run_job(payload: Dict, result_path: str):
+    """
+    Punto de entrada del proceso trabajador.
+    Escribe el resultado (o el error) en result_path y termina con código != 0 si falla.
+    """
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    exit_code = _execute_job(payload, result_path)
+    if exit_code:
+        raise SystemExit(exit_code)
+
+
+JobListener = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class ConciliationJobQueue:
+    """
+    Despachador de trabajos de conciliación.
+    Consulta la cola persistente, lanza cada trabajo en un proceso propio respetando
+    el límite global de trabajadores y el límite por tipo de cliente, reintenta los
+    fallos y notifica a los listeners cuando un trabajo termina.
+
+    Con inline (Lambda) no hay despachador: Lambda congela el contenedor al responder y
+    el proceso trabajador quedaría detenido entre invocaciones, así que quien encola
+    llama a run_inline() y el trabajo corre dentro de la misma petición.
+    """
+
+    def __init__(self, jobs_dir: str = DEFAULT_JOBS_DIR, max_workers: int = DEFAULT_MAX_WORKERS,
+                 client_concurrency: Optional[Dict[str, int]] = None,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS, poll_interval: float = 0.5,
+                 inline: bool = IS_LAMBDA):
+        self.jobs_dir = Path(jobs_dir)
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+        self.store = JobStore(str(self.jobs_dir / "jobs.db"))
+        self.max_workers = max(1, max_workers)
+        self.client_concurrency = client_concurrency or DEFAULT_CLIENT_CONCURRENCY.copy()
+        self.max_attempts = max(1, max_attempts)
+        self.poll_interval = poll_interval
+        self.inline = inline
+
+        self._context = multiprocessing.get_context("spawn")
+        self._running: Dict[str, Dict[str, Any]] = {}
+        self._listeners: List[JobListener] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def add_listener(self, listener: JobListener):
+        """Registra una corrutina que se llamará con el trabajo al terminar"""
+        self._listeners.append(listener)
+
+    async def start(self):
+        """Arranca el despachador (llamar en el evento startup de la app)"""
+        if self._task is not None or self.inline:
+            return
+        orphans = self.store.requeue_orphans()
+        if orphans:
+            logger.warning(f"🔄 {orphans} trabajos interrumpidos regresados a la cola")
+        self._task = asyncio.create_task(self._dispatch_loop())
+        logger.info(f"✅ Cola de conciliación iniciada ({self.max_workers} trabajadores, límites {self.client_concurrency})")
+
+    async def stop(self):
+        """Detiene el despachador; los trabajos en curso vuelven a la cola"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        for job_id, entry in list(self._running.items()):
+            entry['process'].terminate()
+            entry['process'].join(timeout=5)
+            self.store.requeue(job_id, error="Servidor detenido durante la ejecución")
+        self._running.clear()
+
+    def submit(self, session_id: str, client_type: str, payload: Dict) -> Dict[str, Any]:
+        """Encola un trabajo y devuelve su registro"""
+        job = self.store.enqueue(session_id, client_type.upper(), payload, self.max_attempts)
+        logger.info(f"📥 Trabajo {job['job_id']} encolado para sesión {session_id} ({client_type})")
+        return job
+
+    async def run_inline(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Ejecuta un trabajo encolado dentro de la petición actual (en un hilo), con sus reintentos
+
+        Returns:
+            El registro del trabajo ya terminado
+        """
+        job_id = job['job_id']
+        result_path = str(self.jobs_dir / f"{job_id}.json")
+        while self._claim(job_id, result_path):
+            logger.info(f"🚀 Trabajo {job_id} iniciado en la petición")
+            exit_code = await asyncio.to_thread(_execute_job, job['payload'], result_path)
+            if await self._finish(job_id, result_path, exit_code):
+                break
+        return self.store.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self.store.get(job_id)
+
+    def latest_for_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        return self.store.latest_for_session(session_id)
+
+    def list(self, status: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        return self.store.list(status, limit)
+
+    async def cancel(self, job_id: str) -> bool:
+        """
+        Cancela un trabajo en cola o en ejecución
+
+        Returns:
+            True si el trabajo quedó cancelado
+        """
+        if self.store.cancel_if_queued(job_id):
+            logger.info(f"🛑 Trabajo {job_id} cancelado antes de iniciar")
+            await self._notify(self.store.get(job_id))
+            return True
+
+        entry = self._running.pop(job_id, None)
+        if entry is None:
+            return False
+
+        entry['process'].terminate()
+        entry['process'].join(timeout=5)
+        self.store.mark_finished(job_id, JOB_CANCELLED, error="Cancelado por el usuario")
+        logger.info(f"🛑 Trabajo {job_id} cancelado durante la ejecución")
+        await self._notify(self.store.get(job_id))
+        return True
+
+    def results_file(self, job: Dict[str, Any]) -> Optional[str]:
+        """Archivo del almacén de resultados de un trabajo completado (None si no existe)"""
+        result_path = job.get('result_path')
+        if job.get('status') != JOB_COMPLETED or not result_path:
+            return None
+        return results_file(results_base_path(result_path))
+
+    def load_result(self, job: Dict[str, Any]) -> Optional[Dict]:
+        """Lee el resultado de un trabajo completado"""
+        result_path = job.get('result_path')
+        if job.get('status') != JOB_COMPLETED or not result_path or not Path(result_path).exists():
+            return None
+        with open(result_path, "r") as f:
+            return json.load(f).get('result')
+
+    async def _dispatch_loop(self):
+        while True:
+            try:
+                await self._reap_finished()
+                self._launch_pending()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Error en despachador de conciliación: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    def _launch_pending(self):
+        # Cada trabajo se toma con claim(): dos despachadores sobre la misma base no lanzan el mismo trabajo.
+        # requeue_orphans() al arrancar sí supone un solo despachador por base (un proceso de la API).
+        while len(self._running) < self.max_workers:
+            running_by_client: Dict[str, int] = {}
+            for entry in self._running.values():
+                client = entry['client_type']
+                running_by_client[client] = running_by_client.get(client, 0) + 1
+
+            blocked = [client for client, count in running_by_client.items()
+                       if count >= self.client_concurrency.get(client, 1)]
+            job = self.store.next_queued(blocked)
+            if job is None:
+                return
+
+            result_path = str(self.jobs_dir / f"{job['job_id']}.json")
+            if not self._claim(job['job_id'], result_path):
+                continue
+
+            process = self._context.Process(
+                target=_run_job,
+                args=(job['payload'], result_path),
+                name=f"conciliation-{job['job_id'][:8]}",
+                daemon=True
+            )
+            process.start()
+            self._running[job['job_id']] = {
+                'process': process,
+                'client_type': job['client_type'],
+                'result_path': result_path
+            }
+            logger.info(f"🚀 Trabajo {job['job_id']} iniciado (pid {process.pid}, intento {job['attempts'] + 1})")
+
+    def _claim(self, job_id: str, result_path: str) -> bool:
+        """Toma el trabajo y borra lo que haya dejado un intento anterior"""
+        if not self.store.claim(job_id, result_path):
+            return False
+        if os.path.exists(result_path):
+            os.remove(result_path)
+        remove_results(results_base_path(result_path))
+        return True
+
+    async def _reap_finished(self):
+        for job_id, entry in list(self._running.items()):
+            process = entry['process']
+            if process.is_alive():
+                continue
+
+            process.join()
+            del self._running[job_id]
+            await self._finish(job_id, entry['result_path'], process.exitcode)
+
+    async def _finish(self, job_id: str, result_path: str, exitcode: Optional[int]) -> bool:
+        """
+        Registra cómo terminó un intento: completado, reintento o fallo definitivo
+
+        Returns:
+            False si el trabajo volvió a la cola
+        """
+        if exitcode == 0 and Path(result_path).exists():
+            self.store.mark_finished(job_id, JOB_COMPLETED)
+            logger.info(f"✅ Trabajo {job_id} completado")
+        else:
+            error, retryable = self._read_error(result_path, exitcode)
+            job = self.store.get(job_id)
+            if retryable and job['attempts'] < job['max_attempts']:
+                self.store.requeue(job_id, error=error)
+                logger.warning(f"🔄 Trabajo {job_id} falló (intento {job['attempts']}), reintentando: {error}")
+                return False
+            self.store.mark_finished(job_id, JOB_FAILED, error=error)
+            logger.error(f"❌ Trabajo {job_id} falló definitivamente: {error}")
+
+        await self._notify(self.store.get(job_id))
+        return True
+
+    @staticmethod
+    def _read_error(result_path: str, exitcode: Optional[int]):
+        """
+        Returns:
+            tuple: (mensaje de error, si vale la pena reintentar)
+        """
+        # Sin JSON el proceso murió (memoria, señal): otro intento puede funcionar
+        try:
+            with open(result_path, "r") as f:
+                output = json.load(f)
+        except Exception:
+            return f"Proceso terminó con código {exitcode}", True
+        return (output.get('error') or f"Proceso terminó con código {exitcode}",
+                output.get('retryable', True))
+
+    async def _notify(self, job: Optional[Dict[str, Any]]):
+        if job is None:
+            return
+        for listener in self._listeners:
+            try:
+                await listener(job)
+            except Exception as e:
+                logger.error(f"❌ Error notificando fin de trabajo {job['job_id']}: {e}")
@@ -0,0 +1,227 @@
+"""
+Ledger persistente de conciliaciones por cliente
+Guarda, por ID, el hash del contenido de sus filas en cada lado y el resultado de la
+última conciliación. Una corrida nueva (p. ej. la semanal con el acumulado del mes)
+conserva el resultado de los IDs que no cambiaron y solo hace matching del delta.
+"""
+
+import logging
+import os
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from services.data_dirs import connect_sqlite, data_path
+
+from .results_store import build_results_frame, id_to_text
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEDGER_PATH = data_path("CONCILIATOR_LEDGER_PATH", "conciliator", "ledger.db")
+DEFAULT_INCREMENTAL = os.environ.get("CONCILIATOR_INCREMENTAL", "1") == "1"
+
+# Columnas que determinan el resultado de un ID
+HASH_COLUMNS = ('id_matching', 'total_venta')
+
+# Contexto que también se conserva (la sucursal): si está en los datos entra al hash, así un ID
+# corto repetido en otra tienda (folios KIOSKO de 4 dígitos) no hereda la sucursal anterior
+CONTEXT_COLUMNS = ('sucursal', 'Sucursal', 'tienda', 'Tienda')
+
+# Resultado que se conserva por ID (la categoría se recalcula con las tolerancias vigentes)
+OUTCOME_COLUMNS = (
+    'match_type', 'match_confidence', 'valor_source_clean', 'valor_looker_clean',
+    'diferencia_valor', 'diferencia_absoluta', 'diferencia_porcentaje', 'sucursal',
+)
+
+# Solo los matches exactos dependen únicamente de las filas de su propio ID
+CARRY_MATCH_TYPES = ('EXACT',)
+
+# Constante de mezcla para que el hash dependa del orden de las filas dentro del ID
+_POSITION_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+def id_content_hashes(df: pd.DataFrame) -> pd.Series:
+    """
+    Hash del contenido de cada ID (todas sus filas, en orden)
+
+    Args:
+        df: Datos preparados para matching (id_matching, total_venta y, si están, CONTEXT_COLUMNS)
+
+    Returns:
+        Serie int64 indexada por id_matching (con su tipo original)
+    """
+    if df is None or len(df) == 0:
+        return pd.Series(dtype='int64')
+
+    hashed = df[list(HASH_COLUMNS)]
+    context = [column for column in CONTEXT_COLUMNS if column in df.columns]
+    if context:
+        # Como texto: el mismo valor da el mismo hash sin importar el dtype (categoría, objeto)
+        hashed = hashed.assign(**{column: df[column].astype(str) for column in context})
+    row_hash = pd.util.hash_pandas_object(hashed, index=False).to_numpy()
+    codes, uniques = pd.factorize(df['id_matching'])
+
+    # Posición de cada fila dentro de su ID (el agrupado/drop_duplicates depende del orden)
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    position = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+
+    with np.errstate(over='ignore'):
+        mixed = row_hash[order] * ((position.astype(np.uint64) + np.uint64(1)) * _POSITION_MIX)
+        sums = np.add.reduceat(mixed, starts)
+
+    return pd.Series(sums.view(np.int64), index=uniques[sorted_codes[starts]])
+
+
+def _keyed_hashes(hashes: pd.Series, name: str) -> pd.DataFrame:
+    return pd.DataFrame({
+        'key': [id_to_text(value) for value in hashes.index],
+        'id_matching': hashes.index,
+        name: hashes.to_numpy(),
+    })
+
+
+class ReconciliationLedger:
+    """Ledger en SQLite"""
+
+    def __init__(self, db_path: str = DEFAULT_LEDGER_PATH):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._init_schema()
+
+    def _connect(self) -> sqlite3.Connection:
+        return connect_sqlite(self.db_path)
+
+    def _init_schema(self):
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS ledger (
+                    client_type TEXT NOT NULL,
+                    id_key TEXT NOT NULL,
+                    source_hash INTEGER,
+                    looker_hash INTEGER,
+                    match_type TEXT,
+                    match_confidence REAL,
+                    valor_source_clean REAL,
+                    valor_looker_clean REAL,
+                    diferencia_valor REAL,
+                    diferencia_absoluta REAL,
+                    diferencia_porcentaje REAL,
+                    sucursal TEXT,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (client_type, id_key)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_ledger_match ON ledger (client_type, match_type)")
+
+    def carry_forward(self, client_type: str, source_hashes: pd.Series, looker_hashes: pd.Series) -> pd.DataFrame:
+        """
+        Resultados previos de los IDs que no cambiaron en ninguno de los dos lados
+
+        Args:
+            client_type: Tipo de cliente
+            source_hashes: Hashes por ID del cliente (id_content_hashes)
+            looker_hashes: Hashes por ID de Looker
+
+        Returns:
+            DataFrame con id_matching (tipo original) y OUTCOME_COLUMNS
+        """
+        empty = pd.DataFrame(columns=['id_matching', *OUTCOME_COLUMNS])
+        if len(source_hashes) == 0 or len(looker_hashes) == 0:
+            return empty
+
+        current = _keyed_hashes(source_hashes, 'source_hash').merge(
+            _keyed_hashes(looker_hashes, 'looker_hash').drop(columns='id_matching'), on='key'
+        )
+        if len(current) == 0:
+            return empty
+
+        placeholders = ', '.join('?' for _ in CARRY_MATCH_TYPES)
+        with self._connect() as conn:
+            prior = pd.read_sql_query(
+                f"SELECT id_key AS key, source_hash, looker_hash, {', '.join(OUTCOME_COLUMNS)} "
+                f"FROM ledger WHERE client_type = ? AND match_type IN ({placeholders})",
+                conn, params=(client_type.upper(), *CARRY_MATCH_TYPES)
+            )
+        prior = prior.dropna(subset=['source_hash', 'looker_hash'])
+        if len(prior) == 0:
+            return empty
+        prior[['source_hash', 'looker_hash']] = prior[['source_hash', 'looker_hash']].astype('int64')
+
+        carried = current.merge(prior, on=['key', 'source_hash', 'looker_hash'])
+        return carried[['id_matching', *OUTCOME_COLUMNS]]
+
+    def record(self, client_type: str, results: pd.DataFrame,
+               source_hashes: pd.Series, looker_hashes: pd.Series) -> int:
+        """
+        Guarda (o reemplaza) el resultado de los IDs conciliados en esta corrida
+
+        Args:
+            client_type: Tipo de cliente
+            results: Resultados del matching (antes o después de categorizar)
+            source_hashes: Hashes por ID del cliente
+            looker_hashes: Hashes por ID de Looker
+
+        Returns:
+            Número de IDs guardados
+        """
+        if results is None or len(results) == 0:
+            return 0
+
+        frame = build_results_frame(results, client_type).drop_duplicates('id_matching')
+        frame = frame.reindex(columns=['id_matching', *OUTCOME_COLUMNS])
+
+        source_by_key = {id_to_text(key): value for key, value in source_hashes.items()}
+        looker_by_key = {id_to_text(key): value for key, value in looker_hashes.items()}
+
+        values = frame.astype(object).where(frame.notna(), None)
+        updated_at = datetime.now().isoformat()
+        rows = [
+            (
+                client_type.upper(), key,
+                _to_int(source_by_key.get(key)), _to_int(looker_by_key.get(key)),
+                *outcome, updated_at
+            )
+            for key, *outcome in values.itertuples(index=False, name=None)
+        ]
+
+        columns = ', '.join(OUTCOME_COLUMNS)
+        placeholders = ', '.join('?' for _ in range(len(OUTCOME_COLUMNS) + 5))
+        with self._connect() as conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO ledger (client_type, id_key, source_hash, looker_hash, {columns}, updated_at) "
+                f"VALUES ({placeholders})",
+                rows
+            )
+
+        logger.info(f"📒 Ledger {client_type}: {len(rows)} IDs actualizados")
+        return len(rows)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """Resumen del ledger por cliente"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT client_type, COUNT(*) AS ids, "
+                "SUM(CASE WHEN match_type = 'EXACT' THEN 1 ELSE 0 END) AS exact_ids, "
+                "MAX(updated_at) AS updated_at "
+                "FROM ledger GROUP BY client_type ORDER BY client_type"
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def clear(self, client_type: Optional[str] = None) -> int:
+        """Vacía el ledger de un cliente (o completo), p. ej. al iniciar un mes nuevo"""
+        with self._connect() as conn:
+            if client_type:
+                cursor = conn.execute("DELETE FROM ledger WHERE client_type = ?", (client_type.upper(),))
+            else:
+                cursor = conn.execute("DELETE FROM ledger")
+        return cursor.rowcount
+
+
+def _to_int(value) -> Optional[int]:
+    return None if value is None else int(value)
@@ -0,0 +1,245 @@
+"""
+Instrumentación por etapa del conciliador
+Cronómetros (context managers) y contadores que registran tiempo real, filas de
+entrada/salida y cambio de memoria del proceso en cada etapa: lectura de Excel,
+limpieza, agrupación, matching exacto/fuzzy, categorización y reportes.
+Las corridas se guardan en SQLite para detectar regresiones cuando crecen los archivos.
+"""
+
+import logging
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from services.data_dirs import connect_sqlite, data_path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METRICS_PATH = data_path("CONCILIATOR_METRICS_PATH", "conciliator", "metrics.db")
+
+# Corridas que se consideran al resumir por etapa
+DEFAULT_SUMMARY_RUNS = 50
+
+BYTES_PER_MB = 1024 * 1024
+
+try:
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = 4096
+
+
+def _rss_mb() -> Optional[float]:
+    """Memoria residente actual del proceso en MB (None si el sistema no la expone)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE / BYTES_PER_MB
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _rows(value) -> Optional[int]:
+    """Filas de un DataFrame (o el número recibido)"""
+    if value is None:
+        return None
+    if isinstance(value, int):
+        return value
+    return len(value)
+
+
+class StageRecord:
+    """Medición de una etapa; se obtiene de PipelineMetrics.stage()"""
+
+    def __init__(self, name: str, rows_in=None):
+        self.name = name
+        self.rows_in = _rows(rows_in)
+        self.rows_out: Optional[int] = None
+        self.wall_ms = 0.0
+        self.memory_delta_mb: Optional[float] = None
+
+    def output(self, rows_out) -> Any:
+        """Registra las filas de salida y devuelve el valor recibido (para encadenar)"""
+        self.rows_out = _rows(rows_out)
+        return rows_out
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'stage': self.name,
+            'wall_ms': round(self.wall_ms, 2),
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'memory_delta_mb': None if self.memory_delta_mb is None else round(self.memory_delta_mb, 2),
+        }
+
+
+class PipelineMetrics:
+    """
+    Métricas de una corrida del conciliador
+
+    Uso:
+        with metrics.stage('leer_excel_looker') as stage:
+            df = pd.read_excel(path)
+            stage.output(df)
+    """
+
+    def __init__(self, label: str = ''):
+        self.label = label
+        self.stages: List[StageRecord] = []
+        self.counters: Dict[str, int] = {}
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str, rows_in=None) -> Iterator[StageRecord]:
+        """Mide el bloque: tiempo real, filas y cambio de memoria residente"""
+        record = StageRecord(name, rows_in)
+        rss_before = _rss_mb()
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.wall_ms = (time.perf_counter() - started) * 1000
+            rss_after = _rss_mb()
+            if rss_before is not None and rss_after is not None:
+                record.memory_delta_mb = rss_after - rss_before
+            self.stages.append(record)
+            prefix = f"{self.label} " if self.label else ''
+            rows = f" ({record.rows_in} → {record.rows_out} filas)" if record.rows_in is not None or record.rows_out is not None else ''
+            logger.info(f"   ⏱️ {prefix}{name}: {record.wall_ms:,.1f} ms{rows}")
+
+    def count(self, counter: str, value: int = 1):
+        """Incrementa un contador de la corrida"""
+        self.counters[counter] = self.counters.get(counter, 0) + int(value)
+
+    def stage_ms(self, name: str) -> float:
+        """Tiempo acumulado de las etapas con ese nombre"""
+        return sum(record.wall_ms for record in self.stages if record.name == name)
+
+    @property
+    def elapsed_seconds(self) -> float:
+        return time.perf_counter() - self._started
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'total_ms': round(self.elapsed_seconds * 1000, 2),
+            'stages': [record.to_dict() for record in self.stages],
+            'counters': dict(self.counters),
+        }
+
+
+class MetricsStore:
+    """Historial de métricas por etapa en SQLite"""
+
+    def __init__(self, db_path: str = DEFAULT_METRICS_PATH):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._init_schema()
+
+    def _connect(self) -> sqlite3.Connection:
+        return connect_sqlite(self.db_path)
+
+    def _init_schema(self):
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS stage_metrics (
+                    session_id TEXT NOT NULL,
+                    client_type TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    wall_ms REAL NOT NULL,
+                    rows_in INTEGER,
+                    rows_out INTEGER,
+                    memory_delta_mb REAL,
+                    recorded_at TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_metrics_client ON stage_metrics (client_type, recorded_at)")
+
+    def record_run(self, session_id: str, client_type: str, metrics: Dict[str, Any]):
+        """Guarda las etapas de una corrida (el dict de PipelineMetrics.to_dict())"""
+        recorded_at = datetime.now().isoformat()
+        stages = [{'stage': 'total', 'wall_ms': metrics.get('total_ms', 0)}] + list(metrics.get('stages', []))
+        rows = [
+            (session_id, client_type.upper(), stage['stage'], position, stage['wall_ms'],
+             stage.get('rows_in'), stage.get('rows_out'), stage.get('memory_delta_mb'), recorded_at)
+            for position, stage in enumerate(stages)
+        ]
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO stage_metrics (session_id, client_type, stage, position, wall_ms, "
+                "rows_in, rows_out, memory_delta_mb, recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+
+    def summary(self, client_type: Optional[str] = None, runs: int = DEFAULT_SUMMARY_RUNS) -> List[Dict[str, Any]]:
+        """
+        Resumen por cliente y etapa de las últimas corridas
+
+        Args:
+            client_type: Filtrar por cliente (None = todos)
+            runs: Número de corridas recientes a considerar por cliente
+
+        Returns:
+            Lista con corridas, tiempo promedio/máximo, filas (de entrada o, si no hay, de salida)
+            y ms por cada 1,000 filas
+        """
+        query = """
+            WITH recent AS (
+                SELECT client_type, recorded_at,
+                       ROW_NUMBER() OVER (PARTITION BY client_type ORDER BY recorded_at DESC) AS run_rank
+                FROM stage_metrics WHERE stage = 'total'
+                {where}
+            )
+            SELECT m.client_type, m.stage, MIN(m.position) AS position,
+                   COUNT(*) AS runs,
+                   AVG(m.wall_ms) AS avg_ms,
+                   MAX(m.wall_ms) AS max_ms,
+                   AVG(COALESCE(m.rows_in, m.rows_out)) AS avg_rows,
+                   AVG(m.memory_delta_mb) AS avg_memory_delta_mb,
+                   SUM(m.wall_ms) * 1000.0 / NULLIF(SUM(COALESCE(m.rows_in, m.rows_out)), 0) AS ms_per_1k_rows
+            FROM stage_metrics m
+            JOIN recent r ON r.client_type = m.client_type AND r.recorded_at = m.recorded_at
+            WHERE r.run_rank <= ?
+            GROUP BY m.client_type, m.stage
+            ORDER BY m.client_type, position
+        """
+        params: tuple = (runs,)
+        where = ''
+        if client_type:
+            where = "AND client_type = ?"
+            params = (client_type.upper(), runs)
+
+        with self._connect() as conn:
+            rows = conn.execute(query.format(where=where), params).fetchall()
+
+        summary = []
+        for row in rows:
+            item = dict(row)
+            item.pop('position')
+            for key in ('avg_ms', 'max_ms', 'avg_rows', 'avg_memory_delta_mb', 'ms_per_1k_rows'):
+                if item[key] is not None:
+                    item[key] = round(item[key], 2)
+            summary.append(item)
+        return summary
+
+    def recent(self, client_type: Optional[str] = None, limit: int = 20) -> List[Dict[str, Any]]:
+        """Últimas corridas con el detalle de sus etapas"""
+        query = "SELECT DISTINCT session_id, client_type, recorded_at FROM stage_metrics"
+        params: tuple = ()
+        if client_type:
+            query += " WHERE client_type = ?"
+            params = (client_type.upper(),)
+        query += " ORDER BY recorded_at DESC LIMIT ?"
+
+        with self._connect() as conn:
+            runs = [dict(row) for row in conn.execute(query, params + (limit,)).fetchall()]
+            for run in runs:
+                stages = conn.execute(
+                    "SELECT stage, wall_ms, rows_in, rows_out, memory_delta_mb FROM stage_metrics "
+                    "WHERE session_id = ? AND recorded_at = ? ORDER BY position",
+                    (run['session_id'], run['recorded_at'])
+                ).fetchall()
+                run['stages'] = [dict(stage) for stage in stages]
+        return runs
@@ -0,0 +1,257 @@
+"""
+Pipeline de conciliación ejecutable fuera del proceso web
+Contiene la lógica que antes vivía en process_conciliation_background de main.py
+"""
+
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Importar dependencias del conciliador
+try:
+    import pandas as pd
+    PANDAS_AVAILABLE = True
+    try:
+        from .processors.factory import ProcessorFactory
+        from .reconciler import Reconciler
+        from .whatif import summary_for_frontend
+        from .results_store import save_results, build_results_frame, records_to_json, DEFAULT_PAGE_SIZE
+        from .ledger import ReconciliationLedger, DEFAULT_INCREMENTAL
+        from .metrics import PipelineMetrics, MetricsStore
+        REAL_CONCILIATOR = True
+    except ImportError as e:
+        logger.warning(f"⚠️ Sistema básico de conciliación: {e}")
+        REAL_CONCILIATOR = False
+except ImportError:
+    PANDAS_AVAILABLE = False
+    REAL_CONCILIATOR = False
+
+
+def run_conciliation(session_id: str, client_type: str, source_file: str, looker_file: str,
+                     results_path: Optional[str] = None, incremental: Optional[bool] = None) -> Dict:
+    """
+    Ejecuta la conciliación completa de una sesión y devuelve el resultado
+    en el formato que espera el frontend.
+
+    Args:
+        session_id: ID de la sesión de conciliación
+        client_type: Tipo de cliente ('OXXO', 'KIOSKO')
+        source_file: Ruta al archivo del cliente
+        looker_file: Ruta al archivo de Looker
+        results_path: Ruta base (sin extensión) del almacén de resultados (opcional)
+        incremental: Conciliar solo el delta contra el ledger (None = CONCILIATOR_INCREMENTAL)
+
+    Returns:
+        Diccionario serializable a JSON con resumen y registros
+    """
+    logger.info(f"📄 Procesando archivos reales:")
+    logger.info(f"   Source: {source_file}")
+    logger.info(f"   Looker: {looker_file}")
+
+    if REAL_CONCILIATOR and PANDAS_AVAILABLE:
+        return _run_real_conciliation(session_id, client_type, source_file, looker_file, results_path, incremental)
+    elif PANDAS_AVAILABLE:
+        return _run_basic_conciliation(session_id, source_file, looker_file)
+    else:
+        raise Exception("Pandas no está disponible para procesar archivos Excel/CSV")
+
+
+def _run_real_conciliation(session_id: str, client_type: str, source_file: str, looker_file: str,
+                           results_path: Optional[str] = None, incremental: Optional[bool] = None) -> Dict:
+    """Conciliación usando los procesadores y el Reconciler del sistema"""
+    logger.info(f"🚀 Usando sistema real de conciliación")
+
+    # Todas las etapas (procesador, reconciler, almacén) se registran en las mismas métricas
+    metrics = PipelineMetrics(client_type.upper())
+
+    # Crear procesador
+    processor = ProcessorFactory.create_processor(client_type, metrics=metrics)
+    source_data, looker_data = processor.process_files(source_file, looker_file)
+
+    logger.info(f"📈 Datos leídos - Source: {len(source_data)} filas, Looker: {len(looker_data)} filas")
+
+    # Crear reconciliador
+    reconciler = Reconciler(client_type, metrics=metrics)
+    if incremental is None:
+        incremental = DEFAULT_INCREMENTAL
+    if incremental:
+        # Solo se hace matching de los IDs nuevos o modificados desde corridas anteriores
+        reconciliation_results = reconciler.reconcile_incremental(source_data, looker_data, ReconciliationLedger())
+    else:
+        reconciliation_results = reconciler.reconcile(source_data, looker_data)
+    summary_stats = reconciler.get_summary_stats()
+
+    logger.info(f"📉 Conciliación completada - {summary_stats.get('total_records', 0)} registros")
+
+    # Guardar el resultado completo en el almacén columnar: se consulta por páginas
+    # y se recategoriza con otras tolerancias sin repetir el matching
+    results_stored = False
+    if results_path and len(reconciliation_results) > 0:
+        with metrics.stage('guardar_resultados', rows_in=reconciliation_results):
+            save_results(reconciliation_results, results_path, reconciler.client_type, attrs={
+                'tolerance_percentage': reconciler.config['tolerance_percentage'],
+                'tolerance_absolute': reconciler.config['tolerance_absolute'],
+            })
+        results_stored = True
+
+    # Primera página para el frontend (conversión vectorizada solo de esa página)
+    records = []
+    if len(reconciliation_results) > 0:
+        with metrics.stage('primera_pagina', rows_in=reconciliation_results) as stage:
+            records = stage.output(records_to_json(
+                build_results_frame(reconciliation_results, client_type).head(DEFAULT_PAGE_SIZE)
+            ))
+
+    run_metrics = metrics.to_dict()
+    _store_metrics(session_id, client_type, run_metrics)
+
+    # Usar estadísticas reales - convertir a tipos nativos de Python
+    return {
+        "session_id": session_id,
+        "success": True,
+        "summary": summary_for_frontend(summary_stats, client_type),
+        "records": records,  # El resto se consulta en /results/{session_id}/records
+        "reports_generated": [],
+        "processing_time": round(metrics.elapsed_seconds, 3),
+        "metrics": run_metrics,
+        "memory_mb": reconciler.memory_report.to_dict(),
+        "results_stored": results_stored,
+        "incremental": reconciler.incremental_stats,
+        "timestamp": datetime.now().isoformat()
+    }
+
+
+def _store_metrics(session_id: str, client_type: str, run_metrics: Dict):
+    """Guarda las métricas de la corrida en el historial; un fallo aquí no afecta la conciliación"""
+    try:
+        MetricsStore().record_run(session_id, client_type, run_metrics)
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudieron guardar las métricas de la corrida: {e}")
+
+
+def _run_basic_conciliation(session_id: str, source_file: str, looker_file: str) -> Dict:
+    """Conciliación básica con pandas cuando el sistema real no está disponible"""
+    logger.info(f"🔄 Usando procesamiento básico con pandas")
+    started = time.perf_counter()
+
+    # Leer archivos
+    if source_file.endswith('.csv'):
+        source_data = pd.read_csv(source_file)
+    else:
+        source_data = pd.read_excel(source_file)
+
+    if looker_file.endswith('.csv'):
+        looker_data = pd.read_csv(looker_file)
+    else:
+        looker_data = pd.read_excel(looker_file)
+
+    logger.info(f"📈 Archivos leídos - Source: {len(source_data)} filas, Looker: {len(looker_data)} filas")
+
+    # Procesamiento básico de conciliación
+    # Buscar columnas de ID y valor
+    source_id_col = None
+    source_val_col = None
+    looker_id_col = None
+    looker_val_col = None
+
+    # Detectar columnas en archivo source
+    for col in source_data.columns:
+        col_lower = col.lower()
+        if any(x in col_lower for x in ['id', 'folio', 'ticket', 'transaccion']) and source_id_col is None:
+            source_id_col = col
+        if any(x in col_lower for x in ['total', 'importe', 'valor', 'amount', 'monto']) and source_val_col is None:
+            source_val_col = col
+
+    # Detectar columnas en archivo looker
+    for col in looker_data.columns:
+        col_lower = col.lower()
+        if any(x in col_lower for x in ['id', 'folio', 'ticket', 'transaccion']) and looker_id_col is None:
+            looker_id_col = col
+        if any(x in col_lower for x in ['total', 'importe', 'valor', 'amount', 'monto']) and looker_val_col is None:
+            looker_val_col = col
+
+    logger.info(f"🔍 Columnas detectadas:")
+    logger.info(f"   Source ID: {source_id_col}, Valor: {source_val_col}")
+    logger.info(f"   Looker ID: {looker_id_col}, Valor: {looker_val_col}")
+
+    if not (source_id_col and source_val_col and looker_id_col and looker_val_col):
+        raise Exception("No se pudieron detectar las columnas necesarias en los archivos")
+
+    # Realizar merge
+    merged = pd.merge(
+        source_data[[source_id_col, source_val_col]].rename(columns={source_id_col: 'id', source_val_col: 'source_value'}),
+        looker_data[[looker_id_col, looker_val_col]].rename(columns={looker_id_col: 'id', looker_val_col: 'looker_value'}),
+        on='id',
+        how='outer'
+    )
+
+    # Limpiar valores
+    merged['source_value'] = pd.to_numeric(merged['source_value'], errors='coerce').fillna(0)
+    merged['looker_value'] = pd.to_numeric(merged['looker_value'], errors='coerce').fillna(0)
+    merged['difference'] = merged['source_value'] - merged['looker_value']
+
+    # Categorizar
+    def categorize(row):
+        if pd.isna(row['source_value']) or row['source_value'] == 0:
+            return 'MISSING_IN_SOURCE'
+        elif pd.isna(row['looker_value']) or row['looker_value'] == 0:
+            return 'MISSING_IN_LOOKER'
+        elif abs(row['difference']) == 0:
+            return 'EXACT_MATCH'
+        elif abs(row['difference']) <= 50:  # Tolerancia
+            return 'WITHIN_TOLERANCE'
+        else:
+            return 'MAJOR_DIFFERENCE'
+
+    merged['status'] = merged.apply(categorize, axis=1)
+
+    # Crear registros
+    records = []
+    for _, row in merged.iterrows():
+        records.append({
+            "id": str(row['id']),
+            "client_value": float(row['source_value']),
+            "looker_value": float(row['looker_value']),
+            "difference": float(row['difference']),
+            "status": row['status'],
+            "category": {
+                'EXACT_MATCH': 'Conciliado',
+                'WITHIN_TOLERANCE': 'Tolerancia',
+                'MAJOR_DIFFERENCE': 'Diferencia',
+                'MINOR_DIFFERENCE': 'Diferencia',
+                'MISSING_IN_SOURCE': 'Faltante',
+                'MISSING_IN_LOOKER': 'Faltante',
+                'MISSING_IN_OXXO': 'Faltante',
+                'MISSING_IN_KIOSKO': 'Faltante'
+            }.get(row['status'], 'Sin clasificar')
+        })
+
+    # Calcular estadísticas
+    total_records = len(merged)
+    exact_matches = len(merged[merged['status'] == 'EXACT_MATCH'])
+    within_tolerance = len(merged[merged['status'] == 'WITHIN_TOLERANCE'])
+    major_differences = len(merged[merged['status'] == 'MAJOR_DIFFERENCE'])
+    missing_records = len(merged[merged['status'].str.contains('MISSING')])
+
+    return {
+        "session_id": session_id,
+        "success": True,
+        "summary": {
+            "total_records": total_records,
+            "exact_matches": exact_matches,
+            "within_tolerance": within_tolerance,
+            "major_differences": major_differences,
+            "missing_records": missing_records,
+            "reconciliation_rate": ((exact_matches + within_tolerance) / total_records * 100) if total_records > 0 else 0,
+            "total_client_amount": float(merged['source_value'].sum()),
+            "total_looker_amount": float(merged['looker_value'].sum()),
+            "total_difference": float(merged['difference'].sum())
+        },
+        "records": records[:50],  # Limitar para el frontend
+        "reports_generated": [],
+        "processing_time": round(time.perf_counter() - started, 3),
+        "timestamp": datetime.now().isoformat()
+    }
@@ -6,10 +6,14 @@ ENFOQUE SIMPLIFICADO que resuelve los problemas de matching
 
 import pandas as pd
 import numpy as np
-import re
 from typing import Dict, List, Tuple, Optional
 import logging
 
+try:
+    from .matching_ids import last_4_digits, normalize_matching_ids
+except ImportError:
+    from matching_ids import last_4_digits, normalize_matching_ids
+
 logger = logging.getLogger(__name__)
 
 def extract_last_4_digits(value) -> Optional[str]:
@@ -22,19 +26,7 @@ def extract_last_4_digits(value) -> Optional[str]:
     Returns:
         String con los últimos 4 dígitos o None si no es válido
     """
-    if pd.isna(value) or value == '':
-        return None
-    
-    # Convertir a string y extraer solo números
-    value_str = str(value).strip()
-    digits_only = re.sub(r'[^0-9]', '', value_str)
-    
-    # Verificar que tenga al menos 4 dígitos
-    if len(digits_only) < 4:
-        return None
-    
-    # Retornar últimos 4 dígitos
-    return digits_only[-4:]
+    return last_4_digits(value)
 
 def process_kiosko_simple(df: pd.DataFrame, ticket_column: str, value_column: str) -> pd.DataFrame:
     """
@@ -66,7 +58,7 @@ def process_kiosko_simple(df: pd.DataFrame, ticket_column: str, value_column: st
         return pd.DataFrame()
     
     # APLICAR FUNCIÓN SIMPLE: Extraer últimos 4 dígitos
-    df_clean['matching_id'] = df_clean[ticket_column].apply(extract_last_4_digits)
+    df_clean['matching_id'] = normalize_matching_ids(df_clean[ticket_column])
     df_clean['original_ticket'] = df_clean[ticket_column]
     
     # Filtrar solo los que tienen matching_id válido
@@ -126,7 +118,7 @@ def process_looker_simple(df: pd.DataFrame, folio_column: str, value_column: str
         return pd.DataFrame()
     
     # APLICAR FUNCIÓN SIMPLE: Extraer últimos 4 dígitos
-    df_clean['matching_id'] = df_clean[folio_column].apply(extract_last_4_digits)
+    df_clean['matching_id'] = normalize_matching_ids(df_clean[folio_column])
     df_clean['original_folio'] = df_clean[folio_column]
     
     # Filtrar solo los que tienen matching_id válido
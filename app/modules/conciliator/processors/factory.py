@@ -11,6 +11,8 @@ from typing import Dict, Any, Optional, List, Type, Union, Tuple
 import logging
 from abc import ABC, abstractmethod
 
+from ..metrics import PipelineMetrics
+
 logger = logging.getLogger(__name__)
 
 # Interfaz base para procesadores
@@ -57,6 +59,12 @@ class ProcessorFactory:
         }
     }
     
+    # Constructor de cada cliente (el módulo del procesador se importa al crearlo)
+    _processor_builders = {
+        'OXXO': '_create_oxxo_processor',
+        'KIOSKO': '_create_kiosko_processor'
+    }
+    
     # Configuraciones por defecto
     _default_configs = {
         'OXXO': {
@@ -72,13 +80,15 @@ class ProcessorFactory:
     }
     
     @classmethod
-    def create_processor(cls, client_type: str, config_override: Optional[Dict] = None, **kwargs) -> BaseProcessor:
+    def create_processor(cls, client_type: str, config_override: Optional[Dict] = None,
+                         metrics: Optional[PipelineMetrics] = None, **kwargs) -> BaseProcessor:
         """
         Crea un procesador específico para el tipo de cliente
         
         Args:
             client_type: Tipo de cliente ('OXXO', 'KIOSKO')
             config_override: Configuración personalizada opcional
+            metrics: Métricas de la corrida que el procesador debe alimentar (opcional)
             **kwargs: Argumentos adicionales para el procesador
             
         Returns:
@@ -96,18 +106,24 @@ class ProcessorFactory:
         
         logger.info(f"🏭 Creando procesador para cliente: {client_type}")
         
+        metrics = metrics or PipelineMetrics(client_type)
+        
         try:
-            # Obtener metadata del procesador
-            processor_info = cls._processor_registry[client_type]
-            
-            # Cargar configuración específica
-            client_config = cls._load_and_merge_config(client_type, config_override)
-            
-            # Crear instancia del procesador
-            processor_instance = cls._create_processor_instance(client_type, processor_info, client_config, **kwargs)
+            with metrics.stage('crear_procesador'):
+                # Obtener metadata del procesador
+                processor_info = cls._processor_registry[client_type]
+                
+                # Cargar configuración específica
+                client_config = cls._load_and_merge_config(client_type, config_override)
+                
+                # Crear instancia del procesador
+                processor_instance = cls._create_processor_instance(client_type, processor_info, client_config, **kwargs)
+                
+                # Validar el procesador creado
+                cls._validate_processor_instance(processor_instance, client_type)
             
-            # Validar el procesador creado
-            cls._validate_processor_instance(processor_instance, client_type)
+            # Las etapas del procesador se registran en las métricas de la corrida
+            processor_instance.metrics = metrics
             
             logger.info(f"✅ Procesador {client_type} v{processor_info['version']} creado exitosamente")
             return processor_instance
@@ -119,6 +135,28 @@ class ProcessorFactory:
             logger.error(f"❌ Error creando procesador {client_type}: {e}")
             raise
     
+    @classmethod
+    def register_processor(cls, client_type: str, builder, processor_info: Dict,
+                           default_config: Optional[Dict] = None):
+        """
+        Registra (o reemplaza) el procesador de un cliente nuevo
+        
+        Args:
+            client_type: Tipo de cliente
+            builder: Función (processor_info, client_config, **kwargs) -> BaseProcessor;
+                     debe importar el procesador dentro, al crearlo
+            processor_info: Metadata del procesador (config_file, version, capabilities, ...)
+            default_config: Configuración por defecto (tolerances, matching, ...)
+        """
+        client_type = client_type.upper()
+        builder_name = f"_create_{client_type.lower()}_processor"
+        setattr(cls, builder_name, staticmethod(builder))
+        cls._processor_builders[client_type] = builder_name
+        cls._processor_registry[client_type] = processor_info
+        if default_config is not None:
+            cls._default_configs[client_type] = default_config
+        logger.info(f"🧩 Procesador registrado para cliente: {client_type}")
+    
     @classmethod
     def _load_and_merge_config(cls, client_type: str, config_override: Optional[Dict] = None) -> Dict[str, Any]:
         """
@@ -265,12 +303,10 @@ class ProcessorFactory:
         Returns:
             Instancia del procesador
         """
-        if client_type == 'OXXO':
-            return cls._create_oxxo_processor(processor_info, client_config, **kwargs)
-        elif client_type == 'KIOSKO':
-            return cls._create_kiosko_processor(processor_info, client_config, **kwargs)
-        else:
+        builder_name = cls._processor_builders.get(client_type)
+        if builder_name is None:
             raise ValueError(f"Procesador para {client_type} no implementado")
+        return getattr(cls, builder_name)(processor_info, client_config, **kwargs)
     
     @classmethod
     def _create_oxxo_processor(cls, processor_info: Dict, client_config: Dict, **kwargs) -> BaseProcessor:
@@ -17,6 +17,10 @@ from typing import Dict, List, Tuple, Optional
 import logging
 from datetime import datetime
 
+from .matching_ids import last_4_digits, normalize_matching_ids
+from ..dtypes import compact_frame, MemoryReport
+from ..metrics import PipelineMetrics
+
 # Imports para compatibilidad
 try:
     from config import config
@@ -45,6 +49,7 @@ class KioskoProcessor:
         self.source_data = None
         self.looker_data = None
         self.processing_stats = {}
+        self.metrics = PipelineMetrics(self.client_name)
         
         logger.info("🎯 KioskoProcessor inicializado - Matching Simple FINAL")
     
@@ -157,19 +162,7 @@ class KioskoProcessor:
         Returns:
             String con últimos 4 dígitos o None si inválido
         """
-        if pd.isna(value) or value == '':
-            return None
-        
-        # Convertir a string y extraer solo números
-        value_str = str(value).strip()
-        digits_only = re.sub(r'[^0-9]', '', value_str)
-        
-        # Verificar que tenga al menos 4 dígitos
-        if len(digits_only) < 4:
-            return None
-        
-        # Retornar últimos 4 dígitos
-        return digits_only[-4:]
+        return last_4_digits(value)
     
     def load_kiosko_file(self, file_path: str) -> pd.DataFrame:
         """
@@ -179,7 +172,8 @@ class KioskoProcessor:
         
         try:
             # Leer archivo Excel - header en fila 0
-            df = pd.read_excel(file_path, header=0)
+            with self.metrics.stage('leer_excel_kiosko') as stage:
+                df = stage.output(pd.read_excel(file_path, header=0))
             logger.info(f"✅ Archivo cargado: {df.shape[0]} filas, {df.shape[1]} columnas")
             logger.info(f"📋 Columnas encontradas: {list(df.columns)}")
             
@@ -211,7 +205,8 @@ class KioskoProcessor:
                     raise ValueError(f"❌ No se encontraron campos equivalentes a: {missing_columns}")
             
             # Procesar datos
-            processed_df = self._process_kiosko_data(df)
+            with self.metrics.stage('limpiar_kiosko', rows_in=df) as stage:
+                processed_df = stage.output(self._process_kiosko_data(df))
             self.source_data = processed_df
             
             # Estadísticas
@@ -261,12 +256,10 @@ class KioskoProcessor:
         
         # APLICAR MATCHING SIMPLE: Últimos 4 dígitos
         logger.info("🎯 Aplicando matching simple (últimos 4 dígitos)...")
-        df_clean['matching_id'] = df_clean['Ticket'].apply(self.extract_last_4_digits)
+        # IDs y devoluciones ('36_') en una sola pasada vectorizada
+        df_clean['matching_id'], df_clean['is_return'] = normalize_matching_ids(df_clean['Ticket'], detect_returns=True)
         df_clean['original_ticket'] = df_clean['Ticket']
         
-        # Detectar devoluciones
-        df_clean['is_return'] = df_clean['Ticket'].astype(str).str.contains('36_', na=False)
-        
         # Filtrar solo registros con matching_id válido
         valid_before = len(df_clean)
         df_clean = df_clean[df_clean['matching_id'].notna()]
@@ -314,7 +307,8 @@ class KioskoProcessor:
         logger.info(f"📊 Cargando archivo Looker KIOSKO: {file_path}")
         
         try:
-            df = pd.read_excel(file_path, header=0)
+            with self.metrics.stage('leer_excel_looker') as stage:
+                df = stage.output(pd.read_excel(file_path, header=0))
             logger.info(f"✅ Archivo cargado: {df.shape[0]} filas, {df.shape[1]} columnas")
             logger.info(f"📋 Columnas Looker: {list(df.columns)}")
             
@@ -351,7 +345,8 @@ class KioskoProcessor:
             logger.info(f"✅ Campos identificados: {folio_column}, {value_column}")
             
             # Procesar datos sin agrupación
-            processed_df = self._process_looker_data(df, folio_column, value_column)
+            with self.metrics.stage('limpiar_looker', rows_in=df) as stage:
+                processed_df = stage.output(self._process_looker_data(df, folio_column, value_column))
             self.looker_data = processed_df
             
             # Estadísticas
@@ -393,7 +388,7 @@ class KioskoProcessor:
         
         # APLICAR MATCHING SIMPLE: Últimos 4 dígitos
         logger.info("🎯 Aplicando matching simple a Looker...")
-        df_clean['matching_id'] = df_clean[folio_column].apply(self.extract_last_4_digits)
+        df_clean['matching_id'] = normalize_matching_ids(df_clean[folio_column])
         df_clean['original_folio'] = df_clean[folio_column]
         
         # Filtrar registros con matching_id válido
@@ -492,7 +487,8 @@ class KioskoProcessor:
         
         # Preview de matching
         if len(kiosko_processed) > 0 and len(looker_processed) > 0:
-            preview = self.preview_matching()
+            with self.metrics.stage('preview_matching'):
+                preview = self.preview_matching()
             
             logger.info(f"\n🎉 PROCESAMIENTO COMPLETADO")
             logger.info(f"📊 KIOSKO: {len(kiosko_processed)} registros")
@@ -502,6 +498,15 @@ class KioskoProcessor:
         else:
             logger.warning("⚠️ Procesamiento completado pero sin datos válidos")
         
+        # Tipos compactos para el reconciler
+        memory_report = MemoryReport('KIOSKO')
+        memory_report.record('procesado', kiosko_processed, looker_processed)
+        with self.metrics.stage('compactar_tipos'):
+            kiosko_processed = compact_frame(kiosko_processed)
+            looker_processed = compact_frame(looker_processed)
+        memory_report.record('compactado', kiosko_processed, looker_processed)
+        self.processing_stats['memory_mb'] = memory_report.to_dict()
+        
         logger.info("=" * 60)
         
         return kiosko_processed, looker_processed
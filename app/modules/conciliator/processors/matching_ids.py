@@ -0,0 +1,60 @@
+"""
+Normalización de IDs para matching KIOSKO (últimos 4 dígitos)
+Versión vectorizada compartida por KioskoProcessor y Kiosko_SimpleMatch
+"""
+
+import pandas as pd
+import re
+from typing import Optional
+
+# Solo ASCII, igual que la versión original con re.sub
+NON_DIGITS = r'[^0-9]'
+RETURN_MARKER = '36_'
+ID_LENGTH = 4
+
+
+def last_4_digits(value) -> Optional[str]:
+    """
+    Extrae los últimos 4 dígitos de un valor individual
+
+    Args:
+        value: Valor del ticket/folio (puede ser string, int, float)
+
+    Returns:
+        String con los últimos 4 dígitos o None si tiene menos de 4
+    """
+    if pd.isna(value) or value == '':
+        return None
+
+    digits_only = re.sub(NON_DIGITS, '', str(value).strip())
+
+    if len(digits_only) < ID_LENGTH:
+        return None
+
+    return digits_only[-ID_LENGTH:]
+
+
+def normalize_matching_ids(values: pd.Series, detect_returns: bool = False):
+    """
+    Versión vectorizada de last_4_digits para una columna completa
+
+    Args:
+        values: Columna de tickets/folios
+        detect_returns: Si True también calcula qué registros son devoluciones ('36_')
+
+    Returns:
+        Serie (object) con los IDs o None, con el mismo índice que values.
+        Con detect_returns=True regresa la tupla (ids, is_return).
+    """
+    as_text = values.astype(str)
+    digits = as_text.str.replace(NON_DIGITS, '', regex=True)
+
+    valid = values.notna() & (digits.str.len() >= ID_LENGTH)
+    ids = digits.str[-ID_LENGTH:].astype(object)
+    ids[~valid] = None
+
+    if not detect_returns:
+        return ids
+
+    is_return = as_text.str.contains(RETURN_MARKER, regex=False, na=False)
+    return ids, is_return
@@ -11,6 +11,9 @@ import logging
 from datetime import datetime
 import re
 
+from ..dtypes import compact_frame, MemoryReport
+from ..metrics import PipelineMetrics
+
 # Imports
 try:
     from config import config
@@ -35,16 +38,19 @@ class DataProcessor:
         self.processed_oxxo = None
         self.processed_looker = None
         self.processing_stats = {}
+        self.metrics = PipelineMetrics(self.client_name)
         
     def load_oxxo_file(self, file_path: str) -> pd.DataFrame:
         """Carga y limpia el archivo de OXXO"""
         logger.info(f"📁 Cargando archivo OXXO: {file_path}")
         
         try:
-            df = pd.read_excel(file_path, header=None)
+            with self.metrics.stage('leer_excel_oxxo') as stage:
+                df = stage.output(pd.read_excel(file_path, header=None))
             logger.info(f"✅ Archivo OXXO cargado: {df.shape[0]} filas, {df.shape[1]} columnas")
             
-            cleaned_df = self._clean_oxxo_data(df)
+            with self.metrics.stage('limpiar_oxxo', rows_in=df) as stage:
+                cleaned_df = stage.output(self._clean_oxxo_data(df))
             self.oxxo_data = cleaned_df
             
             self.processing_stats['oxxo_original_rows'] = len(df)
@@ -129,7 +135,8 @@ class DataProcessor:
         
         try:
             # Leer archivo Excel
-            df = pd.read_excel(file_path, header=0)
+            with self.metrics.stage('leer_excel_looker') as stage:
+                df = stage.output(pd.read_excel(file_path, header=0))
             logger.info(f"✅ Archivo Looker cargado: {df.shape[0]} filas, {df.shape[1]} columnas")
             
             self.processing_stats['looker_original_rows'] = len(df)
@@ -143,7 +150,8 @@ class DataProcessor:
             
             # APLICAR AGRUPACIÓN CORREGIDA
             logger.info("🔧 INICIANDO AGRUPACIÓN CORREGIDA...")
-            processed_df = self._group_looker_data_fixed(df)
+            with self.metrics.stage('agrupar_looker', rows_in=df) as stage:
+                processed_df = stage.output(self._group_looker_data_fixed(df))
             
             self.looker_data = processed_df
             self.processing_stats['looker_processed_rows'] = len(processed_df)
@@ -205,21 +213,25 @@ class DataProcessor:
                 if field in df_clean.columns:
                     agg_functions[field] = 'first'
             
-            # Productos - CONCATENAR únicos
-            if 'Producto' in df_clean.columns:
-                agg_functions['Producto'] = lambda x: ' + '.join(sorted(x.dropna().astype(str).unique()))
+            # Productos - CONCATENAR únicos (se calcula aparte, vectorizado)
+            product_position = len(agg_functions) + 1  # +1 por la columna del ID
             
             # Fechas
             if 'Submitted at' in df_clean.columns:
                 agg_functions['Submitted at'] = 'first'
             
-            # EJECUTAR AGRUPACIÓN
+            # EJECUTAR AGRUPACIÓN (un solo groupby para agregados, conteo y productos)
             logger.info(f"🔧 Agrupando por '{group_field}' con {len(agg_functions)} funciones...")
-            grouped_df = df_clean.groupby(group_field).agg(agg_functions).reset_index()
+            grouped = df_clean.groupby(group_field)
+            grouped_df = grouped.agg(agg_functions) if agg_functions else pd.DataFrame(index=grouped.size().index)
+            
+            if 'Producto' in df_clean.columns:
+                product_sets = self._encode_product_sets(grouped.ngroup(), df_clean['Producto'])
+                grouped_df.insert(product_position - 1, 'Producto', product_sets.reindex(range(len(grouped_df)), fill_value='').values)
             
-            # PASO 4: Agregar columna de conteo DESPUÉS de la agrupación
-            count_by_id = df_clean.groupby(group_field).size().reset_index(name='productos_agrupados')
-            grouped_df = grouped_df.merge(count_by_id, on=group_field, how='left')
+            # PASO 4: Agregar columna de conteo
+            grouped_df['productos_agrupados'] = grouped.size()
+            grouped_df = grouped_df.reset_index()
             
             # PASO 5: Renombrar columnas para consistencia
             rename_map = {group_field: 'identificador_unico'}
@@ -281,6 +293,41 @@ class DataProcessor:
             logger.warning("🔄 Retornando datos sin agrupar como fallback")
             return df
     
+    def _encode_product_sets(self, group_codes: pd.Series, products: pd.Series) -> pd.Series:
+        """
+        Concatena los productos únicos de cada grupo ('A + B', ordenados) sin lambdas por grupo.
+        Cada producto distinto es un bit; el conjunto de un grupo es el OR de sus bits y
+        solo se decodifica a texto una vez por combinación distinta.
+        
+        Args:
+            group_codes: Número de grupo de cada fila (groupby().ngroup())
+            products: Columna 'Producto'
+            
+        Returns:
+            Serie indexada por número de grupo con el texto concatenado
+        """
+        valid = products.notna() & (group_codes >= 0)
+        # sort=True: los códigos siguen el orden alfabético de los productos
+        codes, labels = pd.factorize(products[valid].astype(str), sort=True)
+        
+        pairs = pd.DataFrame({'group': group_codes[valid].values, 'code': codes}).drop_duplicates()
+        
+        if len(labels) > 63:
+            # Demasiados productos distintos para un bitmask de 64 bits
+            pairs['label'] = labels[pairs['code'].values]
+            return pairs.sort_values(['group', 'code']).groupby('group')['label'].agg(' + '.join)
+        
+        # OR de bits por grupo (los pares ya son únicos, así que la suma equivale al OR)
+        pairs['bit'] = np.left_shift(np.uint64(1), pairs['code'].values.astype(np.uint64))
+        masks = pairs.groupby('group')['bit'].sum()
+        
+        # Decodificar cada combinación distinta una sola vez
+        decoded = {
+            mask: ' + '.join(labels[bit] for bit in range(len(labels)) if int(mask) >> bit & 1)
+            for mask in masks.unique()
+        }
+        return masks.map(decoded)
+    
     def _find_grouping_field_fixed(self, df: pd.DataFrame) -> Optional[str]:
         """Encuentra el campo correcto para agrupación"""
         
@@ -480,14 +527,25 @@ class DataProcessor:
         
         # Normalizar datos OXXO
         if self.processed_oxxo is not None and len(self.processed_oxxo) > 0:
-            self.processed_oxxo = self._normalize_oxxo_fields(self.processed_oxxo)
+            with self.metrics.stage('normalizar_oxxo', rows_in=self.processed_oxxo) as stage:
+                self.processed_oxxo = stage.output(self._normalize_oxxo_fields(self.processed_oxxo))
             logger.info(f"✅ OXXO normalizado: {len(self.processed_oxxo)} registros")
         
         # Normalizar datos Looker
         if self.processed_looker is not None and len(self.processed_looker) > 0:
-            self.processed_looker = self._normalize_looker_fields(self.processed_looker)
+            with self.metrics.stage('normalizar_looker', rows_in=self.processed_looker) as stage:
+                self.processed_looker = stage.output(self._normalize_looker_fields(self.processed_looker))
             logger.info(f"✅ Looker normalizado: {len(self.processed_looker)} registros")
         
+        # Tipos compactos para el reconciler
+        memory_report = MemoryReport('OXXO')
+        memory_report.record('procesado', self.processed_oxxo, self.processed_looker)
+        with self.metrics.stage('compactar_tipos'):
+            self.processed_oxxo = compact_frame(self.processed_oxxo)
+            self.processed_looker = compact_frame(self.processed_looker)
+        memory_report.record('compactado', self.processed_oxxo, self.processed_looker)
+        self.processing_stats['memory_mb'] = memory_report.to_dict()
+        
         # Verificación final CRÍTICA
         logger.info("\n🔍 VERIFICACIÓN FINAL CRÍTICA")
         logger.info("-" * 30)
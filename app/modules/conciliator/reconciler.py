@@ -10,6 +10,11 @@ import logging
 from datetime import datetime
 from fuzzywuzzy import fuzz
 
+from .dtypes import compact_frame, project_for_matching, MemoryReport
+from .whatif import categorize_differences, build_summary_stats
+from .ledger import id_content_hashes
+from .metrics import PipelineMetrics
+
 # Importar config solo para fallback
 try:
     from config import config
@@ -21,18 +26,22 @@ logger = logging.getLogger(__name__)
 class Reconciler:
     """Clase principal para conciliación de datos - VERSIÓN MULTI-CLIENTE MEJORADA"""
     
-    def __init__(self, client_type: str = 'OXXO'):
+    def __init__(self, client_type: str = 'OXXO', metrics: Optional[PipelineMetrics] = None):
         """
         Inicializa el conciliador para un tipo de cliente específico
         
         Args:
             client_type: 'OXXO', 'KIOSKO' o futuro tipo de cliente
+            metrics: Métricas de la corrida a alimentar (opcional)
         """
         self.client_type = client_type.upper()
         self.source_data = None
         self.looker_data = None
         self.reconciliation_results = None
         self.summary_stats = None
+        self.memory_report = MemoryReport(self.client_type)
+        self.incremental_stats = None
+        self.metrics = metrics or PipelineMetrics(self.client_type)
         
         # CARGAR CONFIGURACIÓN ESPECÍFICA DEL CLIENTE
         self._load_client_specific_config()
@@ -173,29 +182,134 @@ class Reconciler:
         logger.info(f"🔄 INICIANDO CONCILIACIÓN {self.client_type}")
         logger.info("=" * 60)
         
+        # PASO 1: Validar y preparar datos
+        source_prepared, looker_prepared = self._prepare_inputs(source_df, looker_df)
+        
+        # PASOS 2-6: Matching y diferencias
+        final_results = self._match_prepared(source_prepared, looker_prepared)
+        
+        # PASOS 7-9: Categorizar, resumir y registrar
+        return self._finalize_results(final_results)
+    
+    def reconcile_incremental(self, source_df: pd.DataFrame, looker_df: pd.DataFrame, ledger) -> pd.DataFrame:
+        """
+        Conciliación incremental contra el ledger de corridas anteriores
+        
+        Los IDs cuyo contenido (hash de sus filas en ambos lados) no cambió desde una corrida
+        anterior y que entonces tuvieron match exacto conservan su resultado; solo se hace
+        matching del resto. Los faltantes y matches fuzzy se recalculan siempre porque
+        dependen de otros IDs. El resultado es el mismo que el de reconcile().
+        
+        Args:
+            source_df: DataFrame procesado del cliente (OXXO/KIOSKO)
+            looker_df: DataFrame procesado de Looker
+            ledger: ReconciliationLedger del cliente
+            
+        Returns:
+            DataFrame con resultados de conciliación
+        """
+        logger.info(f"🔄 INICIANDO CONCILIACIÓN INCREMENTAL {self.client_type}")
+        logger.info("=" * 60)
+        
+        source_prepared, looker_prepared = self._prepare_inputs(source_df, looker_df)
+        
+        # Hash de contenido por ID en cada lado y resultados previos de los IDs que no cambiaron
+        with self.metrics.stage('ledger_lectura', rows_in=len(source_prepared) + len(looker_prepared)) as stage:
+            source_hashes = id_content_hashes(source_prepared)
+            looker_hashes = id_content_hashes(looker_prepared)
+            carried = stage.output(ledger.carry_forward(self.client_type, source_hashes, looker_hashes))
+        carried_ids = carried['id_matching'] if len(carried) > 0 else pd.Series(dtype=object)
+        
+        delta_source = source_prepared[~source_prepared['id_matching'].isin(carried_ids)]
+        delta_looker = looker_prepared[~looker_prepared['id_matching'].isin(carried_ids)]
+        logger.info(f"   ♻️ {len(carried)} IDs sin cambios conservan su resultado")
+        logger.info(f"   🔁 Delta: {len(delta_source)} registros {self.client_type}, {len(delta_looker)} Looker")
+        
+        # PASOS 2-6 solo sobre el delta
+        if len(delta_source) > 0 or len(delta_looker) > 0:
+            delta_results = self._match_prepared(delta_source, delta_looker)
+        else:
+            delta_results = pd.DataFrame()
+        
+        with self.metrics.stage('ledger_escritura', rows_in=delta_results):
+            ledger.record(self.client_type, delta_results, source_hashes, looker_hashes)
+        self.incremental_stats = {
+            'carried_ids': len(carried),
+            'delta_source_rows': len(delta_source),
+            'delta_looker_rows': len(delta_looker),
+        }
+        
+        final_results = pd.concat(
+            [frame for frame in (carried, delta_results) if len(frame) > 0],
+            ignore_index=True, sort=False
+        ) if len(carried) > 0 or len(delta_results) > 0 else pd.DataFrame()
+        
+        return self._finalize_results(final_results)
+    
+    def _prepare_inputs(self, source_df: pd.DataFrame, looker_df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Valida las entradas y las prepara para matching (columnas consistentes y tipos compactos)"""
         # Validar datos de entrada
         if not self._validate_input_data(source_df, looker_df):
             raise ValueError(f"Datos de entrada inválidos para {self.client_type}")
         
-        self.source_data = source_df.copy()
-        self.looker_data = looker_df.copy()
+        # Sin copia: _prepare_*_for_matching ya trabaja sobre su propia copia
+        self.source_data = source_df
+        self.looker_data = looker_df
+        self.memory_report.record('entrada', source_df, looker_df)
         
-        # PASO 1: Preparar datos para matching con nombres consistentes
+        # Preparar datos para matching con nombres consistentes
         logger.info("🔧 Preparando datos para matching...")
-        source_prepared = self._prepare_source_for_matching(self.source_data)
-        looker_prepared = self._prepare_looker_for_matching(self.looker_data)
+        with self.metrics.stage('preparar_datos', rows_in=len(source_df) + len(looker_df)) as stage:
+            source_prepared = self._prepare_source_for_matching(self.source_data)
+            looker_prepared = self._prepare_looker_for_matching(self.looker_data)
+            
+            # Solo las columnas que usa la conciliación, con tipos compactos
+            source_prepared = compact_frame(project_for_matching(source_prepared))
+            looker_prepared = compact_frame(project_for_matching(looker_prepared))
+            stage.output(len(source_prepared) + len(looker_prepared))
+        self.memory_report.record('preparado', source_prepared, looker_prepared)
         
         logger.info(f"   📊 {self.client_type}: {len(source_prepared)} registros preparados")
         logger.info(f"   📊 Looker: {len(looker_prepared)} registros preparados")
         
+        return source_prepared, looker_prepared
+    
+    def _finalize_results(self, final_results: pd.DataFrame) -> pd.DataFrame:
+        """Categoriza, calcula el resumen y registra el cierre de la conciliación"""
+        self.memory_report.record('diferencias', final_results)
+        
+        # PASO 7: Categorizar resultados con tolerancias específicas del cliente
+        logger.info("🏷️ Categorizando resultados...")
+        with self.metrics.stage('categorizar', rows_in=final_results) as stage:
+            categorized_results = stage.output(compact_frame(self._categorize_results(final_results)))
+        self.memory_report.record('resultados', categorized_results)
+        
+        # PASO 8: Calcular estadísticas resumen
+        self.reconciliation_results = categorized_results
+        with self.metrics.stage('resumen', rows_in=categorized_results):
+            self._calculate_summary_stats()
+        
+        # PASO 9: Generar resumen final
+        self._log_reconciliation_summary()
+        
+        logger.info(f"✅ Conciliación {self.client_type} completada exitosamente")
+        logger.info("=" * 60)
+        
+        return categorized_results
+    
+    def _match_prepared(self, source_prepared: pd.DataFrame, looker_prepared: pd.DataFrame) -> pd.DataFrame:
+        """Matching exacto + fuzzy, faltantes y diferencias sobre datos ya preparados"""
         # PASO 2: Realizar matching exacto
+        rows_in = len(source_prepared) + len(looker_prepared)
         logger.info("🎯 Realizando matching exacto...")
-        exact_matches = self._perform_exact_matching(source_prepared, looker_prepared)
+        with self.metrics.stage('matching_exacto', rows_in=rows_in) as stage:
+            exact_matches = stage.output(self._perform_exact_matching(source_prepared, looker_prepared))
         logger.info(f"   ✅ {len(exact_matches)} matches exactos encontrados")
         
         # PASO 3: Realizar matching fuzzy para registros no encontrados
         logger.info("🔍 Realizando matching fuzzy...")
-        fuzzy_matches = self._perform_fuzzy_matching(source_prepared, looker_prepared, exact_matches)
+        with self.metrics.stage('matching_fuzzy', rows_in=rows_in) as stage:
+            fuzzy_matches = stage.output(self._perform_fuzzy_matching(source_prepared, looker_prepared, exact_matches))
         logger.info(f"   🔍 {len(fuzzy_matches)} matches fuzzy encontrados")
         
         # PASO 4: Combinar resultados de matching
@@ -203,28 +317,14 @@ class Reconciler:
         
         # PASO 5: Identificar registros faltantes
         logger.info("❓ Identificando registros faltantes...")
-        missing_records = self._identify_missing_records(source_prepared, looker_prepared, all_matches)
+        with self.metrics.stage('faltantes', rows_in=rows_in) as stage:
+            missing_records = stage.output(self._identify_missing_records(source_prepared, looker_prepared, all_matches))
         logger.info(f"   ❌ {len(missing_records)} registros faltantes identificados")
         
         # PASO 6: Calcular diferencias con manejo robusto
         logger.info("📊 Calculando diferencias...")
-        final_results = self._calculate_differences(all_matches, missing_records)
-        
-        # PASO 7: Categorizar resultados con tolerancias específicas del cliente
-        logger.info("🏷️ Categorizando resultados...")
-        categorized_results = self._categorize_results(final_results)
-        
-        # PASO 8: Calcular estadísticas resumen
-        self.reconciliation_results = categorized_results
-        self._calculate_summary_stats()
-        
-        # PASO 9: Generar resumen final
-        self._log_reconciliation_summary()
-        
-        logger.info(f"✅ Conciliación {self.client_type} completada exitosamente")
-        logger.info("=" * 60)
-        
-        return categorized_results
+        with self.metrics.stage('diferencias', rows_in=len(all_matches) + len(missing_records)) as stage:
+            return stage.output(self._calculate_differences(all_matches, missing_records))
     
     def _validate_input_data(self, source_df: pd.DataFrame, looker_df: pd.DataFrame) -> bool:
         """Valida que los datos de entrada sean apropiados"""
@@ -406,27 +506,8 @@ class Reconciler:
             if self.client_type == 'KIOSKO':
                 logger.info(f"🔧 KIOSKO: Agrupando registros con mismo ID...")
                 
-                # Agrupar por ID y sumar valores
-                source_grouped = source_df.groupby('id_matching').agg({
-                    'total_venta': 'sum',  # Sumar valores
-                    'source': 'first',     # Tomar primer valor para campos de texto
-                    'client_type': 'first',
-                    'source_original_columns': 'first'
-                }).reset_index()
-                
-                # Agregar otros campos numéricos si existen
-                numeric_fields = source_df.select_dtypes(include=[np.number]).columns
-                for field in numeric_fields:
-                    if field not in ['total_venta'] and field in source_df.columns:
-                        if field not in source_grouped.columns:
-                            source_grouped[field] = source_df.groupby('id_matching')[field].sum().values
-                
-                # Agregar campos de texto (tomar primero)
-                text_fields = source_df.select_dtypes(include=['object']).columns
-                for field in text_fields:
-                    if field not in ['id_matching', 'source', 'client_type', 'source_original_columns']:
-                        if field not in source_grouped.columns:
-                            source_grouped[field] = source_df.groupby('id_matching')[field].first().values
+                # Agrupar por ID y sumar valores (una sola pasada de groupby)
+                source_grouped = self._aggregate_by_id(source_df, self._source_aggregation_spec(source_df))
                 
                 logger.info(f"✅ KIOSKO agrupado: {len(source_df)} → {len(source_grouped)} registros únicos")
                 source_for_merge = source_grouped
@@ -438,19 +519,7 @@ class Reconciler:
         
         if looker_duplicates > 0:
             logger.warning(f"⚠️ Looker: {looker_duplicates} IDs duplicados detectados")
-            looker_grouped = looker_df.groupby('id_matching').agg({
-                'total_venta': 'sum',
-                'source': 'first',
-                'client_type': 'first'
-            }).reset_index()
-            
-            # Agregar otros campos
-            for col in looker_df.columns:
-                if col not in ['id_matching', 'total_venta', 'source', 'client_type']:
-                    if looker_df[col].dtype in ['int64', 'float64']:
-                        looker_grouped[col] = looker_df.groupby('id_matching')[col].sum().values
-                    else:
-                        looker_grouped[col] = looker_df.groupby('id_matching')[col].first().values
+            looker_grouped = self._aggregate_by_id(looker_df, self._looker_aggregation_spec(looker_df))
             
             logger.info(f"✅ Looker agrupado: {len(looker_df)} → {len(looker_grouped)} registros únicos")
             looker_for_merge = looker_grouped
@@ -478,7 +547,54 @@ class Reconciler:
         else:
             exact_matches = pd.DataFrame()
         
-        return exact_matches    
+        return exact_matches
+    
+    def _source_aggregation_spec(self, df: pd.DataFrame) -> Dict[str, str]:
+        """
+        Especificación de agregación para IDs duplicados del cliente:
+        sumar valores numéricos y tomar el primer valor de los campos de texto
+        """
+        spec = {
+            'total_venta': 'sum',  # Sumar valores
+            'source': 'first',     # Tomar primer valor para campos de texto
+            'client_type': 'first',
+            'source_original_columns': 'first'
+        }
+        
+        # Otros campos numéricos se suman
+        for field in df.select_dtypes(include=[np.number]).columns:
+            if field != 'id_matching':
+                spec.setdefault(field, 'sum')
+        
+        # Campos de texto (incluye categorías de la capa de tipos compactos): tomar el primero
+        for field in df.select_dtypes(include=['object', 'category']).columns:
+            if field != 'id_matching':
+                spec.setdefault(field, 'first')
+        
+        return spec
+    
+    def _looker_aggregation_spec(self, df: pd.DataFrame) -> Dict[str, str]:
+        """
+        Especificación de agregación para IDs duplicados de Looker:
+        numéricas (int/float, de cualquier tamaño) se suman, cualquier otra columna toma el primer valor
+        """
+        spec = {
+            'total_venta': 'sum',
+            'source': 'first',
+            'client_type': 'first'
+        }
+        
+        for col in df.columns:
+            if col != 'id_matching':
+                is_number = pd.api.types.is_integer_dtype(df[col]) or pd.api.types.is_float_dtype(df[col])
+                spec.setdefault(col, 'sum' if is_number else 'first')
+        
+        return spec
+    
+    def _aggregate_by_id(self, df: pd.DataFrame, spec: Dict[str, str]) -> pd.DataFrame:
+        """Agrupa por id_matching ejecutando toda la especificación en un solo groupby().agg()"""
+        return df.groupby('id_matching').agg(spec).reset_index()
+    
     def _perform_fuzzy_matching(self, source_df: pd.DataFrame, looker_df: pd.DataFrame, 
                                exact_matches: pd.DataFrame) -> pd.DataFrame:
         """Realiza matching fuzzy para identificadores similares (MEJORADO)"""
@@ -492,6 +608,10 @@ class Reconciler:
         unmatched_source = source_df[~source_df['id_matching'].isin(matched_ids)]
         unmatched_looker = looker_df[~looker_df['id_matching'].isin(matched_ids)]
         
+        # Candidatos de la búsqueda fuzzy (el costo crece con el producto de ambos)
+        self.metrics.count('fuzzy_candidatos_source', len(unmatched_source))
+        self.metrics.count('fuzzy_candidatos_looker', len(unmatched_looker))
+        
         if len(unmatched_source) == 0 or len(unmatched_looker) == 0:
             return pd.DataFrame()
         
@@ -681,23 +801,7 @@ class Reconciler:
         tolerance_pct = self.config['tolerance_percentage']
         tolerance_abs = self.config['tolerance_absolute']
         
-        def categorize_row(row):
-            if row['match_type'].startswith('MISSING_'):
-                return row['match_type']
-            
-            diff_abs = abs(row.get('diferencia_valor', 0))
-            diff_pct = abs(row.get('diferencia_porcentaje', 0))
-            
-            if diff_abs == 0:
-                return 'EXACT_MATCH'
-            elif diff_pct <= tolerance_pct or diff_abs <= tolerance_abs:
-                return 'WITHIN_TOLERANCE'
-            elif diff_pct <= tolerance_pct * 3:  # 3x la tolerancia para diferencias menores
-                return 'MINOR_DIFFERENCE'
-            else:
-                return 'MAJOR_DIFFERENCE'
-        
-        results_df['categoria'] = results_df.apply(categorize_row, axis=1)
+        results_df['categoria'] = categorize_differences(results_df, tolerance_pct, tolerance_abs)
         
         # Agregar descripción personalizada por cliente
         results_df['descripcion_categoria'] = results_df['categoria'].map(self.config['categories'])
@@ -718,46 +822,12 @@ class Reconciler:
             self.summary_stats = {}
             return
         
-        df = self.reconciliation_results
-        
-        # Conteo por categorías
-        category_counts = df['categoria'].value_counts().to_dict()
-        
-        # Estadísticas financieras
-        total_source = df['valor_source_clean'].sum()
-        total_looker = df['valor_looker_clean'].sum()
-        total_diferencia = df['diferencia_valor'].sum()
-        
-        # Estadísticas de diferencias
-        numeric_differences = df[df['categoria'].isin(['WITHIN_TOLERANCE', 'MINOR_DIFFERENCE', 'MAJOR_DIFFERENCE'])]
-        avg_diff_pct = numeric_differences['diferencia_porcentaje'].mean() if len(numeric_differences) > 0 else 0
-        max_diff_abs = df['diferencia_absoluta'].max() if len(df) > 0 else 0
-        
-        # Calcular tasa de conciliación
-        successful_matches = category_counts.get('EXACT_MATCH', 0) + category_counts.get('WITHIN_TOLERANCE', 0)
-        total_records = len(df)
-        reconciliation_rate = (successful_matches / total_records * 100) if total_records > 0 else 0
-        
-        # Crear resumen con nombres personalizados
-        self.summary_stats = {
-            'client_type': self.client_type,
-            'total_records': total_records,
-            'exact_matches': category_counts.get('EXACT_MATCH', 0),
-            'within_tolerance': category_counts.get('WITHIN_TOLERANCE', 0),
-            'minor_differences': category_counts.get('MINOR_DIFFERENCE', 0),
-            'major_differences': category_counts.get('MAJOR_DIFFERENCE', 0),
-            f'missing_in_{self.client_type.lower()}': category_counts.get(f'MISSING_IN_{self.client_type}', 0),
-            'missing_in_looker': category_counts.get('MISSING_IN_LOOKER', 0),
-            f'total_valor_{self.client_type.lower()}': total_source,
-            'total_valor_looker': total_looker,
-            'total_diferencia': total_diferencia,
-            'avg_diferencia_porcentaje': avg_diff_pct,
-            'max_diferencia_abs': max_diff_abs,
-            'reconciliation_rate': reconciliation_rate,
-            'successful_matches': successful_matches,
-            'tolerance_percentage': self.config['tolerance_percentage'],
-            'tolerance_absolute': self.config['tolerance_absolute']
-        }
+        self.summary_stats = build_summary_stats(
+            self.reconciliation_results,
+            self.client_type,
+            self.config['tolerance_percentage'],
+            self.config['tolerance_absolute']
+        )
     
     def _log_reconciliation_summary(self):
         """Registra resumen detallado de la conciliación"""
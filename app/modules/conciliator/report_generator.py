@@ -24,14 +24,17 @@ except ImportError:
     sys.path.append(os.path.dirname(os.path.abspath(__file__)))
     from config import config
 
+from .metrics import PipelineMetrics
+
 logger = logging.getLogger(__name__)
 
 class ReportGenerator:
     """Generador de reportes personalizado para diferentes tipos de cliente - VERSIÓN CORREGIDA"""
     
-    def __init__(self, client_type: str = 'OXXO'):
-        """Inicializa el generador de reportes"""
+    def __init__(self, client_type: str = 'OXXO', metrics: Optional[PipelineMetrics] = None):
+        """Inicializa el generador de reportes (metrics: métricas de la corrida a alimentar)"""
         self.client_type = client_type.upper()
+        self.metrics = metrics or PipelineMetrics(self.client_type)
         self.output_dir = Path(config.get_output_dir() if hasattr(config, 'get_output_dir') else './data/output')
         self.output_dir.mkdir(parents=True, exist_ok=True)
         
@@ -160,96 +163,96 @@ class ReportGenerator:
     def generate_complete_report(self, reconciliation_results: pd.DataFrame, 
                                summary_stats: Dict, timestamp: str = None) -> str:
         """Genera un reporte completo personalizado por cliente usando pandas"""
+        with self.metrics.stage('reporte_excel', rows_in=reconciliation_results):
+            if timestamp is None:
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         
-        if timestamp is None:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            filename = f"reporte_{self.client_type.lower()}_{timestamp}.xlsx"
+            filepath = self.output_dir / filename
         
-        filename = f"reporte_{self.client_type.lower()}_{timestamp}.xlsx"
-        filepath = self.output_dir / filename
+            # Asegurar que el directorio existe
+            filepath.parent.mkdir(parents=True, exist_ok=True)
         
-        # Asegurar que el directorio existe
-        filepath.parent.mkdir(parents=True, exist_ok=True)
+            logger.info(f"📊 Generando reporte completo {self.client_type}: {filepath}")
         
-        logger.info(f"📊 Generando reporte completo {self.client_type}: {filepath}")
-        
-        try:
-            # Mapear estatus a nombres legibles
-            status_mapping = {
-                'EXACT_MATCH': 'Conciliado',
-                'WITHIN_TOLERANCE': 'Tolerancia', 
-                'MINOR_DIFFERENCE': 'Diferencia',
-                'MAJOR_DIFFERENCE': 'Diferencia',
-                'MISSING_IN_OXXO': 'Faltante',
-                'MISSING_IN_KIOSKO': 'Faltante',
-                'MISSING_IN_LOOKER': 'Faltante',
-                'MISSING_IN_SOURCE': 'Faltante'
-            }
+            try:
+                # Mapear estatus a nombres legibles
+                status_mapping = {
+                    'EXACT_MATCH': 'Conciliado',
+                    'WITHIN_TOLERANCE': 'Tolerancia', 
+                    'MINOR_DIFFERENCE': 'Diferencia',
+                    'MAJOR_DIFFERENCE': 'Diferencia',
+                    'MISSING_IN_OXXO': 'Faltante',
+                    'MISSING_IN_KIOSKO': 'Faltante',
+                    'MISSING_IN_LOOKER': 'Faltante',
+                    'MISSING_IN_SOURCE': 'Faltante'
+                }
             
-            # Preparar datos para el reporte
-            df_report = reconciliation_results.copy()
-            if 'status' in df_report.columns:
-                df_report['Estado'] = df_report['status'].map(status_mapping).fillna(df_report['status'])
+                # Preparar datos para el reporte
+                df_report = reconciliation_results.copy()
+                if 'status' in df_report.columns:
+                    df_report['Estado'] = df_report['status'].map(status_mapping).fillna(df_report['status'])
             
-            # Crear resumen ejecutivo
-            summary_data = {
-                'Métrica': [
-                    'Tickets Totales',
-                    'Tickets Conciliados', 
-                    'Tickets con Diferencia',
-                    'Tickets Faltantes',
-                    'Tasa de Conciliación (%)',
-                    f'Total {self.client_type} ($)',
-                    'Total Looker ($)',
-                    'Diferencia Total ($)'
-                ],
-                'Valor': [
-                    summary_stats.get('total_records', 0),
-                    summary_stats.get('exact_matches', 0),
-                    summary_stats.get('major_differences', 0) + summary_stats.get('minor_differences', 0),
-                    summary_stats.get('missing_records', 0),
-                    f"{summary_stats.get('reconciliation_rate', 0):.1f}%",
-                    f"${summary_stats.get('total_client_amount', 0):,.2f}",
-                    f"${summary_stats.get('total_looker_amount', 0):,.2f}",
-                    f"${summary_stats.get('total_difference', 0):,.2f}"
-                ]
-            }
+                # Crear resumen ejecutivo
+                summary_data = {
+                    'Métrica': [
+                        'Tickets Totales',
+                        'Tickets Conciliados', 
+                        'Tickets con Diferencia',
+                        'Tickets Faltantes',
+                        'Tasa de Conciliación (%)',
+                        f'Total {self.client_type} ($)',
+                        'Total Looker ($)',
+                        'Diferencia Total ($)'
+                    ],
+                    'Valor': [
+                        summary_stats.get('total_records', 0),
+                        summary_stats.get('exact_matches', 0),
+                        summary_stats.get('major_differences', 0) + summary_stats.get('minor_differences', 0),
+                        summary_stats.get('missing_records', 0),
+                        f"{summary_stats.get('reconciliation_rate', 0):.1f}%",
+                        f"${summary_stats.get('total_client_amount', 0):,.2f}",
+                        f"${summary_stats.get('total_looker_amount', 0):,.2f}",
+                        f"${summary_stats.get('total_difference', 0):,.2f}"
+                    ]
+                }
             
-            df_summary = pd.DataFrame(summary_data)
+                df_summary = pd.DataFrame(summary_data)
             
-            # Usar pandas ExcelWriter para crear el archivo
-            with pd.ExcelWriter(str(filepath), engine='openpyxl') as writer:
-                # Hoja de resumen
-                df_summary.to_excel(writer, sheet_name='Resumen Ejecutivo', index=False)
+                # Usar pandas ExcelWriter para crear el archivo
+                with pd.ExcelWriter(str(filepath), engine='openpyxl') as writer:
+                    # Hoja de resumen
+                    df_summary.to_excel(writer, sheet_name='Resumen Ejecutivo', index=False)
                 
-                # Hoja de resultados detallados
-                df_report.to_excel(writer, sheet_name='Resultados Detallados', index=False)
+                    # Hoja de resultados detallados
+                    df_report.to_excel(writer, sheet_name='Resultados Detallados', index=False)
                 
-                # Hoja de diferencias (solo registros con problemas)
-                if 'status' in df_report.columns:
-                    df_differences = df_report[~df_report['status'].isin(['EXACT_MATCH'])]
-                    if not df_differences.empty:
-                        df_differences.to_excel(writer, sheet_name='Diferencias', index=False)
+                    # Hoja de diferencias (solo registros con problemas)
+                    if 'status' in df_report.columns:
+                        df_differences = df_report[~df_report['status'].isin(['EXACT_MATCH'])]
+                        if not df_differences.empty:
+                            df_differences.to_excel(writer, sheet_name='Diferencias', index=False)
                 
-                logger.info(f"✅ Reporte Excel generado exitosamente")
+                    logger.info(f"✅ Reporte Excel generado exitosamente")
             
-            # Verificar que el archivo se creó correctamente
-            if filepath.exists() and filepath.stat().st_size > 0:
-                logger.info(f"📄 Archivo verificado - Tamaño: {filepath.stat().st_size} bytes")
-                return str(filepath)
-            else:
-                raise Exception("El archivo no se generó correctamente")
+                # Verificar que el archivo se creó correctamente
+                if filepath.exists() and filepath.stat().st_size > 0:
+                    logger.info(f"📄 Archivo verificado - Tamaño: {filepath.stat().st_size} bytes")
+                    return str(filepath)
+                else:
+                    raise Exception("El archivo no se generó correctamente")
             
-        except Exception as e:
-            logger.error(f"❌ Error generando reporte: {e}")
-            # Fallback: generar CSV si Excel falla
-            try:
-                csv_path = filepath.with_suffix('.csv')
-                reconciliation_results.to_csv(csv_path, index=False)
-                logger.info(f"✅ Archivo CSV generado como fallback: {csv_path}")
-                return str(csv_path)
-            except Exception as csv_error:
-                logger.error(f"❌ Error generando CSV fallback: {csv_error}")
-                raise e
+            except Exception as e:
+                logger.error(f"❌ Error generando reporte: {e}")
+                # Fallback: generar CSV si Excel falla
+                try:
+                    csv_path = filepath.with_suffix('.csv')
+                    reconciliation_results.to_csv(csv_path, index=False)
+                    logger.info(f"✅ Archivo CSV generado como fallback: {csv_path}")
+                    return str(csv_path)
+                except Exception as csv_error:
+                    logger.error(f"❌ Error generando CSV fallback: {csv_error}")
+                    raise e
     
     def _create_executive_summary_sheet(self, wb: openpyxl.Workbook, 
                                       summary_stats: Dict, timestamp: str):
@@ -1249,41 +1252,42 @@ class ReportGenerator:
     def generate_csv_reports(self, reconciliation_results: pd.DataFrame, 
                            timestamp: str = None) -> Dict[str, str]:
         """Genera reportes en formato CSV personalizados por cliente"""
-        if timestamp is None:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        
-        csv_files = {}
+        with self.metrics.stage('reportes_csv', rows_in=reconciliation_results):
+            if timestamp is None:
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         
-        try:
-            df_display = self._prepare_display_data_safe(reconciliation_results.copy())
-        except:
-            df_display = self._prepare_fallback_display_data(reconciliation_results.copy())
-        
-        complete_csv = self.output_dir / f"conciliacion_{self.client_type.lower()}_{timestamp}.csv"
-        df_display.to_csv(complete_csv, index=False, encoding='utf-8-sig')
-        csv_files['completo'] = str(complete_csv)
+            csv_files = {}
         
-        # Reportes específicos...
-        approved_statuses = [self.config['categories'].get(cat, cat) for cat in ['EXACT_MATCH', 'WITHIN_TOLERANCE']]
-        if 'Estatus' in df_display.columns:
-            billing_ready = df_display[df_display['Estatus'].isin(approved_statuses)]
+            try:
+                df_display = self._prepare_display_data_safe(reconciliation_results.copy())
+            except:
+                df_display = self._prepare_fallback_display_data(reconciliation_results.copy())
+        
+            complete_csv = self.output_dir / f"conciliacion_{self.client_type.lower()}_{timestamp}.csv"
+            df_display.to_csv(complete_csv, index=False, encoding='utf-8-sig')
+            csv_files['completo'] = str(complete_csv)
+        
+            # Reportes específicos...
+            approved_statuses = [self.config['categories'].get(cat, cat) for cat in ['EXACT_MATCH', 'WITHIN_TOLERANCE']]
+            if 'Estatus' in df_display.columns:
+                billing_ready = df_display[df_display['Estatus'].isin(approved_statuses)]
             
-            if len(billing_ready) > 0:
-                billing_csv = self.output_dir / f"facturacion_{self.client_type.lower()}_{timestamp}.csv"
-                billing_ready.to_csv(billing_csv, index=False, encoding='utf-8-sig')
-                csv_files['facturacion'] = str(billing_csv)
-        
-        difference_statuses = [self.config['categories'].get(cat, cat) for cat in ['MINOR_DIFFERENCE', 'MAJOR_DIFFERENCE']]
-        if 'Estatus' in df_display.columns:
-            differences = df_display[df_display['Estatus'].isin(difference_statuses)]
+                if len(billing_ready) > 0:
+                    billing_csv = self.output_dir / f"facturacion_{self.client_type.lower()}_{timestamp}.csv"
+                    billing_ready.to_csv(billing_csv, index=False, encoding='utf-8-sig')
+                    csv_files['facturacion'] = str(billing_csv)
+        
+            difference_statuses = [self.config['categories'].get(cat, cat) for cat in ['MINOR_DIFFERENCE', 'MAJOR_DIFFERENCE']]
+            if 'Estatus' in df_display.columns:
+                differences = df_display[df_display['Estatus'].isin(difference_statuses)]
             
-            if len(differences) > 0:
-                diff_csv = self.output_dir / f"diferencias_{self.client_type.lower()}_{timestamp}.csv"
-                differences.to_csv(diff_csv, index=False, encoding='utf-8-sig')
-                csv_files['diferencias'] = str(diff_csv)
+                if len(differences) > 0:
+                    diff_csv = self.output_dir / f"diferencias_{self.client_type.lower()}_{timestamp}.csv"
+                    differences.to_csv(diff_csv, index=False, encoding='utf-8-sig')
+                    csv_files['diferencias'] = str(diff_csv)
         
-        logger.info(f"✅ Reportes CSV generados para {self.client_type}: {list(csv_files.keys())}")
-        return csv_files
+            logger.info(f"✅ Reportes CSV generados para {self.client_type}: {list(csv_files.keys())}")
+            return csv_files
     
     def generate_summary_json(self, summary_stats: Dict, timestamp: str = None) -> str:
         """Genera resumen en formato JSON para integración con otros sistemas"""
@@ -0,0 +1,297 @@
+"""
+Almacén columnar de resultados de conciliación
+Guarda el resultado de cada trabajo en un archivo Parquet propio para consultarlo por
+páginas, con filtros y orden, leyendo solo las columnas y row groups que cada consulta
+necesita. pyarrow está en requirements.txt; sin él se guarda en pickle (cada página
+lee el archivo completo) y se avisa en el log
+"""
+
+import logging
+import os
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pyarrow  # noqa: F401
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+    logger.warning("⚠️ pyarrow no está instalado: los resultados de conciliación se guardarán en pickle "
+                   "y cada consulta leerá el archivo completo (pip install -r requirements.txt)")
+
+PARQUET_EXTENSION = '.parquet'
+PICKLE_EXTENSION = '.pkl'
+
+# Columnas que se guardan (las que consultan la API, los escenarios what-if y los reportes)
+RESULTS_COLUMNS = (
+    'id_matching', 'match_type', 'match_confidence', 'categoria', 'descripcion_categoria',
+    'valor_source_clean', 'valor_looker_clean',
+    'diferencia_valor', 'diferencia_absoluta', 'diferencia_porcentaje',
+    'sucursal',
+)
+
+# De dónde sale la sucursal según el cliente (la primera con valor gana).
+# El merge solo agrega sufijo cuando ambos lados tienen la columna
+SUCURSAL_CANDIDATES = (
+    'sucursal_looker', 'Sucursal_looker', 'tienda_looker', 'Tienda_looker',
+    'sucursal_{client}', 'Sucursal_{client}', 'tienda_{client}', 'Tienda_{client}',
+    'sucursal', 'Sucursal', 'tienda', 'Tienda',
+)
+
+# Filas por row group en Parquet (los filtros por ID saltan grupos completos)
+ROW_GROUP_SIZE = 50_000
+
+# Paginación
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Campos de orden aceptados por la API → columna del almacén
+SORT_FIELDS = {
+    'id': 'id_matching',
+    'difference': 'diferencia_valor',
+    'abs_difference': 'diferencia_absoluta',
+    'percentage': 'diferencia_porcentaje',
+    'client_value': 'valor_source_clean',
+    'looker_value': 'valor_looker_clean',
+}
+
+# Columna del almacén → campo del registro que recibe el frontend
+RECORD_FIELDS = {
+    'id_matching': 'id',
+    'valor_source_clean': 'client_value',
+    'valor_looker_clean': 'looker_value',
+    'diferencia_valor': 'difference',
+    'diferencia_porcentaje': 'difference_percentage',
+    'categoria': 'status',
+    'match_type': 'match_type',
+    'sucursal': 'sucursal',
+}
+
+
+def results_file(base_path: str) -> Optional[str]:
+    """Archivo de resultados existente para una ruta base (sin extensión), o None"""
+    for extension in (PARQUET_EXTENSION, PICKLE_EXTENSION):
+        if os.path.exists(base_path + extension):
+            return base_path + extension
+    return None
+
+
+def remove_results(base_path: str):
+    """Elimina los archivos de resultados de una ruta base (en cualquier formato)"""
+    for extension in (PARQUET_EXTENSION, PICKLE_EXTENSION):
+        if os.path.exists(base_path + extension):
+            os.remove(base_path + extension)
+
+
+def _first_available(df: pd.DataFrame, candidates: Iterable[str]) -> Optional[pd.Series]:
+    values = None
+    for column in candidates:
+        if column not in df.columns:
+            continue
+        column_values = df[column].astype(object)
+        values = column_values if values is None else values.where(values.notna(), column_values)
+    return values
+
+
+def build_results_frame(results_df: pd.DataFrame, client_type: str) -> pd.DataFrame:
+    """
+    Reduce el resultado del Reconciler a las columnas del almacén
+
+    Args:
+        results_df: Resultados categorizados
+        client_type: Tipo de cliente (para encontrar la columna de sucursal)
+
+    Returns:
+        DataFrame ordenado por ID con IDs como texto y sucursal unificada
+    """
+    client = client_type.lower()
+    frame = results_df[[col for col in RESULTS_COLUMNS if col in results_df.columns]].copy()
+
+    sucursal = _first_available(results_df, [c.format(client=client) for c in SUCURSAL_CANDIDATES])
+    if sucursal is not None:
+        frame['sucursal'] = sucursal.astype('category')
+
+    # IDs como texto: mismo tipo en Parquet y pickle, y filtros por prefijo
+    frame['id_matching'] = frame['id_matching'].map(id_to_text)
+
+    # Ordenar por ID para que los filtros por prefijo solo lean los row groups necesarios
+    return frame.sort_values('id_matching', kind='stable').reset_index(drop=True)
+
+
+def id_to_text(value) -> str:
+    """ID como texto (los IDs numéricos sin '.0')"""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def save_results(results_df: pd.DataFrame, base_path: str, client_type: str,
+                 attrs: Optional[Dict] = None) -> str:
+    """
+    Guarda los resultados de una conciliación en el almacén
+
+    Args:
+        results_df: Resultados categorizados del Reconciler
+        base_path: Ruta sin extensión
+        client_type: Tipo de cliente
+        attrs: Metadatos a conservar (tolerancias usadas, etc.)
+
+    Returns:
+        Ruta del archivo escrito
+    """
+    frame = build_results_frame(results_df, client_type)
+    frame.attrs = {'client_type': client_type.upper(), **(attrs or {})}
+
+    remove_results(base_path)
+    if PARQUET_AVAILABLE:
+        path = base_path + PARQUET_EXTENSION
+        frame.to_parquet(path, index=False, row_group_size=ROW_GROUP_SIZE)
+    else:
+        path = base_path + PICKLE_EXTENSION
+        logger.warning(f"⚠️ Sin pyarrow: resultados en pickle ({os.path.basename(path)}), "
+                       f"las consultas por página leerán el archivo completo")
+        frame.to_pickle(path)
+
+    logger.info(f"💾 Resultados guardados: {len(frame)} registros en {os.path.basename(path)}")
+    return path
+
+
+def load_results(path: str, columns: Optional[Sequence[str]] = None,
+                 filters: Optional[List[tuple]] = None) -> pd.DataFrame:
+    """
+    Lee resultados del almacén
+
+    Args:
+        path: Archivo devuelto por save_results / results_file
+        columns: Columnas a leer (None = todas)
+        filters: Filtros (columna, operador, valor) con operadores '==', 'in', '>=', '<'
+
+    Returns:
+        DataFrame con las columnas y filas pedidas (conserva attrs)
+    """
+    filters = filters or []
+
+    if path.endswith(PARQUET_EXTENSION):
+        import pyarrow.parquet as pq
+        stored = pq.read_schema(path).names
+        wanted = [col for col in columns if col in stored] if columns else None
+        if any(column not in stored for column, _, _ in filters):
+            # Filtro sobre una columna que este resultado no tiene: ningún registro cumple
+            return pd.read_parquet(path, columns=wanted).iloc[0:0]
+        # Parquet lee solo las columnas pedidas y descarta row groups por estadísticas
+        return pd.read_parquet(path, columns=wanted, filters=filters or None)
+
+    df = pd.read_pickle(path)
+    attrs = df.attrs
+    if filters:
+        df = df[_filter_mask(df, filters)]
+    if columns:
+        df = df[[col for col in columns if col in df.columns]]
+    df.attrs = attrs
+    return df
+
+
+def _filter_mask(df: pd.DataFrame, filters: List[tuple]) -> np.ndarray:
+    mask = np.ones(len(df), dtype=bool)
+    for column, operator, value in filters:
+        if column not in df.columns:
+            return np.zeros(len(df), dtype=bool)
+        values = df[column]
+        if operator == '==':
+            mask &= (values == value).to_numpy()
+        elif operator == 'in':
+            mask &= values.isin(value).to_numpy()
+        elif operator == '>=':
+            mask &= (values >= value).to_numpy()
+        elif operator == '<':
+            mask &= (values < value).to_numpy()
+        else:
+            raise ValueError(f"Operador de filtro no soportado: {operator}")
+    return mask
+
+
+def _prefix_filters(prefix: str) -> List[tuple]:
+    """Un prefijo de texto como rango [prefix, siguiente) para aprovechar el orden por ID"""
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return [('id_matching', '>=', prefix), ('id_matching', '<', upper)]
+
+
+def records_to_json(page: pd.DataFrame) -> List[Dict]:
+    """Convierte una página de resultados a registros del frontend (vectorizado)"""
+    columns = [col for col in RECORD_FIELDS if col in page.columns]
+    records = page[columns].rename(columns=RECORD_FIELDS)
+
+    for field in ('client_value', 'looker_value', 'difference', 'difference_percentage'):
+        if field in records.columns:
+            records[field] = records[field].astype(float).fillna(0.0)
+    for field in ('status', 'match_type', 'sucursal'):
+        if field in records.columns:
+            records[field] = records[field].astype(object).where(records[field].notna(), None)
+
+    if 'status' in records.columns:
+        records['category'] = records['status']
+
+    return records.to_dict('records')
+
+
+def query_results(path: str, page: int = 1, page_size: int = DEFAULT_PAGE_SIZE,
+                  categories: Optional[List[str]] = None, sucursal: Optional[str] = None,
+                  id_prefix: Optional[str] = None, sort_by: str = 'id',
+                  descending: bool = False) -> Dict:
+    """
+    Consulta una página de resultados
+
+    Args:
+        path: Archivo del almacén
+        page: Página (desde 1)
+        page_size: Registros por página (máximo MAX_PAGE_SIZE)
+        categories: Categorías a incluir (EXACT_MATCH, MAJOR_DIFFERENCE, ...)
+        sucursal: Sucursal exacta
+        id_prefix: Prefijo del ID
+        sort_by: Campo de orden (ver SORT_FIELDS)
+        descending: Orden descendente
+
+    Returns:
+        Diccionario con total, páginas y los registros de la página pedida
+
+    Raises:
+        ValueError: Si el campo de orden o la paginación no son válidos
+    """
+    if sort_by not in SORT_FIELDS:
+        raise ValueError(f"Campo de orden no válido. Usa {', '.join(SORT_FIELDS)}")
+    if page < 1 or page_size < 1:
+        raise ValueError("La página y el tamaño de página deben ser mayores a 0")
+    page_size = min(page_size, MAX_PAGE_SIZE)
+
+    filters = []
+    if categories:
+        filters.append(('categoria', 'in', list(categories)))
+    if sucursal:
+        filters.append(('sucursal', '==', sucursal))
+    if id_prefix:
+        filters.extend(_prefix_filters(id_prefix))
+
+    sort_column = SORT_FIELDS[sort_by]
+    columns = list(RECORD_FIELDS) + ([sort_column] if sort_column not in RECORD_FIELDS else [])
+    df = load_results(path, columns=columns, filters=filters)
+
+    if sort_column != 'id_matching' or descending:
+        df = df.sort_values(sort_column, ascending=not descending, kind='stable', na_position='last')
+
+    total = len(df)
+    start = (page - 1) * page_size
+    page_df = df.iloc[start:start + page_size]
+
+    return {
+        "total": total,
+        "page": page,
+        "page_size": page_size,
+        "pages": (total + page_size - 1) // page_size,
+        "sort_by": sort_by,
+        "order": "desc" if descending else "asc",
+        "records": records_to_json(page_df)
+    }
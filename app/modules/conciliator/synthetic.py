@@ -0,0 +1,263 @@
+"""
+Generador de datos sintéticos para el conciliador
+Produce archivos con el mismo formato que los reales (hoja "RECEPCIONES" de OXXO,
+exportación de tickets KIOSKO con devoluciones '36_' y exportaciones de Looker)
+con tamaño y tasas de discrepancia configurables, para medir el rendimiento sin
+depender de archivos de clientes. No usa red ni servicios externos.
+"""
+
+import logging
+import os
+from datetime import timedelta
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_CLIENTS = ('OXXO', 'KIOSKO')
+
+# Productos que aparecen en Looker (un pedido puede tener varios)
+PRODUCTS = ('Bolsa de Hielo 5kg', 'Bolsa de Hielo 15kg', 'Barra de Hielo', 'Hielo Rolito 3kg')
+PRODUCT_PRICES = (18.0, 45.0, 60.0, 12.0)
+
+# Sucursales de ejemplo por cliente
+STORES = {
+    'OXXO': ('CENTRO', 'LAS QUINTAS', 'HUMAYA', 'TRES RIOS', 'ZAPATA', 'OBREGON'),
+    'KIOSKO': ('KIOSKO CENTRO', 'KIOSKO NORTE', 'KIOSKO SUR', 'KIOSKO PLAYA'),
+}
+
+# Filas de Looker de otro cliente por cada fila del cliente (se descartan por el filtro 'Cliente')
+OTHER_CLIENT_RATIO = 0.1
+
+# Diferencias: la mitad pequeñas (dentro de tolerancia) y la mitad grandes
+SMALL_DIFFERENCE_PCT = (0.005, 0.02)
+LARGE_DIFFERENCE_PCT = (0.1, 0.4)
+
+
+def generate_dataset(client_type: str, rows: int, output_dir: str,
+                     missing_rate: float = 0.03, extra_rate: float = 0.02,
+                     difference_rate: float = 0.05, fuzzy_rate: float = 0.0,
+                     return_rate: float = 0.01, max_products: int = 3,
+                     seed: int = 0, overwrite: bool = False) -> Dict:
+    """
+    Genera el archivo del cliente y el de Looker
+
+    Args:
+        client_type: 'OXXO' o 'KIOSKO'
+        rows: Pedidos/tickets en el archivo del cliente
+        output_dir: Carpeta donde se escriben los archivos
+        missing_rate: Proporción de pedidos del cliente que no están en Looker
+        extra_rate: Pedidos solo en Looker (proporción de rows)
+        difference_rate: Proporción de pedidos con importe distinto en Looker
+        fuzzy_rate: Proporción de pedidos con el ID de Looker alterado en un dígito
+        return_rate: Proporción de devoluciones '36_' (solo KIOSKO)
+        max_products: Máximo de productos (filas de Looker) por pedido
+        seed: Semilla para reproducir el mismo conjunto
+        overwrite: Regenerar aunque los archivos ya existan
+
+    Returns:
+        Diccionario con las rutas (source, looker) y los conteos esperados
+    """
+    client_type = client_type.upper()
+    if client_type not in SUPPORTED_CLIENTS:
+        raise ValueError(f"Cliente '{client_type}' no soportado. Disponibles: {', '.join(SUPPORTED_CLIENTS)}")
+    if rows < 1:
+        raise ValueError("El número de registros debe ser mayor a 0")
+
+    os.makedirs(output_dir, exist_ok=True)
+    tag = (f"{client_type.lower()}_{rows}_m{missing_rate:g}_e{extra_rate:g}_d{difference_rate:g}"
+           f"_f{fuzzy_rate:g}_r{return_rate:g}_p{max_products}_s{seed}")
+    source_path = os.path.join(output_dir, f"{tag}_source.xlsx")
+    looker_path = os.path.join(output_dir, f"{tag}_looker.xlsx")
+
+    rng = np.random.default_rng(seed)
+    orders = _build_orders(client_type, rows, rng, missing_rate, extra_rate,
+                           difference_rate, fuzzy_rate, return_rate)
+    expected = _expected_counts(orders)
+
+    if overwrite or not (os.path.exists(source_path) and os.path.exists(looker_path)):
+        logger.info(f"🧪 Generando datos sintéticos {client_type}: {rows} registros → {output_dir}")
+        if client_type == 'OXXO':
+            source_df = _oxxo_source_sheet(orders[orders['in_source']], rng)
+            source_df.to_excel(source_path, index=False, header=False)
+        else:
+            source_df = _kiosko_source_sheet(orders[orders['in_source']], rng)
+            source_df.to_excel(source_path, index=False)
+        _looker_sheet(client_type, orders[orders['in_looker']], rng, max_products).to_excel(looker_path, index=False)
+    else:
+        logger.info(f"♻️ Reutilizando datos sintéticos existentes: {tag}")
+
+    return {
+        'client_type': client_type,
+        'rows': rows,
+        'source': source_path,
+        'looker': looker_path,
+        'expected': expected,
+    }
+
+
+def _build_orders(client_type: str, rows: int, rng: np.random.Generator,
+                  missing_rate: float, extra_rate: float, difference_rate: float,
+                  fuzzy_rate: float, return_rate: float) -> pd.DataFrame:
+    """Tabla de pedidos con su ID, importe y el tipo de discrepancia asignado"""
+    extra = int(round(rows * extra_rate))
+    total = rows + extra
+
+    # IDs únicos: pedidos de 8 dígitos (OXXO) o folios de ticket (KIOSKO)
+    numbers = 10_000_000 + rng.choice(90_000_000, size=total, replace=False)
+    amount = rng.integers(2, 60, size=total) * rng.choice(PRODUCT_PRICES, size=total)
+
+    orders = pd.DataFrame({
+        'number': numbers,
+        'store': rng.choice(STORES[client_type], size=total),
+        'date': pd.Timestamp('2025-01-01') + pd.to_timedelta(rng.integers(0, 30, size=total), unit='D'),
+        'amount': amount.round(2),
+        'in_source': np.r_[np.ones(rows, dtype=bool), np.zeros(extra, dtype=bool)],
+    })
+
+    # Solo en el cliente (faltantes en Looker)
+    orders['in_looker'] = True
+    missing = rng.random(total) < missing_rate
+    orders.loc[missing & orders['in_source'], 'in_looker'] = False
+
+    # Importe distinto en Looker
+    matched = (orders['in_source'] & orders['in_looker']).to_numpy()
+    differs = matched & (rng.random(total) < difference_rate)
+    small = rng.random(total) < 0.5
+    pct = np.where(small, rng.uniform(*SMALL_DIFFERENCE_PCT, size=total), rng.uniform(*LARGE_DIFFERENCE_PCT, size=total))
+    sign = rng.choice([-1.0, 1.0], size=total)
+    orders['looker_amount'] = np.where(differs, (orders['amount'] * (1 + sign * pct)).round(2), orders['amount'])
+    orders['difference'] = differs
+
+    # ID alterado en un dígito en Looker (lo encuentra el matching fuzzy)
+    fuzzy = matched & ~differs & (rng.random(total) < fuzzy_rate)
+    orders['looker_number'] = np.where(fuzzy, orders['number'] + rng.integers(1, 9, size=total) * 10, orders['number'])
+    orders['fuzzy'] = fuzzy
+
+    # Devoluciones KIOSKO
+    orders['is_return'] = (client_type == 'KIOSKO') & orders['in_source'] & (rng.random(total) < return_rate)
+
+    return orders
+
+
+def _expected_counts(orders: pd.DataFrame) -> Dict[str, int]:
+    in_source = orders['in_source']
+    in_looker = orders['in_looker']
+    return {
+        'source_orders': int(in_source.sum()),
+        'looker_orders': int(in_looker.sum()),
+        'missing_in_looker': int((in_source & ~in_looker).sum()),
+        'looker_only': int((~in_source & in_looker).sum()),
+        'with_difference': int(orders['difference'].sum()),
+        'fuzzy_ids': int(orders['fuzzy'].sum()),
+        'returns': int(orders['is_return'].sum()),
+    }
+
+
+def _oxxo_source_sheet(orders: pd.DataFrame, rng: np.random.Generator) -> pd.DataFrame:
+    """Hoja OXXO sin encabezado: títulos, filas 'RECEPCIONES' y otros movimientos que se ignoran"""
+    n = len(orders)
+    valor = orders['amount'].to_numpy()
+    iva = (valor * 0.16).round(2)
+    sheet = pd.DataFrame({
+        0: 'RECEPCIONES',
+        1: [f"{code}-{store}" for code, store in zip(rng.integers(100, 999, size=n), orders['store'])],
+        2: rng.integers(100_000, 999_999, size=n),
+        3: rng.integers(1_000, 9_999, size=n),
+        4: orders['number'].to_numpy(),
+        5: [f"R{value}" for value in rng.integers(10_000, 99_999, size=n)],
+        6: orders['date'].dt.strftime('%d/%m/%Y').to_numpy(),
+        7: valor,
+        8: iva,
+        9: (valor + iva).round(2),
+    })
+
+    # Movimientos que no son recepciones (el procesador los descarta)
+    noise = sheet.sample(frac=0.02, random_state=int(rng.integers(1 << 31))).copy()
+    noise[0] = 'DEVOLUCIONES'
+
+    header = pd.DataFrame([
+        ['REPORTE DE MOVIMIENTOS POR PROVEEDOR'] + [None] * 9,
+        ['Movimiento', 'Tienda', 'Recibo', 'Orden', 'Pedido Adicional', 'Remisión', 'Fecha', 'Valor', 'IVA', 'Neto'],
+    ])
+    return pd.concat([header, sheet, noise], ignore_index=True)
+
+
+def _kiosko_ticket(number: int) -> str:
+    """Ticket KIOSKO 'TTTTCTFFFFF' (tienda, caja, turno, folio) a partir de un número"""
+    text = str(number)
+    return f"41{text[:2]}{text[2]}{text[3]}{text[-5:]}"
+
+
+def _kiosko_folio(number: int) -> str:
+    """El mismo ticket como lo exporta Looker: 'TTTT-C-T-FFFFF'"""
+    ticket = _kiosko_ticket(number)
+    return f"{ticket[:4]}-{ticket[4]}-{ticket[5]}-{ticket[6:]}"
+
+
+def _kiosko_source_sheet(orders: pd.DataFrame, rng: np.random.Generator) -> pd.DataFrame:
+    """Exportación de tickets KIOSKO; las devoluciones llevan el prefijo '36_' y el folio con guiones"""
+    tickets = [
+        f"36_{_kiosko_folio(number)}" if is_return else _kiosko_ticket(number)
+        for number, is_return in zip(orders['number'], orders['is_return'])
+    ]
+    product = rng.integers(0, len(PRODUCTS), size=len(orders))
+    return pd.DataFrame({
+        'Tienda': orders['store'].to_numpy(),
+        'Fecha': orders['date'].to_numpy(),
+        'Ticket': tickets,
+        'Producto': np.asarray(PRODUCTS)[product],
+        'Cantidad': rng.integers(1, 40, size=len(orders)),
+        'Costo Total': orders['amount'].to_numpy(),
+    })
+
+
+def _looker_sheet(client_type: str, orders: pd.DataFrame, rng: np.random.Generator,
+                  max_products: int) -> pd.DataFrame:
+    """Exportación de Looker: una fila por producto, el importe del pedido repartido entre ellas"""
+    products_per_order = rng.integers(1, max(1, max_products) + 1, size=len(orders))
+    repeated = orders.loc[orders.index.repeat(products_per_order)].reset_index(drop=True)
+    position = repeated.groupby('number').cumcount().to_numpy()
+    count = np.repeat(products_per_order, products_per_order)
+
+    # Reparto del importe: partes iguales redondeadas, el residuo en la última fila
+    share = (repeated['looker_amount'] / count).round(2).to_numpy()
+    last = position == count - 1
+    share[last] = (repeated['looker_amount'].to_numpy() - share * (count - 1))[last].round(2)
+
+    if client_type == 'OXXO':
+        id_column, store_column = 'No. Pedido (Filtrado)', 'Sucursal OXXO (Filtrado)'
+        ids = repeated['looker_number'].to_numpy()
+    else:
+        id_column, store_column = 'Folio del Ticket (Filtrado)', 'Sucursal KIOSKO (Filtrado)'
+        ids = [_kiosko_folio(number) for number in repeated['looker_number']]
+
+    looker = pd.DataFrame({
+        'Cliente': client_type,
+        id_column: ids,
+        store_column: repeated['store'].to_numpy(),
+        'Remisión (Filtrado)': [f"R{value}" for value in rng.integers(10_000, 99_999, size=len(repeated))],
+        'Producto': np.asarray(PRODUCTS)[(position + repeated['number'].to_numpy()) % len(PRODUCTS)],
+        'Número de piezas entregadas': rng.integers(1, 40, size=len(repeated)),
+        'Venta': share,
+        'Submitted at': (repeated['date'] + timedelta(hours=9)).dt.strftime('%Y-%m-%d %H:%M:%S').to_numpy(),
+    })
+
+    # Filas de otro cliente que el filtro por 'Cliente' debe descartar
+    other = looker.sample(frac=OTHER_CLIENT_RATIO, random_state=int(rng.integers(1 << 31))).copy()
+    other['Cliente'] = 'KIOSKO' if client_type == 'OXXO' else 'OXXO'
+
+    return pd.concat([looker, other], ignore_index=True).sample(
+        frac=1.0, random_state=int(rng.integers(1 << 31))
+    ).reset_index(drop=True)
+
+
+def describe_dataset(dataset: Dict) -> str:
+    """Resumen de una línea de un conjunto generado"""
+    expected = dataset['expected']
+    return (f"{dataset['client_type']} {dataset['rows']:,} registros — "
+            f"{expected['missing_in_looker']} faltantes, {expected['looker_only']} solo Looker, "
+            f"{expected['with_difference']} con diferencia, {expected['fuzzy_ids']} fuzzy, "
+            f"{expected['returns']} devoluciones")
@@ -0,0 +1,191 @@
+"""
+Recategorización "what-if" con otras tolerancias
+Las tolerancias solo afectan la categorización y el resumen, así que se recalculan
+de forma vectorizada sobre el frame de diferencias ya conciliado, sin volver a
+leer archivos ni hacer matching
+"""
+
+import logging
+from itertools import product
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .results_store import load_results
+
+logger = logging.getLogger(__name__)
+
+# Columnas del almacén de resultados que usa la recategorización
+WHATIF_COLUMNS = (
+    'id_matching', 'match_type', 'valor_source_clean', 'valor_looker_clean',
+    'diferencia_valor', 'diferencia_absoluta', 'diferencia_porcentaje', 'categoria',
+)
+
+# Hasta cuántas veces la tolerancia porcentual una diferencia se considera menor
+MINOR_DIFFERENCE_FACTOR = 3
+
+# Límite de escenarios por barrido para que una petición no bloquee la API
+MAX_GRID_SCENARIOS = 400
+
+
+def _column_or_zero(df: pd.DataFrame, column: str) -> np.ndarray:
+    if column in df.columns:
+        return df[column].to_numpy(dtype=float, na_value=np.nan)
+    return np.zeros(len(df))
+
+
+def categorize_differences(df: pd.DataFrame, tolerance_pct: float, tolerance_abs: float) -> np.ndarray:
+    """
+    Categoriza cada registro según las tolerancias (versión vectorizada)
+
+    Args:
+        df: Resultados con match_type, diferencia_valor y diferencia_porcentaje
+        tolerance_pct: Tolerancia porcentual
+        tolerance_abs: Tolerancia absoluta
+
+    Returns:
+        Arreglo (object) con la categoría de cada registro
+    """
+    match_type = df['match_type'].astype(str).to_numpy(dtype=object)
+    # startswith sobre los valores distintos (pocos) en lugar de fila por fila
+    missing_types = [value for value in pd.unique(match_type) if value.startswith('MISSING_')]
+    is_missing = np.isin(match_type, missing_types)
+
+    diff_abs = np.abs(_column_or_zero(df, 'diferencia_valor'))
+    diff_pct = np.abs(_column_or_zero(df, 'diferencia_porcentaje'))
+
+    # Mismo orden de reglas que la versión fila por fila (NaN cae en diferencia mayor)
+    conditions = [
+        is_missing,
+        diff_abs == 0,
+        (diff_pct <= tolerance_pct) | (diff_abs <= tolerance_abs),
+        diff_pct <= tolerance_pct * MINOR_DIFFERENCE_FACTOR,
+    ]
+    choices = [match_type, 'EXACT_MATCH', 'WITHIN_TOLERANCE', 'MINOR_DIFFERENCE']
+
+    return np.select(conditions, choices, default='MAJOR_DIFFERENCE').astype(object)
+
+
+def build_summary_stats(df: pd.DataFrame, client_type: str,
+                        tolerance_pct: float, tolerance_abs: float) -> Dict:
+    """
+    Calcula el resumen de una conciliación ya categorizada
+
+    Args:
+        df: Resultados con la columna 'categoria'
+        client_type: 'OXXO', 'KIOSKO', ...
+        tolerance_pct: Tolerancia porcentual usada
+        tolerance_abs: Tolerancia absoluta usada
+
+    Returns:
+        Diccionario con conteos por categoría, totales y tasa de conciliación
+    """
+    if df is None or len(df) == 0:
+        return {}
+
+    # Conteo por categorías
+    category_counts = df['categoria'].value_counts().to_dict()
+
+    # Estadísticas financieras
+    total_source = df['valor_source_clean'].sum()
+    total_looker = df['valor_looker_clean'].sum()
+    total_diferencia = df['diferencia_valor'].sum()
+
+    # Estadísticas de diferencias
+    numeric_differences = df[df['categoria'].isin(['WITHIN_TOLERANCE', 'MINOR_DIFFERENCE', 'MAJOR_DIFFERENCE'])]
+    avg_diff_pct = numeric_differences['diferencia_porcentaje'].mean() if len(numeric_differences) > 0 else 0
+    max_diff_abs = df['diferencia_absoluta'].max() if len(df) > 0 else 0
+
+    # Calcular tasa de conciliación
+    successful_matches = category_counts.get('EXACT_MATCH', 0) + category_counts.get('WITHIN_TOLERANCE', 0)
+    total_records = len(df)
+    reconciliation_rate = (successful_matches / total_records * 100) if total_records > 0 else 0
+
+    return {
+        'client_type': client_type,
+        'total_records': total_records,
+        'exact_matches': category_counts.get('EXACT_MATCH', 0),
+        'within_tolerance': category_counts.get('WITHIN_TOLERANCE', 0),
+        'minor_differences': category_counts.get('MINOR_DIFFERENCE', 0),
+        'major_differences': category_counts.get('MAJOR_DIFFERENCE', 0),
+        f'missing_in_{client_type.lower()}': category_counts.get(f'MISSING_IN_{client_type}', 0),
+        'missing_in_looker': category_counts.get('MISSING_IN_LOOKER', 0),
+        f'total_valor_{client_type.lower()}': total_source,
+        'total_valor_looker': total_looker,
+        'total_diferencia': total_diferencia,
+        'avg_diferencia_porcentaje': avg_diff_pct,
+        'max_diferencia_abs': max_diff_abs,
+        'reconciliation_rate': reconciliation_rate,
+        'successful_matches': successful_matches,
+        'tolerance_percentage': tolerance_pct,
+        'tolerance_absolute': tolerance_abs
+    }
+
+
+def summary_for_frontend(summary_stats: Dict, client_type: str) -> Dict:
+    """Convierte el resumen del Reconciler al formato (tipos nativos) que espera el frontend"""
+    return {
+        "total_records": int(summary_stats.get('total_records', 0)),
+        "exact_matches": int(summary_stats.get('exact_matches', 0)),
+        "within_tolerance": int(summary_stats.get('within_tolerance', 0)),
+        "major_differences": int(summary_stats.get('major_differences', 0)),
+        "missing_records": int(summary_stats.get('missing_records', 0)),
+        "reconciliation_rate": float(summary_stats.get('reconciliation_rate', 0)),
+        "total_client_amount": float(summary_stats.get(f'total_valor_{client_type.lower()}', 0)),
+        "total_looker_amount": float(summary_stats.get('total_valor_looker', 0)),
+        "total_difference": float(summary_stats.get('total_diferencia', 0))
+    }
+
+
+def load_whatif_frame(path: str) -> pd.DataFrame:
+    """Lee del almacén de resultados solo las columnas que necesita la recategorización"""
+    return load_results(path, columns=WHATIF_COLUMNS)
+
+
+def tolerance_grid(percentages: Iterable[float], absolutes: Iterable[float]) -> List[Tuple[float, float]]:
+    """
+    Combina listas de tolerancias en escenarios (producto cartesiano)
+
+    Raises:
+        ValueError: Si no hay escenarios o exceden MAX_GRID_SCENARIOS
+    """
+    scenarios = list(product(percentages, absolutes))
+    if not scenarios:
+        raise ValueError("El barrido de tolerancias está vacío")
+    if len(scenarios) > MAX_GRID_SCENARIOS:
+        raise ValueError(f"Demasiados escenarios ({len(scenarios)}); máximo {MAX_GRID_SCENARIOS}")
+    return scenarios
+
+
+def run_what_if(frame: pd.DataFrame, scenarios: Iterable[Tuple[float, float]],
+                client_type: Optional[str] = None) -> List[Dict]:
+    """
+    Recategoriza el frame conciliado para cada par de tolerancias
+
+    Args:
+        frame: Frame leído con load_whatif_frame
+        scenarios: Pares (tolerancia porcentual, tolerancia absoluta)
+        client_type: Tipo de cliente (por defecto el guardado en el frame)
+
+    Returns:
+        Lista de escenarios con resumen, conteo por categoría y registros que cambian de categoría
+    """
+    client_type = (client_type or frame.attrs.get('client_type', 'OXXO')).upper()
+    original = frame['categoria'].astype(str).to_numpy(dtype=object) if 'categoria' in frame.columns else None
+
+    results = []
+    for tolerance_pct, tolerance_abs in scenarios:
+        categories = categorize_differences(frame, tolerance_pct, tolerance_abs)
+        scenario_df = frame.assign(categoria=categories)
+        summary_stats = build_summary_stats(scenario_df, client_type, tolerance_pct, tolerance_abs)
+
+        results.append({
+            "tolerance_percentage": float(tolerance_pct),
+            "tolerance_absolute": float(tolerance_abs),
+            "summary": summary_for_frontend(summary_stats, client_type),
+            "category_counts": {str(k): int(v) for k, v in pd.Series(categories).value_counts().items()},
+            "changed_records": int((categories != original).sum()) if original is not None else None
+        })
+
+    return results
@@ -0,0 +1,189 @@
+"""
+Registro de cadenas comerciales (OXXO, KIOSKO, ...).
+Cada cadena declara en un solo lugar lo que el resto del sistema necesita de ella:
+patrones de detección, parser del texto OCR, índice y filas de Google Sheets, campos
+que identifican el ticket (llave de duplicados) y campo de cantidad. Los endpoints y
+los escritores de Sheets despachan con get_chain(tipo) en lugar de ramas por cadena;
+el procesador del conciliador se registra en su fábrica (ProcessorFactory).
+
+Los patrones son datos y se registran al importar; el parser y las funciones de
+Sheets se importan en el primer uso. TICKET_CHAINS (p. ej. "OXXO") limita las
+cadenas habilitadas: las demás no se detectan ni se importan.
+
+Una cadena nueva se agrega con register_chain.
+"""
+
+import importlib
+import os
+from functools import cached_property
+
+from .parse_cache import parse_cache
+from .ticket_detector import register_chain_patterns
+
+# Cadenas habilitadas, separadas por coma (vacío: todas las registradas)
+ENABLED_CHAINS = [name.strip().upper() for name in os.environ.get("TICKET_CHAINS", "").split(",") if name.strip()]
+
+_CHAINS = {}
+
+
+def _load(path):
+    """'modulo:atributo' (módulo del paquete services) → objeto"""
+    module_name, _, attribute = path.partition(":")
+    return getattr(importlib.import_module(f".{module_name}", __package__), attribute)
+
+
+class RetailChain:
+    """Una cadena registrada; el parser y las funciones de Sheets se cargan al usarse"""
+
+    def __init__(self, name, parser, sheets_index, sheets_planner, quantity_field, ticket_fields,
+                 product_log_fields=(), product_signature=None, verify_first_product=False):
+        self.name = name
+        self._parser_path = parser
+        self._sheets_index_path = sheets_index
+        self._sheets_planner_path = sheets_planner
+        self.quantity_field = quantity_field
+        # {campo: valor por defecto}: los que identifican el ticket (llave de duplicados en Sheets)
+        self.ticket_fields = dict(ticket_fields)
+        # (etiqueta, campo) de cada producto en los logs
+        self.product_log_fields = tuple(product_log_fields)
+        # Campo de producto exclusivo de la cadena (tickets confirmados sin tipo)
+        self.product_signature = product_signature
+        # Con varios productos, /upload verifica primero el primero en Sheets (ticket completo repetido)
+        self.verify_first_product = verify_first_product
+
+    def __repr__(self):
+        return f"RetailChain({self.name!r})"
+
+    @cached_property
+    def parser(self):
+        """texto OCR → lista de productos (o dict con 'error')"""
+        return _load(self._parser_path)
+
+    @cached_property
+    def sheets_index(self):
+        """(all_values, headers) → índice de los tickets existentes en la hoja"""
+        return _load(self._sheets_index_path)
+
+    @cached_property
+    def sheets_planner(self):
+        """(productos, índice, origen) → (resultado, filas a escribir)"""
+        return _load(self._sheets_planner_path)
+
+    @cached_property
+    def parser_version(self):
+        """PARSER_VERSION del módulo del parser (parte de la llave del caché de parseo)"""
+        return getattr(importlib.import_module(self.parser.__module__), "PARSER_VERSION", 0)
+
+    def parse(self, ocr_text):
+        """Productos del ticket; el mismo texto se parsea una sola vez (parse_cache)"""
+        return parse_cache.parse(self.name, self.parser_version, self.parser, ocr_text)
+
+    def quantity(self, item):
+        return item.get(self.quantity_field, 0)
+
+    def describe_product(self, item):
+        return ", ".join(f"{label}={item.get(field)}" for label, field in self.product_log_fields)
+
+    def extract_ticket_fields(self, first_item):
+        """Campos propios de la cadena para la respuesta de /process-tickets"""
+        return {field: first_item.get(field, default) for field, default in self.ticket_fields.items()}
+
+
+def register_chain(name, patterns, **chain_args):
+    """
+    Registra una cadena (si está habilitada) con sus patrones de detección
+
+    Args:
+        name: Tipo de ticket ("OXXO", "KIOSKO", ...)
+        patterns: Argumentos de ticket_detector.register_chain_patterns
+        **chain_args: Argumentos de RetailChain (rutas 'modulo:funcion' del parser y de Sheets, campos)
+
+    Returns:
+        RetailChain o None si la cadena no está habilitada
+    """
+    if ENABLED_CHAINS and name not in ENABLED_CHAINS:
+        return None
+    register_chain_patterns(name, **patterns)
+    chain = _CHAINS[name] = RetailChain(name, **chain_args)
+    return chain
+
+
+def get_chain(name):
+    """Cadena registrada por tipo de ticket, o None"""
+    return _CHAINS.get(name)
+
+
+def enabled_chains():
+    return list(_CHAINS.values())
+
+
+def infer_chain(productos):
+    """
+    Cadena de unos productos sin tipo (tickets confirmados de versiones anteriores):
+    la que tenga su campo exclusivo en algún producto o, si ninguna, la que no tiene campo exclusivo
+    """
+    default = None
+    for chain in _CHAINS.values():
+        if chain.product_signature is None:
+            default = default or chain
+        elif any(chain.product_signature in producto for producto in productos):
+            return chain
+    return default
+
+
+# KIOSKO primero: sus patrones definitivos se revisan antes que los de OXXO
+KIOSKO_PRODUCT_CODES = ("7500465096004", "7500465096011")
+
+register_chain(
+    "KIOSKO",
+    patterns=dict(
+        definitive=("FOLIO:", "ENTRADA POR COMPRA", "GAS CARDONES", "GAS LOMAS", "SKUS", "TOTAL: UNIDADES"),
+        secondary=("FOLIO ", "IMPUESTOS:", "SUBTOTAL:", "BOLSA DE HIELO SANTI ICE", "CODIGO DE BARRAS",
+                   "UNIDADES", "IMPORTE UNITARIO"),
+        # Los códigos de producto aparecen más en tickets KIOSKO ("750046509601": 15kg con el último dígito cortado)
+        product_codes=(*KIOSKO_PRODUCT_CODES, "750046509601"),
+        product_code_weight=2,
+        # KIOSKO tiende a tener más líneas estructuradas
+        min_lines=20,
+        min_lines_weight=1,
+        validations=(
+            (("FOLIO:",), "Falta patrón 'FOLIO:' típico de KIOSKO", 20),
+            (KIOSKO_PRODUCT_CODES, "No se encontraron códigos de producto esperados", 15),
+            (("GAS",), "Falta referencia a estación de gas", 10),
+        ),
+    ),
+    parser="textprocess_KIOSKO:process_text_kiosko",
+    sheets_index="google_sheets:_build_kiosko_index",
+    sheets_planner="google_sheets:_plan_kiosko_ticket",
+    quantity_field="numeroPiezasCompradas",
+    ticket_fields={"folio": "No detectado"},
+    product_log_fields=(("Tipo", "tipoProducto"), ("Cantidad", "numeroPiezasCompradas")),
+)
+
+register_chain(
+    "OXXO",
+    patterns=dict(
+        definitive=("PEDIDO ADICIONAL", "MOVTS. VALORIZADOS", "MOVIMIENTOS VALORIZADOS", "FOL-GOMA",
+                    "SUJETO A REVISION"),
+        secondary=("REMISION", "TIENDA:", "PLAZA:", "FECHA ADMVA", "ORDEN DE COMPRA", "UDS", "U.COM",
+                   "VAL.TOT", "VALTOT", "CUL"),
+        # OXXO tiende a tener patrones de columnas específicos
+        same_line=(("UDS", "COM"),),
+        same_line_weight=2,
+        # Heurística: OXXO es más común, se usa por defecto si hay alguna evidencia
+        fallback=("TIENDA", "PLAZA"),
+        validations=(
+            (("TIENDA:", "PLAZA:"), "Falta información de tienda/plaza típica de OXXO", 15),
+            (("REMISION", "PEDIDO"), "Falta información de remisión/pedido", 20),
+            (("UDS", "U.COM", "VAL.TOT"), "Falta estructura de columnas típica de OXXO", 10),
+        ),
+    ),
+    parser="textprocess_OXXO:process_text_oxxo",
+    sheets_index="google_sheets:_build_oxxo_index",
+    sheets_planner="google_sheets:_plan_oxxo_ticket",
+    quantity_field="cantidad",
+    ticket_fields={"remision": "No detectada", "pedido_adicional": "No detectado"},
+    product_log_fields=(("Costo", "costo"), ("Cantidad", "cantidad")),
+    product_signature="costo",
+    verify_first_product=True,
+)
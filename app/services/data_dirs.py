@@ -0,0 +1,41 @@
+"""
+Ubicación de los datos que el servidor guarda en disco (almacén de imágenes, historial
+de fotos, cola, ledger y métricas del conciliador) y conexión a sus bases SQLite.
+
+Fuera de Lambda todo vive bajo data/ (relativo al directorio de trabajo). En Lambda solo
+/tmp es escribible, así que la raíz pasa a /tmp/santiice; ahí los datos duran lo que el
+contenedor. SANTIICE_DATA_DIR cambia la raíz y cada módulo conserva su propia variable
+de entorno para mover una ruta concreta.
+
+Las bases SQLite se abren con una conexión por operación: así las comparten sin más los
+hilos del servidor, los procesos de trabajo del conciliador y varios procesos uvicorn.
+"""
+
+import os
+import sqlite3
+from pathlib import Path
+
+IS_LAMBDA = os.environ.get("AWS_EXECUTION_ENV") is not None
+
+DATA_DIR = Path(os.environ.get("SANTIICE_DATA_DIR", "/tmp/santiice" if IS_LAMBDA else "data"))
+
+
+def data_path(env_var, *parts):
+    """
+    Ruta de un archivo o carpeta de datos
+
+    Args:
+        env_var: Variable de entorno que, si está definida, reemplaza la ruta
+        parts: Ruta relativa a DATA_DIR
+
+    Returns:
+        str: Ruta a usar
+    """
+    return os.environ.get(env_var) or str(DATA_DIR.joinpath(*parts))
+
+
+def connect_sqlite(db_path):
+    """Conexión nueva a una base SQLite de datos (filas como sqlite3.Row)"""
+    conn = sqlite3.connect(str(db_path), timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
@@ -2,35 +2,41 @@ import json
 import boto3
 from google.oauth2.service_account import Credentials
 import os
+import threading
 import gspread
+from gspread.utils import rowcol_to_a1
+
+from .chains import get_chain
 
 # 📌 Configuración de Google Sheets
 SHEET_ID = "1fjyyofqYP36bGEzRKPhEtzzL1VLT4KkU8EFc4WbaeQM"  # ID de Google Sheet
 SHEET_NAME = "Base de Datos"  # Nombre de la hoja
 CREDENTIALS_PATH = "/Users/analistadesoporte/SantiICE-OCR/service_account.json"
 
-def send_to_google_sheets(sucursal: str, data: list, precios_config: dict = None, origen: str = "extracción"):
+# Hoja autenticada (se reutiliza entre llamadas)
+_sheet = None
+
+# Lectura → verificación de duplicados → escritura es una sola sección: las filas nuevas se
+# escriben en len(all_values) + 1 y los endpoints corren en hilos (asyncio.to_thread). Sin el
+# candado, dos tickets simultáneos leen el mismo conteo y uno pisa las filas del otro.
+# Protege a un solo proceso: con varios workers de uvicorn hace falta otro mecanismo.
+_sheet_lock = threading.Lock()
+
+def _normalize_ticket_data(sucursal, data):
     """
-    Envía datos a Google Sheets y verifica si ya existen registros duplicados.
-    
-    Args:
-        sucursal: String con el nombre de la sucursal ('OXXO' o 'KIOSKO')
-        data: Lista de diccionarios con los datos a enviar
-        
+    Valida y normaliza los datos de un ticket antes de enviarlos.
+
     Returns:
-        dict: Diccionario con el resultado de la operación
+        tuple: (lista de productos, None) o (None, dict de error)
     """
-    print(f"🔍 Datos recibidos en send_to_google_sheets: {data}")
-    print(f"📝 Origen del registro: {origen}")
-    
     # Validar parámetros de entrada
     if not sucursal:
         print("❌ Error: No se proporcionó la sucursal.")
-        return {"success": False, "message": "No se proporcionó la sucursal.", "duplicated": False}
+        return None, {"success": False, "message": "No se proporcionó la sucursal.", "duplicated": False}
     
     if not data or not isinstance(data, (dict, list)):
         print("❌ Error: Formato de datos no válido.")
-        return {"success": False, "message": "Formato de datos no válido para Google Sheets.", "duplicated": False}
+        return None, {"success": False, "message": "Formato de datos no válido para Google Sheets.", "duplicated": False}
 
     # Convertir a lista si es un diccionario
     if isinstance(data, dict):
@@ -41,27 +47,58 @@ def send_to_google_sheets(sucursal: str, data: list, precios_config: dict = None
     
     if not data:
         print("❌ Error: No hay datos válidos para procesar.")
-        return {"success": False, "message": "No hay datos válidos para procesar.", "duplicated": False}
-    
-    try:
+        return None, {"success": False, "message": "No hay datos válidos para procesar.", "duplicated": False}
+
+    return data, None
+
+
+def get_sheet():
+    """
+    Devuelve la hoja de Google Sheets autenticada.
+    El cliente se reutiliza entre llamadas; gspread renueva el token cuando expira.
+    """
+    global _sheet
+    if _sheet is None:
         # 🔐 Autenticación con la cuenta de servicio
         credentials_path = get_google_credentials()
         creds = Credentials.from_service_account_file(credentials_path, scopes=["https://www.googleapis.com/auth/spreadsheets"])
         client = gspread.authorize(creds)
-        sheet = client.open_by_key(SHEET_ID).worksheet(SHEET_NAME)
+        _sheet = client.open_by_key(SHEET_ID).worksheet(SHEET_NAME)
+    return _sheet
 
-        # 📊 Obtener todos los datos actuales
-        all_values = sheet.get_all_values()
-        headers = all_values[0] if all_values else []
+
+def send_to_google_sheets(sucursal: str, data: list, precios_config: dict = None, origen: str = "extracción"):
+    """
+    Envía datos a Google Sheets y verifica si ya existen registros duplicados.
+    
+    Args:
+        sucursal: Tipo de ticket de una cadena registrada ('OXXO', 'KIOSKO', ...)
+        data: Lista de diccionarios con los datos a enviar
         
-        # Procesamiento específico por tipo de sucursal
-        if sucursal == "OXXO":
-            return process_oxxo_tickets(data, all_values, headers, sheet, precios_config, origen)
-        elif sucursal == "KIOSKO":
-            return process_kiosko_tickets(data, all_values, headers, sheet, precios_config, origen)
-        else:
-            print(f"❌ Tipo de sucursal no reconocido: {sucursal}")
-            return {"success": False, "message": f"Tipo de sucursal no reconocido: {sucursal}", "duplicated": False}
+    Returns:
+        dict: Diccionario con el resultado de la operación
+    """
+    print(f"🔍 Datos recibidos en send_to_google_sheets: {data}")
+    print(f"📝 Origen del registro: {origen}")
+    
+    data, error = _normalize_ticket_data(sucursal, data)
+    if error:
+        return error
+    
+    chain = get_chain(sucursal)
+    if chain is None:
+        return _unknown_chain_result(sucursal)
+    
+    try:
+        sheet = get_sheet()
+
+        with _sheet_lock:
+            # 📊 Obtener todos los datos actuales
+            all_values = sheet.get_all_values()
+            headers = all_values[0] if all_values else []
+            
+            # Índice y filas según la cadena del ticket
+            return process_chain_tickets(chain, data, all_values, headers, sheet, origen)
 
     except gspread.exceptions.APIError as api_error:
         print(f"❌ Error en API de Google Sheets: {api_error}")
@@ -80,82 +117,210 @@ def send_to_google_sheets(sucursal: str, data: list, precios_config: dict = None
         }
 
 
-def process_oxxo_tickets(data, all_values, headers, sheet, precios_config=None, origen="extracción"):
+def send_tickets_bulk(tickets: list, precios_config: dict = None):
     """
-    Procesa tickets de OXXO para verificar duplicados y guardarlos.
+    Envía un lote de tickets a Google Sheets con una sola lectura y una sola escritura.
+    Cada ticket se verifica contra la hoja y contra los tickets anteriores del mismo lote.
+    
+    Args:
+        tickets: Lista de diccionarios con 'sucursal' (tipo de ticket), 'data' (productos) y 'origen'
+        precios_config: Configuración de precios
+        
+    Returns:
+        list: Un diccionario de resultado por ticket, en el mismo orden y formato que send_to_google_sheets
     """
-    if not data:
-        return {"success": False, "message": "No hay datos para procesar", "duplicated": False}
+    results = [None] * len(tickets)
+    normalized = []
     
-    # Extraer información del primer elemento para identificar el ticket
-    remision = str(data[0].get("remision", "")).strip()
-    pedido = str(data[0].get("pedido_adicional", "")).strip()
+    for i, ticket in enumerate(tickets):
+        data, error = _normalize_ticket_data(ticket.get("sucursal"), ticket.get("data"))
+        if error:
+            results[i] = error
+        else:
+            normalized.append((i, ticket, data))
     
-    print(f"🔍 Procesando ticket OXXO - Remisión: {remision}, Pedido: {pedido}")
+    if not normalized:
+        return results
     
+    # Lectura, verificación y escritura sin intercalarse con /upload u otra confirmación
+    with _sheet_lock:
+        pending_rows = _send_bulk_locked(normalized, results)
+    
+    print(f"📊 Lote enviado: {len(tickets)} tickets, {len(pending_rows)} filas nuevas")
+    return results
+
+
+def _send_bulk_locked(normalized, results):
+    """
+    Lectura única, verificación de duplicados y escritura única de send_tickets_bulk.
+    Se llama con _sheet_lock tomado; llena results y devuelve las filas escritas.
+    """
+    try:
+        sheet = get_sheet()
+
+        # 📊 Una sola lectura de la hoja para todo el lote
+        all_values = sheet.get_all_values()
+        headers = all_values[0] if all_values else []
+    except Exception as e:
+        print(f"❌ Error leyendo Google Sheets: {e}")
+        message = f"APIError: {str(e)}" if isinstance(e, gspread.exceptions.APIError) else str(e)
+        for i, _, _ in normalized:
+            results[i] = {"success": False, "message": message, "duplicated": False}
+        return []
+    
+    # Índice de la hoja por cadena, construido la primera vez que el lote la necesita
+    indexes = {}
+    pending_rows = []
+    written = []
+    
+    for i, ticket, data in normalized:
+        sucursal = ticket.get("sucursal")
+        origen = ticket.get("origen", "extracción")
+        chain = get_chain(sucursal)
+        try:
+            if chain is None:
+                result, rows = _unknown_chain_result(sucursal), []
+            else:
+                if chain.name not in indexes:
+                    indexes[chain.name] = chain.sheets_index(all_values, headers)
+                result, rows = chain.sheets_planner(data, indexes[chain.name], origen)
+        except Exception as e:
+            print(f"❌ Error inesperado: {e}")
+            result, rows = {"success": False, "message": str(e), "duplicated": False}, []
+        
+        results[i] = result
+        if rows:
+            pending_rows.extend(rows)
+            written.append(i)
+    
+    if pending_rows:
+        try:
+            _write_rows(sheet, len(all_values) + 1, pending_rows)
+        except Exception as e:
+            print(f"❌ Error escribiendo en Google Sheets: {e}")
+            message = f"APIError: {str(e)}" if isinstance(e, gspread.exceptions.APIError) else str(e)
+            for i in written:
+                results[i] = {"success": False, "message": message, "duplicated": False}
+    
+    return pending_rows
+
+
+def _unknown_chain_result(sucursal):
+    print(f"❌ Tipo de sucursal no reconocido: {sucursal}")
+    return {"success": False, "message": f"Tipo de sucursal no reconocido: {sucursal}", "duplicated": False}
+
+
+def process_chain_tickets(chain, data, all_values, headers, sheet, origen="extracción"):
+    """
+    Procesa los productos de un ticket de la cadena: verifica duplicados contra la hoja y los guarda.
+    Se llama con _sheet_lock tomado desde la lectura de all_values.
+    """
+    index = chain.sheets_index(all_values, headers)
+    result, rows = chain.sheets_planner(data, index, origen)
+    if rows:
+        _write_rows(sheet, len(all_values) + 1, rows)
+    return result
+
+
+def _write_rows(sheet, start_row, rows):
+    """
+    Escribe varias filas nuevas en una sola petición a la API.
+    Solo se tocan las celdas con valor (igual que con update_cell), así no se
+    pisan fórmulas u otras columnas de la hoja.
+    
+    Args:
+        sheet: Hoja de gspread
+        start_row: Número de fila (1-based) donde empezar a escribir
+        rows: Lista de diccionarios {columna (1-based): valor}
+    """
+    data = []
+    for offset, row in enumerate(rows):
+        row_number = start_row + offset
+        columns = sorted(row)
+        
+        # Agrupar columnas contiguas en un solo rango (ej. C:F, I:K, O:P)
+        group = [columns[0]]
+        for col in columns[1:] + [None]:
+            if col is not None and col == group[-1] + 1:
+                group.append(col)
+                continue
+            data.append({
+                "range": f"{rowcol_to_a1(row_number, group[0])}:{rowcol_to_a1(row_number, group[-1])}",
+                "values": [[row[c] for c in group]]
+            })
+            if col is not None:
+                group = [col]
+    
+    sheet.batch_update(data, value_input_option="USER_ENTERED")
+    print(f"📄 Escritas {len(rows)} filas a partir de la fila {start_row}")
+
+
+def _build_oxxo_index(all_values, headers):
+    """
+    Indexa los productos OXXO existentes por (remisión, pedido).
+    
+    Returns:
+        dict: {(remision, pedido): {"5kg": bool, "15kg": bool}}
+    """
     # Crear índices de las columnas importantes
     col_indices = {}
     for i, header in enumerate(headers):
         col_indices[header] = i
     
-    # Imprimir las columnas para diagnóstico
-    print(f"📋 Columnas disponibles: {headers}")
-    
     # Determinar los índices de las columnas relevantes
     remision_col = col_indices.get("Remisión", -1)
     pedido_col = col_indices.get("No. Pedido", -1)
     producto_col = col_indices.get("Producto", -1)
     
-    # Imprimir los índices para depuración
     print(f"📊 Índices de columnas: Remisión={remision_col}, Pedido={pedido_col}, Producto={producto_col}")
     
-    # Lista para guardar los registros encontrados que coinciden con este ticket
-    registros_encontrados = []
+    index = {}
+    if remision_col == -1 or pedido_col == -1 or producto_col == -1:
+        return index
     
-    # Verificar qué productos ya existen en la base de datos
-    if remision_col != -1 and pedido_col != -1 and producto_col != -1:
-        # Buscar en todos los registros existentes
-        print(f"🔍 Buscando registros con remisión '{remision}' y pedido '{pedido}'...")
+    for row in all_values[1:]:  # Omitir encabezados
+        if len(row) <= max(remision_col, pedido_col, producto_col):
+            continue  # Fila demasiado corta, saltar
         
-        for row_idx, row in enumerate(all_values[1:], start=2):  # Omitir encabezados, empezar numerando desde 2
-            if len(row) <= max(remision_col, pedido_col, producto_col):
-                continue  # Fila demasiado corta, saltar
-                
-            record_remision = row[remision_col].strip() if remision_col < len(row) else ""
-            record_pedido = row[pedido_col].strip() if pedido_col < len(row) else ""
-            record_producto = row[producto_col].strip().lower() if producto_col < len(row) else ""
-            
-            # Verificar si este registro coincide con nuestro ticket
-            if record_remision == remision and record_pedido == pedido:
-                print(f"📋 Fila {row_idx}: Remisión='{record_remision}', Pedido='{record_pedido}', Producto='{record_producto}'")
-                registros_encontrados.append(row)
-    
-    # Determinar qué productos existen
-    productos_existentes = {"5kg": False, "15kg": False}
-    
-    for registro in registros_encontrados:
-        producto = registro[producto_col].strip().lower()
-        print(f"🔍 Analizando registro existente con producto: '{producto}'")
+        key = (row[remision_col].strip(), row[pedido_col].strip())
+        producto = row[producto_col].strip().lower()
+        productos_existentes = index.setdefault(key, {"5kg": False, "15kg": False})
         
         # IMPORTANTE: Verificación mutualmente excluyente
         if "5kg" in producto and "15kg" not in producto:
             productos_existentes["5kg"] = True
-            print(f"✅ Encontrado producto de 5kg existente en la base de datos")
         elif "15kg" in producto:
             productos_existentes["15kg"] = True
-            print(f"✅ Encontrado producto de 15kg existente en la base de datos")
     
-    # Imprimir un resumen de lo que encontramos
+    return index
+
+
+def _plan_oxxo_ticket(data, oxxo_index, origen="extracción"):
+    """
+    Decide qué productos de un ticket OXXO se insertan y arma sus filas.
+    Registra los productos aceptados en el índice para detectar duplicados
+    dentro del mismo lote.
+    
+    Returns:
+        tuple: (dict de resultado, lista de filas {columna: valor})
+    """
+    if not data:
+        return {"success": False, "message": "No hay datos para procesar", "duplicated": False}, []
+    
+    # Extraer información del primer elemento para identificar el ticket
+    remision = str(data[0].get("remision", "")).strip()
+    pedido = str(data[0].get("pedido_adicional", "")).strip()
+    
+    print(f"🔍 Procesando ticket OXXO - Remisión: {remision}, Pedido: {pedido}")
+    
+    # Determinar qué productos existen
+    productos_existentes = oxxo_index.get((remision, pedido), {"5kg": False, "15kg": False})
     print(f"📊 Resumen de productos existentes: 5kg={productos_existentes['5kg']}, 15kg={productos_existentes['15kg']}")
     
     # Clasificar los productos a insertar
     productos_a_insertar = []
     productos_duplicados = []
-    
-    # Imprimir los datos que estamos procesando
-    print(f"📦 Procesando {len(data)} productos para insertar/verificar:")
-    for idx, item in enumerate(data):
-        print(f"  📦 Producto {idx+1}: {item}")
+    tipos_insertados = set()
     
     for item in data:
         costo = item.get("costo", 0)
@@ -169,16 +334,14 @@ def process_oxxo_tickets(data, all_values, headers, sheet, precios_config=None,
         else:
             tipo = "otro"
             descripcion = f"Producto con costo {costo}"
-            
-        print(f"🔍 Analizando producto: {descripcion}, Costo: {costo}")
         
         # Verificar si este tipo de producto ya existe
         if tipo in productos_existentes and productos_existentes[tipo]:
             print(f"⚠️ Producto {descripcion} ya existe en la base de datos para este ticket")
             productos_duplicados.append(item)
         else:
-            print(f"✅ Producto {descripcion} no existe en la base de datos para este ticket")
             productos_a_insertar.append(item)
+            tipos_insertados.add(tipo)
     
     # Si todos son duplicados
     if not productos_a_insertar and productos_duplicados:
@@ -189,82 +352,67 @@ def process_oxxo_tickets(data, all_values, headers, sheet, precios_config=None,
                 "success": False,
                 "message": f"El ticket de OXXO con remisión {remision} y pedido {pedido} ya existe completo.",
                 "duplicated": True
-            }
+            }, []
         else:
             # Si no encontramos ambos tipos pero aún así no hay nada que insertar
             return {
                 "success": False,
                 "message": f"Los productos específicos que intentas insertar ya existen para este ticket.",
                 "duplicated": True
-            }
+            }, []
+    
+    if not productos_a_insertar:
+        return {
+            "success": False,
+            "message": "No se pudo guardar ningún producto nuevo.",
+            "duplicated": True
+        }, []
     
-    # Si tenemos productos para guardar, procedemos
-    if productos_a_insertar:
-        # Obtener la última fila ocupada
-        last_filled_row = len(all_values)
-        initial_row_count = last_filled_row
+    rows = []
+    for item in productos_a_insertar:
+        # Usar la descripción que viene del frontend
+        descripcion = item.get("descripcion", "Producto desconocido")
         
-        print(f"📄 Última fila ocupada: {last_filled_row}, insertando en: {initial_row_count}")
+        # Usar el precio que viene del frontend (campo 'costo')
+        cantidad = item.get("cantidad", 0)
+        precio_unitario = item.get("costo", 17.5)  # Usar el costo enviado desde el frontend
         
-        successful_inserts = 0
+        total_venta = precio_unitario * cantidad
         
-        for item in productos_a_insertar:
-            # Usar la descripción que viene del frontend
-            descripcion = item.get("descripcion", "Producto desconocido")
-            
-            print(f"📝 Guardando: {descripcion} - Cantidad: {item['cantidad']} - Remisión: {remision} - Pedido: {pedido}")
-            
-            # Insertar una nueva fila
-            initial_row_count += 1
-            
-            # Usar el precio que viene del frontend (campo 'costo')
-            cantidad = item.get("cantidad", 0)
-            precio_unitario = item.get("costo", 17.5)  # Usar el costo enviado desde el frontend
-            
-            total_venta = precio_unitario * cantidad
-            
-            print(f"💰 Calculando total: {cantidad} x {precio_unitario} = {total_venta}")
-            
-            # Actualizar celdas en Google Sheets
-            sheet.update_cell(initial_row_count, 3, item["fecha"])
-            sheet.update_cell(initial_row_count, 4, descripcion)
-            sheet.update_cell(initial_row_count, 5, item["cantidad"])
-            sheet.update_cell(initial_row_count, 6, "OXXO")
-            sheet.update_cell(initial_row_count, 9, item["sucursal"])
-            sheet.update_cell(initial_row_count, 10, item["remision"])
-            sheet.update_cell(initial_row_count, 11, item["pedido_adicional"])
-            sheet.update_cell(initial_row_count, 15, total_venta)  # Columna O (15)
-            sheet.update_cell(initial_row_count, 16, origen)  # Columna P (16) - extraido/manual
-            successful_inserts += 1
+        print(f"📝 Guardando: {descripcion} - Cantidad: {item['cantidad']} - Remisión: {remision} - Pedido: {pedido} - Total: {total_venta}")
         
-        if successful_inserts > 0:
-            if productos_duplicados:
-                return {
-                    "success": True,
-                    "message": f"Se guardaron {successful_inserts} productos. Se omitieron {len(productos_duplicados)} productos duplicados.",
-                    "duplicated": False
-                }
-            else:
-                return {
-                    "success": True,
-                    "message": f"Se guardaron {successful_inserts} productos correctamente.",
-                    "duplicated": False
-                }
-    
-    return {
-        "success": False,
-        "message": "No se pudo guardar ningún producto nuevo.",
-        "duplicated": True
-    }
+        rows.append({
+            3: item["fecha"],
+            4: descripcion,
+            5: item["cantidad"],
+            6: "OXXO",
+            9: item["sucursal"],
+            10: item["remision"],
+            11: item["pedido_adicional"],
+            15: total_venta,  # Columna O (15)
+            16: origen,  # Columna P (16) - extraido/manual
+        })
+    
+    # Registrar los productos aceptados para los siguientes tickets del lote
+    productos_registrados = oxxo_index.setdefault((remision, pedido), {"5kg": False, "15kg": False})
+    for tipo in tipos_insertados & {"5kg", "15kg"}:
+        productos_registrados[tipo] = True
+    
+    if productos_duplicados:
+        message = f"Se guardaron {len(rows)} productos. Se omitieron {len(productos_duplicados)} productos duplicados."
+    else:
+        message = f"Se guardaron {len(rows)} productos correctamente."
+    
+    return {"success": True, "message": message, "duplicated": False}, rows
 
 
-def process_kiosko_tickets(data, all_values, headers, sheet, precios_config=None, origen="extracción"):
+def _build_kiosko_index(all_values, headers):
     """
-    Procesa tickets de KIOSKO para verificar duplicados y guardarlos.
-    """
-    if not data:
-        return {"success": False, "message": "No hay datos para procesar", "duplicated": False}
+    Indexa los tickets KIOSKO existentes por folio.
     
+    Returns:
+        dict: {folio: [fechas]} con los folios no vacíos de la hoja
+    """
     # Crear índices de las columnas importantes
     col_indices = {}
     for i, header in enumerate(headers):
@@ -274,6 +422,139 @@ def process_kiosko_tickets(data, all_values, headers, sheet, precios_config=None
     fecha_col = col_indices.get("Submitted at", -1)
     producto_col = col_indices.get("Producto", -1)
     
+    index = {}
+    for row in all_values[1:]:  # Omitir encabezados
+        if folio_col >= len(row) or fecha_col >= len(row) or producto_col >= len(row):
+            continue  # Fila demasiado corta, saltar
+        
+        record_folio = row[folio_col].strip()
+        
+        # Ignorar registros con folios vacíos
+        if not record_folio:
+            continue
+        
+        index.setdefault(record_folio, []).append(row[fecha_col].strip())
+    
+    return index
+
+
+def _kiosko_ticket_exists(folio, fecha, kiosko_index):
+    """Busca un folio+fecha en el índice, aceptando coincidencias parciales como antes"""
+    def fecha_match(record_fecha):
+        return (fecha == record_fecha) or (
+            len(fecha) > 5 and len(record_fecha) > 5 and
+            (fecha in record_fecha or record_fecha in fecha)
+        )
+    
+    # Coincidencia exacta de folio (caso común, búsqueda directa)
+    if any(fecha_match(record_fecha) for record_fecha in kiosko_index.get(folio, ())):
+        return True
+    
+    # Coincidencia parcial de folio (folios mal leídos por el OCR)
+    if len(folio) <= 3:
+        return False
+    
+    for record_folio, fechas in kiosko_index.items():
+        if len(record_folio) > 3 and (folio in record_folio or record_folio in folio):
+            if any(fecha_match(record_fecha) for record_fecha in fechas):
+                return True
+    
+    return False
+
+
+def _kiosko_row(item, origen="extracción"):
+    """Arma la fila de Google Sheets para un producto KIOSKO"""
+    # Determinar el tipo de producto
+    if "tipoProducto" in item and item["tipoProducto"]:
+        descripcion = item["tipoProducto"]
+    elif "descripcion" in item and item["descripcion"]:
+        descripcion = item["descripcion"]
+    elif "importeUnitario" in item:
+        importe_unitario = float(item["importeUnitario"])
+        if importe_unitario == 15.0 or importe_unitario == 16.0:
+            descripcion = "Bolsa de 5kg"
+        elif importe_unitario == 45.0:
+            descripcion = "Bolsa de 15kg"
+        else:
+            descripcion = f"Producto con importe {importe_unitario}"
+    else:
+        descripcion = "Producto desconocido"
+    
+    # Determinar la cantidad de piezas
+    if "numeroPiezasCompradas" in item and item["numeroPiezasCompradas"]:
+        cantidad = item["numeroPiezasCompradas"]
+    else:
+        # Cálculo de respaldo si no tenemos la cantidad directa
+        importe_total = item.get("importeTotal", 0)
+        importe_unitario = item.get("importeUnitario", 0)
+        if importe_unitario > 0 and importe_total > 0:
+            cantidad = round(importe_total / importe_unitario)
+        else:
+            cantidad = 0
+    
+    # Determinar tipo de producto
+    sucursal_nombre = item.get("nombreTienda", "")
+    
+    if "tipoProducto" in item and item["tipoProducto"]:
+        if "15kg" in item["tipoProducto"].lower() or "15 kg" in item["tipoProducto"].lower():
+            tipo_producto = "15kg"
+        elif "5kg" in item["tipoProducto"].lower() or "5 kg" in item["tipoProducto"].lower():
+            tipo_producto = "5kg"
+        else:
+            tipo_producto = "5kg"
+    elif "descripcion" in item and item["descripcion"]:
+        if "15" in item["descripcion"]:
+            tipo_producto = "15kg"
+        elif "5" in item["descripcion"]:
+            tipo_producto = "5kg"
+        else:
+            tipo_producto = "5kg"
+    else:
+        tipo_producto = "5kg"
+    
+    # Precios por defecto con excepciones específicas
+    sucursales_44_pesos = ["Occidental", "Solidaridad", "Miguel Hidalgo", "Francisco Perez"]
+    
+    if tipo_producto == "15kg" and sucursal_nombre in sucursales_44_pesos:
+        precio_unitario = 44.0
+    elif tipo_producto == "15kg":
+        precio_unitario = 45.0
+    else:
+        precio_unitario = 16.0
+    
+    total_venta = precio_unitario * cantidad
+    
+    print(f"💰 Calculando total KIOSKO ({sucursal_nombre}, {tipo_producto}): {cantidad} x {precio_unitario} = {total_venta}")
+    
+    row = {
+        13: item["folio"],
+        3: item["fecha"],
+        4: descripcion,
+        5: cantidad,
+        6: "KIOSKO",
+        15: total_venta,  # Columna O (15)
+        16: origen,  # Columna P (16) - extraido/manual
+    }
+    
+    # Usar nombreTienda si está disponible
+    if "nombreTienda" in item and item["nombreTienda"] and item["nombreTienda"] != "No encontrada":
+        row[12] = item["nombreTienda"]
+    
+    return row
+
+
+def _plan_kiosko_ticket(data, kiosko_index, origen="extracción"):
+    """
+    Decide qué productos de un ticket KIOSKO se insertan y arma sus filas.
+    Registra los folios aceptados en el índice para detectar duplicados
+    dentro del mismo lote.
+    
+    Returns:
+        tuple: (dict de resultado, lista de filas {columna: valor})
+    """
+    if not data:
+        return {"success": False, "message": "No hay datos para procesar", "duplicated": False}, []
+    
     # Lista para guardar productos a guardar o duplicados
     productos_a_insertar = []
     productos_duplicados = []
@@ -282,7 +563,6 @@ def process_kiosko_tickets(data, all_values, headers, sheet, precios_config=None
     folios_duplicados = set()
     
     for item in data:
-        print(f"🔍 Verificando producto KIOSKO: {item}")
         is_duplicate = False
         
         if "folio" in item:
@@ -292,63 +572,14 @@ def process_kiosko_tickets(data, all_values, headers, sheet, precios_config=None
             # Si este folio ya fue detectado como duplicado, marcar este item como duplicado también
             if folio_to_check in folios_duplicados:
                 print(f"⚠️ Folio '{folio_to_check}' ya marcado como duplicado anteriormente.")
-                is_duplicate = True
                 continue
             
             fecha_to_check = str(item.get("fecha", "")).strip()
             
-            # Determinar el tipo de producto
-            if "tipoProducto" in item and item["tipoProducto"]:
-                tipo_producto_to_check = item["tipoProducto"]
-            elif "descripcion" in item and "5" in item["descripcion"]:
-                tipo_producto_to_check = "Bolsa de 5kg"
-            elif "descripcion" in item and "15" in item["descripcion"]:
-                tipo_producto_to_check = "Bolsa de 15kg"
-            elif "importeUnitario" in item:
-                importe = float(item["importeUnitario"])
-                if importe == 15.0 or importe == 16.0:
-                    tipo_producto_to_check = "Bolsa de 5kg"
-                elif importe == 45.0:
-                    tipo_producto_to_check = "Bolsa de 15kg"
-                else:
-                    tipo_producto_to_check = f"Producto con importe {importe}"
-            else:
-                tipo_producto_to_check = "Producto desconocido"
-            
-            print(f"🔎 Buscando ticket KIOSKO con folio: '{folio_to_check}', fecha: '{fecha_to_check}', tipo: '{tipo_producto_to_check}'")
-            
-            # Buscar en todos los registros existentes
-            for row in all_values[1:]:  # Omitir encabezados
-                if folio_col >= len(row) or fecha_col >= len(row) or producto_col >= len(row):
-                    continue  # Fila demasiado corta, saltar
-                    
-                record_folio = row[folio_col].strip()
-                record_fecha = row[fecha_col].strip()
-                
-                # Ignorar registros con folios vacíos
-                if not record_folio:
-                    continue
-                
-                # Verificar si es el mismo folio
-                folio_match = (folio_to_check == record_folio) or (
-                    len(folio_to_check) > 3 and len(record_folio) > 3 and 
-                    (folio_to_check in record_folio or record_folio in folio_to_check)
-                )
-                
-                if folio_match:
-                    print(f"⚠️ Posible coincidencia de folio encontrada: '{folio_to_check}' vs '{record_folio}'")
-                    
-                    # También verificar la fecha
-                    fecha_match = (fecha_to_check == record_fecha) or (
-                        len(fecha_to_check) > 5 and len(record_fecha) > 5 and
-                        (fecha_to_check in record_fecha or record_fecha in fecha_to_check)
-                    )
-                    
-                    if fecha_match:
-                        print(f"⚠️ Ticket KIOSKO duplicado encontrado: Folio '{folio_to_check}', Fecha '{fecha_to_check}'")
-                        is_duplicate = True
-                        folios_duplicados.add(folio_to_check)
-                        break
+            if _kiosko_ticket_exists(folio_to_check, fecha_to_check, kiosko_index):
+                print(f"⚠️ Ticket KIOSKO duplicado encontrado: Folio '{folio_to_check}', Fecha '{fecha_to_check}'")
+                is_duplicate = True
+                folios_duplicados.add(folio_to_check)
         
         # Si no es duplicado, lo agregamos a la lista para guardar
         if not is_duplicate:
@@ -362,125 +593,30 @@ def process_kiosko_tickets(data, all_values, headers, sheet, precios_config=None
             "success": False, 
             "message": f"El ticket de KIOSKO con folio {productos_duplicados[0].get('folio', '')} ya existe.",
             "duplicated": True
-        }
+        }, []
     
-    # Si tenemos productos para guardar, procedemos
-    if productos_a_insertar:
-        # Obtener la última fila ocupada
-        last_filled_row = len(all_values)
-        initial_row_count = last_filled_row
-        
-        print(f"📄 Última fila ocupada: {last_filled_row}, insertando en: {initial_row_count}")
-        
-        successful_inserts = 0
-        
-        for item in productos_a_insertar:
-            # Determinar el tipo de producto
-            if "tipoProducto" in item and item["tipoProducto"]:
-                descripcion = item["tipoProducto"]
-            elif "descripcion" in item and item["descripcion"]:
-                descripcion = item["descripcion"]
-            elif "importeUnitario" in item:
-                importe_unitario = float(item["importeUnitario"])
-                if importe_unitario == 15.0 or importe_unitario == 16.0:
-                    descripcion = "Bolsa de 5kg"
-                elif importe_unitario == 45.0:
-                    descripcion = "Bolsa de 15kg"
-                else:
-                    descripcion = f"Producto con importe {importe_unitario}"
-            else:
-                descripcion = "Producto desconocido"
-            
-            # Determinar la cantidad de piezas
-            if "numeroPiezasCompradas" in item and item["numeroPiezasCompradas"]:
-                cantidad = item["numeroPiezasCompradas"]
-            else:
-                # Cálculo de respaldo si no tenemos la cantidad directa
-                importe_total = item.get("importeTotal", 0)
-                importe_unitario = item.get("importeUnitario", 0)
-                if importe_unitario > 0 and importe_total > 0:
-                    cantidad = round(importe_total / importe_unitario)
-                else:
-                    cantidad = 0
-            
-            # Determinar tipo de producto
-            sucursal_nombre = item.get("nombreTienda", "")
-            
-            if "tipoProducto" in item and item["tipoProducto"]:
-                if "15kg" in item["tipoProducto"].lower() or "15 kg" in item["tipoProducto"].lower():
-                    tipo_producto = "15kg"
-                elif "5kg" in item["tipoProducto"].lower() or "5 kg" in item["tipoProducto"].lower():
-                    tipo_producto = "5kg"
-                else:
-                    tipo_producto = "5kg"
-            elif "descripcion" in item and item["descripcion"]:
-                if "15" in item["descripcion"]:
-                    tipo_producto = "15kg"
-                elif "5" in item["descripcion"]:
-                    tipo_producto = "5kg"
-                else:
-                    tipo_producto = "5kg"
-            else:
-                tipo_producto = "5kg"
-            
-            # Precios por defecto con excepciones específicas
-            sucursales_44_pesos = ["Occidental", "Solidaridad", "Miguel Hidalgo", "Francisco Perez"]
-            
-            print(f"🔍 Debug precios - Sucursal: '{sucursal_nombre}', Tipo: '{tipo_producto}'")
-            print(f"🔍 Sucursales $44: {sucursales_44_pesos}")
-            print(f"🔍 ¿Está en lista?: {sucursal_nombre in sucursales_44_pesos}")
-            
-            if tipo_producto == "15kg" and sucursal_nombre in sucursales_44_pesos:
-                precio_unitario = 44.0
-                print(f"💰 Aplicando precio especial $44 para {sucursal_nombre}")
-            elif tipo_producto == "15kg":
-                precio_unitario = 45.0
-                print(f"💰 Aplicando precio normal $45 para 15kg")
-            else:
-                precio_unitario = 16.0
-                print(f"💰 Aplicando precio $16 para 5kg")
-            
-            total_venta = precio_unitario * cantidad
-            
-            print(f"💰 Calculando total KIOSKO: {cantidad} x {precio_unitario} = {total_venta}")
-            
-            # Insertar una nueva fila
-            initial_row_count += 1
-            
-            # Actualizar celdas en Google Sheets
-            sheet.update_cell(initial_row_count, 13, item["folio"])
-            sheet.update_cell(initial_row_count, 3, item["fecha"])
-            sheet.update_cell(initial_row_count, 4, descripcion)
-            sheet.update_cell(initial_row_count, 5, cantidad)
-            sheet.update_cell(initial_row_count, 6, "KIOSKO")
-            sheet.update_cell(initial_row_count, 15, total_venta)  # Columna O (15)
-            sheet.update_cell(initial_row_count, 16, origen)  # Columna P (16) - extraido/manual
-            
-            # Usar nombreTienda si está disponible
-            if "nombreTienda" in item and item["nombreTienda"] and item["nombreTienda"] != "No encontrada":
-                sheet.update_cell(initial_row_count, 12, item["nombreTienda"])
-            
-            successful_inserts += 1
-        
-        if successful_inserts > 0:
-            if productos_duplicados:
-                return {
-                    "success": True,
-                    "message": f"Se guardaron {successful_inserts} productos. Se omitieron {len(productos_duplicados)} productos duplicados.",
-                    "duplicated": False
-                }
-            else:
-                return {
-                    "success": True,
-                    "message": f"Se guardaron {successful_inserts} productos correctamente.",
-                    "duplicated": False
-                }
-    
-    return {
-        "success": False,
-        "message": "No se pudo guardar ningún producto nuevo.",
-        "duplicated": True
-    }
+    if not productos_a_insertar:
+        return {
+            "success": False,
+            "message": "No se pudo guardar ningún producto nuevo.",
+            "duplicated": True
+        }, []
+    
+    rows = [_kiosko_row(item, origen) for item in productos_a_insertar]
+    
+    # Registrar los folios aceptados para los siguientes tickets del lote
+    for item in productos_a_insertar:
+        if "folio" in item:
+            folio = str(item.get("folio", "")).strip()
+            if folio:
+                kiosko_index.setdefault(folio, []).append(str(item.get("fecha", "")).strip())
+    
+    if productos_duplicados:
+        message = f"Se guardaron {len(rows)} productos. Se omitieron {len(productos_duplicados)} productos duplicados."
+    else:
+        message = f"Se guardaron {len(rows)} productos correctamente."
+    
+    return {"success": True, "message": message, "duplicated": False}, rows
 
 
 def get_google_credentials():
@@ -0,0 +1,364 @@
+"""
+Detección de fotos casi duplicadas de tickets.
+El mismo ticket fotografiado dos veces (otra luz, otra resolución, un leve giro) tiene
+bytes distintos pero casi el mismo hash perceptual. Antes de pagar el OCR se calcula
+el pHash y el dHash de la foto (NumPy sobre una versión reducida en grises) y se busca
+en el historial de fotos ya enviadas a Sheets con multi-index hashing por distancia de
+Hamming, que solo compara contra las fotos que comparten algún trozo exacto del hash.
+
+El historial vive en SQLite (data_dirs) y el índice en memoria se completa con las filas nuevas en cada búsqueda, de modo que
+varios procesos del servidor comparten el mismo historial. Solo cuentan las fotos de los
+últimos IMAGE_DEDUP_RETENTION_DAYS días: tickets de formato fijo (KIOSKO) se parecen
+entre sí, y un historial sin fin terminaría marcando tickets legítimos.
+"""
+
+import io
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from .data_dirs import connect_sqlite, data_path
+from .image_store import load_image
+
+# IMAGE_DEDUP_ENABLED=0 desactiva la búsqueda de duplicados
+IMAGE_DEDUP_ENABLED = os.environ.get("IMAGE_DEDUP_ENABLED", "1") == "1"
+
+DEFAULT_DB_PATH = data_path("IMAGE_DEDUP_DB", "image_hashes.db")
+
+# Distancias máximas (de 64 bits) para considerar dos fotos el mismo ticket. Tickets
+# distintos de la misma cadena comparten formato: entre las fotos de test_images el par
+# más cercano está a 10 bits de pHash, así que ambos hashes deben coincidir.
+PHASH_MAX_DISTANCE = int(os.environ.get("IMAGE_DEDUP_PHASH_DISTANCE", "8"))
+DHASH_MAX_DISTANCE = int(os.environ.get("IMAGE_DEDUP_DHASH_DISTANCE", "8"))
+
+# Ventana del historial (0 = sin límite) y cada cuánto se borran las filas vencidas
+IMAGE_DEDUP_RETENTION_DAYS = float(os.environ.get("IMAGE_DEDUP_RETENTION_DAYS", "14"))
+IMAGE_DEDUP_PRUNE_INTERVAL = float(os.environ.get("IMAGE_DEDUP_PRUNE_INTERVAL", "3600"))
+
+# Lado de la imagen decodificada (JPEG decodifica directo a 1/2, 1/4 u 1/8 del tamaño)
+HASH_DECODE_SIZE = 256
+PHASH_SIZE = 32
+PHASH_LOW_FREQUENCIES = 8
+DHASH_SIZE = 8
+
+ImageHash = namedtuple("ImageHash", ["phash", "dhash"])
+
+
+def _dct_matrix(size):
+    """Matriz de la DCT-II ortonormal (la DCT 2D es M @ X @ M.T)"""
+    k = np.arange(size)[:, None]
+    i = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT = _dct_matrix(PHASH_SIZE)
+_BIT_WEIGHTS = 1 << np.arange(63, -1, -1, dtype=np.uint64)
+
+
+def _to_int(bits):
+    """64 booleanos → entero de 64 bits"""
+    return int(np.bitwise_or.reduce(_BIT_WEIGHTS[bits.ravel()], initial=np.uint64(0)))
+
+
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+
+def _phash(gray):
+    """pHash: signo de las frecuencias bajas de la DCT respecto de su mediana"""
+    pixels = np.asarray(gray.resize((PHASH_SIZE, PHASH_SIZE), Image.Resampling.BILINEAR), dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:PHASH_LOW_FREQUENCIES, :PHASH_LOW_FREQUENCIES].ravel()
+    # El término de continua (brillo medio) se compara con la mediana de las demás
+    # en lugar de usarse: así el hash no cambia con la iluminación
+    return _to_int(low > np.median(low[1:]))
+
+
+def _dhash(gray):
+    """dHash: gradiente horizontal de una miniatura de 9x8"""
+    pixels = np.asarray(gray.resize((DHASH_SIZE + 1, DHASH_SIZE), Image.Resampling.BILINEAR), dtype=np.int16)
+    return _to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def compute_image_hash(image_bytes):
+    """
+    Hash perceptual de una foto de ticket
+
+    Args:
+        image_bytes: Bytes de la imagen (JPEG o PNG)
+
+    Returns:
+        ImageHash (phash, dhash) o None si la imagen no se puede leer
+    """
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        # Decodificar reducido: evita descomprimir los 12 MP de la foto
+        image.draft("L", (HASH_DECODE_SIZE, HASH_DECODE_SIZE))
+        gray = ImageOps.exif_transpose(image).convert("L")
+        return ImageHash(_phash(gray), _dhash(gray))
+    except Exception as e:
+        print(f"⚠️ No se pudo calcular el hash perceptual: {e}")
+        return None
+
+
+class MultiIndexHash:
+    """
+    Índice de hashes de 64 bits para búsqueda por radio de Hamming (multi-index hashing).
+    El hash se parte en max_distance + 1 trozos: dos hashes a distancia <= max_distance
+    coinciden exactamente en al menos un trozo (principio del palomar), así que basta
+    con revisar las entradas de esos buckets en lugar de todo el historial.
+    """
+
+    def __init__(self, max_distance, bits=64):
+        self.max_distance = max_distance
+        count = max_distance + 1
+        width, extra = divmod(bits, count)
+        self._chunks = []
+        shift = bits
+        for index in range(count):
+            chunk_width = width + (1 if index < extra else 0)
+            shift -= chunk_width
+            self._chunks.append((shift, (1 << chunk_width) - 1))
+        self._tables = [{} for _ in self._chunks]
+        self._keys = []
+        self._values = []
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key, value):
+        position = len(self._keys)
+        self._keys.append(key)
+        self._values.append(value)
+        for (shift, mask), table in zip(self._chunks, self._tables):
+            table.setdefault((key >> shift) & mask, []).append(position)
+
+    def search(self, key, max_distance=None):
+        """
+        Returns:
+            list: (distancia, valor) de los elementos a distancia <= max_distance
+        """
+        max_distance = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        candidates = set()
+        for (shift, mask), table in zip(self._chunks, self._tables):
+            candidates.update(table.get((key >> shift) & mask, ()))
+        found = []
+        for position in candidates:
+            distance = hamming_distance(key, self._keys[position])
+            if distance <= max_distance:
+                found.append((distance, self._values[position]))
+        return found
+
+
+def retention_cutoff(retention_days=IMAGE_DEDUP_RETENTION_DAYS):
+    """Fecha ISO desde la que cuentan las fotos del historial (None sin límite)"""
+    if retention_days <= 0:
+        return None
+    return (datetime.now() - timedelta(days=retention_days)).isoformat()
+
+
+def find_near_duplicate(index, image_hash, phash_distance=PHASH_MAX_DISTANCE, dhash_distance=DHASH_MAX_DISTANCE,
+                        since=None):
+    """
+    Foto más parecida del índice dentro de los umbrales (pHash y dHash)
+
+    Args:
+        index: MultiIndexHash por pHash con valores dict que incluyen 'dhash'
+        since: Fecha ISO; las fotos anteriores se ignoran
+
+    Returns:
+        dict con los datos de la foto y las distancias, o None
+    """
+    best = None
+    for phash_diff, entry in index.search(image_hash.phash, phash_distance):
+        if since is not None and entry["created_at"] < since:
+            continue
+        dhash_diff = hamming_distance(image_hash.dhash, entry["dhash"])
+        if dhash_diff > dhash_distance:
+            continue
+        if best is None or phash_diff + dhash_diff < best["phash_distance"] + best["dhash_distance"]:
+            best = {**entry, "phash_distance": phash_diff, "dhash_distance": dhash_diff}
+    if best is not None:
+        best.pop("dhash")
+    return best
+
+
+class NearDuplicateIndex:
+    """Historial de hashes de las fotos enviadas a Sheets (SQLite + índice en memoria)"""
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, retention_days=IMAGE_DEDUP_RETENTION_DAYS):
+        self.db_path = Path(db_path)
+        self.retention_days = retention_days
+        self._index = MultiIndexHash(PHASH_MAX_DISTANCE)
+        self._last_rowid = 0
+        self._last_prune = 0.0
+        self._lock = threading.Lock()
+        self._schema_ready = False
+
+    def _connect(self):
+        return connect_sqlite(self.db_path)
+
+    def _init_schema(self):
+        if self._schema_ready:
+            return
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS image_hashes (
+                    image_id TEXT PRIMARY KEY,
+                    phash TEXT NOT NULL,
+                    dhash TEXT NOT NULL,
+                    filename TEXT,
+                    ticket_type TEXT,
+                    created_at TEXT NOT NULL
+                )
+            """)
+        self._schema_ready = True
+
+    def _prune(self):
+        """
+        Borra las fotos fuera de la ventana de retención (como mucho una vez por
+        IMAGE_DEDUP_PRUNE_INTERVAL) y rehace el índice en memoria sin ellas
+        """
+        cutoff = retention_cutoff(self.retention_days)
+        if cutoff is None or (self._last_prune and time.monotonic() - self._last_prune < IMAGE_DEDUP_PRUNE_INTERVAL):
+            return
+        self._last_prune = time.monotonic()
+        with self._connect() as conn:
+            removed = conn.execute("DELETE FROM image_hashes WHERE created_at < ?", (cutoff,)).rowcount
+        if removed:
+            print(f"🧹 Historial de fotos podado: {removed} fotos de más de {self.retention_days:g} días")
+        # Se rehace desde la base: también suelta las fotos que podó otro proceso
+        self._reset_index()
+
+    def _reset_index(self):
+        self._index = MultiIndexHash(PHASH_MAX_DISTANCE)
+        self._last_rowid = 0
+
+    def _refresh(self):
+        """Agrega al índice las fotos registradas desde la última lectura (por cualquier proceso)"""
+        self._init_schema()
+        self._prune()
+        with self._connect() as conn:
+            # Si otro proceso vació la tabla los rowid vuelven a empezar: se relee todo
+            max_rowid = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM image_hashes").fetchone()[0]
+            if max_rowid < self._last_rowid:
+                self._reset_index()
+            rows = conn.execute(
+                "SELECT rowid, * FROM image_hashes WHERE rowid > ? ORDER BY rowid", (self._last_rowid,)
+            ).fetchall()
+        for row in rows:
+            self._index.add(int(row["phash"], 16), {
+                "image_id": row["image_id"],
+                "filename": row["filename"],
+                "ticket_type": row["ticket_type"],
+                "created_at": row["created_at"],
+                "dhash": int(row["dhash"], 16),
+            })
+            self._last_rowid = row["rowid"]
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._index)
+
+    def find(self, image_hash):
+        """
+        Foto ya procesada que parece la misma que image_hash
+
+        Returns:
+            dict (image_id, filename, ticket_type, created_at y distancias) o None
+        """
+        with self._lock:
+            self._refresh()
+            # Entre podas el índice conserva fotos ya vencidas: se filtran por fecha
+            return find_near_duplicate(self._index, image_hash, since=retention_cutoff(self.retention_days))
+
+    def register(self, image_id, image_hash, filename=None, ticket_type=None):
+        """Guarda la foto en el historial (una foto repetida se ignora)"""
+        with self._lock:
+            self._init_schema()
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO image_hashes "
+                    "(image_id, phash, dhash, filename, ticket_type, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (image_id, f"{image_hash.phash:016x}", f"{image_hash.dhash:016x}",
+                     filename, ticket_type, datetime.now().isoformat()),
+                )
+
+
+image_dedup_index = NearDuplicateIndex()
+
+
+def check_near_duplicate(image_bytes, batch_index=None):
+    """
+    Hash perceptual de la foto y, si la hay, la foto ya procesada que se le parece
+
+    Args:
+        image_bytes: Bytes de la imagen subida
+        batch_index: Índice de las fotos ya procesadas en el mismo lote (new_batch_index)
+
+    Returns:
+        tuple: (ImageHash o None, dict de la coincidencia o None)
+    """
+    if not IMAGE_DEDUP_ENABLED:
+        return None, None
+    image_hash = compute_image_hash(image_bytes)
+    if image_hash is None:
+        return None, None
+    match = None
+    try:
+        match = image_dedup_index.find(image_hash)
+    except sqlite3.Error as e:
+        print(f"⚠️ Error consultando el historial de fotos: {e}")
+    if match is None and batch_index is not None:
+        match = find_near_duplicate(batch_index, image_hash)
+    if match:
+        print(f"🪞 Foto casi idéntica a '{match['filename']}' ({match['created_at'][:16]}, "
+              f"distancias pHash {match['phash_distance']} / dHash {match['dhash_distance']})")
+    return image_hash, match
+
+
+def remember_image(image_id, image_hash, filename=None, ticket_type=None):
+    """Registra una foto cuyo ticket llegó a Sheets (sin hash no hay nada que registrar)"""
+    if image_hash is None:
+        return
+    try:
+        image_dedup_index.register(image_id, image_hash, filename, ticket_type)
+    except sqlite3.Error as e:
+        print(f"⚠️ Error registrando la foto en el historial: {e}")
+
+
+def new_batch_index():
+    """Índice en memoria para detectar la misma foto repetida dentro de un lote"""
+    return MultiIndexHash(PHASH_MAX_DISTANCE)
+
+
+def remember_in_batch(batch_index, image_id, image_hash, filename=None, ticket_type=None):
+    if batch_index is None or image_hash is None:
+        return
+    batch_index.add(image_hash.phash, {
+        "image_id": image_id,
+        "filename": filename,
+        "ticket_type": ticket_type,
+        "created_at": datetime.now().isoformat(),
+        "dhash": image_hash.dhash,
+    })
+
+
+def remember_stored_image(image_id, filename=None, ticket_type=None):
+    """Registra una foto del almacén de imágenes (tickets confirmados tras la revisión)"""
+    if not IMAGE_DEDUP_ENABLED:
+        return
+    image_bytes = load_image(image_id)
+    if image_bytes is None:
+        return
+    remember_image(image_id, compute_image_hash(image_bytes), filename, ticket_type)
@@ -0,0 +1,135 @@
+"""
+Codificación de las imágenes que se envían al OCR.
+Elige el formato más compacto que conserva lo que el OCR ve:
+- imagen binarizada (solo blanco y negro): PNG de 1 bit, sin pérdida
+- escala de grises o color (imagen original): JPEG en grises con calidad ajustada
+y garantiza el límite de bytes de las llamadas síncronas de Textract.
+"""
+
+import io
+import os
+
+from PIL import Image
+
+# Límite de Document.Bytes en DetectDocumentText (síncrono)
+TEXTRACT_MAX_BYTES = 5 * 1024 * 1024
+
+# Formato para imágenes binarizadas: PNG (1 bit) o TIFF (CCITT G4, aún más compacto)
+BINARY_FORMAT = os.environ.get("OCR_BINARY_FORMAT", "PNG").upper()
+# Calidad JPEG para la imagen original en escala de grises
+GRAY_JPEG_QUALITY = int(os.environ.get("OCR_GRAY_JPEG_QUALITY", "85"))
+# Re-codificar la imagen original antes de enviarla (OCR_COMPACT_ORIGINAL=0 la envía tal cual)
+COMPACT_ORIGINAL = os.environ.get("OCR_COMPACT_ORIGINAL", "1") == "1"
+
+# Pasos para entrar en el límite: primero bajar calidad, luego reducir tamaño
+FALLBACK_QUALITIES = (75, 65)
+MAX_DOWNSCALE_STEP = 0.9
+
+
+def _is_binary(image):
+    """La imagen solo tiene negro y blanco (p. ej. la salida de la umbralización)"""
+    if image.mode == '1':
+        return True
+    if image.mode != 'L':
+        return False
+    histogram = image.histogram()
+    return sum(histogram[1:255]) == 0
+
+
+def _save(image, format, **params):
+    output_buffer = io.BytesIO()
+    image.save(output_buffer, format=format, **params)
+    return output_buffer.getvalue()
+
+
+def _encode_binary(image):
+    if image.mode == '1':
+        bilevel = image
+    else:
+        bilevel = image.point(lambda value: 255 if value > 127 else 0).convert('1', dither=Image.Dither.NONE)
+    if BINARY_FORMAT == 'TIFF':
+        return _save(bilevel, 'TIFF', compression='group4'), 'TIFF'
+    return _save(bilevel, 'PNG'), 'PNG'
+
+
+def _encode_gray(image, quality, exif=None):
+    gray = image if image.mode == 'L' else image.convert('L')
+    params = {'quality': quality}
+    if exif:
+        # Conserva la orientación EXIF de la foto original
+        params['exif'] = exif
+    return _save(gray, 'JPEG', **params), 'JPEG'
+
+
+def encode_for_ocr(image, max_bytes=TEXTRACT_MAX_BYTES, exif=None):
+    """
+    Codifica una imagen para el OCR con el formato más compacto según su contenido
+
+    Args:
+        image: Imagen PIL (binarizada, en grises o color)
+        max_bytes: Tamaño máximo del resultado
+        exif: EXIF a conservar en el JPEG (orientación de la foto original)
+
+    Returns:
+        tuple: (bytes, formato)
+    """
+    if _is_binary(image):
+        data, format = _encode_binary(image)
+    else:
+        data, format = _encode_gray(image, GRAY_JPEG_QUALITY, exif)
+    if len(data) <= max_bytes:
+        return data, format
+
+    # Fuera del límite: bajar calidad (JPEG) y después reducir la imagen
+    if format == 'JPEG':
+        for quality in FALLBACK_QUALITIES:
+            data, format = _encode_gray(image, quality, exif)
+            if len(data) <= max_bytes:
+                return data, format
+
+    while len(data) > max_bytes and min(image.size) > 100:
+        # El tamaño crece con el área: escala estimada con un margen
+        ratio = min(MAX_DOWNSCALE_STEP, (max_bytes / len(data)) ** 0.5 * 0.9)
+        image = image.resize(tuple(max(1, int(dim * ratio)) for dim in image.size), Image.Resampling.LANCZOS)
+        if format == 'JPEG':
+            data, format = _encode_gray(image, FALLBACK_QUALITIES[-1], exif)
+        else:
+            data, format = _encode_binary(image)
+    print(f"📐 Imagen reducida a {image.size} para respetar el límite de {max_bytes // 1024} KB")
+    return data, format
+
+
+def compact_original(image_bytes, max_bytes=TEXTRACT_MAX_BYTES):
+    """
+    Versión compacta de la imagen original para el OCR sin preprocesamiento:
+    escala de grises en JPEG, a resolución completa. Si no reduce el tamaño (y la
+    original cabe en el límite) se devuelve la original.
+
+    Args:
+        image_bytes: Bytes de la imagen subida
+        max_bytes: Tamaño máximo del resultado
+
+    Returns:
+        bytes: Imagen a enviar
+    """
+    if not COMPACT_ORIGINAL and len(image_bytes) <= max_bytes:
+        return image_bytes
+
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        data, _ = encode_for_ocr(image, max_bytes=max_bytes, exif=image.info.get('exif'))
+    except Exception as e:
+        print(f"⚠️ Error codificando la imagen original: {e}")
+        return image_bytes
+
+    if len(data) >= len(image_bytes) and len(image_bytes) <= max_bytes:
+        return image_bytes
+    return data
+
+
+def image_format(image_bytes):
+    """Formato de una imagen codificada (JPEG, PNG, TIFF) o None"""
+    try:
+        return Image.open(io.BytesIO(image_bytes)).format
+    except Exception:
+        return None
@@ -1,102 +1,339 @@
 """
 Módulo de preprocesamiento de imágenes para mejorar la calidad del OCR.
-Incluye funciones para limpiar, mejorar contraste y corregir orientación.
+Incluye funciones para limpiar, mejorar contraste, corregir orientación y
+recortar la imagen al ticket.
 """
 
 import io
+import os
 from PIL import Image, ImageEnhance, ImageFilter
 import numpy as np
 
+from .image_encoding import encode_for_ocr
+
+# Lado mayor de la imagen que recibe el OCR
+OCR_MAX_SIZE = 2000
+
+# Recorte del ticket antes del OCR (OCR_CROP_RECEIPT=0 lo desactiva)
+RECEIPT_CROP_ENABLED = os.environ.get("OCR_CROP_RECEIPT", "1") == "1"
+# Lado mayor aproximado de la imagen reducida donde se busca el ticket
+RECEIPT_SEARCH_SIZE = 512
+# El recorte se descarta si deja menos de esta fracción de la imagen (probable error)...
+RECEIPT_MIN_AREA = 0.15
+# ...o si casi no reduce nada
+RECEIPT_MAX_AREA = 0.92
+# Fracción del umbral de Otsu que aún se considera papel (en sombra)
+RECEIPT_SHADOW_FACTOR = 0.65
+# Margen alrededor del ticket, como fracción de su tamaño
+RECEIPT_MARGIN = 0.03
+# Inclinaciones fuera de este rango (grados) no se corrigen
+RECEIPT_MIN_SKEW = 1.0
+RECEIPT_MAX_SKEW = 10.0
+RECEIPT_SKEW_STEP = 1.0
+# Lado mayor aproximado de la imagen donde se mide la inclinación del texto
+RECEIPT_SKEW_SEARCH_SIZE = 800
+# Mejora mínima del perfil de proyección sobre no girar para aceptar una inclinación
+RECEIPT_SKEW_MIN_GAIN = 1.15
+
+# Código EXIF de orientación → transposición equivalente a la rotación
+EXIF_ORIENTATION_TAG = 274
+EXIF_TRANSPOSE = {
+    3: Image.Transpose.ROTATE_180,
+    6: Image.Transpose.ROTATE_270,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def _to_jpeg(image):
+    output_buffer = io.BytesIO()
+    image.save(output_buffer, format='JPEG', quality=95)
+    return output_buffer.getvalue()
+
+
+def _resize_for_ocr(image, reference_size=None):
+    """
+    Reduce la imagen al tamaño de trabajo del OCR.
+    Con reference_size (tamaño del cuadro completo) se usa la misma escala que tendría
+    el cuadro: un recorte conserva la resolución del texto y pesa menos.
+    """
+    reference = max(reference_size or image.size)
+    if reference <= OCR_MAX_SIZE:
+        return image
+    ratio = OCR_MAX_SIZE / reference
+    new_size = tuple(max(1, int(dim * ratio)) for dim in image.size)
+    print(f"📏 Imagen redimensionada a: {new_size}")
+    return image.resize(new_size, Image.Resampling.LANCZOS)
+
+
+def _enhance_for_ocr(image):
+    """Contraste, nitidez, reducción de ruido, escala de grises y umbralización"""
+    # 2. Mejorar contraste
+    enhancer = ImageEnhance.Contrast(image)
+    image = enhancer.enhance(1.3)  # Aumentar contraste 30%
+
+    # 3. Mejorar nitidez
+    enhancer = ImageEnhance.Sharpness(image)
+    image = enhancer.enhance(1.2)  # Aumentar nitidez 20%
+
+    # 4. Convertir a escala de grises para mejor OCR
+    image = image.convert('L')  # Escala de grises
+
+    # 5. Aplicar filtro para reducir ruido (sobre un solo canal: un tercio del costo)
+    image = image.filter(ImageFilter.MedianFilter(size=3))
+
+    # 6. Aplicar umbralización para mejorar texto
+    image_array = np.array(image)
+    # Umbral adaptativo simple
+    threshold = np.mean(image_array) - 10
+    image_array = np.where(image_array > threshold, 255, 0)
+    return Image.fromarray(image_array.astype(np.uint8))
+
+
 def preprocess_image_for_ocr(image_bytes):
     """
     Preprocesa una imagen para mejorar la calidad del OCR.
-    
+
     Args:
         image_bytes: Bytes de la imagen original
-        
+
     Returns:
         bytes: Imagen procesada en bytes
     """
     try:
         # Cargar imagen desde bytes
         image = Image.open(io.BytesIO(image_bytes))
-        
+
         # Convertir a RGB si es necesario
         if image.mode != 'RGB':
             image = image.convert('RGB')
-        
+
         # 1. Redimensionar si es muy grande (mantener proporción)
-        max_size = 2000
-        if max(image.size) > max_size:
-            ratio = max_size / max(image.size)
-            new_size = tuple(int(dim * ratio) for dim in image.size)
-            image = image.resize(new_size, Image.Resampling.LANCZOS)
-            print(f"📏 Imagen redimensionada a: {new_size}")
-        
-        # 2. Mejorar contraste
-        enhancer = ImageEnhance.Contrast(image)
-        image = enhancer.enhance(1.3)  # Aumentar contraste 30%
-        
-        # 3. Mejorar nitidez
-        enhancer = ImageEnhance.Sharpness(image)
-        image = enhancer.enhance(1.2)  # Aumentar nitidez 20%
-        
-        # 4. Aplicar filtro para reducir ruido
-        image = image.filter(ImageFilter.MedianFilter(size=3))
-        
-        # 5. Convertir a escala de grises para mejor OCR
-        image = image.convert('L')  # Escala de grises
-        
-        # 6. Aplicar umbralización para mejorar texto
-        image_array = np.array(image)
-        # Umbral adaptativo simple
-        threshold = np.mean(image_array) - 10
-        image_array = np.where(image_array > threshold, 255, 0)
-        image = Image.fromarray(image_array.astype(np.uint8))
-        
-        # Convertir de vuelta a bytes
-        output_buffer = io.BytesIO()
-        image.save(output_buffer, format='JPEG', quality=95)
-        processed_bytes = output_buffer.getvalue()
-        
-        print(f"✅ Imagen preprocesada exitosamente")
+        image = _resize_for_ocr(image)
+
+        # 2-6. Contraste, nitidez, ruido, grises y umbral
+        image = _enhance_for_ocr(image)
+
+        # Convertir de vuelta a bytes (imagen binarizada: PNG de 1 bit)
+        processed_bytes, format = encode_for_ocr(image)
+
+        print(f"✅ Imagen preprocesada exitosamente ({format}, {len(processed_bytes) // 1024} KB)")
         return processed_bytes
-        
+
     except Exception as e:
         print(f"⚠️ Error en preprocesamiento: {e}")
         # Devolver imagen original si falla el procesamiento
         return image_bytes
 
+
+def _apply_exif_orientation(image):
+    """Gira la imagen según su orientación EXIF (transposición exacta, sin remuestrear)"""
+    if hasattr(image, '_getexif') and image._getexif() is not None:
+        orientation = image._getexif().get(EXIF_ORIENTATION_TAG)
+        if orientation in EXIF_TRANSPOSE:
+            return image.transpose(EXIF_TRANSPOSE[orientation])
+    return image
+
+
 def detect_and_correct_orientation(image_bytes):
     """
     Detecta y corrige la orientación de la imagen si está rotada.
-    
+
     Args:
         image_bytes: Bytes de la imagen
-        
+
     Returns:
         bytes: Imagen con orientación corregida
     """
     try:
-        image = Image.open(io.BytesIO(image_bytes))
-        
-        # Verificar si la imagen tiene información EXIF de orientación
-        if hasattr(image, '_getexif') and image._getexif() is not None:
-            exif = image._getexif()
-            orientation = exif.get(274)  # Código EXIF para orientación
-            
-            if orientation == 3:
-                image = image.rotate(180, expand=True)
-            elif orientation == 6:
-                image = image.rotate(270, expand=True)
-            elif orientation == 8:
-                image = image.rotate(90, expand=True)
-        
+        image = _apply_exif_orientation(Image.open(io.BytesIO(image_bytes)))
+
         # Convertir de vuelta a bytes
-        output_buffer = io.BytesIO()
-        image.save(output_buffer, format='JPEG', quality=95)
-        return output_buffer.getvalue()
-        
+        return _to_jpeg(image)
+
     except Exception as e:
         print(f"⚠️ Error corrigiendo orientación: {e}")
-        return image_bytes
\ No newline at end of file
+        return image_bytes
+
+
+def _otsu_threshold(gray):
+    """Umbral de Otsu sobre una imagen en escala de grises (uint8)"""
+    histogram = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    weight_background = np.cumsum(histogram)
+    weight_foreground = weight_background[-1] - weight_background
+    cumulative_mean = np.cumsum(histogram * np.arange(256))
+    total_mean = cumulative_mean[-1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_background = cumulative_mean / weight_background
+        mean_foreground = (total_mean - cumulative_mean) / weight_foreground
+        variance = weight_background * weight_foreground * (mean_background - mean_foreground) ** 2
+    return int(np.nanargmax(variance))
+
+
+def _paper_masks(image):
+    """
+    Máscaras de papel de una imagen reducida (el texto se rellena con un filtro de máximo):
+    la estricta (umbral de Otsu) y la tolerante, que incluye el papel en sombra
+    """
+    gray = np.asarray(image.convert('L').filter(ImageFilter.MaxFilter(5)))
+    threshold = _otsu_threshold(gray)
+    return gray > threshold, gray > threshold * RECEIPT_SHADOW_FACTOR
+
+
+def _estimate_skew(image):
+    """
+    Inclinación de las líneas de texto en grados por perfiles de proyección: el ángulo
+    que más concentra los píxeles oscuros en filas (mayor varianza del perfil).
+    Devuelve el giro a aplicar con Image.rotate (0 si ninguno mejora claramente).
+    """
+    factor = max(1, max(image.size) // RECEIPT_SKEW_SEARCH_SIZE)
+    gray = np.asarray((image.reduce(factor) if factor > 1 else image).convert('L'))
+    text = Image.fromarray(((gray < _otsu_threshold(gray)) * 255).astype(np.uint8))
+
+    def score(angle):
+        rotated = np.asarray(text.rotate(angle, resample=Image.Resampling.NEAREST))
+        return float(np.var(rotated.sum(axis=1, dtype=np.int64)))
+
+    baseline = score(0.0)
+    angles = np.arange(-RECEIPT_MAX_SKEW, RECEIPT_MAX_SKEW + RECEIPT_SKEW_STEP / 2, RECEIPT_SKEW_STEP)
+    scores = [score(float(angle)) for angle in angles]
+    best = int(np.argmax(scores))
+    if baseline <= 0 or scores[best] < baseline * RECEIPT_SKEW_MIN_GAIN:
+        return 0.0
+    return float(angles[best])
+
+
+def _longest_run(profile, threshold):
+    """(inicio, fin) del tramo contiguo más largo del perfil por encima del umbral"""
+    above = np.r_[False, profile >= threshold, False]
+    edges = np.flatnonzero(above[1:] != above[:-1])
+    if len(edges) == 0:
+        return None
+    starts, ends = edges[0::2], edges[1::2]
+    longest = int(np.argmax(ends - starts))
+    return int(starts[longest]), int(ends[longest])
+
+
+def _extend_run(profile, start, end, threshold):
+    """Extiende el tramo [start, end) hacia ambos lados mientras el perfil supere el umbral"""
+    while start > 0 and profile[start - 1] >= threshold:
+        start -= 1
+    while end < len(profile) and profile[end] >= threshold:
+        end += 1
+    return start, end
+
+
+def _receipt_box(strong, weak):
+    """
+    Caja (izq, arriba, der, abajo) del ticket, con margen, usando perfiles de proyección:
+    el tramo más largo de columnas y filas con papel en la máscara estricta, extendido
+    sobre la tolerante para no cortar partes del ticket en sombra
+    """
+    column_profile = strong.mean(axis=0)
+    columns = _longest_run(column_profile, 0.5 * np.percentile(column_profile, 95))
+    if columns is None:
+        return None
+    left, right = columns
+    row_profile = strong[:, left:right].mean(axis=1)
+    rows = _longest_run(row_profile, 0.5 * np.percentile(row_profile, 95))
+    if rows is None:
+        return None
+    top, bottom = rows
+
+    top, bottom = _extend_run(weak[:, left:right].mean(axis=1), top, bottom, 0.5)
+    left, right = _extend_run(weak[top:bottom].mean(axis=0), left, right, 0.5)
+
+    height, width = strong.shape
+    margin_x = (right - left) * RECEIPT_MARGIN
+    margin_y = (bottom - top) * RECEIPT_MARGIN
+    return (max(0.0, left - margin_x), max(0.0, top - margin_y),
+            min(float(width), right + margin_x), min(float(height), bottom + margin_y))
+
+
+def _reduced(image):
+    """Versión reducida para buscar el ticket (reducción por bloques, rápida) y su escala"""
+    factor = max(1, max(image.size) // RECEIPT_SEARCH_SIZE)
+    small = image.reduce(factor) if factor > 1 else image
+    return small, image.width / small.width
+
+
+def _crop_box(image, scale, box):
+    """Recorta la imagen con una caja calculada sobre su versión reducida"""
+    return image.crop(tuple(int(round(value * scale)) for value in box))
+
+
+def _crop_receipt(image):
+    """
+    Recorta una imagen RGB al ticket y corrige su inclinación.
+    Busca el papel (claro) sobre el fondo en una versión reducida de la imagen
+    (umbral de Otsu y perfiles de proyección, solo NumPy); la inclinación se estima
+    con los perfiles de proyección del texto. El recorte se reduce con la escala que
+    tendría el cuadro completo en el OCR (misma resolución del texto, menos píxeles).
+    None si la detección no es confiable.
+    """
+    small, scale = _reduced(image)
+    mask, shadow_mask = _paper_masks(small)
+
+    # Papel en casi toda la imagen: el ticket ya llena el cuadro
+    if mask.mean() > RECEIPT_MAX_AREA:
+        return None
+
+    box = _receipt_box(mask, shadow_mask)
+    if box is None:
+        return None
+    left, top, right, bottom = box
+    area = (right - left) * (bottom - top) / mask.size
+    # Sin fondo alrededor tampoco hay referencia confiable para la inclinación
+    if not RECEIPT_MIN_AREA <= area <= RECEIPT_MAX_AREA:
+        return None
+
+    # Reducir antes de rotar: la rotación a resolución completa es la parte más costosa
+    cropped = _resize_for_ocr(_crop_box(image, scale, box), reference_size=image.size)
+
+    skew = _estimate_skew(cropped)
+    if abs(skew) < RECEIPT_MIN_SKEW:
+        skew = 0.0
+    if skew:
+        # Enderezar el texto y volver a recortar las esquinas de relleno
+        cropped = cropped.rotate(skew, resample=Image.Resampling.BILINEAR, expand=True, fillcolor=(0, 0, 0))
+        small, scale = _reduced(cropped)
+        box = _receipt_box(*_paper_masks(small))
+        if box is not None:
+            cropped = _crop_box(cropped, scale, box)
+        cropped = _resize_for_ocr(cropped)
+
+    print(f"✂️ Ticket recortado a {cropped.size} ({area:.0%} del cuadro, inclinación {skew:.1f}°)")
+    return cropped
+
+
+def prepare_image_for_ocr(image_bytes):
+    """
+    Orientación, recorte al ticket y preprocesamiento en una sola pasada:
+    la imagen se decodifica y se codifica una sola vez.
+
+    Args:
+        image_bytes: Bytes de la imagen original
+
+    Returns:
+        bytes: Imagen lista para el OCR (o la original si algo falla)
+    """
+    try:
+        image = _apply_exif_orientation(Image.open(io.BytesIO(image_bytes)))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        cropped = None
+        if RECEIPT_CROP_ENABLED:
+            try:
+                cropped = _crop_receipt(image)
+            except Exception as e:
+                print(f"⚠️ Error recortando el ticket: {e}")
+        image = cropped if cropped is not None else _resize_for_ocr(image)
+
+        processed_bytes, format = encode_for_ocr(_enhance_for_ocr(image))
+        print(f"✅ Imagen preprocesada exitosamente ({format}, {len(processed_bytes) // 1024} KB)")
+        return processed_bytes
+
+    except Exception as e:
+        print(f"⚠️ Error en preprocesamiento: {e}")
+        return image_bytes
@@ -0,0 +1,280 @@
+"""
+Almacén local de imágenes de tickets direccionado por contenido.
+Cada imagen se guarda una sola vez bajo su hash SHA-256, de modo que las
+respuestas de la API solo necesitan devolver URLs y el navegador puede
+cachear la imagen indefinidamente.
+
+El almacén se poda en segundo plano (como mucho una vez por
+IMAGE_STORE_PRUNE_INTERVAL): se borran los archivos sin usar en
+IMAGE_STORE_MAX_AGE_DAYS días y, si aún excede IMAGE_STORE_MAX_MB, los menos
+recientes. Volver a guardar una imagen renueva su fecha.
+
+En Lambda cada contenedor tiene su propio /tmp y otra instancia no encontraría la
+imagen, así que el almacén vive en S3 (IMAGE_STORE_BUCKET, por defecto BUCKET_NAME,
+bajo images/): la miniatura se genera al guardar y las URLs de la respuesta son
+prefirmadas. La retención en S3 la da una regla de ciclo de vida sobre images/.
+"""
+
+import io
+import os
+import re
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import boto3
+from botocore.exceptions import ClientError
+from PIL import Image, ImageOps
+
+from .data_dirs import IS_LAMBDA, data_path
+
+IMAGE_STORE_DIR = Path(data_path('IMAGE_STORE_DIR', 'images'))
+
+# Bucket del almacén ('' = disco local); en Lambda, el mismo bucket de las subidas
+IMAGE_STORE_BUCKET = os.environ.get(
+    'IMAGE_STORE_BUCKET',
+    os.environ.get('BUCKET_NAME', 'santiice-ocr-tickets') if IS_LAMBDA else ''
+)
+IMAGE_STORE_PREFIX = 'images'
+# Vigencia de las URLs prefirmadas (alcanza para revisar un lote)
+IMAGE_URL_EXPIRES = int(os.environ.get('IMAGE_URL_EXPIRES', str(24 * 3600)))
+
+_s3_client = None
+
+# Retención (0 desactiva cada límite)
+IMAGE_STORE_MAX_AGE_DAYS = float(os.environ.get('IMAGE_STORE_MAX_AGE_DAYS', '30'))
+IMAGE_STORE_MAX_MB = float(os.environ.get('IMAGE_STORE_MAX_MB', '2048'))
+IMAGE_STORE_PRUNE_INTERVAL = float(os.environ.get('IMAGE_STORE_PRUNE_INTERVAL', '3600'))
+
+_prune_lock = threading.Lock()
+_last_prune = 0.0
+
+# Miniaturas
+THUMBNAIL_MAX_SIZE = int(os.environ.get('THUMBNAIL_MAX_SIZE', '320'))
+THUMBNAIL_QUALITY = 70
+
+EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+}
+
+_IMAGE_ID_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def _image_dir(image_id):
+    # Subdirectorio por prefijo para no acumular miles de archivos en una carpeta
+    return IMAGE_STORE_DIR / image_id[:2]
+
+
+def _s3():
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client('s3')
+    return _s3_client
+
+
+def _s3_key(image_id, suffix):
+    return f"{IMAGE_STORE_PREFIX}/{image_id[:2]}/{image_id}{suffix}"
+
+
+def _presigned_url(key):
+    return _s3().generate_presigned_url(
+        'get_object', Params={'Bucket': IMAGE_STORE_BUCKET, 'Key': key}, ExpiresIn=IMAGE_URL_EXPIRES
+    )
+
+
+def _make_thumbnail(source):
+    """Miniatura JPEG (bytes) de una imagen (ruta o archivo abierto)"""
+    with Image.open(source) as image:
+        # Decodificar reducido: no hace falta la foto completa para 320 px
+        image.draft('RGB', (THUMBNAIL_MAX_SIZE, THUMBNAIL_MAX_SIZE))
+        # Respetar la orientación EXIF de las fotos tomadas con celular
+        image = ImageOps.exif_transpose(image)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.thumbnail((THUMBNAIL_MAX_SIZE, THUMBNAIL_MAX_SIZE))
+
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+    return output.getvalue()
+
+
+def _write_atomic(path, data):
+    # Temporal único: dos peticiones con la misma foto escriben a la vez el mismo destino
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.part")
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def prune_image_store(max_age_days=IMAGE_STORE_MAX_AGE_DAYS, max_mb=IMAGE_STORE_MAX_MB):
+    """
+    Borra imágenes y miniaturas viejas y, si el almacén excede max_mb, las menos recientes
+
+    Returns:
+        int: Archivos borrados
+    """
+    if not IMAGE_STORE_DIR.is_dir():
+        return 0
+
+    files = []
+    for path in IMAGE_STORE_DIR.glob("*/*"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    files.sort()
+
+    now = time.time()
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    for mtime, size, path in files:
+        too_old = max_age_days > 0 and now - mtime > max_age_days * 86400
+        too_big = max_mb > 0 and total > max_mb * 1024 * 1024
+        if not (too_old or too_big):
+            break
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+
+    if removed:
+        print(f"🧹 Almacén de imágenes podado: {removed} archivos borrados")
+    return removed
+
+
+def _maybe_prune():
+    """Lanza la poda en un hilo si pasó el intervalo desde la última"""
+    global _last_prune
+    with _prune_lock:
+        if time.monotonic() - _last_prune < IMAGE_STORE_PRUNE_INTERVAL and _last_prune:
+            return
+        _last_prune = time.monotonic()
+    threading.Thread(target=prune_image_store, name="image-store-prune", daemon=True).start()
+
+
+def is_valid_image_id(image_id):
+    return bool(image_id) and bool(_IMAGE_ID_RE.match(image_id))
+
+
+def store_image(image_bytes, image_id, content_type):
+    """
+    Guarda una imagen en el almacén si aún no existe.
+
+    Args:
+        image_bytes: Bytes de la imagen original
+        image_id: Hash SHA-256 (hex) de los bytes, calculado al recibir el archivo
+        content_type: "image/jpeg" o "image/png"
+
+    Returns:
+        dict: image_id, image_url y thumbnail_url para incluir en la respuesta
+    """
+    if IMAGE_STORE_BUCKET:
+        return _store_image_s3(image_bytes, image_id, content_type)
+
+    extension = EXTENSIONS.get(content_type, "jpg")
+    image_dir = _image_dir(image_id)
+    image_dir.mkdir(parents=True, exist_ok=True)
+
+    image_path = image_dir / f"{image_id}.{extension}"
+    try:
+        # Ya guardada: se renueva su fecha para la retención
+        os.utime(image_path)
+    except FileNotFoundError:
+        _write_atomic(image_path, image_bytes)
+    _maybe_prune()
+
+    return {
+        "image_id": image_id,
+        "image_url": f"/images/{image_id}",
+        "thumbnail_url": f"/images/{image_id}/thumbnail",
+    }
+
+
+def _store_image_s3(image_bytes, image_id, content_type):
+    """store_image en S3: imagen y miniatura (mismo contenido, misma llave: se reescriben sin más)"""
+    image_key = _s3_key(image_id, "")
+    thumbnail_key = _s3_key(image_id, "_thumb")
+    cache_control = "private, max-age=31536000, immutable"
+    _s3().put_object(Bucket=IMAGE_STORE_BUCKET, Key=image_key, Body=image_bytes,
+                     ContentType=content_type, CacheControl=cache_control)
+    _s3().put_object(Bucket=IMAGE_STORE_BUCKET, Key=thumbnail_key, Body=_make_thumbnail(io.BytesIO(image_bytes)),
+                     ContentType="image/jpeg", CacheControl=cache_control)
+    return {
+        "image_id": image_id,
+        "image_url": _presigned_url(image_key),
+        "thumbnail_url": _presigned_url(thumbnail_key),
+    }
+
+
+def get_image_url(image_id, thumbnail=False):
+    """URL prefirmada de S3 (None si el almacén es local o el id no es válido)"""
+    if not IMAGE_STORE_BUCKET or not is_valid_image_id(image_id):
+        return None
+    return _presigned_url(_s3_key(image_id, "_thumb" if thumbnail else ""))
+
+
+def load_image(image_id):
+    """
+    Bytes de la imagen original, del disco o de S3
+
+    Returns:
+        bytes o None si no existe
+    """
+    if not is_valid_image_id(image_id):
+        return None
+    if IMAGE_STORE_BUCKET:
+        try:
+            return _s3().get_object(Bucket=IMAGE_STORE_BUCKET, Key=_s3_key(image_id, ""))['Body'].read()
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise
+    image_path, _ = get_image_path(image_id)
+    return image_path.read_bytes() if image_path is not None else None
+
+
+def get_image_path(image_id):
+    """
+    Busca la imagen original en el almacén.
+
+    Returns:
+        tuple: (Path, content_type) o (None, None) si no existe
+    """
+    if not is_valid_image_id(image_id):
+        return None, None
+
+    image_dir = _image_dir(image_id)
+    for content_type, extension in EXTENSIONS.items():
+        image_path = image_dir / f"{image_id}.{extension}"
+        if image_path.exists():
+            return image_path, content_type
+
+    return None, None
+
+
+def get_thumbnail_path(image_id):
+    """
+    Devuelve la miniatura JPEG de una imagen, generándola la primera vez que se pide.
+
+    Returns:
+        Path o None si la imagen no existe
+    """
+    image_path, _ = get_image_path(image_id)
+    if image_path is None:
+        return None
+
+    thumbnail_path = image_path.with_name(f"{image_id}_thumb.jpg")
+    if thumbnail_path.exists():
+        return thumbnail_path
+
+    _write_atomic(thumbnail_path, _make_thumbnail(image_path))
+    return thumbnail_path
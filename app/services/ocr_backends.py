@@ -0,0 +1,196 @@
+"""
+Backends de OCR intercambiables detrás de get_textract_client().
+Todos exponen detect_document_text(Document={"Bytes": ...}) como el cliente de boto3:
+
+- textract: AWS Textract real (por defecto)
+- record: llama a Textract y guarda cada respuesta en disco
+- replay: responde con las respuestas guardadas, sin red ni credenciales, con
+  latencia simulada configurable (para benchmarks y pruebas locales)
+
+Se elige con OCR_BACKEND; las grabaciones viven en OCR_RECORDINGS_DIR.
+"""
+
+import contextvars
+import hashlib
+import json
+import os
+import random
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+BACKEND_TEXTRACT = "textract"
+BACKEND_RECORD = "record"
+BACKEND_REPLAY = "replay"
+BACKENDS = (BACKEND_TEXTRACT, BACKEND_RECORD, BACKEND_REPLAY)
+
+DEFAULT_BACKEND = os.environ.get("OCR_BACKEND", BACKEND_TEXTRACT).lower()
+DEFAULT_RECORDINGS_DIR = os.environ.get("OCR_RECORDINGS_DIR", "test_images/textract_responses")
+# "recorded" = la latencia medida al grabar, "250" = fija en ms, "150:600" = uniforme en el rango
+DEFAULT_REPLAY_LATENCY = os.environ.get("OCR_REPLAY_LATENCY_MS", "recorded")
+
+# Imagen original y variante de la llamada en curso (las fija analyze_text)
+_current_request = contextvars.ContextVar("ocr_request", default=None)
+
+
+class RecordingNotFoundError(Exception):
+    """No hay respuesta grabada para la imagen pedida"""
+
+
+def image_digest(image_bytes):
+    """SHA-256 de los bytes de una imagen"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+@contextmanager
+def ocr_request(source_bytes, preprocessed, label=None):
+    """
+    Marca la imagen original de las llamadas OCR del bloque.
+    Permite al replay encontrar la grabación aunque cambie el preprocesamiento
+    (los bytes enviados ya no coinciden, la imagen original sí).
+    """
+    outer = _current_request.get() or {}
+    token = _current_request.set({
+        "source_sha256": image_digest(source_bytes),
+        "preprocessed": bool(preprocessed),
+        # Una etiqueta fijada más arriba (p. ej. el nombre del archivo) se conserva
+        "label": label or outer.get("label"),
+    })
+    try:
+        yield
+    finally:
+        _current_request.reset(token)
+
+
+def parse_latency(spec):
+    """
+    Interpreta la latencia simulada
+
+    Returns:
+        None (usar la grabada) o una tupla (mínimo_ms, máximo_ms)
+    """
+    spec = str(spec).strip().lower()
+    if spec in ("", "recorded"):
+        return None
+    if ":" in spec:
+        low, high = (float(part) for part in spec.split(":", 1))
+    else:
+        low = high = float(spec)
+    if low < 0 or high < low:
+        raise ValueError(f"Latencia simulada no válida: {spec}")
+    return low, high
+
+
+class RecordingTextractClient:
+    """Envuelve al cliente real y guarda cada respuesta de detect_document_text"""
+
+    def __init__(self, client, recordings_dir=DEFAULT_RECORDINGS_DIR):
+        self.client = client
+        self.recordings_dir = Path(recordings_dir)
+        self.recordings_dir.mkdir(parents=True, exist_ok=True)
+
+    def detect_document_text(self, Document, **kwargs):
+        image_bytes = Document["Bytes"]
+        started = time.perf_counter()
+        response = self.client.detect_document_text(Document=Document, **kwargs)
+        latency_ms = (time.perf_counter() - started) * 1000
+
+        request = _current_request.get() or {}
+        sent_sha256 = image_digest(image_bytes)
+        recording = {
+            "sent_sha256": sent_sha256,
+            "source_sha256": request.get("source_sha256", sent_sha256),
+            "preprocessed": request.get("preprocessed", False),
+            "label": request.get("label"),
+            "latency_ms": round(latency_ms, 1),
+            "recorded_at": datetime.now().isoformat(),
+            "response": {key: value for key, value in response.items() if key != "ResponseMetadata"},
+        }
+        with open(self.recordings_dir / f"{sent_sha256}.json", "w") as f:
+            json.dump(recording, f, ensure_ascii=False)
+
+        print(f"💾 Respuesta de Textract grabada ({recording['label'] or sent_sha256[:12]}, {latency_ms:.0f} ms)")
+        return response
+
+
+class ReplayTextractClient:
+    """Responde con grabaciones de RecordingTextractClient, sin llamar a AWS"""
+
+    def __init__(self, recordings_dir=DEFAULT_RECORDINGS_DIR, latency=DEFAULT_REPLAY_LATENCY, seed=None):
+        self.recordings_dir = Path(recordings_dir)
+        self.latency = parse_latency(latency)
+        self._random = random.Random(seed)
+        self._by_sent = {}
+        self._by_source = {}
+        self._load()
+
+    def _load(self):
+        if not self.recordings_dir.is_dir():
+            print(f"⚠️ No existe la carpeta de grabaciones OCR: {self.recordings_dir}")
+            return
+        for path in sorted(self.recordings_dir.glob("*.json")):
+            with open(path, "r") as f:
+                recording = json.load(f)
+            self._by_sent[recording["sent_sha256"]] = recording
+            self._by_source.setdefault((recording["source_sha256"], recording["preprocessed"]), recording)
+        print(f"📼 {len(self._by_sent)} respuestas de Textract grabadas disponibles para replay")
+
+    def __len__(self):
+        return len(self._by_sent)
+
+    def has_recording(self, source_bytes):
+        """Hay alguna grabación de esta imagen original"""
+        digest = image_digest(source_bytes)
+        return digest in self._by_sent or any(source == digest for source, _ in self._by_source)
+
+    def find(self, image_bytes):
+        """Grabación para los bytes enviados o, si no, para la imagen original y variante en curso"""
+        recording = self._by_sent.get(image_digest(image_bytes))
+        if recording is None:
+            request = _current_request.get()
+            if request:
+                recording = self._by_source.get((request["source_sha256"], request["preprocessed"]))
+        return recording
+
+    def _sleep(self, recording):
+        if self.latency is None:
+            delay_ms = recording.get("latency_ms", 0)
+        else:
+            delay_ms = self._random.uniform(*self.latency)
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+
+    def detect_document_text(self, Document, **kwargs):
+        recording = self.find(Document["Bytes"])
+        if recording is None:
+            raise RecordingNotFoundError(
+                f"Sin respuesta grabada para la imagen ({image_digest(Document['Bytes'])[:12]}). "
+                f"Grábala con OCR_BACKEND={BACKEND_RECORD}"
+            )
+        self._sleep(recording)
+        return json.loads(json.dumps(recording["response"]))
+
+
+def create_ocr_client(backend=None, live_client_factory=None):
+    """
+    Crea el cliente OCR del backend indicado
+
+    Args:
+        backend: textract, record o replay (None = OCR_BACKEND)
+        live_client_factory: Función que crea el cliente real de Textract
+
+    Returns:
+        Cliente con detect_document_text, o None si el cliente real no está disponible
+    """
+    backend = (backend or DEFAULT_BACKEND).lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Backend OCR no válido: {backend}. Usa {', '.join(BACKENDS)}")
+
+    if backend == BACKEND_REPLAY:
+        return ReplayTextractClient()
+
+    client = live_client_factory() if live_client_factory else None
+    if client is None or backend == BACKEND_TEXTRACT:
+        return client
+    return RecordingTextractClient(client)
@@ -0,0 +1,34 @@
+"""
+Caché en memoria de resultados de OCR por contenido de la imagen.
+La misma foto (mismo SHA-256) procesada otra vez, por ejemplo al reintentar un
+/upload que falló al escribir en Sheets, no vuelve a pagar el OCR. Es un LRU
+acotado por proceso; OCR_CACHE_SIZE=0 lo desactiva.
+"""
+
+import os
+
+from .result_cache import ResultCache
+
+# Resultados guardados (un resultado pesa unos pocos KB de texto)
+OCR_CACHE_SIZE = int(os.environ.get("OCR_CACHE_SIZE", "256"))
+
+
+class OcrCache(ResultCache):
+    """LRU de resultados de OCR; las llaves incluyen la imagen y la variante (motor, preprocesado, ...)"""
+
+    def __init__(self, max_entries=OCR_CACHE_SIZE):
+        super().__init__(max_entries)
+
+    def get(self, key):
+        """
+        Returns:
+            dict: Copia del resultado guardado (cached=True, bytes_sent=0) o None
+        """
+        result = super().get(key)
+        if result is None:
+            return None
+        # Servido desde el caché: no se envió nada al OCR
+        return {**result, "cached": True, "bytes_sent": 0}
+
+
+ocr_cache = OcrCache()
@@ -0,0 +1,250 @@
+"""
+Motores de OCR y política de ruteo entre ellos.
+
+- tesseract: Tesseract local en un pool de procesos (uno por núcleo), sin red
+- textract: AWS Textract con sus estrategias de fallback (textract.py)
+
+Todos devuelven el mismo diccionario (text, confidence, lines_count, words_count,
+preprocessed, bytes_sent) más 'engine'. Con la política local_first se intenta Tesseract y solo
+se paga Textract cuando la confianza local es baja; si Textract falla (caída de AWS)
+se usa el resultado local disponible. La política tesseract nunca llama a Textract: sin
+Tesseract instalado responde 503.
+"""
+
+import multiprocessing
+import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from fastapi import HTTPException
+
+from .image_preprocessing import prepare_image_for_ocr
+from .textract import analyze_text_with_fallback
+
+try:
+    import pytesseract
+    PYTESSERACT_AVAILABLE = True
+except ImportError:
+    PYTESSERACT_AVAILABLE = False
+
+ENGINE_TESSERACT = "tesseract"
+ENGINE_TEXTRACT = "textract"
+
+POLICY_LOCAL_FIRST = "local_first"
+POLICY_TEXTRACT = "textract"
+POLICY_TESSERACT = "tesseract"
+POLICIES = (POLICY_LOCAL_FIRST, POLICY_TEXTRACT, POLICY_TESSERACT)
+
+DEFAULT_POLICY = os.environ.get("OCR_ENGINE_POLICY", POLICY_LOCAL_FIRST).lower()
+# Confianza mínima de Tesseract para no consultar Textract
+LOCAL_MIN_CONFIDENCE = float(os.environ.get("OCR_LOCAL_MIN_CONFIDENCE", "80"))
+TESSERACT_LANG = os.environ.get("OCR_TESSERACT_LANG", "spa")
+# psm 4: una columna de texto de tamaño variable (tickets)
+TESSERACT_CONFIG = os.environ.get("OCR_TESSERACT_CONFIG", "--oem 1 --psm 4")
+TESSERACT_WORKERS = int(os.environ.get("OCR_TESSERACT_WORKERS", "0")) or os.cpu_count() or 1
+TESSERACT_TIMEOUT = float(os.environ.get("OCR_TESSERACT_TIMEOUT", "60"))
+
+MIN_TEXT_LENGTH = 10
+
+
+def _tesseract_worker(image_bytes, preprocess, lang, config, timeout):
+    """Corre en el pool: preprocesa la imagen y extrae líneas con Tesseract"""
+    import io
+    from PIL import Image
+
+    if preprocess:
+        image_bytes = prepare_image_for_ocr(image_bytes)
+
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        # Con timeout pytesseract mata el binario si se cuelga (el proceso del pool queda libre)
+        data = pytesseract.image_to_data(image, lang=lang, config=config, output_type=pytesseract.Output.DICT,
+                                         timeout=timeout)
+    except Exception as e:
+        # Algunas excepciones de pytesseract no se pueden deserializar en el proceso padre
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+
+    # Agrupar palabras por línea (bloque, párrafo, línea) en el orden de lectura
+    lines = {}
+    for i, word in enumerate(data.get("text", [])):
+        word = (word or "").strip()
+        confidence = float(data["conf"][i])
+        if not word or confidence < 0:
+            continue
+        key = (data["page_num"][i], data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        lines.setdefault(key, []).append((word, confidence))
+
+    extracted_lines = [" ".join(word for word, _ in words) for words in lines.values()]
+    # Igual que Textract: promedio de la confianza por línea
+    line_confidences = [sum(conf for _, conf in words) / len(words) for words in lines.values()]
+
+    return {
+        "text": "\n".join(extracted_lines),
+        "confidence": sum(line_confidences) / len(line_confidences) if line_confidences else 0,
+        "lines_count": len(extracted_lines),
+        "words_count": sum(len(words) for words in lines.values()),
+        "preprocessed": preprocess,
+        # Sin red: nada se envía a AWS
+        "bytes_sent": 0,
+    }
+
+
+class TesseractEngine:
+    """Tesseract local en un pool de procesos creado bajo demanda"""
+
+    name = ENGINE_TESSERACT
+
+    def __init__(self, workers=TESSERACT_WORKERS, lang=TESSERACT_LANG, config=TESSERACT_CONFIG,
+                 timeout=TESSERACT_TIMEOUT):
+        self.workers = workers
+        self.lang = lang
+        self.config = config
+        self.timeout = timeout
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._available = None
+
+    def available(self):
+        """pytesseract instalado y el binario de tesseract en el PATH"""
+        if self._available is None:
+            self._available = PYTESSERACT_AVAILABLE and shutil.which(pytesseract.pytesseract.tesseract_cmd) is not None
+            if not self._available:
+                print("⚠️ Tesseract no disponible; el OCR usará solo AWS Textract")
+        return self._available
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                # spawn como la cola de trabajos: no hereda hilos ni conexiones del servidor
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+                print(f"🧵 Pool de Tesseract iniciado con {self.workers} procesos")
+            return self._pool
+
+    def _discard_pool(self, pool, terminate=False):
+        """
+        Descarta el pool (si no lo reemplazó ya otro hilo); el siguiente ticket crea uno nuevo.
+        Con terminate también mata sus procesos: future.cancel() no detiene un trabajo en curso
+        y un proceso colgado ocuparía su lugar en el pool para siempre.
+        """
+        with self._pool_lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+        # ProcessPoolExecutor no expone sus procesos; los tickets en curso en este pool fallan
+        processes = list((getattr(pool, "_processes", None) or {}).values()) if terminate else []
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        if terminate:
+            print(f"♻️ Pool de Tesseract reiniciado ({len(processes)} procesos terminados)")
+
+    def analyze(self, image_bytes, preprocess=True):
+        """Extrae texto con Tesseract; mismo formato que analyze_text de Textract"""
+        if not image_bytes:
+            raise HTTPException(status_code=400, detail="⚠️ La imagen subida está vacía.")
+
+        pool = self._get_pool()
+        future = pool.submit(_tesseract_worker, image_bytes, preprocess, self.lang, self.config, self.timeout)
+        try:
+            result = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            # Aún en cola se cancela; si ya corría, su proceso está colgado y hay que terminarlo
+            if not future.cancel():
+                self._discard_pool(pool, terminate=True)
+            raise HTTPException(status_code=504, detail="❌ Tesseract excedió el tiempo límite")
+        except BrokenProcessPool:
+            # Un proceso murió (p. ej. sin memoria): el siguiente ticket usa un pool nuevo
+            self._discard_pool(pool)
+            raise HTTPException(status_code=500, detail="❌ El pool de Tesseract se detuvo inesperadamente")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"❌ Error en Tesseract: {str(e)}")
+
+        result["engine"] = self.name
+        print(f"📊 OCR local (Tesseract) - Confianza: {result['confidence']:.1f}%, Líneas: {result['lines_count']}")
+        return result
+
+    def shutdown(self):
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+class TextractEngine:
+    """AWS Textract con las estrategias de analyze_text_with_fallback"""
+
+    name = ENGINE_TEXTRACT
+
+    def available(self):
+        return True
+
+    def analyze(self, image_bytes, preprocess=True):
+        result = analyze_text_with_fallback(image_bytes)
+        result["engine"] = self.name
+        return result
+
+
+tesseract_engine = TesseractEngine()
+textract_engine = TextractEngine()
+
+
+def _usable(result, min_confidence):
+    return (result is not None
+            and len(result.get("text", "").strip()) >= MIN_TEXT_LENGTH
+            and result.get("confidence", 0) >= min_confidence)
+
+
+def analyze_ticket_image(image_bytes, policy=None, min_confidence=LOCAL_MIN_CONFIDENCE):
+    """
+    Extrae el texto de un ticket eligiendo el motor según la política
+
+    Args:
+        image_bytes: Bytes de la imagen
+        policy: local_first, textract o tesseract (None = OCR_ENGINE_POLICY)
+        min_confidence: Confianza local mínima para no consultar Textract
+
+    Returns:
+        dict: Resultado del OCR con 'engine' indicando el motor usado
+    """
+    policy = (policy or DEFAULT_POLICY).lower()
+    if policy not in POLICIES:
+        raise ValueError(f"Política de OCR no válida: {policy}. Usa {', '.join(POLICIES)}")
+
+    if policy == POLICY_TEXTRACT:
+        return textract_engine.analyze(image_bytes)
+    if not tesseract_engine.available():
+        if policy == POLICY_TESSERACT:
+            # Quien pidió solo Tesseract no quiere pagar Textract
+            raise HTTPException(status_code=503,
+                                detail="❌ Tesseract no está instalado y la política de OCR 'tesseract' no usa Textract")
+        return textract_engine.analyze(image_bytes)
+
+    local_result = None
+    try:
+        local_result = tesseract_engine.analyze(image_bytes)
+    except HTTPException as e:
+        if policy == POLICY_TESSERACT:
+            raise
+        print(f"⚠️ Falló el OCR local: {e.detail}")
+
+    if policy == POLICY_TESSERACT or _usable(local_result, min_confidence):
+        return local_result
+
+    print(f"🔄 Confianza local insuficiente (< {min_confidence:.0f}%), consultando AWS Textract...")
+    try:
+        return textract_engine.analyze(image_bytes)
+    except HTTPException:
+        # Sin Textract (caída de AWS, credenciales): mejor el resultado local que nada
+        if local_result and local_result.get("text", "").strip():
+            print("⚠️ AWS Textract no disponible, usando el resultado de Tesseract")
+            return local_result
+        raise
+
+
+def shutdown_ocr_engines():
+    """Detiene el pool de Tesseract (al apagar el servidor)"""
+    tesseract_engine.shutdown()
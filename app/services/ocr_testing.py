@@ -1,202 +1,378 @@
 """
 Módulo de testing para validar y mejorar la precisión del OCR.
 Incluye funciones para probar diferentes configuraciones y medir resultados.
+
+Las imágenes se prueban en paralelo con un pool acotado (OCR_TEST_WORKERS); las
+configuraciones de una misma imagen corren en orden dentro de su tarea. Cada lectura
+de OCR se guarda por (imagen, preprocesado): una configuración que ya tiene la lectura
+de la anterior (p. ej. la reintentada sin preprocesamiento por baja confianza) no
+vuelve a llamar a Textract, y volver a correr el lote tras cambiar un parser solo
+repite el parseo. batch_test_images
+agrega un reporte de precisión y latencia (p50/p95) por imagen, cadena y configuración.
 """
 
+import hashlib
 import json
+import os
+import threading
 import time
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+
+import numpy as np
+
 from .textract import analyze_text, analyze_text_with_fallback
 from .ticket_detector import detect_ticket_type, validate_ticket_content
-from .textprocess_OXXO import process_text_oxxo as process_oxxo
-from .textprocess_KIOSKO import process_text_kiosko as process_kiosko
+from .chains import get_chain
+from .ocr_cache import OcrCache
 
-def test_ocr_accuracy(image_bytes, filename="test_image", expected_type=None):
+# Imágenes probadas a la vez
+OCR_TEST_WORKERS = int(os.environ.get("OCR_TEST_WORKERS", "4"))
+
+# Configuraciones a probar
+TEST_CONFIGS = (
+    {"preprocess": True, "name": "Con preprocesamiento completo"},
+    {"preprocess": False, "name": "Sin preprocesamiento"},
+)
+
+# Lecturas de OCR por (sha256 de la imagen, preprocesado)
+ocr_results = OcrCache()
+# Llave → [lock, pruebas que lo usan]; se borra al soltarlo la última
+_key_locks = {}
+_key_locks_guard = threading.Lock()
+
+
+@contextmanager
+def _key_lock(key):
+    """Exclusión por llave de OCR: la misma imagen pedida dos veces a la vez se lee una sola"""
+    with _key_locks_guard:
+        entry = _key_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _key_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _key_locks[key]
+
+
+def _cached_ocr(image_bytes, image_id, preprocess):
     """
-    Prueba la precisión del OCR con diferentes configuraciones.
-    
-    Args:
-        image_bytes: Bytes de la imagen a probar
-        filename: Nombre del archivo para logging
-        expected_type: Tipo esperado del ticket ("OXXO" o "KIOSKO")
-        
+    OCR de la imagen con la configuración dada, reutilizando lecturas anteriores
+
     Returns:
-        dict: Resultados detallados de las pruebas
+        dict: Resultado de analyze_text (cached=True si no se llamó a Textract)
     """
-    print(f"🧪 Iniciando pruebas de OCR para: {filename}")
-    
+    key = (image_id, preprocess)
+    # Dos pruebas con la misma llave esperan a la primera en lugar de repetir la llamada
+    with _key_lock(key):
+        result = ocr_results.get(key)
+        if result is not None:
+            return result
+        result = analyze_text(image_bytes, preprocess=preprocess)
+        ocr_results.put(key, result)
+        # Con baja confianza analyze_text ya reintentó sin preprocesamiento: esa lectura sirve a la otra configuración
+        if result.get("preprocessed") != preprocess:
+            ocr_results.put((image_id, result.get("preprocessed")), result)
+        return {**result, "cached": False}
+
+
+def _run_config(image_bytes, image_id, filename, expected_type, config):
+    """Una configuración sobre una imagen: OCR, detección, validación y parseo"""
+    print(f"🔬 Probando configuración: {config['name']} ({filename})")
+
+    try:
+        start_time = time.perf_counter()
+
+        # Ejecutar OCR
+        ocr_result = _cached_ocr(image_bytes, image_id, config["preprocess"])
+        ocr_time = time.perf_counter() - start_time
+
+        # Extraer información
+        ocr_text = ocr_result.get('text', '')
+        confidence = ocr_result.get('confidence', 0)
+
+        # Detectar tipo de ticket
+        detected_type = detect_ticket_type(ocr_text)
+
+        # Validar contenido
+        is_valid, validation_confidence, observations = validate_ticket_content(ocr_text, detected_type)
+
+        # Intentar procesar el ticket
+        processing_success = False
+        processing_error = None
+        product_count = 0
+
+        parse_start = time.perf_counter()
+        try:
+            # El parser directo, sin caché de parseo: se mide su precisión y su tiempo reales
+            processed_data = get_chain(detected_type).parser(ocr_text)
+
+            if isinstance(processed_data, list):
+                product_count = len(processed_data)
+                processing_success = True
+            elif isinstance(processed_data, dict) and "error" not in processed_data:
+                product_count = 1
+                processing_success = True
+
+        except Exception as e:
+            processing_error = str(e)
+        parse_time = time.perf_counter() - parse_start
+
+        processing_time = time.perf_counter() - start_time
+
+        # Calcular puntuación general
+        overall_score = (
+            confidence * 0.4 +  # 40% confianza OCR
+            validation_confidence * 0.3 +  # 30% validación de contenido
+            (100 if processing_success else 0) * 0.2 +  # 20% éxito en procesamiento
+            (100 if expected_type and detected_type == expected_type else 50) * 0.1  # 10% tipo correcto
+        )
+
+        test_result = {
+            "config": config,
+            "ocr_confidence": confidence,
+            "detected_type": detected_type,
+            "type_correct": expected_type == detected_type if expected_type else None,
+            "validation_confidence": validation_confidence,
+            "validation_observations": observations,
+            "processing_success": processing_success,
+            "processing_error": processing_error,
+            "product_count": product_count,
+            "processing_time": processing_time,
+            "ocr_ms": round(ocr_time * 1000, 2),
+            "ocr_cached": ocr_result.get("cached", False),
+            "parse_ms": round(parse_time * 1000, 2),
+            "bytes_sent": ocr_result.get("bytes_sent", 0),
+            "text_length": len(ocr_text),
+            "overall_score": overall_score,
+            "text_sample": ocr_text[:200] + "..." if len(ocr_text) > 200 else ocr_text
+        }
+
+        print(f"✅ Configuración completada ({filename}) - Puntuación: {overall_score:.1f}")
+        return test_result
+
+    except Exception as e:
+        print(f"❌ Error en configuración ({filename}): {e}")
+        return {
+            "config": config,
+            "error": str(e),
+            "overall_score": 0
+        }
+
+
+def _summarize_image(filename, expected_type, tests):
+    """Resultados de una imagen: mejor configuración y recomendaciones"""
     results = {
         "filename": filename,
+        "expected_type": expected_type,
         "timestamp": datetime.now().isoformat(),
-        "tests": [],
+        "tests": tests,
         "best_result": None,
         "recommendations": []
     }
-    
-    # Configuraciones a probar
-    test_configs = [
-        {"preprocess": True, "name": "Con preprocesamiento completo"},
-        {"preprocess": False, "name": "Sin preprocesamiento"},
-    ]
-    
+
+    # Mejor resultado (en empate, la primera configuración)
     best_confidence = 0
     best_config = None
-    
-    for config in test_configs:
-        print(f"🔬 Probando configuración: {config['name']}")
-        
-        try:
-            start_time = time.time()
-            
-            # Ejecutar OCR
-            ocr_result = analyze_text(image_bytes, preprocess=config["preprocess"])
-            
-            processing_time = time.time() - start_time
-            
-            # Extraer información
-            ocr_text = ocr_result.get('text', '')
-            confidence = ocr_result.get('confidence', 0)
-            
-            # Detectar tipo de ticket
-            detected_type = detect_ticket_type(ocr_text)
-            
-            # Validar contenido
-            is_valid, validation_confidence, observations = validate_ticket_content(ocr_text, detected_type)
-            
-            # Intentar procesar el ticket
-            processing_success = False
-            processing_error = None
-            product_count = 0
-            
-            try:
-                if detected_type == "KIOSKO":
-                    processed_data = process_kiosko(ocr_text)
-                else:
-                    processed_data = process_oxxo(ocr_text)
-                
-                if isinstance(processed_data, list):
-                    product_count = len(processed_data)
-                    processing_success = True
-                elif isinstance(processed_data, dict) and "error" not in processed_data:
-                    product_count = 1
-                    processing_success = True
-                    
-            except Exception as e:
-                processing_error = str(e)
-            
-            # Calcular puntuación general
-            overall_score = (
-                confidence * 0.4 +  # 40% confianza OCR
-                validation_confidence * 0.3 +  # 30% validación de contenido
-                (100 if processing_success else 0) * 0.2 +  # 20% éxito en procesamiento
-                (100 if expected_type and detected_type == expected_type else 50) * 0.1  # 10% tipo correcto
-            )
-            
-            test_result = {
-                "config": config,
-                "ocr_confidence": confidence,
-                "detected_type": detected_type,
-                "type_correct": expected_type == detected_type if expected_type else None,
-                "validation_confidence": validation_confidence,
-                "validation_observations": observations,
-                "processing_success": processing_success,
-                "processing_error": processing_error,
-                "product_count": product_count,
-                "processing_time": processing_time,
-                "text_length": len(ocr_text),
-                "overall_score": overall_score,
-                "text_sample": ocr_text[:200] + "..." if len(ocr_text) > 200 else ocr_text
-            }
-            
-            results["tests"].append(test_result)
-            
-            # Actualizar mejor resultado
-            if overall_score > best_confidence:
-                best_confidence = overall_score
-                best_config = test_result
-            
-            print(f"✅ Configuración completada - Puntuación: {overall_score:.1f}")
-            
-        except Exception as e:
-            error_result = {
-                "config": config,
-                "error": str(e),
-                "overall_score": 0
-            }
-            results["tests"].append(error_result)
-            print(f"❌ Error en configuración: {e}")
-    
+    for test_result in tests:
+        if "error" not in test_result and test_result["overall_score"] > best_confidence:
+            best_confidence = test_result["overall_score"]
+            best_config = test_result
+
     # Establecer mejor resultado
     results["best_result"] = best_config
-    
+
     # Generar recomendaciones
     recommendations = []
-    
+
     if best_config:
         if best_config["ocr_confidence"] < 70:
             recommendations.append("Considerar mejorar la calidad de la imagen original")
-        
+
         if best_config["validation_confidence"] < 60:
             recommendations.append("El tipo de ticket detectado tiene baja confianza")
-        
+
         if not best_config["processing_success"]:
             recommendations.append("Revisar los patrones de extracción de datos")
-        
+
         if best_config["processing_time"] > 10:
             recommendations.append("El procesamiento es lento, considerar optimizaciones")
-        
+
         if best_config["config"]["preprocess"]:
             recommendations.append("El preprocesamiento mejora los resultados")
         else:
             recommendations.append("El preprocesamiento no es necesario para esta imagen")
-    
+
     results["recommendations"] = recommendations
-    
-    print(f"🏆 Mejor configuración: {best_config['config']['name'] if best_config else 'Ninguna'}")
+
+    print(f"🏆 Mejor configuración para {filename}: {best_config['config']['name'] if best_config else 'Ninguna'}")
     print(f"📊 Puntuación final: {best_confidence:.1f}")
-    
+
     return results
 
-def batch_test_images(image_list, output_file="ocr_test_results.json"):
+
+def _run_image(image_bytes, filename, expected_type, test_configs):
+    """Todas las configuraciones de una imagen, en orden"""
+    image_id = hashlib.sha256(image_bytes).hexdigest()
+    # En orden: la segunda configuración encuentra en caché la lectura que la primera ya reintentó
+    return [_run_config(image_bytes, image_id, filename, expected_type, config) for config in test_configs]
+
+
+def _run_tests(image_list, test_configs, max_workers):
+    """
+    Prueba las imágenes en un pool acotado (una tarea por imagen)
+
+    Returns:
+        list: Por imagen, la lista de resultados de sus configuraciones (en el orden de test_configs)
+    """
+    workers = max(1, max_workers or OCR_TEST_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr-test") as pool:
+        futures = [pool.submit(_run_image, image_bytes, filename, expected_type, test_configs)
+                   for image_bytes, filename, expected_type in image_list]
+        return [future.result() for future in futures]
+
+
+def test_ocr_accuracy(image_bytes, filename="test_image", expected_type=None):
+    """
+    Prueba la precisión del OCR con diferentes configuraciones.
+    
+    Args:
+        image_bytes: Bytes de la imagen a probar
+        filename: Nombre del archivo para logging
+        expected_type: Tipo esperado del ticket ("OXXO" o "KIOSKO")
+        
+    Returns:
+        dict: Resultados detallados de las pruebas
+    """
+    print(f"🧪 Iniciando pruebas de OCR para: {filename}")
+    tests = _run_tests([(image_bytes, filename, expected_type)], TEST_CONFIGS, max_workers=1)[0]
+    return _summarize_image(filename, expected_type, tests)
+
+
+def _percentiles(values):
+    if not values:
+        return {}
+    return {
+        "p50": round(float(np.percentile(values, 50)), 2),
+        "p95": round(float(np.percentile(values, 95)), 2),
+        "mean": round(float(np.mean(values)), 2),
+        "count": len(values),
+    }
+
+
+def _accuracy(tests):
+    """Precisión y latencia de un grupo de pruebas (las que terminaron con error cuentan como fallidas)"""
+    completed = [test for test in tests if "error" not in test]
+    typed = [test for test in completed if test["type_correct"] is not None]
+    return {
+        "tests": len(tests),
+        "errors": len(tests) - len(completed),
+        "average_score": round(sum(test["overall_score"] for test in tests) / len(tests), 2) if tests else 0,
+        "processing_success_rate": round(
+            sum(test["processing_success"] for test in completed) / len(tests) * 100, 1) if tests else 0,
+        "type_accuracy": round(sum(test["type_correct"] for test in typed) / len(typed) * 100, 1) if typed else None,
+        "ocr_confidence": _percentiles([test["ocr_confidence"] for test in completed]),
+        # Latencia del OCR solo de las llamadas reales (las servidas desde el caché no miden a Textract)
+        "ocr_ms": _percentiles([test["ocr_ms"] for test in completed if not test["ocr_cached"]]),
+        "parse_ms": _percentiles([test["parse_ms"] for test in completed]),
+        "total_ms": _percentiles([test["processing_time"] * 1000 for test in completed]),
+    }
+
+
+def build_accuracy_report(individual_results):
+    """
+    Reporte legible por máquina de precisión y latencia
+
+    Args:
+        individual_results: Resultados por imagen (_summarize_image)
+
+    Returns:
+        dict: per_image (mejor configuración), per_chain (por tipo esperado o, sin él, detectado),
+              per_config y overall, cada grupo con p50/p95 de latencia
+    """
+    per_image = []
+    by_chain = defaultdict(list)
+    by_config = defaultdict(list)
+    all_tests = []
+
+    for result in individual_results:
+        tests = result.get("tests", [])
+        best = result.get("best_result") or {}
+        per_image.append({
+            "filename": result["filename"],
+            "expected_type": result.get("expected_type"),
+            "detected_type": best.get("detected_type"),
+            "type_correct": best.get("type_correct"),
+            "best_config": best["config"]["name"] if best else None,
+            "overall_score": round(best.get("overall_score", 0), 2),
+            "ocr_confidence": round(best.get("ocr_confidence", 0), 2),
+            "processing_success": best.get("processing_success", False),
+            "product_count": best.get("product_count", 0),
+            "total_ms": round(sum(test.get("processing_time", 0) for test in tests) * 1000, 2),
+            "error": None if best else next((test["error"] for test in tests if "error" in test), None),
+        })
+        chain = result.get("expected_type") or best.get("detected_type") or "DESCONOCIDO"
+        by_chain[chain].extend(tests)
+        for test in tests:
+            by_config[test["config"]["name"]].append(test)
+        all_tests.extend(tests)
+
+    return {
+        "per_image": per_image,
+        "per_chain": {chain: _accuracy(tests) for chain, tests in by_chain.items()},
+        "per_config": {name: _accuracy(tests) for name, tests in by_config.items()},
+        "overall": _accuracy(all_tests),
+    }
+
+
+def batch_test_images(image_list, output_file="ocr_test_results.json", max_workers=None):
     """
     Prueba múltiples imágenes y genera un reporte consolidado.
     
     Args:
         image_list: Lista de tuplas (image_bytes, filename, expected_type)
-        output_file: Archivo donde guardar los resultados
+        output_file: Archivo donde guardar los resultados (None: no se guarda)
+        max_workers: Imágenes simultáneas (por defecto OCR_TEST_WORKERS)
         
     Returns:
-        dict: Reporte consolidado
+        dict: Reporte consolidado (report: precisión y latencia por imagen, cadena y configuración)
     """
-    print(f"🧪 Iniciando pruebas en lote de {len(image_list)} imágenes")
+    workers = max(1, max_workers or OCR_TEST_WORKERS)
+    print(f"🧪 Iniciando pruebas en lote de {len(image_list)} imágenes × {len(TEST_CONFIGS)} "
+          f"configuraciones ({workers} imágenes a la vez)")
     
     batch_results = {
         "timestamp": datetime.now().isoformat(),
         "total_images": len(image_list),
+        "workers": workers,
         "individual_results": [],
         "summary": {}
     }
     
+    cache_before = ocr_results.stats()
+    started = time.perf_counter()
+    try:
+        all_tests = _run_tests(image_list, TEST_CONFIGS, workers)
+    except Exception as e:
+        print(f"❌ Error en las pruebas en lote: {e}")
+        all_tests = [[] for _ in image_list]
+    wall_time = time.perf_counter() - started
+
     total_score = 0
     successful_tests = 0
     
-    for i, (image_bytes, filename, expected_type) in enumerate(image_list, 1):
-        print(f"\n📸 Procesando imagen {i}/{len(image_list)}: {filename}")
+    for (image_bytes, filename, expected_type), tests in zip(image_list, all_tests):
+        result = _summarize_image(filename, expected_type, tests)
+        batch_results["individual_results"].append(result)
         
-        try:
-            result = test_ocr_accuracy(image_bytes, filename, expected_type)
-            batch_results["individual_results"].append(result)
-            
-            if result["best_result"]:
-                total_score += result["best_result"]["overall_score"]
-                successful_tests += 1
-                
-        except Exception as e:
-            print(f"❌ Error procesando {filename}: {e}")
-            batch_results["individual_results"].append({
-                "filename": filename,
-                "error": str(e)
-            })
+        if result["best_result"]:
+            total_score += result["best_result"]["overall_score"]
+            successful_tests += 1
     
     # Generar resumen
     if successful_tests > 0:
@@ -207,14 +383,28 @@ def batch_test_images(image_list, output_file="ocr_test_results.json"):
             "failed_tests": len(image_list) - successful_tests,
             "success_rate": (successful_tests / len(image_list)) * 100
         }
+
+    cache_after = ocr_results.stats()
+    batch_results["report"] = build_accuracy_report(batch_results["individual_results"])
+    batch_results["report"]["wall_time_ms"] = round(wall_time * 1000, 2)
+    batch_results["report"]["ocr_cache"] = {
+        "hits": cache_after["hits"] - cache_before["hits"],
+        "misses": cache_after["misses"] - cache_before["misses"],
+        "entries": cache_after["entries"],
+    }
+    overall = batch_results["report"]["overall"]
+    print(f"⏱️ Lote completado en {wall_time:.1f}s - total p50 {overall['total_ms'].get('p50', 0):.0f} ms, "
+          f"p95 {overall['total_ms'].get('p95', 0):.0f} ms; OCR reutilizado "
+          f"{batch_results['report']['ocr_cache']['hits']} veces")
     
     # Guardar resultados
-    try:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(batch_results, f, indent=2, ensure_ascii=False)
-        print(f"📄 Resultados guardados en: {output_file}")
-    except Exception as e:
-        print(f"⚠️ No se pudieron guardar los resultados: {e}")
+    if output_file:
+        try:
+            with open(output_file, 'w', encoding='utf-8') as f:
+                json.dump(batch_results, f, indent=2, ensure_ascii=False)
+            print(f"📄 Resultados guardados en: {output_file}")
+        except Exception as e:
+            print(f"⚠️ No se pudieron guardar los resultados: {e}")
     
     return batch_results
 
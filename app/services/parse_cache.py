@@ -0,0 +1,73 @@
+"""
+Caché de resultados de los parsers de tickets (textprocess_OXXO, textprocess_KIOSKO).
+Los parsers son funciones del texto OCR: el mismo texto revisado en /process-tickets,
+vuelto a subir por /upload o medido en ocr_testing se parsea una sola vez.
+
+La llave es el SHA-256 del texto normalizado (saltos de línea uniformes, sin espacios
+al final de cada renglón) más la cadena y la versión de su parser (PARSER_VERSION del
+módulo). El parser recibe el mismo texto normalizado, así que dos textos con la misma
+llave dan exactamente el mismo resultado. PARSE_CACHE_SIZE=0 desactiva el caché (el
+texto se sigue normalizando).
+"""
+
+import hashlib
+import os
+from datetime import date
+from functools import lru_cache
+
+from .result_cache import ResultCache
+
+PARSE_CACHE_SIZE = int(os.environ.get("PARSE_CACHE_SIZE", "256"))
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE or 1)
+def normalize_ocr_text(ocr_text):
+    """
+    Texto OCR normalizado y su huella (memoizado: cada texto se normaliza una vez)
+
+    Returns:
+        tuple: (texto normalizado, sha256 hex)
+    """
+    text = ocr_text.replace("\r\n", "\n").replace("\r", "\n")
+    text = "\n".join(line.rstrip() for line in text.split("\n")).strip()
+    return text, hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ParseCache(ResultCache):
+    """Resultados de parseo por (cadena, versión del parser, texto normalizado)"""
+
+    def __init__(self, max_entries=PARSE_CACHE_SIZE):
+        super().__init__(max_entries)
+
+    def parse(self, chain_name, parser_version, parser, ocr_text):
+        """
+        Parsea el texto con el parser de la cadena, o devuelve el resultado guardado
+
+        Args:
+            chain_name: Tipo de ticket ("OXXO", "KIOSKO", ...)
+            parser_version: Versión del parser (cambiarla invalida lo guardado)
+            parser: Función texto → lista de productos (o dict con 'error')
+            ocr_text: Texto extraído del OCR
+
+        Returns:
+            Resultado del parser; siempre una copia, nunca lo guardado
+        """
+        # Con o sin caché el parser ve el mismo texto normalizado
+        text, digest = normalize_ocr_text(ocr_text)
+        if self.max_entries <= 0:
+            return parser(text)
+
+        # El parser OXXO usa la fecha de hoy cuando no lee la del ticket: lo guardado vale por un día
+        key = (chain_name, parser_version, digest, date.today().isoformat())
+        result = self.get(key)
+        if result is not None:
+            print(f"♻️ Parseo {chain_name} en caché ({digest[:12]})")
+            return result
+
+        # Las excepciones del parser no se guardan: se propagan como siempre
+        result = parser(text)
+        self.put(key, result)
+        return result
+
+
+parse_cache = ParseCache()
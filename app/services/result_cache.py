@@ -0,0 +1,63 @@
+"""
+LRU en memoria para resultados de funciones costosas (OCR, parseo).
+Guarda y entrega copias profundas: quien recibe un resultado puede modificarlo
+sin alterar lo guardado. Acotado por número de entradas y seguro entre hilos.
+"""
+
+import copy
+import threading
+from collections import OrderedDict
+
+
+class ResultCache:
+    """LRU de resultados con estadísticas de aciertos; max_entries=0 lo desactiva"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Returns:
+            Copia del resultado guardado o None
+        """
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return copy.deepcopy(result)
+
+    def put(self, key, result):
+        if self.max_entries <= 0 or result is None:
+            return
+        stored = copy.deepcopy(result)
+        with self._lock:
+            self._entries[key] = stored
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups * 100, 1) if lookups else 0.0,
+            }
@@ -7,6 +7,9 @@ from dotenv import load_dotenv
 # Ya no importamos send_to_google_sheets aquí
 load_dotenv()
 
+# Subir al cambiar la extracción: invalida los resultados guardados en el caché de parseo
+PARSER_VERSION = 1
+
 # Funciones mejoradas para extracción KIOSKO
 def extract_kiosko_quantities_improved(lines, product_code, product_type):
     """Extrae cantidades usando algoritmo mejorado basado en análisis real."""
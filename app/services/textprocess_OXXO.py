@@ -2,6 +2,9 @@ import re
 import traceback
 from app.services.google_sheets import send_to_google_sheets
 
+# Subir al cambiar la extracción: invalida los resultados guardados en el caché de parseo
+PARSER_VERSION = 1
+
 def preprocess_ocr_text(text):
     """
     Preprocesa el texto OCR para eliminar duplicados y mejorar la calidad.
@@ -1,7 +1,13 @@
+import math
+
 import boto3
 import botocore.exceptions
+from botocore.config import Config
 from fastapi import HTTPException
-from .image_preprocessing import preprocess_image_for_ocr, detect_and_correct_orientation
+from .image_encoding import compact_original
+from .image_preprocessing import prepare_image_for_ocr
+from .ocr_backends import create_ocr_client, ocr_request
+from .textract_limiter import TextractBusyError, textract_limiter
 
 # Intentar importar dotenv de manera segura
 try:
@@ -14,6 +20,16 @@ except ImportError:
 # Variables globales
 textract_client = None
 
+class TextractThrottledError(HTTPException):
+    """Textract saturado (limitación de AWS o cola local llena): 503 con Retry-After"""
+
+    def __init__(self, retry_after):
+        super().__init__(
+            status_code=503,
+            detail="⏳ AWS Textract está saturado, intenta de nuevo en unos segundos.",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+
 def analyze_text_with_fallback(image_bytes):
     """
     Analiza texto con múltiples estrategias de fallback para maximizar éxito.
@@ -31,11 +47,14 @@ def analyze_text_with_fallback(image_bytes):
     
     best_result = None
     best_confidence = 0
+    # Bytes enviados a Textract entre todos los intentos
+    bytes_sent = 0
     
     for preprocess, description in strategies:
         try:
             print(f"🔄 Intentando OCR {description}...")
             result = analyze_text(image_bytes, preprocess=preprocess)
+            bytes_sent += result.get('bytes_sent', 0)
             
             confidence = result.get('confidence', 0)
             print(f"📊 Confianza obtenida: {confidence:.1f}%")
@@ -43,6 +62,7 @@ def analyze_text_with_fallback(image_bytes):
             # Si obtenemos buena confianza, usar este resultado
             if confidence > 85:
                 print(f"✅ Excelente confianza obtenida {description}")
+                result['bytes_sent'] = bytes_sent
                 return result
             
             # Guardar el mejor resultado hasta ahora
@@ -50,6 +70,12 @@ def analyze_text_with_fallback(image_bytes):
                 best_result = result
                 best_confidence = confidence
                 
+        except TextractThrottledError:
+            # Textract está limitando: otra estrategia solo sumaría carga
+            if best_result is None:
+                raise
+            print("⏳ Textract saturado, se omiten las demás estrategias")
+            break
         except Exception as e:
             print(f"❌ Falló estrategia {description}: {e}")
             continue
@@ -57,30 +83,47 @@ def analyze_text_with_fallback(image_bytes):
     # Devolver el mejor resultado encontrado
     if best_result:
         print(f"✅ Usando mejor resultado con confianza: {best_confidence:.1f}%")
+        best_result['bytes_sent'] = bytes_sent
         return best_result
     else:
         # Si todo falla, intentar una vez más con configuración básica
         print("🚨 Todas las estrategias fallaron, intentando configuración básica...")
-        return analyze_text(image_bytes, preprocess=False)
+        result = analyze_text(image_bytes, preprocess=False)
+        result['bytes_sent'] += bytes_sent
+        return result
+
+def _create_live_client():
+    """Crea el cliente real de AWS Textract (None si no hay credenciales)"""
+    try:
+        # En Lambda, no necesitamos profile_name
+        session = boto3.Session()
+        # Sin reintentos de botocore: los hace textract_limiter con backoff compartido por el proceso
+        return session.client("textract", config=Config(retries={"max_attempts": 0, "mode": "standard"}))
+    except botocore.exceptions.NoCredentialsError:
+        print("⚠️ No se encontraron credenciales de AWS.")
+        return None
+    except Exception as e:
+        print(f"⚠️ Error al inicializar la sesión de AWS: {str(e)}")
+        return None
 
 def get_textract_client():
-    """Inicializa y devuelve el cliente de AWS Textract bajo demanda"""
+    """
+    Inicializa y devuelve el cliente OCR bajo demanda.
+    Según OCR_BACKEND es Textract real, Textract grabando respuestas o el replay offline.
+    """
     global textract_client
     
     if textract_client is None:
-        try:
-            # En Lambda, no necesitamos profile_name
-            session = boto3.Session()
-            textract_client = session.client("textract")
-        except botocore.exceptions.NoCredentialsError:
-            print("⚠️ No se encontraron credenciales de AWS.")
-            return None
-        except Exception as e:
-            print(f"⚠️ Error al inicializar la sesión de AWS: {str(e)}")
-            return None
+        textract_client = create_ocr_client(live_client_factory=_create_live_client)
     
     return textract_client
 
+def _retry_original(image_bytes, bytes_sent):
+    """Reintenta sin preprocesamiento sumando los bytes ya enviados"""
+    result = analyze_text(image_bytes, preprocess=False)
+    result["bytes_sent"] += bytes_sent
+    return result
+
 def analyze_text(image_bytes, preprocess=True):
     """ 
     Extrae texto de una imagen usando AWS Textract con preprocesamiento opcional.
@@ -91,6 +134,7 @@ def analyze_text(image_bytes, preprocess=True):
         
     Returns:
         dict: Diccionario con el texto extraído y metadatos
+              (bytes_sent: bytes enviados a Textract, reintentos incluidos)
     """
 
     if not image_bytes:
@@ -101,18 +145,23 @@ def analyze_text(image_bytes, preprocess=True):
     if client is None:
         raise HTTPException(status_code=500, detail="⚠️ No se pudo inicializar el cliente de AWS Textract.")
 
+    bytes_sent = 0
     try:
         # Preprocesar imagen si está habilitado
-        processed_image_bytes = image_bytes
         if preprocess:
             print("🔧 Aplicando preprocesamiento a la imagen...")
-            # Corregir orientación primero
-            processed_image_bytes = detect_and_correct_orientation(image_bytes)
-            # Luego aplicar mejoras de calidad
-            processed_image_bytes = preprocess_image_for_ocr(processed_image_bytes)
+            # Orientación, recorte al ticket y mejoras de calidad en una sola pasada
+            processed_image_bytes = prepare_image_for_ocr(image_bytes)
+        else:
+            # Original en escala de grises y dentro del límite de bytes de Textract
+            processed_image_bytes = compact_original(image_bytes)
         
-        # Intentar OCR con imagen procesada
-        response = client.detect_document_text(Document={"Bytes": processed_image_bytes})
+        # Intentar OCR con imagen procesada (la original identifica la grabación en modo replay)
+        bytes_sent = len(processed_image_bytes)
+        print(f"📤 Enviando {bytes_sent // 1024} KB a Textract")
+        with ocr_request(image_bytes, preprocess):
+            # Ritmo, simultáneas y reintentos por limitación de AWS compartidos por todo el proceso
+            response = textract_limiter.call(client.detect_document_text, Document={"Bytes": processed_image_bytes})
         
         # Extraer texto con mejor estructura
         extracted_lines = []
@@ -141,32 +190,42 @@ def analyze_text(image_bytes, preprocess=True):
         # Si la confianza es muy baja, intentar sin preprocesamiento
         if preprocess and avg_confidence < 70:
             print("⚠️ Confianza baja, reintentando sin preprocesamiento...")
-            return analyze_text(image_bytes, preprocess=False)
+            return _retry_original(image_bytes, bytes_sent)
         
         return {
             "text": final_text,
             "confidence": avg_confidence,
             "lines_count": len(extracted_lines),
             "words_count": len(extracted_words),
-            "preprocessed": preprocess
+            "preprocessed": preprocess,
+            "bytes_sent": bytes_sent
         }
 
+    except HTTPException:
+        # Ya resuelto (p. ej. el reintento sin preprocesamiento): no repetir la llamada
+        raise
+
+    except TextractBusyError as e:
+        # Reintentar con la original solo sumaría carga mientras AWS limita
+        print(f"⏳ {e}")
+        raise TextractThrottledError(e.retry_after)
+
     except botocore.exceptions.ClientError as e:
         error_msg = e.response["Error"]["Message"]
         # Si falla con imagen procesada, intentar con original
         if preprocess:
             print("⚠️ Error con imagen procesada, reintentando con original...")
-            return analyze_text(image_bytes, preprocess=False)
+            return _retry_original(image_bytes, bytes_sent)
         raise HTTPException(status_code=500, detail=f"❌ AWS Textract ClientError: {error_msg}")
 
     except boto3.exceptions.Boto3Error as e:
         if preprocess:
             print("⚠️ Error con imagen procesada, reintentando con original...")
-            return analyze_text(image_bytes, preprocess=False)
+            return _retry_original(image_bytes, bytes_sent)
         raise HTTPException(status_code=500, detail=f"❌ Error en AWS Textract: {str(e)}")
 
     except Exception as e:
         if preprocess:
             print("⚠️ Error con imagen procesada, reintentando con original...")
-            return analyze_text(image_bytes, preprocess=False)
+            return _retry_original(image_bytes, bytes_sent)
         raise HTTPException(status_code=500, detail=f"❌ Error inesperado en Textract: {str(e)}")
\ No newline at end of file
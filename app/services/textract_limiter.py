@@ -0,0 +1,233 @@
+"""
+Control de tráfico hacia AWS Textract compartido por todo el proceso.
+
+Todas las llamadas a Textract (/upload, /process-tickets, ocr_testing, ...) pasan por
+textract_limiter:
+- un token bucket limita las llamadas por segundo (TEXTRACT_RATE_PER_SEC, ráfagas de
+  TEXTRACT_BURST), por debajo de la cuota de la cuenta en lugar de descubrirla con errores
+- un máximo de llamadas simultáneas (TEXTRACT_MAX_IN_FLIGHT)
+- ThrottlingException / ProvisionedThroughputExceededException se reintentan con
+  backoff exponencial con jitter y vacían el bucket, así todo el proceso baja el ritmo
+- si no hay turno en TEXTRACT_MAX_WAIT_S o se agotan los reintentos se lanza
+  TextractBusyError (textract.py responde 503 con Retry-After)
+
+stats() reporta llamadas, limitaciones de AWS, reintentos y tiempo de espera (p50/p95).
+TEXTRACT_RATE_PER_SEC=0 y TEXTRACT_MAX_IN_FLIGHT=0 desactivan cada límite.
+"""
+
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import botocore.exceptions
+
+TEXTRACT_RATE_PER_SEC = float(os.environ.get("TEXTRACT_RATE_PER_SEC", "5"))
+TEXTRACT_BURST = int(os.environ.get("TEXTRACT_BURST", "5"))
+TEXTRACT_MAX_IN_FLIGHT = int(os.environ.get("TEXTRACT_MAX_IN_FLIGHT", "4"))
+TEXTRACT_MAX_RETRIES = int(os.environ.get("TEXTRACT_MAX_RETRIES", "4"))
+TEXTRACT_BACKOFF_BASE_MS = float(os.environ.get("TEXTRACT_BACKOFF_BASE_MS", "250"))
+TEXTRACT_BACKOFF_MAX_MS = float(os.environ.get("TEXTRACT_BACKOFF_MAX_MS", "8000"))
+# Espera máxima por un turno antes de responder "ocupado" (el cliente reintenta después)
+TEXTRACT_MAX_WAIT_S = float(os.environ.get("TEXTRACT_MAX_WAIT_S", "30"))
+
+THROTTLING_ERROR_CODES = ("ThrottlingException", "ProvisionedThroughputExceededException", "Throttling")
+
+# Esperas recientes para los percentiles de stats()
+WAIT_SAMPLES = 1000
+
+
+class TextractBusyError(Exception):
+    """Sin turno para Textract (cola local llena o AWS sigue limitando tras los reintentos)"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        # Segundos sugeridos antes de volver a intentar
+        self.retry_after = retry_after
+
+
+def is_throttling_error(error):
+    """True si el ClientError es una limitación de tasa de AWS"""
+    return (isinstance(error, botocore.exceptions.ClientError)
+            and error.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES)
+
+
+class TokenBucket:
+    """
+    Token bucket con reservas: cada llamada toma un token y recibe cuánto esperar.
+    Los tokens pueden quedar en negativo; las esperas se reparten en orden de llegada.
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._clock = clock
+        self._tokens = float(self.capacity)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        """Toma un token; devuelve los segundos a esperar antes de usarlo"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    def refund(self):
+        """Devuelve un token reservado que no se usó"""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + 1)
+
+    def drain(self):
+        """Descarta la ráfaga disponible (AWS acaba de limitar: nadie sale sin esperar su turno)"""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0.0)
+
+
+class TextractLimiter:
+    """Ritmo, concurrencia y reintentos de las llamadas a Textract"""
+
+    def __init__(self, rate=TEXTRACT_RATE_PER_SEC, burst=TEXTRACT_BURST, max_in_flight=TEXTRACT_MAX_IN_FLIGHT,
+                 max_retries=TEXTRACT_MAX_RETRIES, backoff_base_ms=TEXTRACT_BACKOFF_BASE_MS,
+                 backoff_max_ms=TEXTRACT_BACKOFF_MAX_MS, max_wait=TEXTRACT_MAX_WAIT_S, sleep=time.sleep):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_in_flight = max_in_flight
+        self._slots = threading.BoundedSemaphore(max_in_flight) if max_in_flight > 0 else None
+        self.max_retries = max(0, max_retries)
+        self.backoff_base = backoff_base_ms / 1000
+        self.backoff_max = backoff_max_ms / 1000
+        self.max_wait = max_wait
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.throttled = 0
+            self.retries = 0
+            self.gave_up = 0
+            self.busy = 0
+            self.in_flight = 0
+            self.peak_in_flight = 0
+            self.waits_ms = deque(maxlen=WAIT_SAMPLES)
+            self.total_wait_ms = 0.0
+            self.max_wait_ms = 0.0
+
+    def backoff(self, attempt):
+        """Backoff exponencial con jitter completo: uniforme entre 0 y base·2^intento (acotado)"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _acquire(self):
+        """Espera turno (lugar entre las simultáneas y token); devuelve los ms esperados"""
+        started = time.monotonic()
+        if self._slots is not None and not self._slots.acquire(timeout=self.max_wait):
+            with self._lock:
+                self.busy += 1
+            raise TextractBusyError(
+                f"{self.max_in_flight} llamadas a Textract en curso tras {self.max_wait:.0f}s de espera",
+                retry_after=self.max_wait)
+        try:
+            delay = self.bucket.reserve()
+            if time.monotonic() - started + delay > self.max_wait:
+                self.bucket.refund()
+                with self._lock:
+                    self.busy += 1
+                raise TextractBusyError(f"Cola de Textract llena ({delay:.1f}s de espera)", retry_after=delay)
+            if delay > 0:
+                self._sleep(delay)
+        except BaseException:
+            if self._slots is not None:
+                self._slots.release()
+            raise
+
+        waited_ms = (time.monotonic() - started) * 1000
+        with self._lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            self.waits_ms.append(waited_ms)
+            self.total_wait_ms += waited_ms
+            self.max_wait_ms = max(self.max_wait_ms, waited_ms)
+        return waited_ms
+
+    def _release(self):
+        with self._lock:
+            self.in_flight -= 1
+        if self._slots is not None:
+            self._slots.release()
+
+    def call(self, func, *args, **kwargs):
+        """
+        Llama a func (p. ej. client.detect_document_text) respetando ritmo y concurrencia
+
+        Raises:
+            TextractBusyError: Sin turno a tiempo o AWS siguió limitando tras los reintentos
+            botocore.exceptions.ClientError: Otros errores de AWS (sin reintento aquí)
+        """
+        attempt = 0
+        while True:
+            self._acquire()
+            try:
+                with self._lock:
+                    self.calls += 1
+                return func(*args, **kwargs)
+            except botocore.exceptions.ClientError as e:
+                if not is_throttling_error(e):
+                    raise
+                self.bucket.drain()
+                with self._lock:
+                    self.throttled += 1
+                if attempt >= self.max_retries:
+                    with self._lock:
+                        self.gave_up += 1
+                    raise TextractBusyError(
+                        f"AWS Textract siguió limitando tras {attempt + 1} intentos",
+                        retry_after=self.backoff_max) from e
+            finally:
+                self._release()
+
+            # Fuera del turno: la espera no ocupa un lugar de las simultáneas
+            delay = self.backoff(attempt)
+            attempt += 1
+            with self._lock:
+                self.retries += 1
+            print(f"⏳ Textract limitó la tasa, reintento {attempt}/{self.max_retries} en {delay * 1000:.0f} ms")
+            self._sleep(delay)
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self.waits_ms)
+            return {
+                "rate_per_sec": self.bucket.rate,
+                "burst": self.bucket.capacity,
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "calls": self.calls,
+                "throttled": self.throttled,
+                "retries": self.retries,
+                "gave_up": self.gave_up,
+                "busy": self.busy,
+                "wait_ms": {
+                    "p50": round(waits[int(0.50 * (len(waits) - 1))], 2) if waits else 0.0,
+                    "p95": round(waits[int(0.95 * (len(waits) - 1))], 2) if waits else 0.0,
+                    "max": round(self.max_wait_ms, 2),
+                    "total": round(self.total_wait_ms, 2),
+                },
+            }
+
+
+textract_limiter = TextractLimiter()
@@ -1,188 +1,293 @@
 """
 Módulo para detectar automáticamente el tipo de ticket (OXXO o KIOSKO)
 basado en patrones presentes en el texto OCR.
-Versión mejorada con más patrones y mejor lógica de decisión.
+
+Los patrones de todas las cadenas (definitivos, secundarios, códigos de producto y
+los de validación) se buscan sobre un solo texto en mayúsculas, cada uno a lo sumo
+una vez y solo cuando la decisión lo necesita: detección y validación comparten los
+resultados. El veredicto se guarda en caché, así que detect_ticket_type y
+validate_ticket_content sobre el mismo texto no lo vuelven a recorrer.
+
+Cada cadena registra sus patrones con register_chain_patterns (ver chains.py), sin
+pasadas adicionales.
 """
 
+from functools import lru_cache
+
+# Confianza mínima (%) para decidir por patrones secundarios
+MIN_DETECTION_CONFIDENCE = 15
+# Confianza mínima (%) para que el contenido se considere consistente con el tipo
+MIN_VALIDATION_CONFIDENCE = 60
+# Veredictos guardados (un texto OCR por ticket; los endpoints consultan varias veces)
+VERDICT_CACHE_SIZE = 256
+
+# Patrones por cadena, en orden de prioridad para los patrones definitivos
+_CHAIN_PATTERNS = {}
+
+
+def register_chain_patterns(name, definitive=(), secondary=(), product_codes=(), product_code_weight=0,
+                            min_lines=None, min_lines_weight=0, same_line=(), same_line_weight=0,
+                            fallback=(), validations=()):
+    """
+    Registra (o reemplaza) los patrones de detección de una cadena
+
+    Args:
+        name: Tipo de ticket ("OXXO", "KIOSKO", ...)
+        definitive: Patrones que por sí solos deciden el tipo
+        secondary: Patrones que suman a la confianza
+        product_codes: Códigos de producto; cualquiera suma product_code_weight
+        min_lines: Textos con más líneas que esto suman min_lines_weight
+        same_line: Pares de patrones que juntos en una línea suman same_line_weight
+        fallback: Patrones que, con confianza baja en todas las cadenas, eligen esta cadena
+        validations: (patrones, observación, penalización): si no aparece ninguno de los
+                     patrones se agrega la observación y se resta la penalización
+    """
+    spec = {
+        "definitive": tuple(definitive),
+        "secondary": tuple(secondary),
+        "product_codes": tuple(product_codes),
+        "product_code_weight": product_code_weight,
+        "min_lines": min_lines,
+        "min_lines_weight": min_lines_weight,
+        "same_line": tuple(tuple(pair) for pair in same_line),
+        "same_line_weight": same_line_weight,
+        "fallback": tuple(fallback),
+        "validations": tuple((tuple(patterns), observation, penalty)
+                             for patterns, observation, penalty in validations),
+    }
+    # Denominador de la confianza: patrones secundarios más los bonos posibles
+    spec["possible"] = (len(set(spec["secondary"]))
+                        + (product_code_weight if spec["product_codes"] else 0)
+                        + (min_lines_weight if min_lines is not None else 0)
+                        + (same_line_weight if spec["same_line"] else 0))
+    _CHAIN_PATTERNS[name] = spec
+    # Los patrones cambiaron: olvidar los veredictos
+    _scoring_patterns.cache_clear()
+    classify_ticket.cache_clear()
+
+
+def registered_chains():
+    return list(_CHAIN_PATTERNS)
+
+
+@lru_cache(maxsize=1)
+def _scoring_patterns():
+    """Patrones que decide la detección por puntaje (secundarios, códigos y columnas), sin repetir"""
+    patterns = set()
+    for spec in _CHAIN_PATTERNS.values():
+        patterns.update(spec["secondary"], spec["product_codes"])
+        for pair in spec["same_line"]:
+            patterns.update(pair)
+    return frozenset(patterns)
+
+
+class _TextMatches:
+    """Presencia de patrones en el texto: cada patrón se busca a lo sumo una vez"""
+
+    __slots__ = ("text_upper", "known", "scored", "scored_present")
+
+    def __init__(self, text_upper, known=None):
+        self.text_upper = text_upper
+        self.known = known if known is not None else {}
+        # Patrones buscados todos juntos para el puntaje y los que aparecieron
+        self.scored = frozenset()
+        self.scored_present = frozenset()
+
+    def __contains__(self, pattern):
+        if pattern in self.scored:
+            return pattern in self.scored_present
+        present = self.known.get(pattern)
+        if present is None:
+            present = self.known[pattern] = pattern in self.text_upper
+        return present
+
+    def any(self, patterns):
+        return any(pattern in self for pattern in patterns)
+
+    def same_line(self, first, second):
+        """Algún renglón contiene ambos patrones (solo se revisan los renglones de first)"""
+        if first not in self or second not in self:
+            return False
+        text = self.text_upper
+        position = text.find(first)
+        while position != -1:
+            start = text.rfind('\n', 0, position) + 1
+            end = text.find('\n', position)
+            if second in text[start:end if end != -1 else len(text)]:
+                return True
+            position = text.find(first, position + 1)
+        return False
+
+
+class TicketVerdict:
+    """Resultado de classify_ticket; las validaciones se calculan al pedirlas"""
+
+    __slots__ = ("ticket_type", "reason", "pattern", "secondary", "matches", "confidences", "bonuses",
+                 "_found", "_validations")
+
+    def __init__(self, ticket_type, reason, found, pattern=None, scores=({}, {}, {}, ())):
+        self.ticket_type = ticket_type
+        # "definitivo", "confianza" o "heuristica"
+        self.reason = reason
+        # Patrón definitivo que decidió (o None)
+        self.pattern = pattern
+        # {cadena: secundarios}, {cadena: coincidencias con bonos}, {cadena: confianza %}, bonos aplicados
+        self.secondary, self.matches, self.confidences, self.bonuses = scores
+        self._found = found
+        self._validations = {}
+
+    def validation(self, chain):
+        """
+        Returns:
+            tuple: (es_valido, confianza, observaciones) o None si la cadena no está registrada
+        """
+        if chain not in self._validations:
+            spec = _CHAIN_PATTERNS.get(chain)
+            self._validations[chain] = None if spec is None else _validate(spec, self._found)
+        return self._validations[chain]
+
+
+def _validate(spec, found):
+    observaciones = []
+    confianza = 100
+    for patterns, observation, penalty in spec["validations"]:
+        if not found.any(patterns):
+            observaciones.append(observation)
+            confianza -= penalty
+    return confianza >= MIN_VALIDATION_CONFIDENCE, confianza, tuple(observaciones)
+
+
+def _secondary_scores(found):
+    """
+    Coincidencias y confianzas por patrones secundarios y bonos de cada cadena
+
+    Returns:
+        tuple: ({cadena: secundarios}, {cadena: coincidencias con bonos}, {cadena: confianza %}, bonos)
+    """
+    # Todos los patrones del puntaje en una sola pasada (los definitivos ya se descartaron)
+    text = found.text_upper
+    found.scored = _scoring_patterns()
+    found.scored_present = present = {pattern for pattern in found.scored if pattern in text}
+
+    secondary = {name: len(present.intersection(spec["secondary"])) for name, spec in _CHAIN_PATTERNS.items()}
+    matches = dict(secondary)
+    bonuses = []
+
+    for name, spec in _CHAIN_PATTERNS.items():
+        if spec["product_code_weight"] and not present.isdisjoint(spec["product_codes"]):
+            codes = [code for code in spec["product_codes"] if code in present]
+            matches[name] += spec["product_code_weight"]
+            bonuses.append(f"🔍 Códigos de producto detectados: {', '.join(codes)}")
+
+        if spec["min_lines"] is not None and spec["min_lines_weight"] and text.count('\n') + 1 > spec["min_lines"]:
+            matches[name] += spec["min_lines_weight"]
+            bonuses.append(f"🔍 Estructura de texto larga detectada (+{spec['min_lines_weight']} {name})")
+
+        if spec["same_line_weight"] and any(found.same_line(first, second) for first, second in spec["same_line"]):
+            matches[name] += spec["same_line_weight"]
+            bonuses.append(f"🔍 Estructura de columnas {name} detectada (+{spec['same_line_weight']} {name})")
+
+    confidences = {name: matches[name] / spec["possible"] * 100 if spec["possible"] else 0
+                   for name, spec in _CHAIN_PATTERNS.items()}
+    return secondary, matches, confidences, tuple(bonuses)
+
+
+@lru_cache(maxsize=VERDICT_CACHE_SIZE)
+def classify_ticket(ocr_text):
+    """
+    Clasifica el ticket; las validaciones contra cada cadena reutilizan las mismas búsquedas
+
+    Args:
+        ocr_text: Texto extraído del OCR
+
+    Returns:
+        TicketVerdict (se comparte entre llamadas con el mismo texto)
+    """
+    text_upper = ocr_text.upper()
+
+    # Patrones definitivos, en el orden de registro de las cadenas
+    for name, spec in _CHAIN_PATTERNS.items():
+        for pattern in spec["definitive"]:
+            if pattern in text_upper:
+                return TicketVerdict(name, "definitivo", _TextMatches(text_upper, {pattern: True}), pattern)
+
+    found = _TextMatches(text_upper)
+    scores = _secondary_scores(found)
+    _, matches, confidences, _ = scores
+
+    # Una cadena gana si supera a todas las demás y al umbral mínimo
+    for name, confidence in confidences.items():
+        if confidence > MIN_DETECTION_CONFIDENCE and all(
+            confidence > other for other_name, other in confidences.items() if other_name != name
+        ):
+            return TicketVerdict(name, "confianza", found, scores=scores)
+
+    # Confianza baja en todas: la primera cadena con alguna evidencia de respaldo
+    for name, spec in _CHAIN_PATTERNS.items():
+        if spec["fallback"] and (matches[name] > 0 or found.any(spec["fallback"])):
+            return TicketVerdict(name, "heuristica", found, scores=scores)
+    fallback_type = next((name for name, spec in _CHAIN_PATTERNS.items() if not spec["fallback"]),
+                         next(iter(_CHAIN_PATTERNS)))
+    return TicketVerdict(fallback_type, "heuristica", found, scores=scores)
+
+
 def validate_ticket_content(ocr_text, detected_type):
     """
     Valida que el contenido del ticket sea consistente con el tipo detectado.
-    
+
     Args:
         ocr_text: Texto del OCR
         detected_type: Tipo detectado ("OXXO" o "KIOSKO")
-        
+
     Returns:
         tuple: (es_valido, confianza, observaciones)
     """
-    text_upper = ocr_text.upper()
-    observaciones = []
-    confianza = 100
-    
-    if detected_type == "KIOSKO":
-        # Validaciones específicas para KIOSKO
-        if "FOLIO:" not in text_upper:
-            observaciones.append("Falta patrón 'FOLIO:' típico de KIOSKO")
-            confianza -= 20
-        
-        if not any(codigo in text_upper for codigo in ["7500465096004", "7500465096011"]):
-            observaciones.append("No se encontraron códigos de producto esperados")
-            confianza -= 15
-        
-        if "GAS" not in text_upper:
-            observaciones.append("Falta referencia a estación de gas")
-            confianza -= 10
-            
-    elif detected_type == "OXXO":
-        # Validaciones específicas para OXXO
-        if "TIENDA:" not in text_upper and "PLAZA:" not in text_upper:
-            observaciones.append("Falta información de tienda/plaza típica de OXXO")
-            confianza -= 15
-        
-        if "REMISION" not in text_upper and "PEDIDO" not in text_upper:
-            observaciones.append("Falta información de remisión/pedido")
-            confianza -= 20
-        
-        if not any(patron in text_upper for patron in ["UDS", "U.COM", "VAL.TOT"]):
-            observaciones.append("Falta estructura de columnas típica de OXXO")
-            confianza -= 10
-    
-    es_valido = confianza >= 60
-    
+    validation = classify_ticket(ocr_text).validation(detected_type)
+    if validation is None:
+        return True, 100, []
+    es_valido, confianza, observaciones = validation
+
     if observaciones:
         print(f"⚠️ Validación del ticket {detected_type}:")
         for obs in observaciones:
             print(f"   - {obs}")
         print(f"   - Confianza final: {confianza}%")
-    
-    return es_valido, confianza, observaciones
+
+    return es_valido, confianza, list(observaciones)
 
 def detect_ticket_type(ocr_text):
     """
     Detecta automáticamente si un ticket es de OXXO o KIOSKO basado en patrones en el texto.
-    Versión mejorada con más patrones y mejor lógica de decisión.
-    
+
     Args:
         ocr_text: Texto extraído del OCR
-        
+
     Returns:
         str: "OXXO" o "KIOSKO"
     """
-    # Convertir a mayúsculas para hacer la búsqueda insensible a mayúsculas/minúsculas
-    text_upper = ocr_text.upper()
-    
-    # Patrones definitivos para KIOSKO (si aparece cualquiera, es KIOSKO seguro)
-    kiosko_definitive = [
-        "FOLIO:",
-        "ENTRADA POR COMPRA",
-        "GAS CARDONES",
-        "GAS LOMAS",
-        "SKUS",
-        "TOTAL: UNIDADES"
-    ]
-    
-    # Patrones definitivos para OXXO (si aparece cualquiera, es OXXO seguro)
-    oxxo_definitive = [
-        "PEDIDO ADICIONAL",
-        "MOVTS. VALORIZADOS",
-        "MOVIMIENTOS VALORIZADOS",
-        "FOL-GOMA",
-        "SUJETO A REVISION"
-    ]
-    
-    # Verificar patrones definitivos primero
-    for pattern in kiosko_definitive:
-        if pattern in text_upper:
-            print(f"🔍 Ticket detectado como KIOSKO (patrón definitivo: {pattern})")
-            return "KIOSKO"
-    
-    for pattern in oxxo_definitive:
-        if pattern in text_upper:
-            print(f"🔍 Ticket detectado como OXXO (patrón definitivo: {pattern})")
-            return "OXXO"
-    
-    # Patrones secundarios para KIOSKO
-    kiosko_patterns = [
-        "FOLIO ",
-        "IMPUESTOS:",
-        "SUBTOTAL:",
-        "BOLSA DE HIELO SANTI ICE",
-        "CODIGO DE BARRAS",
-        "UNIDADES",
-        "IMPORTE UNITARIO"
-    ]
-    
-    # Patrones secundarios para OXXO
-    oxxo_patterns = [
-        "REMISION",
-        "TIENDA:",
-        "PLAZA:",
-        "FECHA ADMVA",
-        "ORDEN DE COMPRA",
-        "UDS",
-        "U.COM",
-        "VAL.TOT",
-        "VALTOT",
-        "CUL"
-    ]
-    
-    # Contar coincidencias para cada tipo
-    kiosko_matches = sum(1 for pattern in kiosko_patterns if pattern in text_upper)
-    oxxo_matches = sum(1 for pattern in oxxo_patterns if pattern in text_upper)
-    
-    # Calcular confianza (porcentaje de patrones que coinciden)
-    kiosko_confidence = (kiosko_matches / len(kiosko_patterns)) * 100
-    oxxo_confidence = (oxxo_matches / len(oxxo_patterns)) * 100
-    
-    # Imprimir información de diagnóstico
+    verdict = classify_ticket(ocr_text)
+
+    if verdict.reason == "definitivo":
+        print(f"🔍 Ticket detectado como {verdict.ticket_type} (patrón definitivo: {verdict.pattern})")
+        return verdict.ticket_type
+
     print(f"📊 Detección automática:")
-    print(f"   - KIOSKO: {kiosko_matches}/{len(kiosko_patterns)} patrones ({kiosko_confidence:.1f}%)")
-    print(f"   - OXXO: {oxxo_matches}/{len(oxxo_patterns)} patrones ({oxxo_confidence:.1f}%)")
-    
-    # Análisis adicional por códigos de producto
-    codigo_5kg = "7500465096004" in text_upper
-    codigo_15kg = "7500465096011" in text_upper or "750046509601" in text_upper
-    
-    if codigo_5kg or codigo_15kg:
-        print(f"🔍 Códigos de producto detectados: 5kg={codigo_5kg}, 15kg={codigo_15kg}")
-        # Los códigos de producto aparecen más en tickets KIOSKO
-        kiosko_matches += 2
-        kiosko_confidence = (kiosko_matches / (len(kiosko_patterns) + 2)) * 100
-    
-    # Análisis por estructura de texto
-    lines = text_upper.split('\n')
-    
-    # KIOSKO tiende a tener más líneas estructuradas
-    if len(lines) > 20:
-        kiosko_matches += 1
-        print("🔍 Estructura de texto larga detectada (+1 KIOSKO)")
-    
-    # OXXO tiende a tener patrones de columnas específicos
-    if any("UDS" in line and "COM" in line for line in lines):
-        oxxo_matches += 2
-        print("🔍 Estructura de columnas OXXO detectada (+2 OXXO)")
-    
-    # Recalcular confianzas
-    kiosko_confidence = (kiosko_matches / (len(kiosko_patterns) + 3)) * 100
-    oxxo_confidence = (oxxo_matches / (len(oxxo_patterns) + 2)) * 100
-    
-    print(f"📊 Confianza final: KIOSKO={kiosko_confidence:.1f}%, OXXO={oxxo_confidence:.1f}%")
-    
-    # Decisión final con umbral mínimo
-    if kiosko_confidence > oxxo_confidence and kiosko_confidence > 15:
-        print(f"🔍 Ticket detectado como KIOSKO ({kiosko_confidence:.1f}% confianza)")
-        return "KIOSKO"
-    elif oxxo_confidence > kiosko_confidence and oxxo_confidence > 15:
-        print(f"🔍 Ticket detectado como OXXO ({oxxo_confidence:.1f}% confianza)")
-        return "OXXO"
+    for name, count in verdict.secondary.items():
+        total = len(_CHAIN_PATTERNS[name]["secondary"])
+        print(f"   - {name}: {count}/{total} patrones ({count / total * 100 if total else 0:.1f}%)")
+    for bonus in verdict.bonuses:
+        print(bonus)
+    print("📊 Confianza final: " + ", ".join(
+        f"{name}={confidence:.1f}%" for name, confidence in verdict.confidences.items()))
+
+    if verdict.reason == "confianza":
+        print(f"🔍 Ticket detectado como {verdict.ticket_type} "
+              f"({verdict.confidences[verdict.ticket_type]:.1f}% confianza)")
     else:
-        # Si ambas confianzas son bajas, usar heurística adicional
         print("⚠️ Confianza baja en ambos tipos, aplicando heurística adicional...")
-        
-        # Heurística: OXXO es más común, usar como default si hay alguna evidencia
-        if oxxo_matches > 0 or "TIENDA" in text_upper or "PLAZA" in text_upper:
-            print("🔍 Ticket detectado como OXXO (heurística por defecto)")
-            return "OXXO"
-        else:
-            print("🔍 Ticket detectado como KIOSKO (heurística alternativa)")
-            return "KIOSKO"
\ No newline at end of file
+        print(f"🔍 Ticket detectado como {verdict.ticket_type} (heurística por defecto)")
+    return verdict.ticket_type
+
+
+# Los patrones de cada cadena se declaran en su registro (chains.py)
+from . import chains  # noqa: E402,F401
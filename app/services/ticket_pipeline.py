@@ -0,0 +1,359 @@
+"""
+Procesamiento de un ticket por etapas:
+duplicados → ocr → deteccion → validacion → parseo → cantidades → sheets
+
+/upload, /process-uploaded-file y /process-tickets recorren la misma secuencia con
+un TicketPipeline; cada uno elige sus etapas y arma su respuesta a partir del
+TicketContext. Una etapa corta el recorrido con TicketStop (sin texto, cantidad no
+leída, ticket repetido en Sheets, ...). Una foto casi idéntica a otra ya procesada
+queda marcada en ctx.near_duplicate; solo corta el recorrido si el contexto se creó
+con reject_near_duplicate=True.
+
+Los hooks se llaman antes y después de cada etapa. Vienen incluidos el caché de OCR
+(antes de 'ocr' entrega el resultado guardado y la etapa se omite), los tiempos por
+etapa del ticket y las métricas acumuladas del proceso (ticket_metrics).
+"""
+
+import threading
+import time
+
+from .chains import get_chain
+from .google_sheets import send_to_google_sheets
+from .image_dedup import check_near_duplicate, remember_image, remember_in_batch
+from .ocr_cache import ocr_cache
+from .ocr_engines import DEFAULT_POLICY, analyze_ticket_image
+from .parse_cache import parse_cache
+from .textract_limiter import textract_limiter
+from .ticket_detector import detect_ticket_type, validate_ticket_content
+
+# Texto mínimo para considerar que el OCR leyó el ticket
+MIN_OCR_TEXT_LENGTH = 10
+
+
+class TicketStop(Exception):
+    """Una etapa ya conoce el resultado del ticket: no se ejecutan las siguientes"""
+
+    def __init__(self, reason, message, status_code=500, **details):
+        super().__init__(message)
+        # near_duplicate, no_text, parse_error, no_products, quantity, duplicated o sheets_error
+        self.reason = reason
+        self.message = message
+        self.status_code = status_code
+        # match (near_duplicate), headers de la respuesta HTTP, ...
+        self.details = details
+
+
+class TicketContext:
+    """Estado de un ticket a lo largo de las etapas"""
+
+    def __init__(self, image_bytes, image_id, filename, batch_index=None, origen="extracción",
+                 reject_near_duplicate=False):
+        self.image_bytes = image_bytes
+        # SHA-256 de la imagen: llave del caché de OCR y del historial de fotos
+        self.image_id = image_id
+        self.filename = filename
+        # Fotos ya procesadas del mismo lote (new_batch_index)
+        self.batch_index = batch_index
+        self.origen = origen
+        # True: una foto casi idéntica corta el recorrido (409) en lugar de solo marcarse
+        self.reject_near_duplicate = reject_near_duplicate
+
+        self.image_hash = None
+        # Foto ya procesada que se parece a esta (aviso para el operador)
+        self.near_duplicate = None
+        self.ocr_result = None
+        self.ocr_text = ""
+        self.sucursal = None
+        self.chain = None
+        self.validation = None
+        self.processed_data = None
+        self.sheets_response = None
+        self.stop = None
+        # Excepción inesperada de una etapa (se propaga a quien llamó a run)
+        self.error = None
+        # {etapa: ms} y etapas resueltas por un hook sin ejecutarse
+        self.timings = {}
+        self.skipped = set()
+
+    @property
+    def confidence(self):
+        return self.ocr_result.get("confidence", 0) if self.ocr_result else 0
+
+
+# Etapas: reciben el contexto, lo completan y pueden lanzar TicketStop
+
+def _stage_duplicates(ctx):
+    ctx.image_hash, match = check_near_duplicate(ctx.image_bytes, ctx.batch_index)
+    ctx.near_duplicate = match
+    if match and ctx.reject_near_duplicate:
+        raise TicketStop("near_duplicate", f"La foto es casi idéntica a '{match['filename']}'",
+                         409, match=match)
+
+
+def _stage_ocr(ctx):
+    print(f"📝 Analizando imagen '{ctx.filename}'...")
+    ctx.ocr_result = analyze_ticket_image(ctx.image_bytes)
+    ctx.ocr_text = ctx.ocr_result.get('text', '')
+
+    result = ctx.ocr_result
+    print(f"📊 OCR completado ({result.get('engine', 'textract')}) - Confianza: {ctx.confidence:.1f}%, "
+          f"Preprocesado: {result.get('preprocessed', False)}, Enviado: {result.get('bytes_sent', 0) // 1024} KB")
+
+    if len(ctx.ocr_text.strip()) < MIN_OCR_TEXT_LENGTH:
+        raise TicketStop("no_text", "No se pudo extraer texto suficiente del archivo.", 500)
+
+
+def _stage_detect(ctx):
+    ctx.sucursal = detect_ticket_type(ctx.ocr_text)
+    ctx.chain = get_chain(ctx.sucursal)
+    print(f"🔍 Tipo de ticket detectado automáticamente: {ctx.sucursal} (archivo: {ctx.filename})")
+
+
+def _stage_validate(ctx):
+    ctx.validation = validate_ticket_content(ctx.ocr_text, ctx.sucursal)
+    es_valido, confianza_validacion, observaciones = ctx.validation
+    if not es_valido:
+        print(f"⚠️ Advertencia: Baja confianza en tipo de ticket ({confianza_validacion}%)")
+        for obs in observaciones:
+            print(f"   - {obs}")
+
+
+def _stage_parse(ctx):
+    print(f"🔍 Procesando texto para {ctx.sucursal} (archivo: {ctx.filename})")
+    processed_data = ctx.chain.parse(ctx.ocr_text)
+
+    if isinstance(processed_data, dict) and "error" in processed_data:
+        raise TicketStop("parse_error", processed_data["error"], 500)
+
+    # Asegurar que los datos estén en formato de lista
+    ctx.processed_data = processed_data if isinstance(processed_data, list) else [processed_data]
+
+
+def _stage_quantities(ctx):
+    """Confianza mínima para producción: productos y cantidades leídas"""
+    if not ctx.processed_data:
+        raise TicketStop("no_products", "No se pudo extraer información válida del ticket.", 400)
+
+    for item in ctx.processed_data:
+        if ctx.chain.quantity(item) == 0:
+            raise TicketStop(
+                "quantity",
+                f"Ticket requiere revisión manual: No se pudo extraer cantidad con suficiente confianza "
+                f"para {item.get('descripcion', 'producto')}.",
+                422
+            )
+
+    print(f"📄 Se encontraron {len(ctx.processed_data)} productos en el ticket {ctx.sucursal} (archivo: {ctx.filename})")
+    for i, item in enumerate(ctx.processed_data):
+        print(f"📄 Producto {i+1}: {ctx.chain.describe_product(item)}")
+
+
+def _reject_duplicate(ctx, response):
+    print(f"🚫 Rechazando ticket duplicado ({ctx.filename}): {response.get('message')}")
+    # Ya está en Sheets: otra foto casi idéntica quedará marcada (o se rechazará en /upload)
+    remember_image(ctx.image_id, ctx.image_hash, ctx.filename, ctx.sucursal)
+    raise TicketStop("duplicated", response.get("message", "Este ticket ya ha sido procesado anteriormente."), 409)
+
+
+def _stage_sheets(ctx):
+    print(f"🛠️ Enviando datos a Google Sheets para archivo: {ctx.filename}")
+
+    # Tickets con varios productos (OXXO): verificar duplicados solo para el primer producto
+    if ctx.chain.verify_first_product and len(ctx.processed_data) > 1:
+        verify_response = send_to_google_sheets(ctx.sucursal, [ctx.processed_data[0]], precios_config=None, origen=ctx.origen)
+        # Si el primer producto está duplicado, asumimos que todo el ticket está duplicado
+        if verify_response.get("duplicated", False):
+            _reject_duplicate(ctx, verify_response)
+
+    ctx.sheets_response = send_to_google_sheets(ctx.sucursal, ctx.processed_data, precios_config=None, origen=ctx.origen)
+
+    if ctx.sheets_response.get("duplicated", False):
+        _reject_duplicate(ctx, ctx.sheets_response)
+
+    if not ctx.sheets_response.get("success", False):
+        raise TicketStop("sheets_error", ctx.sheets_response.get("message", "Error desconocido"), 500)
+
+    # La foto ya está en Sheets: otra casi idéntica quedará marcada (o se rechazará en /upload)
+    remember_image(ctx.image_id, ctx.image_hash, ctx.filename, ctx.sucursal)
+
+
+def _stage_batch(ctx):
+    """Registra la foto en el lote para detectar la misma foto repetida más adelante"""
+    remember_in_batch(ctx.batch_index, ctx.image_id, ctx.image_hash, ctx.filename, ctx.sucursal)
+
+
+STAGES = {
+    "duplicados": _stage_duplicates,
+    "ocr": _stage_ocr,
+    "deteccion": _stage_detect,
+    "validacion": _stage_validate,
+    "parseo": _stage_parse,
+    "cantidades": _stage_quantities,
+    "sheets": _stage_sheets,
+    "lote": _stage_batch,
+}
+
+
+class PipelineHook:
+    """Base de los hooks: se redefinen solo los métodos necesarios"""
+
+    def before_stage(self, ctx, stage):
+        """Devuelve True si el hook resolvió la etapa (no se ejecuta)"""
+        return False
+
+    def after_stage(self, ctx, stage, elapsed_ms):
+        pass
+
+    def finished(self, ctx):
+        pass
+
+
+class OcrCacheHook(PipelineHook):
+    """Resultado de OCR guardado por imagen y política de motores"""
+
+    def __init__(self, cache=ocr_cache):
+        self.cache = cache
+
+    def _key(self, ctx):
+        return (ctx.image_id, DEFAULT_POLICY)
+
+    def before_stage(self, ctx, stage):
+        if stage != "ocr" or not ctx.image_id:
+            return False
+        result = self.cache.get(self._key(ctx))
+        if result is None:
+            return False
+        ctx.ocr_result = result
+        ctx.ocr_text = result.get('text', '')
+        print(f"♻️ OCR en caché para '{ctx.filename}' ({result.get('engine', 'textract')}, "
+              f"confianza {ctx.confidence:.1f}%)")
+        return True
+
+    def after_stage(self, ctx, stage, elapsed_ms):
+        # Solo se guardan lecturas útiles (las que no cortaron el recorrido)
+        if stage == "ocr" and ctx.image_id and ctx.stop is None and ctx.error is None and "ocr" not in ctx.skipped:
+            self.cache.put(self._key(ctx), ctx.ocr_result)
+
+
+class TimingHook(PipelineHook):
+    """Tiempo de cada etapa del ticket (ctx.timings) y resumen en el log"""
+
+    def after_stage(self, ctx, stage, elapsed_ms):
+        ctx.timings[stage] = elapsed_ms
+
+    def finished(self, ctx):
+        stages = ", ".join(f"{stage}={ms:.0f}" for stage, ms in ctx.timings.items())
+        print(f"⏱️ Etapas de '{ctx.filename}' (ms): {stages}")
+
+
+class TicketMetrics(PipelineHook):
+    """Métricas acumuladas del proceso: tiempos por etapa y motivos de corte"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.tickets = 0
+        self.completed = 0
+        self.stops = {}
+        self.stages = {}
+
+    def after_stage(self, ctx, stage, elapsed_ms):
+        with self._lock:
+            stats = self.stages.setdefault(stage, {"count": 0, "skipped": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stats["count"] += 1
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+            if stage in ctx.skipped:
+                stats["skipped"] += 1
+
+    def finished(self, ctx):
+        with self._lock:
+            self.tickets += 1
+            if ctx.stop is None and ctx.error is None:
+                self.completed += 1
+            else:
+                reason = ctx.stop.reason if ctx.stop is not None else "error"
+                self.stops[reason] = self.stops.get(reason, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "tickets": self.tickets,
+                "completed": self.completed,
+                "stops": dict(self.stops),
+                "stages": {
+                    stage: {
+                        "count": stats["count"],
+                        "skipped": stats["skipped"],
+                        "mean_ms": round(stats["total_ms"] / stats["count"], 2),
+                        "max_ms": round(stats["max_ms"], 2),
+                    }
+                    for stage, stats in self.stages.items()
+                },
+                "ocr_cache": ocr_cache.stats(),
+                "parse_cache": parse_cache.stats(),
+                "textract": textract_limiter.stats(),
+            }
+
+
+ticket_metrics = TicketMetrics()
+
+
+class TicketPipeline:
+    """Secuencia de etapas con hooks; run() es síncrono (los endpoints lo corren en un hilo)"""
+
+    def __init__(self, stages, hooks=None):
+        unknown = [stage for stage in stages if stage not in STAGES]
+        if unknown:
+            raise ValueError(f"Etapas desconocidas: {', '.join(unknown)}")
+        self.stages = tuple(stages)
+        self.hooks = list(hooks) if hooks is not None else [OcrCacheHook(), TimingHook(), ticket_metrics]
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def run(self, ctx):
+        """
+        Recorre las etapas sobre el contexto
+
+        Returns:
+            TicketContext (ctx.stop indica dónde y por qué se cortó, None si terminó)
+        """
+        try:
+            for stage in self.stages:
+                # Todos los hooks ven la etapa; basta uno para resolverla
+                resolved = [hook.before_stage(ctx, stage) for hook in self.hooks]
+                started = time.perf_counter()
+                try:
+                    if any(resolved):
+                        ctx.skipped.add(stage)
+                    else:
+                        STAGES[stage](ctx)
+                except TicketStop as stop:
+                    ctx.stop = stop
+                except Exception as e:
+                    ctx.error = e
+                    raise
+                finally:
+                    elapsed_ms = (time.perf_counter() - started) * 1000
+                    for hook in self.hooks:
+                        hook.after_stage(ctx, stage, elapsed_ms)
+                if ctx.stop is not None:
+                    break
+        finally:
+            for hook in self.hooks:
+                hook.finished(ctx)
+        return ctx
+
+
+# Procesar y guardar en Sheets (/upload, /process-uploaded-file)
+upload_pipeline = TicketPipeline(
+    ("duplicados", "ocr", "deteccion", "validacion", "parseo", "cantidades", "sheets")
+)
+
+# Extraer para revisión, sin escribir en Sheets (/process-tickets y su variante en streaming)
+review_pipeline = TicketPipeline(
+    ("duplicados", "ocr", "deteccion", "validacion", "parseo", "lote")
+)
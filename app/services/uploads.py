@@ -0,0 +1,194 @@
+"""
+Módulo de recepción de archivos subidos.
+Lee los archivos por bloques, limita el tamaño sin cargarlos completos en memoria,
+calcula el hash SHA-256 al vuelo y valida el tipo real a partir de los primeros bytes.
+"""
+
+import hashlib
+import os
+import uuid
+from pathlib import Path
+from fastapi import HTTPException, UploadFile
+
+# Tamaño de bloque para lectura/escritura
+CHUNK_SIZE = 1024 * 1024  # 1MB
+
+# Límite por defecto (el conciliador usa MAX_FILE_SIZE de su config.py)
+DEFAULT_MAX_SIZE = 50 * 1024 * 1024  # 50MB
+
+# Tipos permitidos por uso
+IMAGE_TYPES = ("jpeg", "png")
+SPREADSHEET_TYPES = ("xlsx", "xls", "csv")
+
+CONTENT_TYPES = {
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "xls": "application/vnd.ms-excel",
+    "csv": "text/csv",
+}
+
+# Firmas de archivo (magic numbers)
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"PK\x03\x04", "xlsx"),
+    (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "xls"),
+)
+
+_SNIFF_BYTES = 8
+
+
+def sniff_file_type(head):
+    """
+    Detecta el tipo de archivo a partir de sus primeros bytes.
+
+    Args:
+        head: Primeros bytes del archivo
+
+    Returns:
+        str: "jpeg", "png", "xlsx", "xls", "csv" o None si no se reconoce
+    """
+    for signature, kind in _SIGNATURES:
+        if head.startswith(signature):
+            return kind
+
+    # Texto plano sin bytes nulos: lo tratamos como CSV
+    if head and b"\x00" not in head:
+        return "csv"
+
+    return None
+
+
+def _format_size(size):
+    return f"{size / (1024 * 1024):.0f}MB"
+
+
+class _UploadReader:
+    """Lee un UploadFile por bloques validando tipo y tamaño y calculando el hash"""
+
+    def __init__(self, file: UploadFile, allowed_types, max_size):
+        self.file = file
+        self.allowed_types = allowed_types
+        self.max_size = max_size
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.kind = None
+
+    async def chunks(self):
+        head = b""
+        pending = []
+
+        while True:
+            chunk = await self.file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+
+            self.size += len(chunk)
+            if self.size > self.max_size:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"El archivo '{self.file.filename}' excede el tamaño máximo de {_format_size(self.max_size)}."
+                )
+            self.sha256.update(chunk)
+
+            # Validar el tipo con los primeros bytes antes de escribir nada
+            if self.kind is None:
+                head += chunk[:_SNIFF_BYTES - len(head)]
+                pending.append(chunk)
+                if len(head) < _SNIFF_BYTES:
+                    continue
+                self._check_type(head)
+                for buffered in pending:
+                    yield buffered
+                pending = []
+                continue
+
+            yield chunk
+
+        if self.size == 0:
+            raise HTTPException(status_code=400, detail="Archivo vacío")
+
+        # Archivos más cortos que la firma
+        if self.kind is None:
+            self._check_type(head)
+            for buffered in pending:
+                yield buffered
+
+    def _check_type(self, head):
+        kind = sniff_file_type(head)
+        if kind not in self.allowed_types:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Formato de archivo no permitido. Usa {', '.join(t.upper() for t in self.allowed_types)}."
+            )
+        self.kind = kind
+
+    def info(self):
+        return {
+            "filename": self.file.filename,
+            "size": self.size,
+            "sha256": self.sha256.hexdigest(),
+            "kind": self.kind,
+            "content_type": CONTENT_TYPES.get(self.kind, "application/octet-stream"),
+        }
+
+
+async def save_upload(file: UploadFile, dest_path, allowed_types=SPREADSHEET_TYPES, max_size=DEFAULT_MAX_SIZE):
+    """
+    Guarda un archivo subido en disco por bloques.
+    El archivo se escribe en una ruta temporal y se renombra al terminar, de modo
+    que un archivo rechazado nunca queda a medias en el destino.
+
+    Args:
+        file: Archivo recibido por FastAPI
+        dest_path: Ruta destino
+        allowed_types: Tipos aceptados (ver sniff_file_type)
+        max_size: Tamaño máximo en bytes
+
+    Returns:
+        dict: filename, path, size, sha256, kind y content_type
+
+    Raises:
+        HTTPException: 400 si el tipo no es válido o está vacío, 413 si excede el tamaño
+    """
+    dest_path = Path(dest_path)
+    dest_path.parent.mkdir(parents=True, exist_ok=True)
+    # Temporal único: dos subidas al mismo destino no comparten archivo a medias
+    tmp_path = dest_path.with_name(f".{dest_path.name}.{uuid.uuid4().hex}.part")
+
+    reader = _UploadReader(file, allowed_types, max_size)
+    try:
+        with open(tmp_path, "wb") as buffer:
+            async for chunk in reader.chunks():
+                buffer.write(chunk)
+        os.replace(tmp_path, dest_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+    info = reader.info()
+    info["path"] = str(dest_path)
+    return info
+
+
+async def read_upload(file: UploadFile, allowed_types=IMAGE_TYPES, max_size=DEFAULT_MAX_SIZE):
+    """
+    Lee un archivo subido a memoria por bloques (para imágenes que van al OCR).
+    El tamaño se valida mientras se lee, así que un archivo demasiado grande
+    se rechaza sin cargarlo completo.
+
+    Args:
+        file: Archivo recibido por FastAPI
+        allowed_types: Tipos aceptados (ver sniff_file_type)
+        max_size: Tamaño máximo en bytes
+
+    Returns:
+        tuple: (bytes del archivo, dict con filename, size, sha256, kind y content_type)
+
+    Raises:
+        HTTPException: 400 si el tipo no es válido o está vacío, 413 si excede el tamaño
+    """
+    reader = _UploadReader(file, allowed_types, max_size)
+    chunks = [chunk async for chunk in reader.chunks()]
+    return b"".join(chunks), reader.info()
@@ -83,7 +83,11 @@ const AppContent = () => {
     setCurrentStep(STEPS.PROCESSING);
     const result = await processTickets(files);
     if (result && result.success) {
-      showToast(`¡${result.processedCount} tickets procesados exitosamente!`, 'success');
+      if (result.nearDuplicateCount > 0) {
+        showToast(`${result.processedCount} tickets procesados; ${result.nearDuplicateCount} parecen fotos repetidas, revísalos antes de confirmar`, 'warning');
+      } else {
+        showToast(`¡${result.processedCount} tickets procesados exitosamente!`, 'success');
+      }
       setCurrentStep(STEPS.REVIEW);
     } else {
       showToast('Error al procesar algunos tickets', 'error');
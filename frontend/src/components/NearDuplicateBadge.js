@@ -0,0 +1,49 @@
+import React from 'react';
+import { useConfig } from '../contexts/ConfigContext';
+
+// Aviso de foto casi idéntica a otra ya procesada; el usuario puede marcarla como otro ticket
+const NearDuplicateBadge = ({ ticket, onUpdateTicket }) => {
+  const { config } = useConfig();
+  const match = ticket.near_duplicate;
+
+  if (!match) return null;
+
+  const fecha = match.created_at ? match.created_at.slice(0, 16).replace('T', ' ') : null;
+  const title = `Se parece a ${match.filename || 'otra foto'}${fecha ? ` (${fecha})` : ''}`;
+
+  if (ticket.force) {
+    return (
+      <div className="flex items-center space-x-1 mt-1" title={title}>
+        <span className={`px-2 py-0.5 rounded-full text-xs ${
+          config.darkMode ? 'bg-gray-700 text-gray-300' : 'bg-gray-100 text-gray-600'
+        }`}>
+          Confirmado como otro ticket
+        </span>
+        <button
+          onClick={() => onUpdateTicket(ticket.id, 'force', false)}
+          className="text-xs text-gray-500 underline"
+        >
+          Deshacer
+        </button>
+      </div>
+    );
+  }
+
+  return (
+    <div className="flex items-center space-x-1 mt-1" title={title}>
+      <span className={`px-2 py-0.5 rounded-full text-xs font-medium ${
+        config.darkMode ? 'bg-yellow-800 text-yellow-100' : 'bg-yellow-50 text-yellow-700'
+      }`}>
+        ⚠️ Posible duplicado
+      </span>
+      <button
+        onClick={() => onUpdateTicket(ticket.id, 'force', true)}
+        className={`text-xs underline ${config.darkMode ? 'text-yellow-200' : 'text-yellow-700'}`}
+      >
+        Es otro ticket
+      </button>
+    </div>
+  );
+};
+
+export default NearDuplicateBadge;
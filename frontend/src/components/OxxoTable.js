@@ -2,9 +2,11 @@ import React, { useState, useEffect } from 'react';
 import EditableCell from './EditableCell';
 import DatePicker from './DatePicker';
 import ConfidenceIndicator from './ConfidenceIndicator';
+import NearDuplicateBadge from './NearDuplicateBadge';
 import SucursalSelector from './SucursalSelector';
 import EditableQuantity from './EditableQuantity';
 import { useConfig } from '../contexts/ConfigContext';
+import { getTicketImageUrl } from '../utils/api';
 
 const OxxoTable = ({ 
   tickets, 
@@ -195,7 +197,7 @@ const OxxoTable = ({
               <td className="px-2 py-4 whitespace-nowrap">
                 <div className="flex items-center space-x-1">
                   <button
-                    onClick={() => openImageModal(ticket.image_base64, ticket.filename)}
+                    onClick={() => openImageModal(getTicketImageUrl(ticket), ticket.filename)}
                     className="flex items-center justify-center w-8 h-8 bg-gray-100 hover:bg-gray-200 rounded transition-colors"
                     title={`Ver imagen: ${ticket.filename}`}
                   >
@@ -207,6 +209,7 @@ const OxxoTable = ({
                     {ticket.filename}
                   </span>
                 </div>
+                <NearDuplicateBadge ticket={ticket} onUpdateTicket={onUpdateTicket} />
               </td>
               <td className="px-3 py-4 whitespace-nowrap">
                 <SucursalSelector
@@ -190,6 +190,23 @@ const ReviewTable = ({ tickets, onUpdateTicket, onConfirm, onCancel, onAddMoreFi
       );
       return;
     }
+
+    // Posibles fotos repetidas que el usuario no marcó como otro ticket
+    const nearDuplicates = ticketsToConfirm.filter(t => t.near_duplicate && !t.force);
+
+    if (nearDuplicates.length > 0) {
+      const lista = nearDuplicates
+        .map(t => `• ${t.filename} (parecida a ${t.near_duplicate.filename || 'otra foto'})`)
+        .join('\n');
+      const enviar = window.confirm(
+        `${nearDuplicates.length} ticket(s) parecen fotos repetidas de tickets ya procesados:\n\n${lista}\n\n¿Son tickets distintos y deseas enviarlos de todos modos?`
+      );
+      if (!enviar) {
+        return;
+      }
+      onConfirm(ticketsToConfirm.map(t => (t.near_duplicate ? { ...t, force: true } : t)));
+      return;
+    }
     
     onConfirm(ticketsToConfirm);
   };
@@ -19,6 +19,7 @@ export const BACKEND_CONFIG = {
       upload: '/api/conciliator/upload',
       process: '/api/conciliator/process',
       results: '/api/conciliator/results',
+      whatif: '/api/conciliator/whatif',
       download: '/api/conciliator/download'
     },
     websocket: process.env.REACT_APP_CONCILIATOR_WS_URL || 'ws://54.165.190.194/api/conciliator/ws',
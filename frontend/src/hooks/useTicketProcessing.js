@@ -1,5 +1,5 @@
 import { useState } from 'react';
-import { processTickets as apiProcessTickets, confirmTickets as apiConfirmTickets } from '../utils/api';
+import { processTicketsStream as apiProcessTickets, confirmTickets as apiConfirmTickets } from '../utils/api';
 import { useConfig } from '../contexts/ConfigContext';
 import { sanitizeApiResponse } from '../utils/errorUtils';
 
@@ -24,12 +24,13 @@ export const useTicketProcessing = () => {
         });
       }
 
-      const response = await apiProcessTickets(files, (progress) => {
+      // El progreso avanza conforme el backend termina cada ticket
+      const response = await apiProcessTickets(files, (ticket, completed) => {
         if (!isAdditional) {
           setProcessing(prev => ({
             ...prev,
-            completed: progress.completed,
-            current: progress.current
+            completed,
+            current: ticket.filename
           }));
         }
       });
@@ -48,7 +49,8 @@ export const useTicketProcessing = () => {
           setProcessing(null);
           setNewTicketCounts({ oxxo: 0, kiosko: 0 });
         }
-        return { success: true, processedCount: response.processed };
+        const nearDuplicateCount = response.results.filter(t => t.near_duplicate).length;
+        return { success: true, processedCount: response.processed, nearDuplicateCount };
       } else {
         throw new Error('Error al procesar tickets');
       }
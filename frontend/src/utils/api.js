@@ -8,6 +8,14 @@ const api = axios.create({
   timeout: 300000, // 5 minutos para procesamiento de múltiples archivos
 });
 
+// Las imágenes de los tickets se sirven desde el backend o, en Lambda, con URLs
+// prefirmadas de S3 (las respuestas antiguas traían base64)
+const resolveImageUrl = (url) => (/^https?:\/\//.test(url) ? url : `${API_BASE_URL}${url}`);
+
+export const getTicketImageUrl = (ticket) => (
+  ticket.image_url ? resolveImageUrl(ticket.image_url) : ticket.image_base64
+);
+
 export const processTickets = async (files, onProgress) => {
   const formData = new FormData();
   
@@ -38,6 +46,62 @@ export const processTickets = async (files, onProgress) => {
   }
 };
 
+// Variante en streaming: el backend envía un JSON por línea (NDJSON) conforme termina cada ticket
+export const processTicketsStream = async (files, onTicket) => {
+  const formData = new FormData();
+  
+  files.forEach(file => {
+    formData.append('files', file);
+  });
+
+  try {
+    const response = await fetch(`${API_BASE_URL}/process-tickets/stream`, {
+      method: 'POST',
+      body: formData,
+    });
+
+    if (!response.ok || !response.body) {
+      throw new Error(`Error ${response.status} al procesar tickets`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    const results = [];
+    let summary = null;
+    let buffer = '';
+
+    const handleLine = (line) => {
+      if (!line.trim()) return;
+      const event = JSON.parse(line);
+      if (event.type === 'ticket') {
+        results.push(event.result);
+        onTicket?.(event.result, results.length);
+      } else if (event.type === 'summary') {
+        summary = event;
+      }
+    };
+
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      const lines = buffer.split('\n');
+      buffer = lines.pop();
+      lines.forEach(handleLine);
+    }
+    handleLine(buffer);
+
+    if (!summary) {
+      throw new Error('La respuesta terminó sin resumen');
+    }
+
+    return sanitizeApiResponse({ ...summary, results });
+  } catch (error) {
+    console.error('Error processing tickets:', error);
+    throw error;
+  }
+};
+
 export const confirmTickets = async (tickets) => {
   try {
     const response = await api.post('/confirm-tickets', {
@@ -74,9 +138,13 @@ export const confirmTickets = async (tickets) => {
 };
 
 // Endpoint original para compatibilidad
-export const uploadSingleTicket = async (file) => {
+export const uploadSingleTicket = async (file, { force = false } = {}) => {
   const formData = new FormData();
   formData.append('file', file);
+  // force: el usuario confirmó que una posible foto repetida es otro ticket (evita el 409)
+  if (force) {
+    formData.append('force', 'true');
+  }
 
   try {
     const response = await api.post('/upload', formData, {
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Benchmark del conciliador con datos sintéticos.
+
+Genera archivos OXXO/KIOSKO/Looker del tamaño y con las discrepancias indicadas,
+ejecuta el pipeline completo (carga, limpieza, agrupación, matching exacto y fuzzy,
+categorización y reportes) y mide cada etapa y la memoria pico. Cada caso corre
+en un proceso propio para que la memoria pico sea solo la suya. Los resultados se
+guardan en JSON para comparar tendencias entre corridas (--baseline).
+
+Ejemplos:
+    python scripts/benchmark_conciliator.py --clients OXXO KIOSKO --sizes 1000 10000
+    python scripts/benchmark_conciliator.py --sizes 5000 --fuzzy-rate 0.01 --baseline data/benchmarks/anterior.json
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+APP_DIR = ROOT / 'app'
+
+# Igual que main.py: 'modules.conciliator' importable y 'config' del conciliador
+sys.path.insert(0, str(APP_DIR / 'modules' / 'conciliator'))
+sys.path.insert(0, str(APP_DIR))
+
+# Etapas de PipelineMetrics agrupadas en las fases del benchmark
+STAGE_GROUPS = {
+    'load': ('leer_excel_oxxo', 'leer_excel_kiosko', 'leer_excel_looker'),
+    'clean': ('limpiar_oxxo', 'limpiar_kiosko', 'limpiar_looker', 'normalizar_oxxo',
+              'normalizar_looker', 'compactar_tipos', 'preparar_datos'),
+    'group': ('agrupar_looker',),
+    'exact': ('matching_exacto',),
+    'fuzzy': ('matching_fuzzy',),
+    'categorize': ('faltantes', 'diferencias', 'categorizar', 'resumen'),
+    'report': ('reporte_excel', 'reportes_csv'),
+}
+
+# Una fase se marca como regresión si tarda más que esta proporción del baseline
+REGRESSION_RATIO = 1.25
+# Fases más rápidas que esto no se comparan (ruido)
+MIN_COMPARABLE_MS = 20.0
+
+
+def _peak_rss_mb():
+    """Memoria residente pico del proceso en MB (None si el sistema no la expone)"""
+    # VmHWM es propio del proceso; ru_maxrss en Linux conserva el pico del padre tras el spawn
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 2)
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reporta bytes, el resto KB
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 2)
+
+
+def _run_case(dataset, output_dir, with_reports, queue):
+    """Proceso trabajador: ejecuta el pipeline completo sobre un conjunto generado"""
+    logging.basicConfig(level=logging.WARNING)
+    try:
+        from modules.conciliator.metrics import PipelineMetrics
+        from modules.conciliator.processors.factory import ProcessorFactory
+        from modules.conciliator.reconciler import Reconciler
+        from modules.conciliator.report_generator import ReportGenerator
+
+        client_type = dataset['client_type']
+        baseline_rss = _peak_rss_mb()
+        metrics = PipelineMetrics(client_type)
+
+        processor = ProcessorFactory.create_processor(client_type, metrics=metrics)
+        source_data, looker_data = processor.process_files(dataset['source'], dataset['looker'])
+
+        reconciler = Reconciler(client_type, metrics=metrics)
+        results = reconciler.reconcile(source_data, looker_data)
+        summary = reconciler.get_summary_stats()
+
+        if with_reports:
+            generator = ReportGenerator(client_type, metrics=metrics)
+            generator.output_dir = Path(output_dir)
+            generator.generate_complete_report(results, summary, timestamp='benchmark')
+            generator.generate_csv_reports(results, timestamp='benchmark')
+
+        queue.put({
+            'metrics': metrics.to_dict(),
+            'baseline_rss_mb': baseline_rss,
+            'peak_rss_mb': _peak_rss_mb(),
+            'summary': {key: summary.get(key) for key in (
+                'total_records', 'exact_matches', 'within_tolerance', 'minor_differences',
+                'major_differences', 'missing_in_looker', f'missing_in_{client_type.lower()}',
+                'reconciliation_rate'
+            )},
+        })
+    except Exception as e:
+        queue.put({'error': f"{type(e).__name__}: {e}"})
+
+
+def run_case(dataset, with_reports=True):
+    """Ejecuta un caso en un proceso nuevo y devuelve sus mediciones"""
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    with tempfile.TemporaryDirectory(prefix='conciliator_bench_') as output_dir:
+        process = context.Process(target=_run_case, args=(dataset, output_dir, with_reports, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+    return result
+
+
+def group_stages(metrics):
+    """Suma el tiempo de las etapas por fase (load, clean, group, ...)"""
+    stage_ms = {}
+    for stage in metrics['stages']:
+        stage_ms[stage['stage']] = stage_ms.get(stage['stage'], 0.0) + stage['wall_ms']
+    return {group: round(sum(stage_ms.get(name, 0.0) for name in names), 2)
+            for group, names in STAGE_GROUPS.items()}
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def _environment():
+    import numpy
+    import pandas
+    return {
+        'python': platform.python_version(),
+        'pandas': pandas.__version__,
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'git_commit': _git_commit(),
+    }
+
+
+def compare_with_baseline(report, baseline_path):
+    """Imprime la variación por fase contra un JSON anterior y devuelve las regresiones"""
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    previous = {(case['client_type'], case['rows']): case for case in baseline.get('cases', [])}
+
+    regressions = []
+    print(f"\n📈 Comparación contra {baseline_path} ({baseline.get('timestamp')})")
+    for case in report['cases']:
+        before = previous.get((case['client_type'], case['rows']))
+        if before is None or 'phases_ms' not in case or 'phases_ms' not in before:
+            continue
+        print(f"   {case['client_type']} {case['rows']:,}:")
+        for phase, current_ms in list(case['phases_ms'].items()) + [('total', case['total_ms'])]:
+            before_ms = before['phases_ms'].get(phase) if phase != 'total' else before['total_ms']
+            if not before_ms or not current_ms or max(before_ms, current_ms) < MIN_COMPARABLE_MS:
+                continue
+            ratio = current_ms / before_ms
+            flag = ' ⚠️ REGRESIÓN' if ratio > REGRESSION_RATIO else ''
+            print(f"      {phase:<11} {before_ms:>10,.1f} → {current_ms:>10,.1f} ms  (x{ratio:.2f}){flag}")
+            if flag:
+                regressions.append(f"{case['client_type']} {case['rows']} {phase} x{ratio:.2f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del conciliador con datos sintéticos")
+    parser.add_argument('--clients', nargs='+', default=['OXXO', 'KIOSKO'], help="Clientes a medir")
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 5000], help="Registros por archivo del cliente")
+    parser.add_argument('--missing-rate', type=float, default=0.03, help="Pedidos del cliente sin registro en Looker")
+    parser.add_argument('--extra-rate', type=float, default=0.02, help="Pedidos solo en Looker")
+    parser.add_argument('--difference-rate', type=float, default=0.05, help="Pedidos con importe distinto")
+    parser.add_argument('--fuzzy-rate', type=float, default=0.0, help="Pedidos con ID alterado (ejercita el matching fuzzy)")
+    parser.add_argument('--return-rate', type=float, default=0.01, help="Devoluciones '36_' (KIOSKO)")
+    parser.add_argument('--max-products', type=int, default=3, help="Máximo de productos por pedido en Looker")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=str(ROOT / 'data' / 'benchmarks' / 'datasets'),
+                        help="Carpeta de los archivos generados (se reutilizan entre corridas)")
+    parser.add_argument('--output-dir', default=str(ROOT / 'data' / 'benchmarks'), help="Carpeta del JSON de resultados")
+    parser.add_argument('--no-reports', action='store_true', help="No medir la generación de reportes")
+    parser.add_argument('--regenerate', action='store_true', help="Regenerar los archivos aunque existan")
+    parser.add_argument('--baseline', help="JSON de una corrida anterior para comparar")
+    parser.add_argument('--fail-on-regression', action='store_true', help="Terminar con código 1 si hay regresiones")
+    args = parser.parse_args()
+
+    from modules.conciliator.synthetic import generate_dataset, describe_dataset
+
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'environment': _environment(),
+        'parameters': {
+            'missing_rate': args.missing_rate, 'extra_rate': args.extra_rate,
+            'difference_rate': args.difference_rate, 'fuzzy_rate': args.fuzzy_rate,
+            'return_rate': args.return_rate, 'max_products': args.max_products,
+            'seed': args.seed, 'reports': not args.no_reports,
+        },
+        'cases': [],
+    }
+
+    print("🧪 BENCHMARK DEL CONCILIADOR")
+    print("=" * 60)
+    for client_type in args.clients:
+        for rows in args.sizes:
+            dataset = generate_dataset(
+                client_type, rows, args.data_dir,
+                missing_rate=args.missing_rate, extra_rate=args.extra_rate,
+                difference_rate=args.difference_rate, fuzzy_rate=args.fuzzy_rate,
+                return_rate=args.return_rate, max_products=args.max_products,
+                seed=args.seed, overwrite=args.regenerate
+            )
+            print(f"\n▶️ {describe_dataset(dataset)}")
+
+            result = run_case(dataset, with_reports=not args.no_reports)
+            case = {'client_type': dataset['client_type'], 'rows': rows, 'expected': dataset['expected']}
+            if 'error' in result:
+                print(f"   ❌ {result['error']}")
+                case['error'] = result['error']
+                report['cases'].append(case)
+                continue
+
+            case.update({
+                'total_ms': result['metrics']['total_ms'],
+                'phases_ms': group_stages(result['metrics']),
+                'stages': result['metrics']['stages'],
+                'counters': result['metrics']['counters'],
+                'baseline_rss_mb': result['baseline_rss_mb'],
+                'peak_rss_mb': result['peak_rss_mb'],
+                'summary': result['summary'],
+            })
+            report['cases'].append(case)
+
+            phases = ', '.join(f"{phase} {ms:,.0f}" for phase, ms in case['phases_ms'].items() if ms)
+            print(f"   ⏱️ Total {case['total_ms']:,.0f} ms — {phases}")
+            print(f"   🧠 Memoria pico: {case['peak_rss_mb']} MB (al iniciar {case['baseline_rss_mb']} MB)")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_path = os.path.join(args.output_dir, f"conciliator_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"\n💾 Resultados guardados en {output_path}")
+
+    regressions = compare_with_baseline(report, args.baseline) if args.baseline else []
+    failed = any('error' in case for case in report['cases'])
+    if regressions:
+        print(f"\n⚠️ {len(regressions)} regresiones: {', '.join(regressions)}")
+    return 1 if failed or (regressions and args.fail_on_regression) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Benchmark de punta a punta de /upload con OCR offline.
+
+Envía las imágenes de test_images/OXXO y test_images/KIOSKO a /upload con el backend
+OCR en replay (respuestas de Textract grabadas, sin red ni credenciales) y mide cada
+etapa: lectura del archivo, búsqueda de fotos duplicadas, preprocesamiento (orientación
+y recorte incluidos), Textract, detección, validación, parseo, cantidades y escritura en
+Sheets, además de los bytes enviados a Textract por petición. Reporta p50/p95/p99 por etapa y guarda el detalle en JSON. Google Sheets se reemplaza por un no-op local solo en este script.
+
+Las grabaciones se generan una vez con credenciales de AWS (--record) y se guardan en
+test_images/textract_responses.
+
+Ejemplos:
+    python scripts/benchmark_ocr.py --record
+    python scripts/benchmark_ocr.py --iterations 5 --latency 150:600
+    python scripts/benchmark_ocr.py --clients OXXO --latency 0
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+APP_DIR = ROOT / 'app'
+IMAGES_DIR = ROOT / 'test_images'
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# Igual que main.py: 'services' y 'modules.conciliator' importables
+# (los parsers importan 'app.services', así que la raíz también)
+sys.path.insert(0, str(APP_DIR / 'modules' / 'conciliator'))
+sys.path.insert(0, str(APP_DIR))
+sys.path.insert(0, str(ROOT))
+
+# Etapas en el orden en que ocurren dentro de /upload
+STAGES = ('lectura', 'duplicados', 'tesseract', 'preprocesamiento', 'textract', 'ocr',
+          'deteccion', 'validacion', 'parseo', 'cantidades', 'sheets', 'total')
+PERCENTILES = (50, 95, 99)
+
+
+class StageTimer:
+    """Acumula el tiempo de cada etapa de la petición en curso (también es hook del pipeline de tickets)"""
+
+    def __init__(self):
+        self.current = {}
+        self.bytes_sent = 0
+
+    def start_request(self):
+        self.current = {}
+        self.bytes_sent = 0
+
+    def add(self, stage, elapsed_ms):
+        self.current[stage] = self.current.get(stage, 0.0) + elapsed_ms
+
+    def before_stage(self, ctx, stage):
+        return False
+
+    def after_stage(self, ctx, stage, elapsed_ms):
+        self.add(stage, elapsed_ms)
+
+    def finished(self, ctx):
+        pass
+
+    def wrap(self, stage, func):
+        @wraps(func)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, (time.perf_counter() - started) * 1000)
+        return timed
+
+    def wrap_async(self, stage, func):
+        @wraps(func)
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.add(stage, (time.perf_counter() - started) * 1000)
+        return timed
+
+
+def _sheets_noop(sucursal, data, precios_config=None, origen="extracción"):
+    """Sustituto local de send_to_google_sheets: acepta todo sin escribir"""
+    return {"success": True, "duplicated": False, "message": f"{len(data)} registros (no-op)"}
+
+
+def collect_images(clients):
+    """Imágenes de prueba por cliente (la carpeta indica el tipo esperado)"""
+    images = []
+    for client in clients:
+        folder = IMAGES_DIR / client
+        for path in sorted(folder.iterdir()) if folder.is_dir() else []:
+            if path.suffix.lower() in IMAGE_EXTENSIONS:
+                images.append((client, path))
+    return images
+
+
+def record(images):
+    """Graba las respuestas de Textract de ambas variantes (con y sin preprocesamiento)"""
+    from services.ocr_backends import ocr_request
+    from services.textract import analyze_text
+
+    failures = 0
+    for client, path in images:
+        image_bytes = path.read_bytes()
+        label = f"{client}/{path.name}"
+        for preprocess in (True, False):
+            try:
+                with ocr_request(image_bytes, preprocess, label=label):
+                    analyze_text(image_bytes, preprocess=preprocess)
+            except Exception as e:
+                failures += 1
+                print(f"   ❌ {label} (preprocesado={preprocess}): {e}")
+    return failures
+
+
+def instrument(timer):
+    """Envuelve las funciones que usa /upload para medir cada etapa"""
+    import main
+    from services import ocr_engines, textract, ticket_pipeline
+
+    main.read_upload = timer.wrap_async('lectura', main.read_upload)
+    # Las etapas del pipeline (duplicados, ocr, deteccion, ...) se miden con un hook
+    ticket_pipeline.upload_pipeline.add_hook(timer)
+    ticket_pipeline.send_to_google_sheets = _sheets_noop
+    # Sin historial de fotos: cada pasada recorre todas las etapas
+    ticket_pipeline.remember_image = lambda *args, **kwargs: None
+
+    ocr_engines.tesseract_engine.analyze = timer.wrap('tesseract', ocr_engines.tesseract_engine.analyze)
+    textract.prepare_image_for_ocr = timer.wrap('preprocesamiento', textract.prepare_image_for_ocr)
+    client = textract.get_textract_client()
+    detect_document_text = timer.wrap('textract', client.detect_document_text)
+
+    def counted(Document, **kwargs):
+        timer.bytes_sent += len(Document['Bytes'])
+        return detect_document_text(Document=Document, **kwargs)
+
+    client.detect_document_text = counted
+    return main.app, client
+
+
+def percentiles(values):
+    import numpy as np
+    if not values:
+        return {}
+    result = {f"p{p}": round(float(np.percentile(values, p)), 2) for p in PERCENTILES}
+    result.update({'mean': round(float(np.mean(values)), 2), 'count': len(values)})
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de /upload con OCR offline (replay de Textract)")
+    parser.add_argument('--clients', nargs='+', default=['OXXO', 'KIOSKO'], help="Carpetas de test_images a usar")
+    parser.add_argument('--iterations', type=int, default=3, help="Pasadas sobre todas las imágenes")
+    parser.add_argument('--latency', default='recorded',
+                        help="Latencia simulada de Textract: 'recorded', ms fijos (250) o rango (150:600)")
+    parser.add_argument('--recordings-dir', default=str(IMAGES_DIR / 'textract_responses'),
+                        help="Carpeta de respuestas grabadas")
+    parser.add_argument('--policy', default='textract', choices=['textract', 'local_first', 'tesseract'],
+                        help="Política de motores OCR (local_first/tesseract requieren tesseract instalado)")
+    parser.add_argument('--record', action='store_true', help="Grabar respuestas con Textract real (requiere AWS)")
+    parser.add_argument('--output-dir', default=str(ROOT / 'data' / 'benchmarks'), help="Carpeta del JSON de resultados")
+    args = parser.parse_args()
+
+    # Antes de importar los servicios: el backend se elige al crear el cliente
+    os.environ['OCR_BACKEND'] = 'record' if args.record else 'replay'
+    os.environ['OCR_RECORDINGS_DIR'] = args.recordings_dir
+    os.environ['OCR_REPLAY_LATENCY_MS'] = args.latency
+    os.environ['OCR_ENGINE_POLICY'] = args.policy
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    # Cada pasada mide el recorrido completo: sin cachés de OCR/parseo ni historial de fotos compartido
+    os.environ['OCR_CACHE_SIZE'] = '0'
+    os.environ['PARSE_CACHE_SIZE'] = '0'
+    os.environ['IMAGE_DEDUP_DB'] = str(Path(tempfile.mkdtemp(prefix='benchmark-ocr-')) / 'image_hashes.db')
+
+    images = collect_images(args.clients)
+    if not images:
+        print("❌ No se encontraron imágenes de prueba")
+        return 1
+
+    if args.record:
+        print(f"🎙️ Grabando respuestas de Textract para {len(images)} imágenes en {args.recordings_dir}")
+        return 1 if record(images) else 0
+
+    from fastapi.testclient import TestClient
+
+    timer = StageTimer()
+    app, ocr_client = instrument(timer)
+    if len(ocr_client) == 0:
+        print(f"❌ No hay respuestas grabadas en {args.recordings_dir}; ejecuta primero con --record")
+        return 1
+
+    missing = [f"{client}/{path.name}" for client, path in images if not ocr_client.has_recording(path.read_bytes())]
+    if missing:
+        print(f"⚠️ {len(missing)} imágenes sin grabación se omiten: {', '.join(missing)}")
+        images = [(client, path) for client, path in images if f"{client}/{path.name}" not in missing]
+        if not images:
+            print("❌ Ninguna imagen tiene grabación; ejecuta primero con --record")
+            return 1
+
+    http = TestClient(app)
+    requests_log = []
+
+    print("🧪 BENCHMARK DE /upload (OCR offline)")
+    print("=" * 60)
+    print(f"   {len(images)} imágenes × {args.iterations} pasadas, latencia Textract: {args.latency}")
+    for iteration in range(args.iterations):
+        for client, path in images:
+            timer.start_request()
+            started = time.perf_counter()
+            with open(path, 'rb') as f:
+                response = http.post('/upload', files={'file': (path.name, f, 'image/jpeg')})
+            timer.add('total', (time.perf_counter() - started) * 1000)
+
+            body = response.json()
+            requests_log.append({
+                'iteration': iteration,
+                'client_type': client,
+                'image': path.name,
+                'status_code': response.status_code,
+                'detected_type': body.get('detected_type'),
+                'stages_ms': {stage: round(ms, 2) for stage, ms in timer.current.items()},
+                'bytes_sent': timer.bytes_sent,
+                'error': body.get('detail') or body.get('details') if response.status_code != 200 else None,
+            })
+        print(f"   ✅ Pasada {iteration + 1}/{args.iterations}")
+
+    stage_percentiles = {
+        stage: percentiles([entry['stages_ms'][stage] for entry in requests_log if stage in entry['stages_ms']])
+        for stage in STAGES
+    }
+    # Bytes enviados a Textract por petición (las que no llegaron a Textract no cuentan)
+    bytes_sent = percentiles([entry['bytes_sent'] / 1024 for entry in requests_log if entry['bytes_sent']])
+    first_pass = [entry for entry in requests_log if entry['iteration'] == 0]
+    outcomes = {}
+    for entry in first_pass:
+        key = f"{entry['client_type']} → {entry['status_code']}"
+        outcomes[key] = outcomes.get(key, 0) + 1
+    misdetected = [f"{e['client_type']}/{e['image']} → {e['detected_type']}" for e in first_pass
+                   if e['status_code'] == 200 and e['detected_type'] != e['client_type']]
+
+    print(f"\n{'Etapa':<18}{'p50':>10}{'p95':>10}{'p99':>10}{'media':>10}  ms")
+    for stage, stats in stage_percentiles.items():
+        if stats:
+            print(f"{stage:<18}{stats['p50']:>10,.1f}{stats['p95']:>10,.1f}{stats['p99']:>10,.1f}{stats['mean']:>10,.1f}")
+    if bytes_sent:
+        print(f"{'enviado a Textract':<18}{bytes_sent['p50']:>10,.1f}{bytes_sent['p95']:>10,.1f}"
+              f"{bytes_sent['p99']:>10,.1f}{bytes_sent['mean']:>10,.1f}  KB")
+    print(f"\n📊 Resultados por cliente y código: {outcomes}")
+    if misdetected:
+        print(f"⚠️ Tipo detectado distinto a la carpeta: {', '.join(misdetected)}")
+
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'git_commit': _git_commit(),
+        },
+        'parameters': {
+            'clients': args.clients, 'iterations': args.iterations, 'latency': args.latency, 'policy': args.policy,
+            'images': len(images), 'recordings': len(ocr_client),
+        },
+        'stages': stage_percentiles,
+        'bytes_sent_kb': bytes_sent,
+        'outcomes': outcomes,
+        'misdetected': misdetected,
+        'requests': requests_log,
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_path = os.path.join(args.output_dir, f"ocr_upload_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False, default=str)
+    print(f"\n💾 Resultados guardados en {output_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
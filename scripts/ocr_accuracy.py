@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Precisión y latencia del OCR + parsers sobre test_images, para validar cambios de parser.
+
+Corre services.ocr_testing.batch_test_images sobre test_images/OXXO y test_images/KIOSKO
+(la carpeta indica el tipo esperado) con varias imágenes en paralelo. Por
+defecto llama a Textract (requiere credenciales de AWS). Con --replay usa respuestas
+grabadas antes con benchmark_ocr.py --record (el repositorio no incluye grabaciones:
+hay que grabarlas una vez con acceso a AWS); así no necesita red y la latencia es
+simulada, de modo que sus p50/p95 no miden Textract. Guarda el reporte JSON (por
+imagen, por cadena y por configuración, p50/p95) y, con --min-score o --max-p95-ms,
+termina con código 1 si no se cumple el umbral.
+
+Ejemplos:
+    python scripts/ocr_accuracy.py
+    python scripts/ocr_accuracy.py --clients OXXO --workers 8
+    python scripts/ocr_accuracy.py --min-score 75 --max-p95-ms 5000
+    python scripts/benchmark_ocr.py --record && python scripts/ocr_accuracy.py --replay
+"""
+import argparse
+import os
+import sys
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+APP_DIR = ROOT / 'app'
+IMAGES_DIR = ROOT / 'test_images'
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# Igual que main.py: 'services' importable (los parsers importan 'app.services', así que la raíz también)
+sys.path.insert(0, str(APP_DIR))
+sys.path.insert(0, str(ROOT))
+
+
+def collect_images(clients):
+    """Imágenes de prueba por cliente (la carpeta indica el tipo esperado)"""
+    images = []
+    for client in clients:
+        folder = IMAGES_DIR / client
+        for path in sorted(folder.iterdir()) if folder.is_dir() else []:
+            if path.suffix.lower() in IMAGE_EXTENSIONS:
+                images.append((client, path))
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precisión y latencia del OCR y los parsers sobre test_images")
+    parser.add_argument('--clients', nargs='+', default=['OXXO', 'KIOSKO'], help="Carpetas de test_images a usar")
+    parser.add_argument('--workers', type=int, default=None, help="Imágenes simultáneas (por defecto OCR_TEST_WORKERS)")
+    parser.add_argument('--replay', action='store_true',
+                        help="Usar respuestas grabadas con benchmark_ocr.py --record en lugar de Textract")
+    parser.add_argument('--recordings-dir', default=str(IMAGES_DIR / 'textract_responses'),
+                        help="Carpeta de respuestas grabadas (con --replay)")
+    parser.add_argument('--latency', default='0',
+                        help="Latencia simulada con --replay: 'recorded', ms fijos (250) o rango (150:600)")
+    parser.add_argument('--min-score', type=float, default=None, help="Puntuación promedio mínima")
+    parser.add_argument('--max-p95-ms', type=float, default=None, help="p95 máximo por prueba (ms)")
+    parser.add_argument('--output-dir', default=str(ROOT / 'data' / 'benchmarks'), help="Carpeta del JSON de resultados")
+    args = parser.parse_args()
+
+    # Antes de importar los servicios: el backend se elige al crear el cliente
+    if args.replay:
+        os.environ['OCR_BACKEND'] = 'replay'
+        os.environ['OCR_RECORDINGS_DIR'] = args.recordings_dir
+        os.environ['OCR_REPLAY_LATENCY_MS'] = args.latency
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    from services.ocr_testing import batch_test_images
+    from services.textract import get_textract_client
+
+    images = collect_images(args.clients)
+    if args.replay:
+        client = get_textract_client()
+        missing = [path for _, path in images if not client.has_recording(path.read_bytes())]
+        if missing:
+            print(f"⚠️ {len(missing)} imágenes sin grabación se omiten (benchmark_ocr.py --record las graba)")
+            images = [(name, path) for name, path in images if path not in missing]
+    if not images:
+        print("❌ No se encontraron imágenes de prueba")
+        return 1
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_path = os.path.join(args.output_dir, f"ocr_accuracy_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    results = batch_test_images([(path.read_bytes(), f"{name}/{path.name}", name) for name, path in images],
+                                output_file=output_path, max_workers=args.workers)
+    report = results['report']
+
+    print(f"\n{'Grupo':<32}{'puntos':>8}{'parseo %':>10}{'tipo %':>8}{'p50 ms':>10}{'p95 ms':>10}")
+    groups = [(name, stats) for name, stats in report['per_chain'].items()]
+    groups += [(name, stats) for name, stats in report['per_config'].items()]
+    groups.append(('total', report['overall']))
+    for name, stats in groups:
+        total_ms = stats['total_ms']
+        print(f"{name:<32}{stats['average_score']:>8.1f}{stats['processing_success_rate']:>10.1f}"
+              f"{stats['type_accuracy'] if stats['type_accuracy'] is not None else 0:>8.1f}"
+              f"{total_ms.get('p50', 0):>10,.1f}{total_ms.get('p95', 0):>10,.1f}")
+
+    failures = []
+    overall = report['overall']
+    if args.min_score is not None and overall['average_score'] < args.min_score:
+        failures.append(f"puntuación promedio {overall['average_score']:.1f} < {args.min_score}")
+    if args.max_p95_ms is not None and overall['total_ms'].get('p95', 0) > args.max_p95_ms:
+        failures.append(f"p95 {overall['total_ms']['p95']:.1f} ms > {args.max_p95_ms} ms")
+    for failure in failures:
+        print(f"❌ Umbral no cumplido: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,9 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Igual que main.py: 'services' importable (los parsers importan 'app.services', así que la raíz también)
+sys.path.insert(0, os.path.join(ROOT, "app"))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
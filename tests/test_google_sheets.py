@@ -0,0 +1,115 @@
+"""
+Escritura en Google Sheets con una hoja falsa en memoria: duplicados contra la hoja,
+dentro del mismo lote y envíos simultáneos (las filas nuevas se calculan con el conteo leído).
+"""
+
+import re
+import threading
+import time
+
+import pytest
+from gspread.utils import a1_to_rowcol
+
+from services import google_sheets
+
+HEADERS = ["ID", "Estado", "Submitted at", "Producto", "Cantidad", "Cliente", "G", "H", "Sucursal",
+           "Remisión", "No. Pedido", "Tienda", "Folio del Ticket", "N", "Total", "Origen"]
+
+
+class FakeWorksheet:
+    """get_all_values / batch_update sobre una matriz; read_delay abre la ventana de carrera"""
+
+    def __init__(self, rows=(), read_delay=0.0):
+        self.rows = [list(HEADERS)] + [list(row) for row in rows]
+        self.read_delay = read_delay
+        self.batch_updates = 0
+
+    def get_all_values(self):
+        snapshot = [list(row) for row in self.rows]
+        time.sleep(self.read_delay)
+        return snapshot
+
+    def batch_update(self, data, value_input_option=None):
+        self.batch_updates += 1
+        for update in data:
+            start, end = update["range"].split(":")
+            row, first_col = a1_to_rowcol(start)
+            _, last_col = a1_to_rowcol(end)
+            while len(self.rows) < row:
+                self.rows.append([""] * len(HEADERS))
+            for col, value in zip(range(first_col, last_col + 1), update["values"][0]):
+                self.rows[row - 1][col - 1] = str(value)
+
+    def column(self, header):
+        return [row[HEADERS.index(header)] for row in self.rows[1:]]
+
+
+@pytest.fixture
+def sheet(monkeypatch):
+    fake = FakeWorksheet()
+    monkeypatch.setattr(google_sheets, "get_sheet", lambda: fake)
+    return fake
+
+
+def oxxo_ticket(remision, pedido, costo=17.5, cantidad=3):
+    return [{"fecha": "01/06/2025", "descripcion": "Bolsa de 5kg" if costo == 17.5 else "Bolsa de 15kg",
+             "cantidad": cantidad, "costo": costo, "sucursal": "Tienda Centro",
+             "remision": remision, "pedido_adicional": pedido}]
+
+
+def kiosko_ticket(folio, fecha="02/06/2025"):
+    return [{"folio": folio, "fecha": fecha, "tipoProducto": "Bolsa de 5kg", "numeroPiezasCompradas": 4,
+             "nombreTienda": "Gas Cardones"}]
+
+
+def test_bulk_dedups_within_batch_and_against_sheet(sheet):
+    sheet.rows.append(["", "", "01/06/2025", "Bolsa de 5kg", "2", "OXXO", "", "", "Tienda Centro",
+                       "111", "222", "", "", "", "35", "extracción"])
+
+    results = google_sheets.send_tickets_bulk([
+        {"sucursal": "OXXO", "data": oxxo_ticket("111", "222")},          # ya está en la hoja
+        {"sucursal": "OXXO", "data": oxxo_ticket("333", "444")},          # nuevo
+        {"sucursal": "OXXO", "data": oxxo_ticket("333", "444")},          # repetido dentro del lote
+        {"sucursal": "OXXO", "data": oxxo_ticket("333", "444", costo=37.5)},  # otro producto del mismo ticket
+        {"sucursal": "KIOSKO", "data": kiosko_ticket("1234")},            # nuevo
+        {"sucursal": "KIOSKO", "data": kiosko_ticket("1234")},            # repetido dentro del lote
+    ])
+
+    assert [r["duplicated"] for r in results] == [True, False, True, False, False, True]
+    assert [r["success"] for r in results] == [False, True, False, True, True, False]
+    # Una sola escritura, a continuación de la fila existente
+    assert sheet.batch_updates == 1
+    assert sheet.column("Remisión") == ["111", "333", "333", ""]
+    assert sheet.column("Producto") == ["Bolsa de 5kg", "Bolsa de 5kg", "Bolsa de 15kg", "Bolsa de 5kg"]
+    assert sheet.column("Folio del Ticket") == ["", "", "", "1234"]
+
+
+def test_bulk_then_single_sees_written_rows(sheet):
+    google_sheets.send_tickets_bulk([{"sucursal": "KIOSKO", "data": kiosko_ticket("5678")}])
+
+    result = google_sheets.send_to_google_sheets("KIOSKO", kiosko_ticket("5678"))
+
+    assert result["duplicated"] is True
+    assert sheet.column("Folio del Ticket") == ["5678"]
+
+
+def test_concurrent_sends_do_not_overwrite_rows(sheet):
+    # Sin el candado, cada hilo leería el mismo conteo y escribiría en la misma fila
+    sheet.read_delay = 0.05
+    senders = [
+        threading.Thread(target=google_sheets.send_to_google_sheets, args=("OXXO", oxxo_ticket(str(n), "9")))
+        for n in range(4)
+    ] + [
+        threading.Thread(target=google_sheets.send_tickets_bulk,
+                         args=([{"sucursal": "KIOSKO", "data": kiosko_ticket(str(1000 + n))} for n in range(2)],))
+        for _ in range(1)
+    ]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+
+    assert sorted(value for value in sheet.column("Remisión") if value) == ["0", "1", "2", "3"]
+    assert sorted(value for value in sheet.column("Folio del Ticket") if value) == ["1000", "1001"]
+    assert len(sheet.rows) == 1 + 6
+    assert all(re.match(r"^\d", row[2]) for row in sheet.rows[1:])